@@ -3,7 +3,7 @@ import torch
 from torch.distributed import destroy_process_group, init_process_group, ReduceOp
 import torch.utils.benchmark as benchmark
 
-from zeroband.collectives import Compression, all_reduce
+from zeroband.collectives import ERROR_FEEDBACK_COMPRESSIONS, Compression, all_reduce, error_feedback_all_reduce
 from zeroband.utils.world_info import get_world_info
 from zeroband.utils.logger import get_logger
 
@@ -33,6 +33,7 @@ class Config(BaseConfig):
 
 
 def main(config: Config):
+    logger = get_logger()
     world_info = get_world_info()
 
     mat = torch.rand(1, config.size_model)
@@ -41,11 +42,18 @@ def main(config: Config):
         f"\n ======== Benchmark all reduce between {world_info.world_size} gpus over {world_info.nnodes} nodes =========\n"
     )
 
+    if config.compression in ERROR_FEEDBACK_COMPRESSIONS:
+        stmt = "error_feedback_all_reduce(compression, mat, residual, op=op)"
+    else:
+        stmt = "all_reduce(compression, mat, op=op)"
+
     t0 = benchmark.Timer(
-        stmt="compressed_all_reduce(compression, mat, op=op)",
+        stmt=stmt,
         globals={
-            "compressed_all_reduce": all_reduce,
+            "all_reduce": all_reduce,
+            "error_feedback_all_reduce": error_feedback_all_reduce,
             "mat": mat,
+            "residual": torch.zeros_like(mat),
             "compression": config.compression,
             "op": ReduceOp.SUM,
         },
@@ -64,6 +72,5 @@ if __name__ == "__main__":
     torch.set_float32_matmul_precision("high")
     init_process_group(backend="gloo")
 
-    logger = get_logger()
     main(config)
     destroy_process_group()
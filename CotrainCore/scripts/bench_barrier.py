@@ -0,0 +1,104 @@
+# Usage:
+# python scripts/bench_barrier.py
+# python scripts/bench_barrier.py --world_sizes "[2, 16, 64]" --n_iters 100
+
+"""
+Localhost benchmark of the monitored barrier store protocol.
+
+For each world size, spawn one process per rank sharing a TCPStore and time back to back barriers on rank 0, with the
+event driven StoreBarrier used by ElasticDeviceMesh.monitored_barrier and with the previous protocol polling the store
+every `polling_interval` seconds.
+"""
+
+import multiprocessing as mp
+import statistics
+import time
+from datetime import timedelta
+
+import torch.distributed as dist
+from pydantic_config import BaseConfig, parse_argv
+
+from zeroband.comms import StoreBarrier
+from zeroband.utils.logger import get_logger
+from zeroband.utils import get_random_available_port
+
+
+class Config(BaseConfig):
+    world_sizes: list[int] = [2, 4, 8, 16, 32, 64]
+    n_iters: int = 50
+    warmup_iters: int = 5
+    polling_interval: float = 0.1  # interval of the polling baseline, the default of the previous implementation
+    skip_polling: bool = False
+
+
+def polling_barrier(store: dist.Store, rank: int, world_size: int, flag: str, polling_interval: float):
+    """The previous monitored barrier protocol, without the timeout handling"""
+    if rank == 0:
+        while not all(store.get(f"poll_{i}").decode("utf-8") == flag for i in range(1, world_size)):
+            time.sleep(polling_interval)
+        store.set("poll_0", flag)
+    else:
+        store.set(f"poll_{rank}", flag)
+        while store.get("poll_0").decode("utf-8") != flag:
+            time.sleep(polling_interval)
+
+
+def run_rank(rank: int, world_size: int, port: int, mode: str, config: Config, results: mp.Queue):
+    store = dist.TCPStore(
+        "127.0.0.1", port, world_size, is_master=rank == 0, timeout=timedelta(seconds=300), wait_for_workers=True
+    )
+    barrier = StoreBarrier(store, rank, world_size)
+    if mode == "polling" and rank == 0:
+        for i in range(world_size):
+            store.set(f"poll_{i}", "null")
+    barrier.wait(barrier.arrive("start"))  # all ranks are connected and the polling keys are set
+
+    latencies = []
+    for i in range(config.warmup_iters + config.n_iters):
+        start = time.perf_counter()
+        if mode == "event":
+            barrier.wait(barrier.arrive(str(i)))
+        else:
+            polling_barrier(store, rank, world_size, str(i), config.polling_interval)
+        if i >= config.warmup_iters:
+            latencies.append(time.perf_counter() - start)
+
+    # keep the store alive until every rank is done
+    barrier.wait(barrier.arrive("end"))
+    if rank == 0:
+        results.put(latencies)
+
+
+def bench(world_size: int, mode: str, config: Config) -> list[float]:
+    ctx = mp.get_context("spawn")
+    results = ctx.Queue()
+    port = get_random_available_port()
+    processes = [
+        ctx.Process(target=run_rank, args=(rank, world_size, port, mode, config, results)) for rank in range(world_size)
+    ]
+    for process in processes:
+        process.start()
+    latencies = results.get()
+    for process in processes:
+        process.join()
+        if process.exitcode != 0:
+            raise RuntimeError(f"Rank process failed with exit code {process.exitcode}")
+    return latencies
+
+
+def main(config: Config):
+    modes = ["event"] if config.skip_polling else ["event", "polling"]
+    for world_size in config.world_sizes:
+        for mode in modes:
+            latencies = sorted(bench(world_size, mode, config))
+            p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+            logger.info(
+                f"world size {world_size:>3} | {mode:>7} | mean {statistics.mean(latencies) * 1e3:8.3f} ms | "
+                f"p50 {statistics.median(latencies) * 1e3:8.3f} ms | p99 {p99 * 1e3:8.3f} ms"
+            )
+
+
+if __name__ == "__main__":
+    config = Config(**parse_argv())
+    logger = get_logger()
+    main(config)
@@ -0,0 +1,193 @@
+# Usage:
+# python scripts/bench_collectives.py
+# python scripts/bench_collectives.py --world_sizes "[2, 4, 8]" --sizes "[1000000, 100000000]" --output results.json
+# sudo python scripts/bench_collectives.py --throttle_rate 500mbit --throttle_delay 25ms
+
+"""
+Localhost gloo benchmark suite of the all reduce implementations and compressions used by diloco.
+
+For each number of ranks, tensor size and compression, spawn the gloo ranks and time every all reduce supporting the
+compression:
+- no compression: the fp32 gloo all reduce (`gloo_all_reduce`) and the pipelined python ring (`ring_allreduce_py`)
+- uint8: the python ring with the uint8 quantization and the c++ ring
+- quantile4 and topk: the error feedback all gather (`error_feedback_all_reduce`)
+
+Each result holds the latency of the slowest rank, the algorithmic bandwidth (bytes of the fp32 tensor / latency), the
+bus bandwidth (algorithmic bandwidth * 2 (n - 1) / n, comparable across rank counts) and the relative error of the
+compressed result against the exact fp32 average. The results are written to the `output` json file.
+
+`throttle_rate` and `throttle_delay` shape the loopback interface with tc netem during the benchmark, like
+`scripts/bandwith/down.sh`, to emulate WAN links between the ranks. It needs root and iproute2. The delay is applied
+to each packet, a round trip between two ranks waits twice the delay.
+"""
+
+import json
+import subprocess
+import time
+from contextlib import contextmanager
+from logging import Logger
+from typing import Callable, Literal
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from pydantic_config import BaseConfig, parse_argv
+
+from zeroband.collectives import error_feedback_all_reduce, gloo_all_reduce, ring_allreduce_py
+from zeroband.config import Compression
+from zeroband.utils import get_random_available_port
+from zeroband.utils.logger import get_logger
+
+Algorithm = Literal["gloo", "ring_py", "ring_c", "all_gather"]
+
+
+class Config(BaseConfig):
+    world_sizes: list[int] = [2, 4]
+    sizes: list[int] = [1_000_000, 10_000_000, 100_000_000]
+    compressions: list[Compression] = list(Compression)
+    algorithms: list[Algorithm] = ["gloo", "ring_py", "ring_c", "all_gather"]
+    n_iters: int = 5
+    buffer_depth: int = 4  # sub-chunks in flight of the python ring
+    topk_ratio: float = 0.01
+    c_extensions: bool = True  # the c++ ring and uint8 quantization, False to not compile the extensions
+    output: str = "bench_collectives.json"
+
+    throttle_rate: str | None = None  # tc rate of the loopback, e.g. "500mbit"
+    throttle_delay: str | None = None  # tc delay of each packet on the loopback, e.g. "25ms"
+
+
+def get_all_reduce_funcs(
+    compression: Compression, config: Config, group: dist.ProcessGroup
+) -> dict[Algorithm, Callable[[torch.Tensor], None]]:
+    """The all reduce implementations supporting `compression`, averaging the tensor in place"""
+    op = dist.ReduceOp.AVG
+    funcs: dict[Algorithm, Callable[[torch.Tensor], None]] = {}
+    if compression == Compression.NO:
+        funcs["gloo"] = lambda tensor: gloo_all_reduce(tensor, op, group)
+        funcs["ring_py"] = lambda tensor: ring_allreduce_py(tensor, op, group, buffer_depth=config.buffer_depth)
+    elif compression == Compression.UINT8:
+        if config.c_extensions:
+            from zeroband.C.collectives import ring_allreduce
+            from zeroband.C.compression import uniform_8bit_quantize
+
+            funcs["ring_c"] = lambda tensor: ring_allreduce(tensor, op, group)
+        else:
+            from zeroband.compression import uniform_8bit_quantize
+
+        funcs["ring_py"] = lambda tensor: ring_allreduce_py(
+            tensor, op, group, quantization_func=uniform_8bit_quantize, buffer_depth=config.buffer_depth
+        )
+    else:
+        residuals: dict[int, torch.Tensor] = {}
+
+        def all_gather(tensor: torch.Tensor):
+            # one residual per tensor, like the error feedback buffer of diloco
+            if id(tensor) not in residuals:
+                residuals[id(tensor)] = torch.zeros_like(tensor)
+            residual = residuals[id(tensor)]
+            error_feedback_all_reduce(compression, tensor, residual, op, group, topk_ratio=config.topk_ratio)
+
+        funcs["all_gather"] = all_gather
+    return {name: func for name, func in funcs.items() if name in config.algorithms}
+
+
+def timeit(func: Callable[[], None], n_iters: int, group: dist.ProcessGroup) -> float:
+    func()  # warmup
+    dist.barrier(group=group)
+    start = time.perf_counter()
+    for _ in range(n_iters):
+        func()
+    elapsed = torch.tensor((time.perf_counter() - start) / n_iters)
+    # report the slowest rank
+    dist.all_reduce(elapsed, dist.ReduceOp.MAX, group=group)
+    return elapsed.item()
+
+
+def worker(rank: int, world_size: int, port: int, config: Config, results: mp.SimpleQueue):
+    # spawned processes do not run the __main__ block
+    logger = get_logger()
+    dist.init_process_group("gloo", init_method=f"tcp://localhost:{port}", rank=rank, world_size=world_size)
+    group = dist.distributed_c10d._get_default_group()
+    torch.manual_seed(rank)
+
+    for size in config.sizes:
+        tensor = torch.randn(size)
+        expected = tensor.clone()
+        dist.all_reduce(expected, dist.ReduceOp.SUM, group=group)
+        expected.div_(world_size)
+
+        for compression in config.compressions:
+            for algorithm, func in get_all_reduce_funcs(compression, config, group).items():
+                result = tensor.clone()
+                func(result)
+                error = ((result - expected).norm() / expected.norm()).item()
+
+                latency = timeit(lambda: func(result), config.n_iters, group)
+                algbw = size * 4 / latency / 1e9
+                busbw = algbw * 2 * (world_size - 1) / world_size
+
+                if rank == 0:
+                    logger.info(
+                        f"ranks {world_size:>3} | {size:>12,} | {compression.value:>9} | {algorithm:>10} | "
+                        f"{latency * 1e3:10.2f} ms | algbw {algbw:6.3f} GB/s | busbw {busbw:6.3f} GB/s | "
+                        f"rel error {error:.2e}"
+                    )
+                    results.put(
+                        {
+                            "world_size": world_size,
+                            "size": size,
+                            "compression": compression.value,
+                            "algorithm": algorithm,
+                            "latency": latency,
+                            "algbw": algbw,
+                            "busbw": busbw,
+                            "rel_error": error,
+                        }
+                    )
+
+    dist.destroy_process_group()
+
+
+@contextmanager
+def throttle_loopback(rate: str | None, delay: str | None, logger: Logger):
+    if rate is None and delay is None:
+        yield
+        return
+
+    netem = []
+    if delay is not None:
+        netem += ["delay", delay]
+    if rate is not None:
+        netem += ["rate", rate]
+    subprocess.run(["tc", "qdisc", "add", "dev", "lo", "root", "netem", *netem], check=True)
+    logger.info(f"Loopback shaped with netem {' '.join(netem)}")
+    try:
+        yield
+    finally:
+        subprocess.run(["tc", "qdisc", "del", "dev", "lo", "root"], check=True)
+
+
+def main(config: Config):
+    logger = get_logger()
+    logger.info(f"{config.n_iters} iterations per measure, results written to {config.output}")
+    results = mp.get_context("spawn").SimpleQueue()
+    records = []
+
+    with throttle_loopback(config.throttle_rate, config.throttle_delay, logger):
+        for world_size in config.world_sizes:
+            port = get_random_available_port()
+            context = mp.spawn(worker, args=(world_size, port, config, results), nprocs=world_size, join=False)
+            # drain the queue while the ranks run, a full pipe would block rank 0
+            finished = False
+            while not finished:
+                finished = context.join(timeout=1)
+                while not results.empty():
+                    records.append(results.get())
+
+    with open(config.output, "w") as f:
+        json.dump({"config": config.model_dump(mode="json"), "results": records}, f, indent=2)
+
+
+if __name__ == "__main__":
+    config = Config(**parse_argv())
+    main(config)
@@ -0,0 +1,73 @@
+# Usage:
+# python scripts/bench_compression.py
+# python scripts/bench_compression.py --num_tensors 200 --sizes "[1000, 100000, 10000000]" --num_threads "[1, 8]"
+
+"""
+CPU microbenchmark of the uint8 compression kernels.
+
+For each tensor size and thread pool size, quantize `num_tensors` tensors (like the layers of a model) with
+the python implementation, one call to the C extension per tensor, and a single batched call.
+"""
+
+import torch
+import torch.utils.benchmark as benchmark
+from pydantic_config import BaseConfig, parse_argv
+
+from zeroband.compression import uniform_8bit_quantize as uniform_8bit_quantize_py
+from zeroband.C.compression import set_num_threads, uniform_8bit_quantize, uniform_8bit_quantize_batched
+from zeroband.utils.logger import get_logger
+
+
+class Config(BaseConfig):
+    sizes: list[int] = [1_000, 10_000, 100_000, 1_000_000, 10_000_000]
+    num_tensors: int = 64
+    num_threads: list[int] = [1, 4, 16]
+    n_iters: int = 5
+    skip_python: bool = False  # the python implementation is very slow on the large sizes
+
+
+def per_tensor(tensors: list[torch.Tensor], quantize_func):
+    return [quantize_func(tensor) for tensor in tensors]
+
+
+def main(config: Config):
+    logger = get_logger()
+    for num_threads in config.num_threads:
+        set_num_threads(num_threads)
+        for size in config.sizes:
+            # keep the total amount of data reasonable for the large sizes
+            num_tensors = max(1, min(config.num_tensors, 100_000_000 // size))
+            tensors = [torch.randn(size) for _ in range(num_tensors)]
+
+            stmts = {
+                "per tensor": "per_tensor(tensors, uniform_8bit_quantize)",
+                "batched": "uniform_8bit_quantize_batched(tensors)",
+            }
+            if not config.skip_python:
+                stmts["python"] = "per_tensor(tensors, uniform_8bit_quantize_py)"
+
+            timer_globals = {
+                "per_tensor": per_tensor,
+                "uniform_8bit_quantize": uniform_8bit_quantize,
+                "uniform_8bit_quantize_batched": uniform_8bit_quantize_batched,
+                "uniform_8bit_quantize_py": uniform_8bit_quantize_py,
+                "tensors": tensors,
+            }
+            timings = {}
+            for name, stmt in stmts.items():
+                timer = benchmark.Timer(stmt=stmt, globals=timer_globals)
+                timings[name] = timer.timeit(config.n_iters).mean
+
+            gigabytes = num_tensors * size * 4 / 1e9
+            results = " | ".join(
+                f"{name}: {t * 1e3:9.3f} ms ({gigabytes / t:6.2f} GB/s)" for name, t in timings.items()
+            )
+            logger.info(
+                f"threads {num_threads:>3} | {num_tensors:>4} x {size:>10,} | {results} | "
+                f"batched speedup: {timings['per tensor'] / timings['batched']:.2f}x"
+            )
+
+
+if __name__ == "__main__":
+    config = Config(**parse_argv())
+    main(config)
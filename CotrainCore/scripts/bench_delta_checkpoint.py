@@ -0,0 +1,85 @@
+# Usage:
+# python scripts/bench_delta_checkpoint.py
+# python scripts/bench_delta_checkpoint.py --num_params 500000000 --num_threads "[1, 8, 32]" --lr 1e-4
+
+"""
+Size and time of a delta checkpoint against a full one, on CPU.
+
+A fake local shard of fp32 weights with the two Adam moments is saved in full with `torch.save` (like the base
+checkpoint), then moved by a small outer update and encoded against it with `encode_state_delta` for each number of
+compression threads. Also reports the host memory held by the delta base between the full checkpoints.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import io
+import time
+
+import torch
+from pydantic_config import BaseConfig, parse_argv
+
+from zeroband.checkpoint import clone_local_state, encode_state_delta
+from zeroband.utils.logger import get_logger
+
+
+class Config(BaseConfig):
+    num_params: int = 100_000_000
+    num_layers: int = 32
+    num_threads: list[int] = [1, 4, 16]
+    lr: float = 1e-3  # relative size of the update between the base and the delta checkpoint
+
+
+def make_state(num_params: int, num_layers: int) -> dict:
+    layer_size = num_params // num_layers
+    model = {f"layers.{i}.weight": torch.randn(layer_size) * 0.02 for i in range(num_layers)}
+    optimizer = {
+        f"layers.{i}.weight": {"exp_avg": torch.randn(layer_size) * 1e-3, "exp_avg_sq": torch.rand(layer_size) * 1e-6}
+        for i in range(num_layers)
+    }
+    return {"model": model, "optimizer": optimizer}
+
+
+def serialized_size(state: dict) -> tuple[int, float]:
+    buffer = io.BytesIO()
+    start = time.perf_counter()
+    torch.save(state, buffer)
+    return buffer.tell(), time.perf_counter() - start
+
+
+def main(config: Config):
+    logger = get_logger()
+    state = make_state(config.num_params, config.num_layers)
+    base = clone_local_state(state)
+    base_bytes = sum(t.numel() * t.element_size() for t in _tensors(base))
+    logger.info(f"delta base held in host memory: {base_bytes / 2**20:.1f} MiB")
+
+    full_bytes, full_time = serialized_size(state)
+    logger.info(f"{'full':>12} | {full_bytes / 2**20:9.1f} MiB | {full_time:7.2f} s")
+
+    for tensor in _tensors(state):
+        tensor.add_(torch.randn_like(tensor) * tensor.abs().mean() * config.lr)
+
+    for num_threads in config.num_threads:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(num_threads) as executor:
+            delta = encode_state_delta(state, base, executor)
+        encode_time = time.perf_counter() - start
+        delta_bytes, save_time = serialized_size(delta)
+        logger.info(
+            f"{num_threads:>4} threads | {delta_bytes / 2**20:9.1f} MiB | {encode_time + save_time:7.2f} s | "
+            f"{delta_bytes / full_bytes:6.1%} of the full size"
+        )
+
+
+def _tensors(state: dict) -> list[torch.Tensor]:
+    tensors = []
+    for value in state.values():
+        if isinstance(value, dict):
+            tensors.extend(_tensors(value))
+        elif isinstance(value, torch.Tensor):
+            tensors.append(value)
+    return tensors
+
+
+if __name__ == "__main__":
+    config = Config(**parse_argv())
+    main(config)
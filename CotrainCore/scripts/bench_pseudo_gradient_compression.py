@@ -0,0 +1,93 @@
+# Usage:
+# python scripts/bench_pseudo_gradient_compression.py
+# python scripts/bench_pseudo_gradient_compression.py --world_size 4 --size 50000000 --topk_ratio 0.001
+
+"""
+Compare the pseudo gradient compressions of the diloco all reduce on localhost gloo.
+
+Each rank starts from a random pseudo gradient and runs `n_rounds` outer steps with every compression scheme.
+For each scheme, report the bytes sent per rank and per round, the mean reduction time, and the relative error of
+the sum over all rounds against an exact fp32 all reduce. The error feedback schemes (quantile4, topk) carry their
+residual from one round to the next like the diloco outer loop does.
+"""
+
+import time
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from pydantic_config import BaseConfig, parse_argv
+
+from zeroband.collectives import ERROR_FEEDBACK_COMPRESSIONS, all_reduce, error_feedback_all_reduce
+from zeroband.config import Compression
+from zeroband.utils import get_random_available_port
+from zeroband.utils.logger import get_logger
+
+
+class Config(BaseConfig):
+    world_size: int = 2
+    size: int = 10_000_000
+    n_rounds: int = 10
+    topk_ratio: float = 0.01
+    compressions: list[Compression] = [Compression.NO, Compression.UINT8, Compression.QUANTILE4, Compression.TOPK]
+
+
+def bytes_on_wire(compression: Compression, config: Config) -> float:
+    """Bytes one rank sends per all reduce, for a ring all reduce or an all gather of the compressed payload"""
+    ring_factor = 2 * (config.world_size - 1) / config.world_size
+    if compression == Compression.NO:
+        return config.size * 4 * ring_factor
+    if compression == Compression.UINT8:
+        return config.size * 1 * ring_factor
+    if compression == Compression.QUANTILE4:
+        return (config.size / 2 + 16 * 4) * (config.world_size - 1)
+    if compression == Compression.TOPK:
+        return int(config.size * config.topk_ratio) * (4 + 4) * (config.world_size - 1)
+    raise ValueError(f"Unknown compression {compression}")
+
+
+def worker(rank: int, port: int, config: Config):
+    # spawned processes do not run the __main__ block
+    logger = get_logger()
+    dist.init_process_group("gloo", init_method=f"tcp://localhost:{port}", rank=rank, world_size=config.world_size)
+    torch.manual_seed(rank)
+    pseudo_gradient = torch.randn(config.size)
+    expected = pseudo_gradient.clone()
+    dist.all_reduce(expected, dist.ReduceOp.SUM)
+    expected *= config.n_rounds
+
+    for compression in config.compressions:
+        residual = torch.zeros_like(pseudo_gradient)
+        total = torch.zeros_like(pseudo_gradient)
+        elapsed = 0.0
+        for _ in range(config.n_rounds):
+            tensor = pseudo_gradient.clone()
+            dist.barrier()
+            start = time.perf_counter()
+            if compression in ERROR_FEEDBACK_COMPRESSIONS:
+                error_feedback_all_reduce(compression, tensor, residual, dist.ReduceOp.SUM, topk_ratio=config.topk_ratio)
+            else:
+                all_reduce(compression, tensor, dist.ReduceOp.SUM, dist.distributed_c10d._get_default_group())
+            elapsed += time.perf_counter() - start
+            total += tensor
+
+        if rank == 0:
+            error = torch.norm(total - expected) / torch.norm(expected)
+            logger.info(
+                f"{compression.value:>10} | {bytes_on_wire(compression, config) / 1e6:10.2f} MB sent per rank | "
+                f"{elapsed / config.n_rounds * 1e3:9.2f} ms per round | relative error {error:.5f}"
+            )
+
+    dist.destroy_process_group()
+
+
+def main(config: Config):
+    logger.info(f"world size {config.world_size} | {config.size:,} params | {config.n_rounds} rounds")
+    port = get_random_available_port()
+    mp.spawn(worker, args=(port, config), nprocs=config.world_size, join=True)
+
+
+if __name__ == "__main__":
+    config = Config(**parse_argv())
+    logger = get_logger()
+    main(config)
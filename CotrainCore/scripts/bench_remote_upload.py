@@ -0,0 +1,111 @@
+# Usage:
+# python scripts/bench_remote_upload.py
+# python scripts/bench_remote_upload.py --num_files 8 --file_size 500000000 --workers "[1, 8, 32]" --latency 0.1
+
+"""
+Throughput of the parallel remote checkpoint upload against a local stand-in of an object store.
+
+The stand-in is a local filesystem where each request (each part of a multipart upload) waits `latency` seconds and
+each connection is capped at `stream_bandwidth` bytes/s, like a cloud bucket. A fake sharded checkpoint is uploaded
+file by file in a single part (what the fsspec rsync did) and with `upload_directory` for each number of workers, then
+uploaded again unchanged to time the resume.
+"""
+
+import os
+import shutil
+import tempfile
+import time
+
+from fsspec.implementations.local import LocalFileSystem
+from pydantic_config import BaseConfig, parse_argv
+
+from zeroband.utils.logger import get_logger
+from zeroband.utils.remote_upload import download_directory, upload_directory
+
+
+class Config(BaseConfig):
+    num_files: int = 8
+    file_size: int = 100_000_000  # bytes
+    chunk_size: int = 16 * 2**20
+    workers: list[int] = [1, 4, 16]
+    latency: float = 0.05  # seconds per request
+    stream_bandwidth: float = 100e6  # bytes/s per connection
+
+
+class ThrottledFileSystem(LocalFileSystem):
+    """Local filesystem with the latency and per connection bandwidth of an object store"""
+
+    cachable = False
+
+    def __init__(self, latency: float, stream_bandwidth: float):
+        super().__init__()
+        self.latency = latency
+        self.stream_bandwidth = stream_bandwidth
+
+    def _throttle(self, num_bytes: int):
+        time.sleep(self.latency + num_bytes / self.stream_bandwidth)
+
+    def pipe_file(self, path, value, **kwargs):
+        self._throttle(len(value))
+        return super().pipe_file(path, value, **kwargs)
+
+    def _open(self, path, mode="rb", **kwargs):
+        f = super()._open(path, mode=mode, **kwargs)
+        if "w" in mode:
+            write = f.write
+
+            def throttled_write(data):
+                self._throttle(len(data))
+                return write(data)
+
+            f.write = throttled_write
+        return f
+
+    def cat_file(self, path, start=None, end=None, **kwargs):
+        data = super().cat_file(path, start=start, end=end, **kwargs)
+        self._throttle(len(data))
+        return data
+
+
+def main(config: Config):
+    logger = get_logger()
+    fs = ThrottledFileSystem(config.latency, config.stream_bandwidth)
+    total_bytes = config.num_files * config.file_size
+
+    with tempfile.TemporaryDirectory() as workdir:
+        local_path = os.path.join(workdir, "step_0")
+        os.makedirs(local_path)
+        for i in range(config.num_files):
+            with open(os.path.join(local_path, f"__{i}_0.distcp"), "wb") as f:
+                f.write(os.urandom(config.file_size))
+
+        runs = {"file by file": dict(chunk_size=config.file_size + 1, num_workers=1)}
+        for num_workers in config.workers:
+            runs[f"{num_workers} workers"] = dict(chunk_size=config.chunk_size, num_workers=num_workers)
+
+        for name, kwargs in runs.items():
+            remote_path = os.path.join(workdir, "remote")
+            shutil.rmtree(remote_path, ignore_errors=True)
+
+            start = time.perf_counter()
+            upload_directory(local_path, remote_path, fs=fs, **kwargs)
+            upload_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            upload_directory(local_path, remote_path, fs=fs, **kwargs)
+            resume_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            download_directory(remote_path, os.path.join(workdir, "download"), num_workers=kwargs["num_workers"], fs=fs)
+            download_time = time.perf_counter() - start
+            shutil.rmtree(os.path.join(workdir, "download"))
+
+            logger.info(
+                f"{name:>14} | upload {upload_time:7.2f} s ({total_bytes / upload_time / 1e6:8.1f} MB/s) | "
+                f"unchanged re-upload {resume_time:6.2f} s | download {download_time:7.2f} s"
+            )
+
+
+if __name__ == "__main__":
+    config = Config(**parse_argv())
+    main(config)
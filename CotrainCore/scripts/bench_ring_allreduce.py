@@ -0,0 +1,100 @@
+# Usage:
+# python scripts/bench_ring_allreduce.py
+# python scripts/bench_ring_allreduce.py --world_size 4 --sizes "[1000000, 100000000]" --buffer_depths "[1, 2, 8]"
+
+"""
+Localhost gloo benchmark of the pipelined ring all reduce.
+
+For each tensor size, time the uint8 pipelined python ring (`ring_allreduce_py`) for each buffer depth, both with the
+default sub-chunk size and with the one found by `autotune_ring_chunk_size`, against the c++ uint8 ring and the fp32
+gloo all reduce.
+"""
+
+import time
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from pydantic_config import BaseConfig, parse_argv
+
+from zeroband.collectives import autotune_ring_chunk_size, get_ring_chunk_size, ring_allreduce_py
+from zeroband.utils import get_random_available_port
+from zeroband.utils.logger import get_logger
+
+
+class Config(BaseConfig):
+    world_size: int = 2
+    sizes: list[int] = [1_000_000, 10_000_000, 100_000_000]
+    buffer_depths: list[int] = [1, 2, 4, 8]
+    n_iters: int = 5
+    autotune: bool = True
+    c_ring: bool = True  # also time the c++ ring, needs to compile the extension
+
+
+def timeit(func, n_iters: int, group: dist.ProcessGroup) -> float:
+    func()  # warmup
+    dist.barrier(group=group)
+    start = time.perf_counter()
+    for _ in range(n_iters):
+        func()
+    elapsed = torch.tensor((time.perf_counter() - start) / n_iters)
+    # report the slowest rank
+    dist.all_reduce(elapsed, dist.ReduceOp.MAX, group=group)
+    return elapsed.item()
+
+
+def worker(rank: int, port: int, config: Config):
+    # spawned processes do not run the __main__ block
+    logger = get_logger()
+    dist.init_process_group("gloo", init_method=f"tcp://localhost:{port}", rank=rank, world_size=config.world_size)
+    group = dist.distributed_c10d._get_default_group()
+
+    from zeroband.C.compression import uniform_8bit_quantize
+
+    if config.c_ring:
+        from zeroband.C.collectives import ring_allreduce
+
+    for size in config.sizes:
+        tensor = torch.randn(size)
+        timings = {"gloo fp32": timeit(lambda: dist.all_reduce(tensor, dist.ReduceOp.AVG), config.n_iters, group)}
+        if config.c_ring:
+            timings["c++ uint8"] = timeit(lambda: ring_allreduce(tensor, dist.ReduceOp.AVG, group), config.n_iters, group)
+
+        for depth in config.buffer_depths:
+            chunk_sizes = {"default": get_ring_chunk_size(size, config.world_size, depth)}
+            if config.autotune:
+                chunk_sizes["autotuned"] = autotune_ring_chunk_size(
+                    size, group, buffer_depth=depth, quantization_func=uniform_8bit_quantize, n_iters=1
+                )
+            for name, chunk_size in chunk_sizes.items():
+                timings[f"depth {depth} {name} ({chunk_size:,})"] = timeit(
+                    lambda: ring_allreduce_py(
+                        tensor,
+                        dist.ReduceOp.AVG,
+                        group,
+                        quantization_func=uniform_8bit_quantize,
+                        buffer_depth=depth,
+                        chunk_size=chunk_size,
+                    ),
+                    config.n_iters,
+                    group,
+                )
+
+        if rank == 0:
+            gigabytes = size * 4 / 1e9
+            for name, t in timings.items():
+                logger.info(f"{size:>12,} | {name:>36} | {t * 1e3:10.2f} ms | {gigabytes / t:6.2f} GB/s")
+
+    dist.destroy_process_group()
+
+
+def main(config: Config):
+    logger.info(f"world size {config.world_size} | {config.n_iters} iterations per measure")
+    port = get_random_available_port()
+    mp.spawn(worker, args=(port, config), nprocs=config.world_size, join=True)
+
+
+if __name__ == "__main__":
+    config = Config(**parse_argv())
+    logger = get_logger()
+    main(config)
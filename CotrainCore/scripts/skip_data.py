@@ -5,13 +5,20 @@ It has the same api as the training one. The only difference is that you probabl
 
 It can load config from the config file to have the same setup as the real run.
 
+With `--data.num_workers 0` and parquet datasets, streaming or not, the datasets seek to the target sample using the
+parquet metadata and the token counts of each file instead of tokenizing and packing every skipped sample. The token counts are computed once
+per file and cached in `--data.token_counts_cache_dir`. The training run needs the same `--data.num_workers 0` to load
+the state. Otherwise the script iterates over the dataloader like before.
+
 example.
 ```
 uv run torchrun --nproc_per_node=4 scripts/skip_data.py @configs/150M/3090.toml --optim.total_steps 100 --ckpt.data_path out_data
+uv run torchrun --nproc_per_node=4 scripts/skip_data.py @configs/150M/3090.toml --optim.total_steps 100000 --ckpt.data_path out_data --data.num_workers 0 --data.token_counts_cache_dir token_counts
 ```
 
 """
 
+import math
 import os
 import torch
 from pydantic_config import parse_argv
@@ -53,23 +60,26 @@ def skip_data(config: Config):
         data_config=config.data,
     )
 
-    train_dataloader_iterator = iter(train_dataloader)
-
     logger.info("starting skipping data up to step: %d", config.optim.total_steps)
 
-    total_steps = 0
+    num_inner_steps = config.diloco.inner_steps if config.diloco is not None else 1
+    # the training loop runs whole outer steps
+    total_steps = math.ceil(config.optim.total_steps / num_inner_steps) * num_inner_steps
 
-    while True:
-        num_inner_steps = config.diloco.inner_steps if config.diloco is not None else 1
+    if config.data.num_workers == 0 and not config.data.pretokenized:
+        dataset = train_dataloader.original_dataloader.dataset
+        dataset.seek(total_steps * gradient_accumulation_steps * config.train.micro_bs)
+        logger.info("total steps: %d", total_steps)
+    else:
+        logger.info("seeking needs parquet datasets and no dataloader workers, iterating over the data instead")
+        train_dataloader_iterator = iter(train_dataloader)
 
-        for _inner_step in range(num_inner_steps):
-            for _ in range(gradient_accumulation_steps):
-                next(train_dataloader_iterator)
+        for step in range(0, total_steps, num_inner_steps):
+            for _inner_step in range(num_inner_steps):
+                for _ in range(gradient_accumulation_steps):
+                    next(train_dataloader_iterator)
 
-        total_steps += num_inner_steps
-        logger.info("total steps: %d", total_steps)
-        if total_steps >= config.optim.total_steps:
-            break
+            logger.info("total steps: %d", step + num_inner_steps)
 
     CkptManager.save_data(os.path.join(config.ckpt.data_path, "data"), train_dataloader, world_info.local_rank)
 
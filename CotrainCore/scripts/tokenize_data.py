@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Usage:
+# python scripts/tokenize_data.py --input_dir datasets/fineweb-edu --output_dir datasets/fineweb-edu-llama3 --num_workers 12
+#
+# Then train with:
+# --data.dataset_name_or_paths datasets/fineweb-edu-llama3 --data.pretokenized
+
+"""
+Tokenize a folder of parquet files offline into token shards that can be read with `TokenShardDataset`.
+
+Each parquet file is converted into one shard (`.bin` + `.idx`) keeping the relative path, so that the
+sorted list of shards, and therefore the split of files per data rank, is the same as for the parquet files.
+"""
+
+import argparse
+import logging
+import multiprocessing as mp
+import os
+from pathlib import Path
+
+from pyarrow import parquet as pq
+from tqdm import tqdm
+from transformers import AutoTokenizer
+
+from zeroband.data import TOKEN_SHARD_SUFFIX, TokenShardWriter
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+
+TOKENIZERS = {
+    "llama2": "mistralai/Mistral-7B-v0.1",
+    "llama3": "meta-llama/Meta-Llama-3-8B",
+}
+
+_tokenizer = None
+
+
+def _init_worker(tokenizer_name: str):
+    global _tokenizer
+    _tokenizer = AutoTokenizer.from_pretrained(tokenizer_name, use_fast=True)
+
+
+def _tokenize_file(paths: tuple[str, str]) -> int:
+    """Tokenize one parquet file into a token shard. Return the number of documents written"""
+    input_path, output_path = paths
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+
+    parquet_file = pq.ParquetFile(input_path)
+    num_docs = 0
+    with TokenShardWriter(output_path, vocab_size=len(_tokenizer), eos_token=_tokenizer.eos_token_id) as writer:
+        for row_group_index in range(parquet_file.num_row_groups):
+            texts = parquet_file.read_row_group(row_group_index, columns=["text"])["text"].to_pylist()
+            for input_ids in _tokenizer([str(text) for text in texts])["input_ids"]:
+                writer.write(input_ids)
+            num_docs += len(texts)
+
+    return num_docs
+
+
+def main(args):
+    input_dir = Path(args.input_dir)
+    input_files = sorted(str(p) for p in input_dir.rglob("*.parquet"))
+    logger.info(f"Found {len(input_files)} parquet files in {input_dir}")
+
+    jobs = []
+    for input_file in input_files:
+        output_path = os.path.join(args.output_dir, os.path.relpath(input_file, input_dir)[: -len(".parquet")])
+        if args.skip_existing and os.path.exists(output_path + TOKEN_SHARD_SUFFIX):
+            continue
+        jobs.append((input_file, output_path))
+
+    tokenizer_name = TOKENIZERS.get(args.tokenizer, args.tokenizer)
+
+    with mp.Pool(args.num_workers, initializer=_init_worker, initargs=(tokenizer_name,)) as pool:
+        num_docs = sum(
+            tqdm(
+                pool.imap_unordered(_tokenize_file, jobs),
+                desc="Tokenizing files",
+                total=len(jobs),
+                bar_format="{l_bar}{bar:10}{r_bar}",
+            )
+        )
+
+    logger.info(f"Tokenized {num_docs} documents from {len(jobs)} files into {args.output_dir}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tokenize parquet files into memory mappable token shards")
+    parser.add_argument("--input_dir", type=str, required=True, help="folder containing the parquet files")
+    parser.add_argument("--output_dir", type=str, required=True, help="folder to write the token shards to")
+    parser.add_argument(
+        "--tokenizer", type=str, default="llama3", help="llama2, llama3 or any huggingface tokenizer name"
+    )
+    parser.add_argument("--skip_existing", action="store_true", help="do not tokenize files already converted")
+    parser.add_argument("--num_workers", type=int, default=12)
+    args = parser.parse_args()
+    main(args)
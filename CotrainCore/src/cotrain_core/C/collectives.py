@@ -33,3 +33,8 @@ def ring_allreduce(
         return
     else:
         collectives_ops.ring_allreduce(tensor, op, group)
+
+
+def set_num_threads(num_threads: int) -> None:
+    """Resize the thread pool used to quantize the chunks sent by ring_allreduce"""
+    collectives_ops.set_num_threads(num_threads)
@@ -1,4 +1,4 @@
-from typing import Tuple
+from typing import List, Tuple
 import torch
 from torch.utils.cpp_extension import load
 from pathlib import Path
@@ -19,6 +19,20 @@ def uniform_8bit_quantize(tensor: torch.Tensor, inplace: bool = True) -> Tuple[t
     return compress_ops.uniform_8bit_quantize(tensor, inplace)
 
 
+def uniform_8bit_quantize_batched(tensors: List[torch.Tensor]) -> List[Tuple[torch.Tensor, torch.Tensor]]:
+    """Quantize a list of tensors to 8-bit integers in a single call
+
+    The chunks of all tensors are quantized by the same parallel job, which is much faster than
+    calling uniform_8bit_quantize on each tensor when there are many small tensors.
+
+    Args:
+        tensors (List[torch.Tensor]): The tensors to quantize
+    Returns:
+        List[Tuple[torch.Tensor, torch.Tensor]]: The quantized tensor and the lookup table of each tensor
+    """
+    return compress_ops.uniform_8bit_quantize_batched(tensors)
+
+
 def average_buckets(tensor: torch.Tensor, quant_weight: torch.Tensor, n_bins: int) -> torch.Tensor:
     """Return the average value in each bin
     Args:
@@ -44,3 +58,16 @@ def quantize_per_tensor_uint8(tensor: torch.Tensor, scale: float, zero_point: in
         torch.Tensor: The quantized tensor
     """
     return compress_ops.quantize_per_tensor_uint8(tensor, scale, zero_point)
+
+
+def set_num_threads(num_threads: int) -> None:
+    """Resize the persistent thread pool used by the compression kernels
+    Args:
+        num_threads (int): The number of threads, including the calling thread
+    """
+    compress_ops.set_num_threads(num_threads)
+
+
+def get_num_threads() -> int:
+    """Return the number of threads used by the compression kernels"""
+    return compress_ops.get_num_threads()
@@ -246,4 +246,11 @@ PYBIND11_MODULE(collectives, m) {
         py::arg("op"),
         py::arg("pg")
     );
+    // this extension has its own copy of the compression thread pool
+    m.def(
+        "set_num_threads",
+        &set_compression_threads,
+        "Resize the thread pool used to quantize the chunks",
+        py::arg("num_threads")
+    );
 }
\ No newline at end of file
@@ -1,44 +1,255 @@
 #include <torch/torch.h>
 
+#include <atomic>
+#include <condition_variable>
+#include <exception>
+#include <functional>
+#include <memory>
+#include <mutex>
+#include <thread>
+#include <unistd.h>
+
 namespace py = pybind11;
 
 constexpr int n_bins = 256;  // 8-bit quantization
 constexpr double RANGE_IN_SIGMAS = 6.0;
-const int max_num_threads = std::thread::hardware_concurrency();
+constexpr int64_t GRAIN_SIZE = 1 << 16;  // minimum number of elements per task, smaller tensors are done inline
+const int max_num_threads = std::max(1u, std::thread::hardware_concurrency());
 
-torch::Tensor quantize_per_tensor_multithreaded(const torch::Tensor& tensor, float scale, int32_t zero_point, int num_threads) {
-    torch::TensorOptions options = tensor.options().dtype(torch::kByte);
-    torch::Tensor quantized_tensor = torch::empty_like(tensor, options);
-    
-    float* tensor_data = tensor.data_ptr<float>();
-    uint8_t* quant_data = quantized_tensor.data_ptr<uint8_t>();
-    int64_t numel = tensor.numel();
-    float inv_scale = 1.0f / scale;
+// Persistent pool of worker threads shared by all the compression kernels.
+//
+// Spawning a new set of std::thread on every call dominates the cost of quantizing the many small tensors of a model,
+// so the workers are started once and woken up for each job. The calling thread also executes tasks.
+class ThreadPool {
+public:
+    static ThreadPool& instance() {
+        // Pools are never destroyed: the workers of the parent do not exist in a forked child (e.g. a dataloader
+        // worker), so the child leaks the inherited pool and starts its own.
+        static std::mutex instance_mutex;
+        static ThreadPool* pool = nullptr;
+        static pid_t pool_pid = 0;
+        std::lock_guard<std::mutex> lock(instance_mutex);
+        pid_t pid = getpid();
+        if (pool == nullptr || pool_pid != pid) {
+            pool = new ThreadPool(pool == nullptr ? max_num_threads : pool->num_threads());
+            pool_pid = pid;
+        }
+        return *pool;
+    }
 
-    std::vector<std::thread> threads;
-    int64_t chunk_size = numel / num_threads;
+    // Number of threads executing a job, including the caller
+    int num_threads() const {
+        return static_cast<int>(workers_.size()) + 1;
+    }
+
+    void resize(int num_threads) {
+        TORCH_CHECK(num_threads >= 1, "num_threads must be at least 1, got ", num_threads);
+        std::lock_guard<std::mutex> submit_lock(submit_mutex_);
+        if (num_threads == this->num_threads()) {
+            return;
+        }
+        stop_workers();
+        start_workers(num_threads - 1);
+    }
 
-    auto quantize_chunk = [&](int64_t start, int64_t end) {
-        for (int64_t i = start; i < end; ++i) {
-            int32_t quant_val = static_cast<int32_t>(std::round(tensor_data[i] * inv_scale)) + zero_point;
-            quant_data[i] = static_cast<uint8_t>(std::clamp(quant_val, 0, 255));
+    // Call fn(task) for each task in [0, num_tasks), blocking until all of them are done
+    void parallel_for(int64_t num_tasks, const std::function<void(int64_t)>& fn) {
+        if (num_tasks <= 0) {
+            return;
+        }
+        // nested calls from a task are done inline, waiting for the pool from one of its workers would deadlock
+        if (num_tasks == 1 || in_worker_) {
+            run_inline(num_tasks, fn);
+            return;
         }
+
+        std::lock_guard<std::mutex> submit_lock(submit_mutex_);
+        if (workers_.empty()) {
+            run_inline(num_tasks, fn);
+            return;
+        }
+        auto job = std::make_shared<Job>(fn, num_tasks);
+        {
+            std::lock_guard<std::mutex> lock(mutex_);
+            job_ = job;
+            ++generation_;
+        }
+        cv_.notify_all();
+
+        run_tasks(*job);
+
+        std::unique_lock<std::mutex> lock(mutex_);
+        done_cv_.wait(lock, [&] { return job->remaining.load() == 0; });
+        job_.reset();
+        lock.unlock();
+
+        if (job->error) {
+            std::rethrow_exception(job->error);
+        }
+    }
+
+private:
+    // State of a single parallel_for call. Workers hold a reference to it so that a late worker can never pick a task
+    // of the next job with the counters of the previous one.
+    struct Job {
+        Job(const std::function<void(int64_t)>& fn, int64_t num_tasks) : fn(fn), num_tasks(num_tasks), remaining(num_tasks) {}
+
+        const std::function<void(int64_t)>& fn;
+        const int64_t num_tasks;
+        std::atomic<int64_t> next{0};
+        std::atomic<int64_t> remaining;
+        std::exception_ptr error;
+        std::mutex error_mutex;
     };
 
-    for (int i = 0; i < num_threads - 1; ++i) {
-        int64_t start = i * chunk_size;
-        int64_t end = (i + 1) * chunk_size;
-        threads.emplace_back(quantize_chunk, start, end);
+    explicit ThreadPool(int num_threads) {
+        start_workers(num_threads - 1);
     }
 
-    // Handle the last chunk (which may be slightly larger due to rounding)
-    threads.emplace_back(quantize_chunk, (num_threads - 1) * chunk_size, numel);
+    static void run_inline(int64_t num_tasks, const std::function<void(int64_t)>& fn) {
+        for (int64_t task = 0; task < num_tasks; ++task) {
+            fn(task);
+        }
+    }
 
-    // Wait for all threads to complete
-    for (auto& thread : threads) {
-        thread.join();
+    void start_workers(int num_workers) {
+        stop_ = false;
+        for (int i = 0; i < num_workers; ++i) {
+            workers_.emplace_back([this] { worker_loop(); });
+        }
+    }
+
+    void stop_workers() {
+        {
+            std::lock_guard<std::mutex> lock(mutex_);
+            stop_ = true;
+        }
+        cv_.notify_all();
+        for (auto& worker : workers_) {
+            if (worker.joinable()) {
+                worker.join();
+            }
+        }
+        workers_.clear();
+    }
+
+    void worker_loop() {
+        in_worker_ = true;
+        std::unique_lock<std::mutex> lock(mutex_);
+        uint64_t seen_generation = generation_;
+        while (true) {
+            cv_.wait(lock, [&] { return stop_ || generation_ != seen_generation; });
+            if (stop_) {
+                return;
+            }
+            seen_generation = generation_;
+            std::shared_ptr<Job> job = job_;
+            lock.unlock();
+            if (job) {
+                run_tasks(*job);
+            }
+            lock.lock();
+        }
     }
 
+    void run_tasks(Job& job) {
+        int64_t task;
+        while ((task = job.next.fetch_add(1)) < job.num_tasks) {
+            try {
+                job.fn(task);
+            } catch (...) {
+                std::lock_guard<std::mutex> error_lock(job.error_mutex);
+                if (!job.error) {
+                    job.error = std::current_exception();
+                }
+            }
+            if (job.remaining.fetch_sub(1) == 1) {
+                std::lock_guard<std::mutex> lock(mutex_);
+                done_cv_.notify_all();
+            }
+        }
+    }
+
+    std::vector<std::thread> workers_;
+    std::mutex submit_mutex_;  // one job at a time
+    std::mutex mutex_;
+    std::condition_variable cv_;
+    std::condition_variable done_cv_;
+    std::shared_ptr<Job> job_;
+    uint64_t generation_ = 0;
+    bool stop_ = false;
+    static thread_local bool in_worker_;
+};
+
+thread_local bool ThreadPool::in_worker_ = false;
+
+void set_compression_threads(int num_threads) {
+    ThreadPool::instance().resize(num_threads);
+}
+
+int get_compression_threads() {
+    return ThreadPool::instance().num_threads();
+}
+
+// Number of tasks to split numel elements into, so that each task has at least GRAIN_SIZE elements
+inline int64_t num_tasks_for(int64_t numel, int max_tasks) {
+    int64_t num_tasks = (numel + GRAIN_SIZE - 1) / GRAIN_SIZE;
+    return std::max<int64_t>(1, std::min<int64_t>(num_tasks, std::min(max_tasks, get_compression_threads())));
+}
+
+// quantized = clamp(round(x / scale) + zero_point, 0, 255), with ties rounded up.
+// The loop only uses float ops and a truncating cast on a non negative value so that it is auto vectorized.
+inline void quantize_chunk(const float* data, uint8_t* quant_data, int64_t start, int64_t end, float inv_scale, float zero_point) {
+    const float offset = zero_point + 0.5f;
+    for (int64_t i = start; i < end; ++i) {
+        float value = data[i] * inv_scale + offset;
+        value = std::min(std::max(value, 0.0f), 255.0f);
+        quant_data[i] = static_cast<uint8_t>(value);
+    }
+}
+
+// Accumulate the sum and count of the values falling in each bin into the task's own partial histogram
+inline void histogram_chunk(const float* data, const uint8_t* quant_data, int64_t start, int64_t end, float* sums, int64_t* counts, int64_t n_bins) {
+    for (int64_t i = start; i < end; ++i) {
+        uint8_t bin = quant_data[i];
+        if (bin < n_bins) {  // No need to check for >= 0 as uint8_t is always non-negative
+            sums[bin] += data[i];
+            counts[bin]++;
+        }
+    }
+}
+
+// Sum the partial histograms of all tasks and divide by the counts
+inline void reduce_histograms(const float* partial_sums, const int64_t* partial_counts, int64_t num_partials, int64_t n_bins, float* averages) {
+    for (int64_t bin = 0; bin < n_bins; ++bin) {
+        float sum = 0.0f;
+        int64_t count = 0;
+        for (int64_t p = 0; p < num_partials; ++p) {
+            sum += partial_sums[p * n_bins + bin];
+            count += partial_counts[p * n_bins + bin];
+        }
+        averages[bin] = count > 0 ? sum / count : 0.0f;
+    }
+}
+
+torch::Tensor quantize_per_tensor_multithreaded(const torch::Tensor& tensor, float scale, int32_t zero_point, int num_threads) {
+    TORCH_CHECK(tensor.scalar_type() == torch::kFloat, "quantize_per_tensor_uint8 only supports float32 tensors");
+    auto contiguous_tensor = tensor.contiguous();
+    torch::Tensor quantized_tensor = torch::empty_like(contiguous_tensor, contiguous_tensor.options().dtype(torch::kByte));
+
+    const float* tensor_data = contiguous_tensor.data_ptr<float>();
+    uint8_t* quant_data = quantized_tensor.data_ptr<uint8_t>();
+    int64_t numel = contiguous_tensor.numel();
+    float inv_scale = 1.0f / scale;
+
+    int64_t num_tasks = num_tasks_for(numel, num_threads);
+    int64_t chunk_size = (numel + num_tasks - 1) / num_tasks;
+    ThreadPool::instance().parallel_for(num_tasks, [&](int64_t task) {
+        int64_t start = task * chunk_size;
+        int64_t end = std::min(numel, start + chunk_size);
+        quantize_chunk(tensor_data, quant_data, start, end, inv_scale, static_cast<float>(zero_point));
+    });
+
     return quantized_tensor;
 }
 
@@ -46,82 +257,118 @@ torch::Tensor average_buckets_multithread(const torch::Tensor& tensor, const tor
     torch::NoGradGuard no_grad;
     auto flat_tensor = tensor.flatten().contiguous();
     auto flat_quant_weight = quant_weight.flatten().contiguous();
-    auto options = flat_tensor.options();
-    auto bin_sums = torch::zeros({n_bins}, options);
-    auto bin_counts = torch::zeros({n_bins}, options.dtype(torch::kLong));
-
-    // Get raw pointers
-    float* tensor_data = flat_tensor.data_ptr<float>();
-    uint8_t* quant_data = flat_quant_weight.data_ptr<uint8_t>();
-    float* sums_data = bin_sums.data_ptr<float>();
-    int64_t* counts_data = bin_counts.data_ptr<int64_t>();
+    auto bin_averages = torch::empty({n_bins}, flat_tensor.options());
+
+    const float* tensor_data = flat_tensor.data_ptr<float>();
+    const uint8_t* quant_data = flat_quant_weight.data_ptr<uint8_t>();
     int64_t numel = flat_tensor.numel();
 
-    // Create a vector to hold our threads
-    std::vector<std::thread> threads;
+    // Each task fills its own partial histogram, they are summed once all tasks are done. No lock needed.
+    int64_t num_tasks = num_tasks_for(numel, num_threads);
+    int64_t chunk_size = (numel + num_tasks - 1) / num_tasks;
+    std::vector<float> partial_sums(num_tasks * n_bins, 0.0f);
+    std::vector<int64_t> partial_counts(num_tasks * n_bins, 0);
 
-    // Lambda function for the work each thread will do
-    auto worker = [&](int64_t start, int64_t end) {
-        std::vector<float> local_sums(n_bins, 0.0f);
-        std::vector<int64_t> local_counts(n_bins, 0);
+    ThreadPool::instance().parallel_for(num_tasks, [&](int64_t task) {
+        int64_t start = task * chunk_size;
+        int64_t end = std::min(numel, start + chunk_size);
+        histogram_chunk(tensor_data, quant_data, start, end, &partial_sums[task * n_bins], &partial_counts[task * n_bins], n_bins);
+    });
 
-        for (int64_t i = start; i < end; ++i) {
-            uint8_t bin = quant_data[i];
-            if (bin < n_bins) {  // No need to check for >= 0 as uint8_t is always non-negative
-                local_sums[bin] += tensor_data[i];
-                local_counts[bin]++;
-            }
+    reduce_histograms(partial_sums.data(), partial_counts.data(), num_tasks, n_bins, bin_averages.data_ptr<float>());
+    return bin_averages;
+}
+
+std::vector<std::tuple<torch::Tensor, torch::Tensor>> uniform_8bit_quantize_batched(const std::vector<torch::Tensor>& tensors) {
+    torch::NoGradGuard no_grad;
+    int zero_point = n_bins / 2;
+    size_t num_tensors = tensors.size();
+
+    // Split every tensor in chunks of at least GRAIN_SIZE elements, the chunks of all tensors are processed by the
+    // same parallel_for so that small tensors do not each pay for a round trip to the pool.
+    struct Chunk {
+        size_t tensor_index;
+        int64_t start;
+        int64_t end;
+    };
+    std::vector<Chunk> chunks;
+    std::vector<torch::Tensor> inputs;
+    std::vector<torch::Tensor> quantized;
+    inputs.reserve(num_tensors);
+    quantized.reserve(num_tensors);
+    for (size_t t = 0; t < num_tensors; ++t) {
+        TORCH_CHECK(tensors[t].scalar_type() == torch::kFloat, "uniform_8bit_quantize only supports float32 tensors");
+        inputs.push_back(tensors[t].contiguous());
+        quantized.push_back(torch::empty_like(inputs[t], inputs[t].options().dtype(torch::kByte)));
+        int64_t numel = inputs[t].numel();
+        int64_t num_tasks = num_tasks_for(numel, max_num_threads);
+        int64_t chunk_size = (numel + num_tasks - 1) / num_tasks;
+        for (int64_t start = 0; start < numel; start += chunk_size) {
+            chunks.push_back({t, start, std::min(numel, start + chunk_size)});
         }
+    }
+    int64_t num_chunks = chunks.size();
+    auto& pool = ThreadPool::instance();
 
-        // Use a mutex to safely update the shared data
-        static std::mutex mutex;
-        std::lock_guard<std::mutex> lock(mutex);
-        for (int64_t i = 0; i < n_bins; ++i) {
-            sums_data[i] += local_sums[i];
-            counts_data[i] += local_counts[i];
+    // First pass: sum of squares of each chunk, to compute the standard deviation of each tensor
+    std::vector<double> partial_sq_sums(num_chunks, 0.0);
+    pool.parallel_for(num_chunks, [&](int64_t c) {
+        const Chunk& chunk = chunks[c];
+        const float* data = inputs[chunk.tensor_index].data_ptr<float>();
+        double sq_sum = 0.0;
+        for (int64_t i = chunk.start; i < chunk.end; ++i) {
+            sq_sum += static_cast<double>(data[i]) * data[i];
         }
-    };
+        partial_sq_sums[c] = sq_sum;
+    });
 
-    // Divide the work among threads
-    int64_t chunk_size = numel / num_threads;
-    for (unsigned int i = 0; i < num_threads; ++i) {
-        int64_t start = i * chunk_size;
-        int64_t end = (i == num_threads - 1) ? numel : (i + 1) * chunk_size;
-        threads.emplace_back(worker, start, end);
+    std::vector<double> sq_sums(num_tensors, 0.0);
+    for (int64_t c = 0; c < num_chunks; ++c) {
+        sq_sums[chunks[c].tensor_index] += partial_sq_sums[c];
     }
-
-    // Wait for all threads to complete
-    for (auto& thread : threads) {
-        thread.join();
+    std::vector<float> inv_scales(num_tensors);
+    for (size_t t = 0; t < num_tensors; ++t) {
+        int64_t numel = inputs[t].numel();
+        double std_unbiased = std::sqrt(sq_sums[t]) / std::sqrt(std::max<int64_t>(numel - 1, 1));
+        double scale = RANGE_IN_SIGMAS * std_unbiased / n_bins;
+        inv_scales[t] = static_cast<float>(1.0 / scale);
     }
 
-    // Compute averages
-    for (int64_t i = 0; i < n_bins; ++i) {
-        sums_data[i] = counts_data[i] > 0 ? sums_data[i] / counts_data[i] : 0.0f;
-    }
+    // Second pass: quantize each chunk and fill its partial histogram
+    std::vector<float> partial_sums(num_chunks * n_bins, 0.0f);
+    std::vector<int64_t> partial_counts(num_chunks * n_bins, 0);
+    pool.parallel_for(num_chunks, [&](int64_t c) {
+        const Chunk& chunk = chunks[c];
+        const float* data = inputs[chunk.tensor_index].data_ptr<float>();
+        uint8_t* quant_data = quantized[chunk.tensor_index].data_ptr<uint8_t>();
+        quantize_chunk(data, quant_data, chunk.start, chunk.end, inv_scales[chunk.tensor_index], static_cast<float>(zero_point));
+        histogram_chunk(data, quant_data, chunk.start, chunk.end, &partial_sums[c * n_bins], &partial_counts[c * n_bins], n_bins);
+    });
 
-    return bin_sums;
+    // Chunks of a tensor are contiguous in the chunk list, so their partial histograms are too
+    std::vector<std::tuple<torch::Tensor, torch::Tensor>> results;
+    results.reserve(num_tensors);
+    int64_t first_chunk = 0;
+    for (size_t t = 0; t < num_tensors; ++t) {
+        int64_t last_chunk = first_chunk;
+        while (last_chunk < num_chunks && chunks[last_chunk].tensor_index == t) {
+            ++last_chunk;
+        }
+        auto lookup = torch::empty({n_bins}, inputs[t].options());
+        reduce_histograms(
+            &partial_sums[first_chunk * n_bins], &partial_counts[first_chunk * n_bins], last_chunk - first_chunk, n_bins, lookup.data_ptr<float>()
+        );
+        if (last_chunk == first_chunk) {
+            lookup.zero_();  // empty tensor
+        }
+        results.emplace_back(quantized[t], lookup);
+        first_chunk = last_chunk;
+    }
+    return results;
 }
 
 std::tuple<torch::Tensor, torch::Tensor> uniform_8bit_quantize(torch::Tensor tensor, bool inplace) {
-    int offset = n_bins / 2;
-    
-    // Centered tensor handling (currently commented out, so no centering)
-    torch::Tensor centered_tensor = tensor;
-
-    // Calculate unbiased standard deviation
-    double std_unbiased = centered_tensor.norm().item<double>() / std::sqrt(centered_tensor.numel() - 1);
-
-    // Calculate scale for quantization
-    double scale = RANGE_IN_SIGMAS * std_unbiased / n_bins;
-
-    // Perform quantization
-    torch::Tensor quantized_tensor = quantize_per_tensor_multithreaded(centered_tensor, scale, offset, max_num_threads);
-
-    // Call average_buckets to create the lookup table
-    torch::Tensor lookup = average_buckets_multithread(tensor, quantized_tensor, n_bins, max_num_threads);
-
-    return std::make_tuple(quantized_tensor, lookup);
+    return uniform_8bit_quantize_batched({tensor})[0];
 }
 
 
@@ -143,6 +390,13 @@ PYBIND11_MODULE(compression, m) {
         py::arg("tensor"),
         py::arg("inplace") = true
     )
+    .def(
+        "uniform_8bit_quantize_batched",
+        &uniform_8bit_quantize_batched,
+        "Uniform 8-bit quantization of a list of tensors in a single call",
+        py::arg("tensors"),
+        py::call_guard<py::gil_scoped_release>()
+    )
     .def(
         "quantize_per_tensor_uint8",
         &quantize_per_tensor_multithreaded,
@@ -151,5 +405,16 @@ PYBIND11_MODULE(compression, m) {
         py::arg("scale"),
         py::arg("zero_point"),
         py::arg("num_threads") = max_num_threads
+    )
+    .def(
+        "set_num_threads",
+        &set_compression_threads,
+        "Resize the thread pool used by the compression kernels",
+        py::arg("num_threads")
+    )
+    .def(
+        "get_num_threads",
+        &get_compression_threads,
+        "Number of threads used by the compression kernels"
     );
 }
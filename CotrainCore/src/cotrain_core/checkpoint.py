@@ -1,4 +1,7 @@
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+import copy
 from dataclasses import dataclass
+from functools import partial
 import gc
 import multiprocessing
 import os
@@ -7,8 +10,8 @@ import threading
 import time
 from typing import Any
 import uuid
+import zlib
 import fsspec
-from fsspec.generic import rsync as rsync_fsspec
 import torch
 from torch import nn
 from torch.optim import Optimizer
@@ -32,11 +35,16 @@ from torch.distributed._tensor.api import DTensor
 from zeroband.utils.state_dict_send_recv import (
     _get_sendable_state_dict,
     recv_state_dict,
+    recv_state_dict_bulk,
+    recv_tensors_bulk,
     send_state_dict,
+    send_state_dict_bulk,
     send_tensor_and_state_dict,
+    send_tensors_bulk,
 )
 from distributed_shampoo import DistributedShampoo
 from zeroband.utils.logger import get_logger
+from zeroband.utils.remote_upload import download_directory, upload_directory
 from zeroband.config import CkptConfig
 from zeroband.utils.world_info import get_world_info
 
@@ -147,6 +155,118 @@ class OuterOptimizerWrapper(Stateful):
         self.optimizer.load_state_dict(state_dict)
 
 
+DELTA_BASE_FILE = "delta_base"
+DELTA_STATES = ("model", "optimizer")
+DELTA_COMPRESSION_LEVEL = 1
+DELTA_CHUNK_SIZE = 4 * 2**20  # bytes, tensors are compressed in chunks of this size, in parallel
+_INT_DTYPES = {1: torch.uint8, 2: torch.int16, 4: torch.int32, 8: torch.int64}
+
+
+@dataclass
+class TensorDelta:
+    """
+    A tensor encoded against its value in the base checkpoint: the bitwise xor of both, zlib compressed.
+    Lossless, and the bits that did not change since the base (most of the sign and exponent bits of slowly moving
+    weights) compress to almost nothing. `xor` is False when the tensor was not in the base, `chunks` are then the
+    compressed tensor itself. The bytes are compressed in independent chunks of `DELTA_CHUNK_SIZE`, so that zlib (which
+    releases the GIL) can run on several threads.
+    """
+
+    chunks: list[bytes]
+    dtype: torch.dtype
+    shape: torch.Size
+    xor: bool
+
+
+def _as_int(tensor: torch.Tensor) -> torch.Tensor:
+    return tensor.detach().cpu().contiguous().view(_INT_DTYPES[tensor.element_size()])
+
+
+def _to_local(tensor: torch.Tensor) -> torch.Tensor:
+    return tensor.to_local() if isinstance(tensor, DTensor) else tensor
+
+
+def encode_tensor_delta(
+    tensor: torch.Tensor, base: torch.Tensor | None, executor: Executor | None = None
+) -> TensorDelta:
+    bits = _as_int(tensor)
+    xor = base is not None and base.shape == tensor.shape and base.dtype == tensor.dtype
+    if xor:
+        bits = torch.bitwise_xor(bits, _as_int(base))
+    data = memoryview(bits.reshape(-1).numpy()).cast("B")
+    parts = [data[i : i + DELTA_CHUNK_SIZE] for i in range(0, len(data), DELTA_CHUNK_SIZE)]
+    compress = partial(zlib.compress, level=DELTA_COMPRESSION_LEVEL)
+    chunks = list(executor.map(compress, parts) if executor is not None else map(compress, parts))
+    return TensorDelta(chunks, tensor.dtype, tensor.shape, xor)
+
+
+def decode_tensor_delta(delta: TensorDelta, base: torch.Tensor | None) -> torch.Tensor:
+    if delta.shape.numel() == 0:
+        return torch.empty(delta.shape, dtype=delta.dtype)
+    int_dtype = _INT_DTYPES[torch.empty(0, dtype=delta.dtype).element_size()]
+    data = bytearray().join(zlib.decompress(chunk) for chunk in delta.chunks)
+    bits = torch.frombuffer(data, dtype=int_dtype).reshape(delta.shape)
+    if delta.xor:
+        bits = torch.bitwise_xor(bits, _as_int(base))
+    return bits.view(delta.dtype)
+
+
+def clone_local_state(state: dict[str, Any]) -> dict[str, Any]:
+    """Copy the tensors of a state dict to cpu, DTensors are replaced by their local shard"""
+    base = {}
+    for key, value in state.items():
+        if isinstance(value, dict):
+            base[key] = clone_local_state(value)
+        elif isinstance(value, torch.Tensor):
+            base[key] = _to_local(value).detach().to("cpu", copy=True)
+    return base
+
+
+def encode_state_delta(
+    state: dict[str, Any], base: dict[str, Any] | None, executor: Executor | None = None
+) -> dict[str, Any]:
+    """
+    Replace the tensors of a state dict by their `TensorDelta` against the same keys of `base`, the chunks are
+    compressed on `executor` if given
+    """
+    delta = {}
+    for key, value in state.items():
+        base_value = base.get(key) if base is not None else None
+        if isinstance(value, dict):
+            delta[key] = encode_state_delta(value, base_value, executor)
+        elif isinstance(value, torch.Tensor):
+            delta[key] = encode_tensor_delta(_to_local(value), base_value, executor)
+        else:
+            delta[key] = value
+    return delta
+
+
+def apply_state_delta(state: dict[str, Any], delta: dict[str, Any]) -> None:
+    """Apply in place a delta of `encode_state_delta` to a state dict holding the values of the base"""
+    for key, value in delta.items():
+        if isinstance(value, dict):
+            apply_state_delta(state.setdefault(key, {}), value)
+        elif isinstance(value, TensorDelta):
+            current = state.get(key)
+            local = _to_local(current) if isinstance(current, torch.Tensor) else None
+            decoded = decode_tensor_delta(value, local)
+            if local is not None and local.shape == decoded.shape and local.dtype == decoded.dtype:
+                local.copy_(decoded)
+            else:
+                state[key] = decoded
+        else:
+            state[key] = value
+
+
+def get_delta_base(ckpt_path: str) -> str | None:
+    """Name of the full checkpoint a delta checkpoint was saved against, None for a full checkpoint"""
+    delta_base_path = os.path.join(ckpt_path, DELTA_BASE_FILE)
+    if not os.path.exists(delta_base_path):
+        return None
+    with open(delta_base_path) as f:
+        return f.read().strip()
+
+
 def non_error_barrier():
     try:
         dist.barrier()
@@ -166,6 +286,13 @@ class CkptManager:
             ...
         step_1/
             ...
+
+    With `delta_interval`, only one save out of `delta_interval` is a full checkpoint. The others are delta
+    checkpoints: each rank writes `delta_<local_rank>.pt` with its model and optimizer shards encoded against the last
+    full checkpoint (see `TensorDelta`), and the `delta_base` file names that full checkpoint. A delta checkpoint can
+    only be loaded with the same number of ranks and next to its base. The base is kept in host memory for the whole
+    run: each rank holds a cpu copy of its model and optimizer shards, as large as its share of a full checkpoint.
+    `scripts/bench_delta_checkpoint.py` measures the size and time of a delta save against a full one.
     """
 
     states: dict[str, Stateful]
@@ -181,6 +308,7 @@ class CkptManager:
         data_rank: int | None,
         diloco_offloaded_param_list: list[nn.Parameter] | None,
         diloco_offloaded_optimizer: Optimizer | None,
+        diloco_residual: torch.Tensor | None = None,
     ):
         self.config = config
 
@@ -198,9 +326,16 @@ class CkptManager:
         self.diloco_offloaded_optimizer = diloco_offloaded_optimizer  # he we don't use Wrapper because it failed
         # which might make the ckpt less generic in term of loading from different number of device. FSDP ckpt seems to be a mess tho
         self.diloco_offloaded_param_list = diloco_offloaded_param_list
+        # error feedback residual of the pseudo gradient compression, saved with the outer optimizer of each rank
+        self.diloco_residual = diloco_residual
 
         self._init_state()
 
+        # local shards of the last full checkpoint, the delta checkpoints are encoded against them
+        self._delta_base: dict[str, dict[str, Any]] | None = None
+        self._delta_base_path: str | None = None
+        self._deltas_since_base = 0
+
         self._logger = get_logger(config)
         self.world_info = get_world_info()
 
@@ -208,6 +343,15 @@ class CkptManager:
         self.blocking_process: list[multiprocessing.Process] = []
         self._live_reco_thread: threading.Thread | None = None
 
+        self._async_save_thread: threading.Thread | None = None
+        self._async_save_error: BaseException | None = None
+        if self.config.async_save:
+            # the background writer runs its collectives on its own gloo group so that they can never interleave
+            # with the collectives of the training loop
+            self._async_save_pg = dist.new_group(backend="gloo")
+            # the writer keeps the pinned cpu buffers of the staged state dict from one save to the next
+            self._async_storage_writer = dcp.FileSystemWriter(self.config.path, cache_staged_state_dict=True)
+
         if self.world_info.local_rank == 0:
             if self.config.path is not None:
                 self.check_path_access(self.config.path)
@@ -264,9 +408,14 @@ class CkptManager:
 
         step_ckpt_path = os.path.join(self.config.path, f"step_{self.training_progress.step}")
 
+        remote_ckpt_path = None
         if remote and self.config.remote is not None:
             remote_ckpt_path = os.path.join(self.config.remote.path, f"step_{self.training_progress.step}")
 
+        if self.config.async_save:
+            self._start_async_save(step_ckpt_path, remote_ckpt_path)
+            return
+
         # if we are not in self recovery mode we save to disk
         time_start = time.perf_counter()
         self._save(step_ckpt_path)
@@ -275,7 +424,7 @@ class CkptManager:
         # push to remote
         non_error_barrier()
         if self.world_info.local_rank == 0:
-            if remote and self.config.remote is not None:
+            if remote_ckpt_path is not None:
                 self._async_save_remote(step_ckpt_path, remote_ckpt_path)
 
     @torch.no_grad()
@@ -290,12 +439,23 @@ class CkptManager:
             if catch_warning:
                 warnings.simplefilter("ignore")
 
-            dcp.save(self.states, checkpoint_id=ckpt_path)
+            if self._delta_base is not None and self._deltas_since_base < self.config.delta_interval - 1:
+                self._save_delta(ckpt_path)
+            else:
+                dcp.save(self.states, checkpoint_id=ckpt_path)
+                if self.config.delta_interval is not None:
+                    self._delta_base = {
+                        name: clone_local_state(self.states[name].state_dict()) for name in DELTA_STATES
+                    }
+                    self._delta_base_path = ckpt_path
+                    self._deltas_since_base = 0
 
             if self.diloco_offloaded_optimizer:
                 with open(os.path.join(ckpt_path, f"__{self.world_info.local_rank}_0.pt"), "wb") as f:
                     state = {}
                     state["optimizer"] = OuterOptimizerWrapper(self.diloco_offloaded_optimizer).state_dict()
+                    if self.diloco_residual is not None:
+                        state["residual"] = self.diloco_residual
 
                     torch.save(state, f)
 
@@ -315,23 +475,173 @@ class CkptManager:
 
         gc.collect()
 
+    @torch.no_grad()
+    def _save_delta(self, ckpt_path: str):
+        """Write the model and optimizer as a delta against the last full checkpoint, the other states in full"""
+        time_start = time.perf_counter()
+        os.makedirs(ckpt_path, exist_ok=True)
+
+        with ThreadPoolExecutor(self.config.delta_compression_threads or os.cpu_count()) as executor:
+            state = {
+                name: encode_state_delta(self.states[name].state_dict(), self._delta_base[name], executor)
+                for name in DELTA_STATES
+            }
+        state["scheduler"] = self.scheduler.state_dict()
+        state["training_progress"] = self.training_progress.state_dict()
+        with open(os.path.join(ckpt_path, f"delta_{self.world_info.local_rank}.pt"), "wb") as f:
+            torch.save(state, f)
+
+        if self.world_info.local_rank == 0:
+            with open(os.path.join(ckpt_path, DELTA_BASE_FILE), "w") as f:
+                f.write(os.path.basename(self._delta_base_path))
+        self._deltas_since_base += 1
+
+        self._logger.debug(
+            f"Saved delta checkpoint against {self._delta_base_path} in {time.perf_counter() - time_start} seconds"
+        )
+
+    @torch.no_grad()
+    def _load_delta(self, resume_ckpt_path: str, delta_base: str):
+        """Load the full checkpoint a delta checkpoint is based on, then apply the delta"""
+        base_path = os.path.join(os.path.dirname(os.path.normpath(resume_ckpt_path)), delta_base)
+        self._logger.debug(f"Loading delta checkpoint {resume_ckpt_path} on top of {base_path}")
+        dcp.load(self.states, checkpoint_id=base_path)
+
+        with open(os.path.join(resume_ckpt_path, f"delta_{get_world_info().local_rank}.pt"), "rb") as f:
+            delta = torch.load(f)
+
+        for name in DELTA_STATES:
+            state = self.states[name].state_dict()
+            apply_state_delta(state, delta[name])
+            self.states[name].load_state_dict(state)
+        self.scheduler.load_state_dict(delta["scheduler"])
+        self.training_progress.load_state_dict(delta["training_progress"])
+
+    @torch.no_grad()
+    def _start_async_save(self, ckpt_path: str, remote_ckpt_path: str | None) -> None:
+        """
+        Snapshot all the states and return, the snapshot is written to `ckpt_path` by a background thread.
+
+        The model, inner optimizer, scheduler and training progress are staged by dcp into pinned cpu buffers,
+        the outer optimizer and dataloader states are copied. Training can modify the live states right away.
+        """
+        # at most one save in flight: this also makes sure the previous checkpoint is complete before topk deletion
+        self.wait_for_blocking_job()
+
+        time_start = time.perf_counter()
+        catch_warning = self._logger.getEffectiveLevel() <= logging.INFO
+        with warnings.catch_warnings():
+            if catch_warning:
+                warnings.simplefilter("ignore")
+
+            dcp_future = dcp.async_save(
+                self.states,
+                checkpoint_id=ckpt_path,
+                storage_writer=self._async_storage_writer,
+                process_group=self._async_save_pg,
+            )
+
+        rank_state = None
+        if self.diloco_offloaded_optimizer:
+            # the outer optimizer state and the residual live on cpu and are updated in place by the next outer step
+            outer_optimizer_state = OuterOptimizerWrapper(self.diloco_offloaded_optimizer).state_dict()
+            rank_state = {"optimizer": copy.deepcopy(outer_optimizer_state)}
+            if self.diloco_residual is not None:
+                rank_state["residual"] = self.diloco_residual.clone()
+        dataloader_state = copy.deepcopy(self.dataloader.state_dict())
+
+        self._logger.info(f"Staged checkpoint {ckpt_path} in {time.perf_counter() - time_start} seconds")
+
+        self._async_save_thread = threading.Thread(
+            target=self._write_async_save,
+            args=(
+                dcp_future,
+                ckpt_path,
+                remote_ckpt_path,
+                rank_state,
+                dataloader_state,
+                self.training_progress.step,
+            ),
+            name="async-ckpt-writer",
+        )
+        self._async_save_thread.start()
+
+    def _write_async_save(
+        self,
+        dcp_future: Future,
+        ckpt_path: str,
+        remote_ckpt_path: str | None,
+        rank_state: dict[str, Any] | None,
+        dataloader_state: dict[str, Any],
+        step: int,
+    ) -> None:
+        """Background part of an async save, does the same as `_save` followed by the remote push of `save`"""
+        time_start = time.perf_counter()
+        try:
+            dcp_future.result()
+
+            if rank_state is not None:
+                with open(os.path.join(ckpt_path, f"__{self.world_info.local_rank}_0.pt"), "wb") as f:
+                    torch.save(rank_state, f)
+
+            data_path = os.path.join(ckpt_path, "data")
+            self.save_data(data_path, self.dataloader, self.world_info.local_rank, state=dataloader_state)
+
+            # every local rank is done writing, the checkpoint is complete and can be pushed
+            dist.barrier(group=self._async_save_pg)
+        except BaseException as e:
+            self._async_save_error = e
+            return
+
+        self._logger.info(f"Saved checkpoint to {ckpt_path} in {time.perf_counter() - time_start} seconds")
+
+        if self.config.remote_data_path is not None:
+            remote_data_path = os.path.join(self.config.remote_data_path, f"data_{self.data_rank}", f"step_{step}")
+            latest_remote_data_path = os.path.join(self.config.remote_data_path, f"data_{self.data_rank}", "latest")
+
+            self._async_save_remote(data_path, remote_data_path, blocking=False)
+            self._async_save_remote(data_path, latest_remote_data_path, blocking=False)
+
+        if self.world_info.local_rank == 0 and remote_ckpt_path is not None:
+            self._async_save_remote(ckpt_path, remote_ckpt_path)
+
+    def wait_for_async_save(self) -> None:
+        """Block until the checkpoint being written in the background, if any, is complete"""
+        if self._async_save_thread is None:
+            return
+
+        time_start = time.perf_counter()
+        self._async_save_thread.join()
+        self._async_save_thread = None
+        self._logger.debug(f"Waited {time.perf_counter() - time_start} seconds for the async checkpoint")
+
+        if self._async_save_error is not None:
+            error, self._async_save_error = self._async_save_error, None
+            raise error
+
     @staticmethod
-    def save_data(data_path: str, dataloader, local_rank: int):
+    def save_data(data_path: str, dataloader, local_rank: int, state: dict[str, Any] | None = None):
         os.makedirs(data_path, exist_ok=True)
         with open(os.path.join(data_path, f"_{local_rank}.pt"), "wb") as f:
-            state = {"data_loader": dataloader.state_dict()}
+            state = {"data_loader": dataloader.state_dict() if state is None else state}
             torch.save(state, f)
 
     def _async_save_remote(self, ckpt_path: str, remote_ckpt_path: str, blocking: bool = True) -> None:
-        """asyncronously rsync a ckpt folder to a remote location. Using fsspec to handle remote cloud storage without to install
-        specific libraries (e.g. s3fs).
+        """asyncronously upload a ckpt folder to a remote location. Using fsspec to handle remote cloud storage without to install
+        specific libraries (e.g. s3fs). See `upload_directory` for the chunking and the resume.
         """
 
         def rsync():
             time_start = time.perf_counter()
             self._logger.info(f"start pushing {ckpt_path} to {remote_ckpt_path} asynchronously")
             try:
-                rsync_fsspec(ckpt_path, destination=remote_ckpt_path)
+                upload_directory(
+                    ckpt_path,
+                    remote_ckpt_path,
+                    chunk_size=self.config.upload_chunk_size,
+                    num_workers=self.config.upload_workers,
+                    max_retries=self.config.upload_retries,
+                )
             except Exception as e:
                 self._logger.error(f"Error pushing {ckpt_path} to {remote_ckpt_path}: {e}")
             self._logger.info(
@@ -347,6 +657,9 @@ class CkptManager:
             self.non_blocking_process.append(processes)
 
     def wait_for_blocking_job(self):
+        # the remote push of an async save is only started once its local write is done
+        self.wait_for_async_save()
+
         for process in self.blocking_process:
             process.join()
 
@@ -354,7 +667,7 @@ class CkptManager:
 
         if self.world_info.local_rank == 0:
             if self.config.topk is not None:
-                delete_topk(self.logger, self.config.path, self.config.topk)
+                delete_topk(self._logger, self.config.path, self.config.topk)
 
     def _del__(self):
         self.wait_for_blocking_job()
@@ -402,7 +715,13 @@ class CkptManager:
             )
             resume_ckpt_path = os.path.join(resume_ckpt_path, files[0])
 
-        dcp.load(self.states, checkpoint_id=resume_ckpt_path)
+        delta_base = get_delta_base(resume_ckpt_path)
+        if delta_base is not None:
+            self._load_delta(resume_ckpt_path, delta_base)
+        else:
+            dcp.load(self.states, checkpoint_id=resume_ckpt_path)
+        # the base of the next delta checkpoints is only known once a full checkpoint has been saved
+        self._delta_base = None
 
         if self.config.token_count is not None:
             self.training_progress.total_tokens = self.config.token_count
@@ -419,6 +738,8 @@ class CkptManager:
 
             opt_wrapper = OuterOptimizerWrapper(self.diloco_offloaded_optimizer)
             opt_wrapper.load_state_dict(rank_state_dict["optimizer"])
+            if self.diloco_residual is not None and "residual" in rank_state_dict:
+                self.diloco_residual.copy_(rank_state_dict["residual"])
 
         if not skip_dataloader:
             if self.config.remote_data_load:
@@ -435,7 +756,12 @@ class CkptManager:
         remote_data_path = os.path.join(self.config.remote_data_path, f"data_{self.data_rank}", "latest")
         id_ = uuid.uuid4()
         dest = f"/tmp/zeroband/data_{id_}"
-        rsync_fsspec(remote_data_path, os.path.join(dest, "data"))
+        download_directory(
+            remote_data_path,
+            os.path.join(dest, "data"),
+            num_workers=self.config.upload_workers,
+            max_retries=self.config.upload_retries,
+        )
         data_path = dest
         self._load_data(data_path)
 
@@ -443,6 +769,9 @@ class CkptManager:
     def recv_ckpt_from_peer(self, global_pg: dist.ProcessGroup):
         assert self.diloco_offloaded_param_list is not None, "recv_ckpt_from_peers is only supported with diloco"
 
+        if self.config.live_recovery_bulk:
+            return self._recv_ckpt_from_peer_bulk(global_pg)
+
         time_start = time.perf_counter()
         self._logger.debug(f"Start receiving ckpt from rank {self.config.live_recovery_rank_src}")
 
@@ -506,6 +835,72 @@ class CkptManager:
             f"Received ckpt from rank {self.config.live_recovery_rank_src} in {time.perf_counter() - time_start} seconds"
         )
 
+    @torch.no_grad()
+    def _recv_ckpt_from_peer_bulk(self, global_pg: dist.ProcessGroup):
+        """Same as `recv_ckpt_from_peer` but every state is received in place with `recv_tensors_bulk`"""
+        src_rank = self.config.live_recovery_rank_src
+        time_start = time.perf_counter()
+        self._logger.debug(f"Start receiving ckpt from rank {src_rank} in bulk mode")
+
+        # the offloaded model of the peer is written straight into the inner model parameters
+        recv_tensors_bulk(global_pg, src_rank, [param.data for param in self.model.parameters()])
+        self._logger.debug("live recovery progress: offloaded model received 1/5")
+
+        self.diloco_offloaded_optimizer.load_state_dict(
+            recv_state_dict_bulk(global_pg, src_rank, self.diloco_offloaded_optimizer.state_dict())
+        )
+        self._logger.debug("live recovery progress: outer optimizer state dict received 2/5")
+
+        self.training_progress.load_state_dict(
+            recv_state_dict_bulk(global_pg, src_rank, self.training_progress.state_dict())
+        )
+        self._logger.debug("live recovery progress: training progress state dict received 3/5")
+
+        for group in self.optimizer.param_groups:
+            for p in group["params"]:
+                p.grad = torch.randn_like(p)
+
+        self.optimizer.step()
+        self.optimizer.zero_grad()
+
+        self.optimizer.load_state_dict(recv_state_dict_bulk(global_pg, src_rank, self.optimizer.state_dict()))
+        self._logger.debug("live recovery progress: inner optimizer state dict received 4/5")
+
+        self.scheduler.load_state_dict(recv_state_dict_bulk(global_pg, src_rank, self.scheduler.state_dict()))
+        self._logger.debug("live recovery progress: scheduler state dict received 5/5")
+
+        self._logger.debug(f"Received ckpt from rank {src_rank} in {time.perf_counter() - time_start} seconds")
+
+    def _send_ckpt_to_peer(self, global_pg: dist.ProcessGroup, dest_rank: int):
+        jobs = []
+        for i, param in enumerate(self.diloco_offloaded_param_list):
+            data = param.data
+            if isinstance(data, DTensor):
+                data = data.to_local()
+            jobs.append(global_pg.send([data], dest_rank, i))
+
+        for job in jobs:
+            job.wait()
+
+        send_state_dict(global_pg, self.diloco_offloaded_optimizer.state_dict(), dest_rank)
+        send_state_dict(global_pg, self.training_progress.state_dict(), dest_rank)
+
+        inner_optimizer_non_tensor_state_dict, inner_optimizer_tensors = _get_sendable_state_dict(
+            self.optimizer.state_dict()
+        )
+        send_tensor_and_state_dict(
+            global_pg, dest_rank, inner_optimizer_non_tensor_state_dict, inner_optimizer_tensors
+        )
+
+        send_state_dict(global_pg, self.scheduler.state_dict(), dest_rank)
+
+    def _send_ckpt_to_peer_bulk(self, global_pg: dist.ProcessGroup, dest_rank: int):
+        send_tensors_bulk(global_pg, dest_rank, [param.data for param in self.diloco_offloaded_param_list])
+        send_state_dict_bulk(global_pg, self.diloco_offloaded_optimizer.state_dict(), dest_rank)
+        send_state_dict_bulk(global_pg, self.training_progress.state_dict(), dest_rank)
+        send_state_dict_bulk(global_pg, self.optimizer.state_dict(), dest_rank)
+        send_state_dict_bulk(global_pg, self.scheduler.state_dict(), dest_rank)
+
     @torch.no_grad()
     def send_ckpt_to_peer(self, global_pg: dist.ProcessGroup, dest_rank: int, blocking: bool = False):
         def async_send():
@@ -514,27 +909,10 @@ class CkptManager:
             self._logger.debug(f"Start sending ckpt to rank {dest_rank}")
 
             try:
-                jobs = []
-                for i, param in enumerate(self.diloco_offloaded_param_list):
-                    data = param.data
-                    if isinstance(data, DTensor):
-                        data = data.to_local()
-                    jobs.append(global_pg.send([data], dest_rank, i))
-
-                for job in jobs:
-                    job.wait()
-
-                send_state_dict(global_pg, self.diloco_offloaded_optimizer.state_dict(), dest_rank)
-                send_state_dict(global_pg, self.training_progress.state_dict(), dest_rank)
-
-                inner_optimizer_non_tensor_state_dict, inner_optimizer_tensors = _get_sendable_state_dict(
-                    self.optimizer.state_dict()
-                )
-                send_tensor_and_state_dict(
-                    global_pg, dest_rank, inner_optimizer_non_tensor_state_dict, inner_optimizer_tensors
-                )
-
-                send_state_dict(global_pg, self.scheduler.state_dict(), dest_rank)
+                if self.config.live_recovery_bulk:
+                    self._send_ckpt_to_peer_bulk(global_pg, dest_rank)
+                else:
+                    self._send_ckpt_to_peer(global_pg, dest_rank)
             except RuntimeError as e:
                 self._logger.error(f"Error sending ckpt to rank {dest_rank}: {e}")
             else:
@@ -560,4 +938,6 @@ def delete_topk(logger: logging.Logger, ckpt_path: str, topk: int):
 def get_checkpoints_to_delete(ckpt_path: str, topk: int) -> list[str]:
     checkpoints = [d for d in os.listdir(ckpt_path) if d.startswith("step_")]
     sorted_checkpoints = sorted(checkpoints, key=lambda x: int(x.split("_")[1]), reverse=True)
-    return [os.path.join(ckpt_path, d) for d in sorted_checkpoints[topk:]]
+    # the full checkpoints still needed by the kept delta checkpoints are kept on top of the topk
+    delta_bases = {get_delta_base(os.path.join(ckpt_path, d)) for d in sorted_checkpoints[:topk]}
+    return [os.path.join(ckpt_path, d) for d in sorted_checkpoints[topk:] if d not in delta_bases]
@@ -1,9 +1,19 @@
+import math
+import time
+from collections import deque
+from dataclasses import dataclass
+from datetime import timedelta
+from functools import partial
 from typing import Callable, Optional, TypeAlias
 import torch
 import torch.distributed as dist
 
+from zeroband.compression import quantile_4bit_dequantize, quantile_4bit_quantize, topk_sparsify
 from zeroband.config import Compression
 
+# lossy compressions that need the error feedback residual of `error_feedback_all_reduce`
+ERROR_FEEDBACK_COMPRESSIONS = (Compression.QUANTILE4, Compression.TOPK)
+
 AllReduceFunc: TypeAlias = Callable[
     [torch.Tensor, dist.ReduceOp, Optional[dist.ProcessGroup], Optional[torch.dtype]], None
 ]
@@ -38,16 +48,275 @@ def all_reduce(
         from zeroband.C.collectives import ring_allreduce as ring_allreduce_c
 
         return ring_allreduce_c(tensor, op, group)
+    elif compression in ERROR_FEEDBACK_COMPRESSIONS:
+        raise ValueError(f"{compression.value} compression needs a residual, use error_feedback_all_reduce")
     else:
         return gloo_all_reduce(tensor, op, group)
 
 
+def error_feedback_all_reduce(
+    compression: Compression,
+    tensor: torch.Tensor,
+    residual: torch.Tensor,
+    op: dist.ReduceOp = dist.ReduceOp.SUM,  # type: ignore
+    group: Optional[dist.ProcessGroup] = None,
+    topk_ratio: float = 0.01,
+    new_residual: Optional[torch.Tensor] = None,
+) -> None:
+    """
+    All reduce with a lossy compression (QUANTILE4 or TOPK) and error feedback.
+
+    The residual holds what the previous compressions of this tensor lost. It is added to the tensor before compressing
+    and the new compression error is written to `new_residual` (the residual itself by default) once the collective
+    succeeded. A tensor reduced in several buckets should stage the new residuals in a separate buffer and commit them
+    once all the buckets succeeded, so that a failed bucket can be retried from the same residuals.
+
+    Each rank compresses its own tensor once and the compressed payloads are all gathered, nothing is compressed again
+    on the way. Each rank receives (world_size - 1) payloads of 1/8 (QUANTILE4) or 2 * topk_ratio (TOPK) of the tensor,
+    more than the uint8 ring above `all_gather_max_world_size` ranks.
+    """
+    if group is None:
+        group = dist.distributed_c10d._get_default_group()
+    if op not in [dist.ReduceOp.SUM, dist.ReduceOp.AVG]:
+        raise ValueError(f"Unsupported reduce operation {op}. Only SUM and AVG are supported.")
+
+    numel = tensor.numel()
+    compensated = tensor.flatten() + residual.flatten()
+    if compression == Compression.QUANTILE4:
+        payload = quantile_4bit_quantize(compensated)
+        local = quantile_4bit_dequantize(*payload, numel)
+    elif compression == Compression.TOPK:
+        payload = topk_sparsify(compensated, max(1, int(numel * topk_ratio)))
+        local = torch.zeros_like(compensated).index_copy_(0, payload[1].long(), payload[0])
+    else:
+        raise ValueError(f"{compression.value} compression does not use error feedback")
+
+    gathered = [[torch.empty_like(t) for _ in range(group.size())] for t in payload]
+    for outputs, t in zip(gathered, payload):
+        dist.all_gather(outputs, t, group=group)
+
+    result = torch.zeros_like(compensated)
+    for rank_payload in zip(*gathered):
+        if compression == Compression.QUANTILE4:
+            result.add_(quantile_4bit_dequantize(*rank_payload, numel))
+        else:
+            values, indices = rank_payload
+            result.index_add_(0, indices.long(), values)
+
+    if new_residual is None:
+        new_residual = residual
+    new_residual.copy_(compensated.sub_(local).view_as(new_residual))
+    if op == dist.ReduceOp.AVG:
+        result.div_(group.size())
+    tensor.copy_(result.view_as(tensor))
+
+
+def all_gather_max_world_size(compression: Compression, topk_ratio: float = 0.01) -> int:
+    """
+    Largest world size for which `error_feedback_all_reduce` receives less data per rank than the uint8 ring.
+
+    Relative to the fp32 tensor, the all gather receives (world_size - 1) * payload and the uint8 ring sends and
+    receives 2 * (world_size - 1) / world_size * 1/4, so the all gather is cheaper up to 1 / (2 * payload) ranks:
+    4 ranks for QUANTILE4 and 25 ranks for TOPK with topk_ratio = 0.01.
+    """
+    if compression == Compression.QUANTILE4:
+        payload = 1 / 8
+    elif compression == Compression.TOPK:
+        payload = 2 * topk_ratio  # fp32 values and int32 indices
+    else:
+        raise ValueError(f"{compression.value} compression does not use error feedback")
+    return max(1, math.floor(1 / (2 * payload) + 1e-9))
+
+
+@dataclass
+class HierarchicalGroups:
+    """The process groups of one rank for `hierarchical_all_reduce`.
+
+    The leader of a group is its first rank, it has rank 0 in the intra group. leader_group is None for the other ranks.
+    """
+
+    groups: list[list[int]]  # global ranks of each group
+    intra_group: dist.ProcessGroup
+    leader_group: Optional[dist.ProcessGroup]
+
+    @property
+    def world_size(self) -> int:
+        return sum(len(group) for group in self.groups)
+
+
+def group_ranks_by_label(labels: list[str]) -> list[list[int]]:
+    """Group the ranks that share the same label, e.g. the name of their datacenter"""
+    groups: dict[str, list[int]] = {}
+    for rank, label in enumerate(labels):
+        groups.setdefault(label, []).append(rank)
+    return sorted(groups.values())
+
+
+def group_ranks_by_bandwidth(pings: list[list[int]], max_ping: int) -> list[list[int]]:
+    """Group the ranks connected by links faster than max_ping in both directions.
+
+    pings[i][j] is the time to send 10Tb from i to j as measured by ElasticDeviceMesh. The groups are the connected
+    components of the fast links, so two ranks of a group can be connected through a third one.
+    """
+    world_size = len(pings)
+    parents = list(range(world_size))
+
+    def find(i: int) -> int:
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    for i in range(world_size):
+        for j in range(i + 1, world_size):
+            if max(pings[i][j], pings[j][i]) <= max_ping:
+                parents[find(j)] = find(i)
+
+    groups: dict[int, list[int]] = {}
+    for i in range(world_size):
+        groups.setdefault(find(i), []).append(i)
+    return sorted(groups.values())
+
+
+def create_hierarchical_groups(
+    store: dist.Store, rank: int, groups: list[list[int]], prefix: str, timeout: timedelta
+) -> HierarchicalGroups:
+    """Create the gloo process groups of this rank. Only the members of a group take part in its creation."""
+    group_index = next(i for i, group in enumerate(groups) if rank in group)
+    group = groups[group_index]
+    intra_group = dist.ProcessGroupGloo(
+        dist.PrefixStore(f"{prefix}_intra_{group_index}", store), group.index(rank), len(group), timeout
+    )
+
+    leader_group = None
+    leaders = [group[0] for group in groups]
+    if rank in leaders:
+        leader_group = dist.ProcessGroupGloo(
+            dist.PrefixStore(f"{prefix}_leaders", store), leaders.index(rank), len(leaders), timeout
+        )
+    return HierarchicalGroups(groups=groups, intra_group=intra_group, leader_group=leader_group)
+
+
+def hierarchical_all_reduce(
+    compression: Compression,
+    tensor: torch.Tensor,
+    groups: HierarchicalGroups,
+    op: dist.ReduceOp = dist.ReduceOp.SUM,  # type: ignore
+) -> None:
+    """
+    All reduce in three steps: reduce to the leader inside each group, all reduce between the leaders (compressed
+    according to `compression`), then broadcast from the leader inside each group.
+
+    Only one tensor crosses the slow links between groups per group instead of one per rank.
+    """
+    if op not in [dist.ReduceOp.SUM, dist.ReduceOp.AVG]:
+        raise ValueError(f"Unsupported reduce operation {op}. Only SUM and AVG are supported.")
+
+    # the process groups are not registered in c10d so we call them directly, ranks are relative to the group
+    if groups.intra_group.size() > 1:
+        groups.intra_group.reduce(tensor, 0, dist.ReduceOp.SUM).wait()
+    if groups.leader_group is not None and groups.leader_group.size() > 1:
+        all_reduce(compression, tensor, dist.ReduceOp.SUM, groups.leader_group)
+    if groups.intra_group.size() > 1:
+        groups.intra_group.broadcast(tensor, 0).wait()
+
+    if op == dist.ReduceOp.AVG:
+        tensor.div_(groups.world_size)
+
+
 # ===============
-# Code purgatory
-# ---------------
-# This code is still here because it is used by tests
-# ring_allreduce is used by tests/test_c/test_collectives.py to make sure the new c impl doesnt deviate too much numerically
-BUFFER_COUNT = 2
+MIN_RING_CHUNK_SIZE = 2**16
+MAX_RING_CHUNK_SIZE = 2**22
+QUANTIZATION_LOOKUP_SIZE = 256  # the quantization funcs of the ring all reduce encode each value on one byte
+
+
+def get_ring_chunk_size(numel: int, world_size: int, buffer_depth: int) -> int:
+    """
+    Default sub-chunk size (in elements) of `ring_allreduce_py`. Each segment of the ring is split in about
+    2 * buffer_depth sub-chunks so that the pipeline fills up, without going below the size where the overhead per
+    message dominates nor above the size where the last sub-chunk delays the whole pipeline.
+    """
+    segment_numel = math.ceil(numel / world_size)
+    chunk_size = math.ceil(segment_numel / (2 * buffer_depth))
+    return min(max(chunk_size, MIN_RING_CHUNK_SIZE), MAX_RING_CHUNK_SIZE)
+
+
+def autotune_ring_chunk_size(
+    numel: int,
+    group: Optional[dist.ProcessGroup] = None,
+    buffer_depth: int = 4,
+    quantization_func: Optional[Callable] = None,
+    candidates: Optional[list[int]] = None,
+    n_iters: int = 3,
+) -> int:
+    """
+    Time `ring_allreduce_py` on a random tensor of `numel` elements for each candidate sub-chunk size and return the
+    fastest one. This is a collective, all the ranks of the group must call it with the same arguments. The slowest
+    rank decides the time of each candidate so that all the ranks return the same chunk size.
+    """
+    if group is None:
+        group = dist.distributed_c10d._get_default_group()
+    if candidates is None:
+        candidates = [2**i for i in range(16, 23)]
+
+    tensor = torch.randn(numel)
+    timings = torch.zeros(len(candidates), dtype=torch.float64)
+    for i, chunk_size in enumerate(candidates):
+        start = time.perf_counter()
+        for _ in range(n_iters):
+            ring_allreduce_py(
+                tensor,
+                dist.ReduceOp.AVG,
+                group,
+                quantization_func=quantization_func,
+                buffer_depth=buffer_depth,
+                chunk_size=chunk_size,
+            )
+        timings[i] = (time.perf_counter() - start) / n_iters
+    dist.all_reduce(timings, dist.ReduceOp.MAX, group=group)
+    return candidates[int(timings.argmin())]
+
+
+def _encode_chunk(
+    chunk: torch.Tensor, transfer_dtype: torch.dtype, quantization_func: Optional[Callable]
+) -> tuple[torch.Tensor, ...]:
+    if quantization_func is not None:
+        return quantization_func(chunk)
+    return (chunk.to(transfer_dtype),)
+
+
+def _decode_chunk(payload: tuple[torch.Tensor, ...]) -> torch.Tensor:
+    if len(payload) == 2:
+        quantized, lookup = payload
+        return lookup[quantized.long()]
+    return payload[0]
+
+
+def _empty_payload(
+    chunk: torch.Tensor, transfer_dtype: torch.dtype, quantization_func: Optional[Callable]
+) -> tuple[torch.Tensor, ...]:
+    if quantization_func is not None:
+        return (
+            torch.empty_like(chunk, dtype=torch.uint8),
+            torch.empty(QUANTIZATION_LOOKUP_SIZE, dtype=chunk.dtype),
+        )
+    return (torch.empty_like(chunk, dtype=transfer_dtype),)
+
+
+def _send_recv(
+    send_payload: tuple[torch.Tensor, ...],
+    recv_payload: tuple[torch.Tensor, ...],
+    send_rank: int,
+    recv_rank: int,
+    group: dist.ProcessGroup,
+    tag: int,
+) -> list[dist.Work]:
+    # the ranks are group ranks, call the group directly so that unregistered gloo groups work too
+    works = []
+    for i, (send_tensor, recv_tensor) in enumerate(zip(send_payload, recv_payload)):
+        works.append(group.send([send_tensor], send_rank, tag + i))
+        works.append(group.recv([recv_tensor], recv_rank, tag + i))
+    return works
 
 
 def ring_allreduce_py(
@@ -56,11 +325,18 @@ def ring_allreduce_py(
     group: Optional[dist.ProcessGroup] = None,
     transfer_dtype: Optional[torch.dtype] = None,
     quantization_func: Optional[Callable] = None,
+    buffer_depth: int = 4,
+    chunk_size: Optional[int] = None,
 ) -> None:
     """
-    Perform all-reduce on a tensor using ring algorithm.
+    Perform all-reduce on a tensor using a pipelined ring algorithm.
     The accumulation will be done in-place on the input tensor.
-    The transfers will be done using the specified transfer_dtype.
+    The transfers will be done using the specified transfer_dtype, or quantized with quantization_func.
+
+    Each of the world_size segments of the ring is split in sub-chunks of chunk_size elements (see
+    `get_ring_chunk_size` for the default) and up to buffer_depth sub-chunks are in flight at a time: the next
+    sub-chunk is quantized while the previous ones are transferred. In the all gather phase, the received payloads
+    are forwarded as is, so each reduced segment is quantized once and all the ranks end up with the same values.
     """
     if quantization_func is not None:
         if transfer_dtype is not None:
@@ -72,121 +348,79 @@ def ring_allreduce_py(
         group = dist.distributed_c10d._get_default_group()
     if op not in [dist.ReduceOp.SUM, dist.ReduceOp.AVG]:
         raise ValueError(f"Unsupported reduce operation {op}. Only SUM and AVG are supported.")
+    if buffer_depth < 1:
+        raise ValueError(f"buffer_depth must be at least 1, got {buffer_depth}")
 
     world_size = group.size()
     rank = group.rank()
+    if world_size == 1:
+        return
 
-    # Divide the tensor into chunks
+    # Divide the tensor into segments and the segments into sub-chunks. The segments differ by at most one element,
+    # a sub-chunk is always sent and received as the same sub-chunk of the same segment so their sizes match.
     flat_tensor = tensor.as_strided((tensor.numel(),), (1,))
-    chunks = flat_tensor.chunk(world_size * BUFFER_COUNT)
-
-    assert flat_tensor.size(0) % (world_size * BUFFER_COUNT) == 0, "Tensor size must be divisible by world size"
-
-    # Temporary buffers for transferring data
-    num_buffers = BUFFER_COUNT * world_size
-    if quantization_func is not None:
-        recv_buffer = [torch.empty_like(chunks[0], dtype=torch.uint8) for _ in range(BUFFER_COUNT)]
-        send_buffer = [None for _ in range(BUFFER_COUNT)]
-        send_lookup_buffer = [None for _ in range(BUFFER_COUNT)]
-        recv_lookup_buffer = [torch.empty(256, dtype=chunks[0].dtype) for _ in range(BUFFER_COUNT)]
-        send_lookup_work = [None for _ in range(BUFFER_COUNT)]
-        recv_lookup_work = [None for _ in range(BUFFER_COUNT)]
-    else:
-        recv_buffer = [torch.empty_like(chunks[0], dtype=transfer_dtype) for _ in range(BUFFER_COUNT)]
-        send_buffer = [torch.empty_like(chunks[0], dtype=transfer_dtype) for _ in range(BUFFER_COUNT)]
-    send_work = [None] * BUFFER_COUNT
-    recv_work = [None] * BUFFER_COUNT
+    segments = flat_tensor.tensor_split(world_size)
+    if chunk_size is None:
+        chunk_size = get_ring_chunk_size(flat_tensor.numel(), world_size, buffer_depth)
+    num_sub_chunks = max(1, math.ceil(segments[0].numel() / chunk_size))
+    chunks = [segment.tensor_split(num_sub_chunks) for segment in segments]
+    # the send of a sub-chunk at step t + 1 needs its receive at step t, which is num_sub_chunks transfers earlier
+    depth = min(buffer_depth, num_sub_chunks)
+    num_transfers = (world_size - 1) * num_sub_chunks
 
     send_rank = (rank + 1) % world_size
     recv_rank = (rank - 1) % world_size
-    for step in range(1, world_size * BUFFER_COUNT + 1):
-        send_chunk = (rank * BUFFER_COUNT - step) % num_buffers
-
-        if send_work[step % BUFFER_COUNT] is not None:
-            send_work[step % BUFFER_COUNT].wait()
-            recv_work[step % BUFFER_COUNT].wait()
-            if quantization_func is not None:
-                send_lookup_work[step % BUFFER_COUNT].wait()
-                recv_lookup_work[step % BUFFER_COUNT].wait()
-                # print(recv_lookup_buffer[step % BUFFER_COUNT][recv_buffer[step % BUFFER_COUNT].long()])
-                chunks[send_chunk].add_(
-                    recv_lookup_buffer[step % BUFFER_COUNT][recv_buffer[step % BUFFER_COUNT].long()]
-                )
-            else:
-                chunks[send_chunk].add_(recv_buffer[step % BUFFER_COUNT])
-
-        if step <= (world_size - 1) * BUFFER_COUNT:
-            # Send and receive
-            if quantization_func is not None:
-                send_buffer[step % BUFFER_COUNT], send_lookup_buffer[step % BUFFER_COUNT] = quantization_func(
-                    chunks[send_chunk]
-                )
-                send_lookup_work[step % BUFFER_COUNT] = dist.isend(
-                    send_lookup_buffer[step % BUFFER_COUNT], dst=send_rank, group=group, tag=step + 1000
-                )
-                recv_lookup_work[step % BUFFER_COUNT] = dist.irecv(
-                    recv_lookup_buffer[step % BUFFER_COUNT], src=recv_rank, group=group, tag=step + 1000
-                )
-            else:
-                send_buffer[step % BUFFER_COUNT].copy_(chunks[send_chunk])
-            send_work[step % BUFFER_COUNT] = dist.isend(
-                send_buffer[step % BUFFER_COUNT], dst=send_rank, group=group, tag=step
-            )
-            recv_work[step % BUFFER_COUNT] = dist.irecv(
-                recv_buffer[step % BUFFER_COUNT], src=recv_rank, group=group, tag=step
-            )
+    in_flight: deque[tuple[list[dist.Work], Callable[[], None]]] = deque()
 
-    if op == dist.ReduceOp.AVG:
-        for i in range(BUFFER_COUNT):
-            chunks[i + rank * BUFFER_COUNT].divide_(world_size)
-    if quantization_func is not None:
-        for i in range(BUFFER_COUNT):
-            quant_weight, lookup = quantization_func(chunks[i + rank * BUFFER_COUNT])
-            chunks[i + rank * BUFFER_COUNT].copy_(lookup[quant_weight.long()])
+    def wait_oldest():
+        works, on_received = in_flight.popleft()
+        for work in works:
+            work.wait()
+        on_received()
 
-    if quantization_func is not None:
-        recv_buffer = [torch.empty_like(chunks[0], dtype=torch.uint8) for _ in range(BUFFER_COUNT)]
-        send_buffer = [None for _ in range(BUFFER_COUNT)]
-        send_lookup_buffer = [None for _ in range(BUFFER_COUNT)]
-        recv_lookup_buffer = [torch.empty(256, dtype=chunks[0].dtype) for _ in range(BUFFER_COUNT)]
-        send_lookup_work = [None for _ in range(BUFFER_COUNT)]
-        recv_lookup_work = [None for _ in range(BUFFER_COUNT)]
-    send_work = [None] * BUFFER_COUNT
-    recv_work = [None] * BUFFER_COUNT
-
-    for step in range(1, world_size * BUFFER_COUNT + 1):
-        send_chunk = (rank * BUFFER_COUNT + BUFFER_COUNT - step) % num_buffers
-
-        if send_work[step % BUFFER_COUNT] is not None:
-            send_work[step % BUFFER_COUNT].wait()
-            recv_work[step % BUFFER_COUNT].wait()
-            if quantization_func is not None:
-                send_lookup_work[step % BUFFER_COUNT].wait()
-                recv_lookup_work[step % BUFFER_COUNT].wait()
-                chunks[send_chunk].copy_(
-                    recv_lookup_buffer[step % BUFFER_COUNT][recv_buffer[step % BUFFER_COUNT].long()]
-                )
-            else:
-                chunks[send_chunk].copy_(recv_buffer[step % BUFFER_COUNT])
-
-        if step <= (world_size - 1) * BUFFER_COUNT:
-            # Send and receive
-            if quantization_func is not None:
-                send_buffer[step % BUFFER_COUNT], send_lookup_buffer[step % BUFFER_COUNT] = quantization_func(
-                    chunks[send_chunk]
-                )
-                send_lookup_work[step % BUFFER_COUNT] = dist.isend(
-                    send_lookup_buffer[step % BUFFER_COUNT], dst=send_rank, group=group, tag=step + 1000
-                )
-                recv_lookup_work[step % BUFFER_COUNT] = dist.irecv(
-                    recv_lookup_buffer[step % BUFFER_COUNT], src=recv_rank, group=group, tag=step + 1000
-                )
-            else:
-                send_buffer[step % BUFFER_COUNT].copy_(chunks[send_chunk])
-
-            send_work[step % BUFFER_COUNT] = dist.isend(
-                send_buffer[step % BUFFER_COUNT], dst=send_rank, group=group, tag=step
-            )
-            recv_work[step % BUFFER_COUNT] = dist.irecv(
-                recv_buffer[step % BUFFER_COUNT], src=recv_rank, group=group, tag=step
-            )
+    def on_reduced(chunk: torch.Tensor, payload: tuple[torch.Tensor, ...]):
+        chunk.add_(_decode_chunk(payload))
+
+    # Reduce scatter: at step t, send segment rank - t and accumulate the received segment rank - t - 1
+    for i in range(num_transfers):
+        step, sub = divmod(i, num_sub_chunks)
+        send_chunk = chunks[(rank - step) % world_size][sub]
+        recv_chunk = chunks[(rank - step - 1) % world_size][sub]
+        if len(in_flight) == depth:
+            wait_oldest()
+
+        send_payload = _encode_chunk(send_chunk, transfer_dtype, quantization_func)
+        recv_payload = _empty_payload(recv_chunk, transfer_dtype, quantization_func)
+        works = _send_recv(send_payload, recv_payload, send_rank, recv_rank, group, tag=2 * i)
+        in_flight.append((works, partial(on_reduced, recv_chunk, recv_payload)))
+    while in_flight:
+        wait_oldest()
+
+    # This rank now holds the reduced segment rank + 1, it is encoded once and forwarded around the ring
+    own_chunks = chunks[(rank + 1) % world_size]
+    forward_payloads = []
+    for chunk in own_chunks:
+        if op == dist.ReduceOp.AVG:
+            chunk.div_(world_size)
+        payload = _encode_chunk(chunk, transfer_dtype, quantization_func)
+        chunk.copy_(_decode_chunk(payload))
+        forward_payloads.append(payload)
+
+    def on_gathered(chunk: torch.Tensor, sub: int, payload: tuple[torch.Tensor, ...]):
+        chunk.copy_(_decode_chunk(payload))
+        forward_payloads[sub] = payload
+
+    # All gather: at step t, forward segment rank + 1 - t and receive segment rank - t
+    for i in range(num_transfers):
+        step, sub = divmod(i, num_sub_chunks)
+        recv_chunk = chunks[(rank - step) % world_size][sub]
+        if len(in_flight) == depth:
+            wait_oldest()
+
+        recv_payload = _empty_payload(recv_chunk, transfer_dtype, quantization_func)
+        works = _send_recv(
+            forward_payloads[sub], recv_payload, send_rank, recv_rank, group, tag=2 * (num_transfers + i)
+        )
+        in_flight.append((works, partial(on_gathered, recv_chunk, sub, recv_payload)))
+    while in_flight:
+        wait_oldest()
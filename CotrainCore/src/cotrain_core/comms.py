@@ -1,5 +1,6 @@
 import sys
 import os
+import json
 import time
 import subprocess
 from torch.distributed.device_mesh import init_device_mesh
@@ -10,9 +11,16 @@ from datetime import timedelta
 from typing import List, Tuple, Optional
 from torch.testing._internal.distributed.fake_pg import FakeProcessGroup
 import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor
 from uuid import uuid4
 import toposolve
 from zeroband.utils.ip import parse_iperf_output
+from zeroband.collectives import (
+    HierarchicalGroups,
+    create_hierarchical_groups,
+    group_ranks_by_bandwidth,
+    group_ranks_by_label,
+)
 
 TCPSTORE_TIMEOUT = timedelta(seconds=int(os.getenv("ZERO_BAND_GLOBAL_STORE_TIMEOUT_SECONDS", "300")))
 TCPSTORE_POLLING_INTERVAL = float(os.getenv("ZERO_BAND_GLOBAL_STORE_POLLING_INTERVAL_SECONDS", "0.1"))
@@ -27,6 +35,7 @@ HEARTBEAT_TIMEOUT = int(
 IPERF_PORT = int(os.getenv("ZERO_BAND_IPERF_PORT", "10101"))
 IPERF_IFNAME = os.getenv("GLOO_SOCKET_IFNAME", "eth0")
 BENCH_TENSOR_SIZE = 1_000_000
+UNKNOWN_PING = 1_000_000_000  # ping value of the pairs that were not measured or could not be reached
 
 
 class ElasticDeviceMesh:
@@ -42,17 +51,36 @@ class ElasticDeviceMesh:
     - mesh_count: The version of the mesh
     - rank_{uuid}: The rank of the node with the given uuid
     - joiner_{i}: The uuid of the ith joiner. Its a KV implmentation of a queue.
+    - resolve_count, resolved_{n}: The number of world resolutions and the key set when the nth one is done.
+    - barrier_{mesh_count}_{generation}_*: The keys of the monitored barriers, see StoreBarrier.
+    - group_{uuid}: The hierarchical group label of the node, hierarchical_groups_{mesh_count}: The groups as json.
+    - ping_{uuid_i}_{uuid_j}: The time to send 10Tb from i to j measured by iperf, used to find the best ring.
+    - ping_time_{uuid_i}_{uuid_j}: When i measured it. Only the pairs older than bandwidth_cache_ttl are measured again.
     """
 
     local_pg: dist.ProcessGroup
     global_pg: dist.ProcessGroup
 
     def __init__(
-        self, backend: str = "cpu:gloo,cuda:nccl", enable: bool = True, live_recovery_rank_src: int | None = None
+        self,
+        backend: str = "cpu:gloo,cuda:nccl",
+        enable: bool = True,
+        live_recovery_rank_src: int | None = None,
+        bandwidth_probe_concurrency: int = 1,
+        bandwidth_cache_ttl: float = 600,
+        hierarchical: bool = False,
+        hierarchical_group: str | None = None,
+        hierarchical_min_bandwidth: float = 10.0,
     ):
         self._logger = get_logger()
         self.world_info = get_world_info()
         self.live_recovery_rank_src = live_recovery_rank_src
+        self.bandwidth_probe_concurrency = bandwidth_probe_concurrency
+        self.bandwidth_cache_ttl = bandwidth_cache_ttl
+        self.hierarchical = hierarchical
+        self.hierarchical_group = hierarchical_group
+        self.hierarchical_min_bandwidth = hierarchical_min_bandwidth
+        self.hierarchical_groups: HierarchicalGroups | None = None
 
         # Initialize global process group
         self.global_pg = FakeProcessGroup(self.world_info.rank, 1)
@@ -110,18 +138,18 @@ class ElasticDeviceMesh:
         self._logger.debug("Initializing global store values")
         self.global_store.set(f"gid_{self.world_info.global_rank}", self.world_info.global_unique_id)
         self.global_store.set(f"rank_{self.world_info.global_unique_id}", str(self.world_info.global_rank))
+        if self.hierarchical:
+            # nodes without label are grouped by bandwidth if the leader has no label, alone otherwise
+            label = self.hierarchical_group if self.hierarchical_group is not None else self.world_info.global_unique_id
+            self.global_store.set(f"group_{self.world_info.global_unique_id}", label)
         if self._global_leader:
             self.global_store.set("mesh_count", "0")
             self.global_store.set("world_size", str(self.world_info.global_world_size))
             self.global_store.set("joiner_0", "null")
-            for i in range(self.world_info.global_world_size):
-                self.global_store.set(f"barrier_{i}", "null")
             self._global_ids = [
                 self.global_store.get(f"gid_{i}").decode("utf-8") for i in range(self.world_info.global_world_size)
             ]
-            for i in self._global_ids:
-                for j in self._global_ids:
-                    self.global_store.set(f"ping_{i}_{j}", "1000_000_000")
+            self._init_pings()
             self.global_store.set("status", "init")
             self.global_status = "init"
         else:
@@ -161,6 +189,12 @@ class ElasticDeviceMesh:
         self.global_pg = dist.ProcessGroupGloo(
             prefix_store, self.world_info.global_rank, self.world_info.global_world_size, GLOBAL_PG_TIMEOUT
         )
+        self._barrier = StoreBarrier(
+            self.global_store,
+            self.world_info.global_rank,
+            self.world_info.global_world_size,
+            prefix=f"barrier_{self.mesh_count}",
+        )
         self._logger.debug("Global pg created with %d peers. Timeout of %s", self.global_pg.size(), GLOBAL_PG_TIMEOUT)
 
     def _optimize_ring_ranks(self):
@@ -196,6 +230,29 @@ class ElasticDeviceMesh:
             self.global_store.get(f"gid_{i}").decode("utf-8") for i in range(self.world_info.global_world_size)
         ]
         self._create_global_pg()
+        if self.hierarchical:
+            self._create_hierarchical_groups()
+
+    def _create_hierarchical_groups(self):
+        """Group the ranks by label or by bandwidth for the hierarchical all reduce, the leader decides the groups."""
+        key = f"hierarchical_groups_{self.mesh_count}"
+        if self._global_leader:
+            if self.hierarchical_group is not None:
+                labels = [self.global_store.get(f"group_{gid}").decode("utf-8") for gid in self._global_ids]
+                groups = group_ranks_by_label(labels)
+            else:
+                # pings are the time to send 10Tb, 1e13 bits at hierarchical_min_bandwidth Gbit/s
+                groups = group_ranks_by_bandwidth(self.get_pings(), int(1e4 / self.hierarchical_min_bandwidth))
+            self.global_store.set(key, json.dumps(groups))
+        groups = json.loads(self.global_store.get(key).decode("utf-8"))
+        self._logger.info("Hierarchical all reduce groups: %s", groups)
+        self.hierarchical_groups = create_hierarchical_groups(
+            self.global_store,
+            self.world_info.global_rank,
+            groups,
+            prefix=f"mesh_{self.mesh_count}_hierarchical",
+            timeout=GLOBAL_PG_TIMEOUT,
+        )
 
     def _queue_join(self):
         """Queue a node to join the mesh."""
@@ -264,9 +321,9 @@ class ElasticDeviceMesh:
         # Update global store values
         if self._global_leader:
             self.global_store.set("status", "running")
-            self.global_store.set("resolved_time", uuid4().hex)
+            self.global_store.set("resolve_count", "0")
         self.global_status = "running"
-        self._last_resolved_time = self.global_store.get("resolved_time").decode("utf-8")
+        self._resolve_count = int(self.global_store.get("resolve_count").decode("utf-8"))
 
         self._start_heartbeat()
 
@@ -357,6 +414,7 @@ class ElasticDeviceMesh:
             self._evicted_nodes,
         )
         dead_nodes.extend(self._evicted_nodes)
+        self._evicted_nodes = []
 
         # If no joiners or dead nodes, no resolution needed
         if len(joiners) == 0 and len(dead_nodes) == 0:
@@ -378,11 +436,7 @@ class ElasticDeviceMesh:
             new_world_size += 1
 
         self._global_ids = live_ranks
-        for i in self._global_ids:
-            for j in self._global_ids:
-                self.global_store.set(f"ping_{i}_{j}", "1000_000_000")
-        for i in range(1, new_world_size):
-            self.global_store.set(f"barrier_{i}", "null")
+        self._init_pings()
         # Update world_size
         self.global_store.set("world_size", str(new_world_size))
         self.global_store.set("mesh_count", str(self.mesh_count + 1))
@@ -404,14 +458,15 @@ class ElasticDeviceMesh:
 
         time_start = time.perf_counter()
         self._logger.debug("[%s] Resolving world", self.world_info.global_unique_id)
+        self._resolve_count += 1
         if self._global_leader:
+            # published before the status changes so that joiners wait for the next resolution
+            self.global_store.set("resolve_count", str(self._resolve_count))
             self._resolve_world(admit_joiners=admit_joiners)
-            self.global_store.set("resolved_time", uuid4().hex)
+            self.global_store.set(f"resolved_{self._resolve_count}", uuid4().hex)
         else:
-            while (ans := self.global_store.get("resolved_time").decode("utf-8")) == self._last_resolved_time:
-                # TODO: Have a timeout here in case the leader is dead
-                time.sleep(TCPSTORE_POLLING_INTERVAL)
-            self._last_resolved_time = ans
+            # TODO: Have a timeout here in case the leader is dead
+            wait_for_keys(self.global_store, [f"resolved_{self._resolve_count}"])
 
         self._logger.debug("World resolved in %s seconds", time.perf_counter() - time_start)
 
@@ -453,37 +508,42 @@ class ElasticDeviceMesh:
         flag = str(flag)
         time_start = time.perf_counter()
         self._logger.debug("[%s] Monitored Barrier %s", self.world_info.global_unique_id, flag)
+        generation = self._barrier.arrive(flag)
         if self._global_leader:
             self._logger.debug("Others have %d seconds to resolve", GLOBAL_PG_TIMEOUT.total_seconds())
-            while not all(
-                self.global_store.get(f"barrier_{i}").decode("utf-8") == flag
-                for i in range(1, self.world_info.global_world_size)
-            ):
-                if time.perf_counter() - time_start > GLOBAL_PG_TIMEOUT.total_seconds():
-                    self._logger.error("Monitored barrier failed due to timeout")
-                    self._evicted_nodes = [
-                        i
-                        for i in range(1, self.world_info.global_world_size)
-                        if self.global_store.get(f"barrier_{i}").decode("utf-8") != flag
-                    ]
-                    self._logger.info("Evicting nodes: %s", self._evicted_nodes)
-                    self.global_store.set(f"barrier_{self.world_info.global_rank}", "error")
-                    # We neeed to evict the dead node
-                    raise RuntimeError("Monitored barrier failed due to timeout")
-                time.sleep(TCPSTORE_POLLING_INTERVAL)
-            self.global_store.set(f"barrier_{self.world_info.global_rank}", flag)
+            try:
+                result = self._barrier.wait(generation, GLOBAL_PG_TIMEOUT)
+            except dist.DistStoreError:
+                # the last rank can arrive while we give up, whoever sets the result first wins
+                result = self._barrier.abort(generation)
+            if result == "error":
+                self._logger.error("Monitored barrier failed due to timeout")
+                # We neeed to evict the dead node
+                self._evicted_nodes = [self._global_ids[i] for i in self._barrier.missing_ranks(generation)]
+                self._logger.info("Evicting nodes: %s", self._evicted_nodes)
+                raise RuntimeError("Monitored barrier failed due to timeout")
+            if generation > 0:
+                # every rank is done with the previous generation since they all arrived to this one
+                self._barrier.clear(generation - 1)
         else:
-            self.global_store.set(f"barrier_{self.world_info.global_rank}", flag)
-            while (ans := self.global_store.get("barrier_0").decode("utf-8")) != flag:
-                if ans == "error":
-                    raise RuntimeError("Monitored barrier failed due to error")
-                # TODO: Have a timeout here in case the leader is dead
-                time.sleep(TCPSTORE_POLLING_INTERVAL)
+            # TODO: Have a timeout here in case the leader is dead
+            result = self._barrier.wait(generation)
+            if result == "error":
+                raise RuntimeError("Monitored barrier failed due to error")
 
+        if result != flag:
+            raise RuntimeError(f"Monitored barrier flag mismatch: got {result}, expected {flag}")
         self._logger.debug("Monitored barrier resolved in %s seconds", time.perf_counter() - time_start)
 
+    def _init_pings(self):
+        """Set the unknown ping of the new pairs, the pairs already measured keep their cached value."""
+        for i in self._global_ids:
+            for j in self._global_ids:
+                if not self.global_store.check([f"ping_{i}_{j}"]):
+                    self.global_store.set(f"ping_{i}_{j}", str(UNKNOWN_PING))
+
     def get_pings(self) -> List[List[int]]:
-        pings = [[1000_000_000] * self.world_info.global_world_size for _ in range(self.world_info.global_world_size)]
+        pings = [[UNKNOWN_PING] * self.world_info.global_world_size for _ in range(self.world_info.global_world_size)]
         for i, e1 in enumerate(self._global_ids):
             for j, e2 in enumerate(self._global_ids):
                 if i == j:
@@ -508,14 +568,35 @@ class ElasticDeviceMesh:
             self._logger.error(f"Failed to start iperf server: {str(e)}")
             raise
 
-    def _measure_connectivity(self):
+    def _get_stale_peers(self) -> List[str]:
+        """Peers that were never measured or whose measurement is older than bandwidth_cache_ttl."""
+        now = time.time()
+        stale_peers = []
         for i in self._global_ids:
             if i == self.world_info.global_unique_id:
                 continue
-            target_host, target_port = self.god_store.get(f"iperf_{i}").decode("utf-8").split(":")
-            target_port = int(target_port)
-            time_taken = self.measure_bandwidth(target_host, target_port)
+            key = f"ping_time_{self.world_info.global_unique_id}_{i}"
+            if not self.god_store.check([key]) or now - float(self.god_store.get(key)) > self.bandwidth_cache_ttl:
+                stale_peers.append(i)
+        return stale_peers
+
+    def _measure_connectivity(self):
+        peers = self._get_stale_peers()
+        num_cached = len(self._global_ids) - 1 - len(peers)
+        self._logger.debug("Measuring bandwidth to %d peers, %d cached", len(peers), num_cached)
+        if len(peers) == 0:
+            return
+
+        # the store is only used from this thread, the probes only run iperf. By default the peers are probed one
+        # after the other: concurrent probes through the same NIC would each measure a share of its bandwidth
+        targets = [self.god_store.get(f"iperf_{i}").decode("utf-8").split(":") for i in peers]
+        with ThreadPoolExecutor(max_workers=self.bandwidth_probe_concurrency) as executor:
+            times_taken = list(executor.map(lambda target: self.measure_bandwidth(target[0], int(target[1])), targets))
+
+        for i, time_taken in zip(peers, times_taken):
             self.god_store.set(f"ping_{self.world_info.global_unique_id}_{i}", str(time_taken))
+            if time_taken < UNKNOWN_PING:  # failed probes are not cached so that they are retried on the next reinit
+                self.god_store.set(f"ping_time_{self.world_info.global_unique_id}_{i}", str(time.time()))
 
     def measure_bandwidth(self, target_host: str, target_port: int) -> int:
         """
@@ -544,12 +625,81 @@ class ElasticDeviceMesh:
                 raise Exception(f"iperf error: {result.stderr}")
 
             time_taken: int = int(1e13 / parse_iperf_output(result.stdout))
-            time_taken = min(time_taken, 1_000_000_000)
+            time_taken = min(time_taken, UNKNOWN_PING)
 
             return time_taken
         except Exception as e:
             self._logger.error(f"Error measuring bandwidth to {target_host}:{target_port} {str(e)}")
-            return int(1e9)
+            return UNKNOWN_PING
+
+
+def wait_for_keys(store: dist.Store, keys: List[str], timeout: Optional[timedelta] = None):
+    """Block until the keys are set. The store notifies the waiters, there is no polling.
+
+    Without timeout, wait forever. Otherwise raise DistStoreError once the timeout is reached.
+    """
+    if timeout is not None:
+        store.wait(keys, timeout)
+        return
+    while True:
+        try:
+            store.wait(keys, TCPSTORE_TIMEOUT)
+            return
+        except dist.DistStoreError:
+            continue
+
+
+class StoreBarrier:
+    """A barrier on top of a store that blocks on the store instead of polling it.
+
+    Each call is a new generation with its own keys:
+    - {prefix}_{generation}_arrived_{rank}: The flag of each rank that arrived, to know who is missing on timeout
+    - {prefix}_{generation}_count: The number of ranks that arrived, incremented with `add`
+    - {prefix}_{generation}_done: The result, set with `compare_set` by the last rank to arrive or "error" on abort
+
+    The ranks waiting on the done key are woken up by the store as soon as it is set, so the latency is a few round
+    trips to the store whatever the world size.
+    """
+
+    def __init__(self, store: dist.Store, rank: int, world_size: int, prefix: str = "barrier"):
+        self.store = store
+        self.rank = rank
+        self.world_size = world_size
+        self.prefix = prefix
+        self.generation = 0
+
+    def _key(self, generation: int, name: str) -> str:
+        return f"{self.prefix}_{generation}_{name}"
+
+    def _set_result(self, generation: int, result: str) -> str:
+        """Set the result of a generation if it is not set yet and return the result"""
+        return self.store.compare_set(self._key(generation, "done"), "", result).decode("utf-8")
+
+    def arrive(self, flag: str) -> int:
+        """Register the arrival of this rank and return the generation to wait on"""
+        generation = self.generation
+        self.generation += 1
+        self.store.set(self._key(generation, f"arrived_{self.rank}"), flag)
+        if self.store.add(self._key(generation, "count"), 1) == self.world_size:
+            self._set_result(generation, flag)
+        return generation
+
+    def wait(self, generation: int, timeout: Optional[timedelta] = None) -> str:
+        """Wait for all the ranks to arrive and return the result, the flag of the last rank or "error" """
+        key = self._key(generation, "done")
+        wait_for_keys(self.store, [key], timeout)
+        return self.store.get(key).decode("utf-8")
+
+    def abort(self, generation: int) -> str:
+        """Set the result to "error", unless all ranks already arrived. Return the result"""
+        return self._set_result(generation, "error")
+
+    def missing_ranks(self, generation: int) -> List[int]:
+        return [i for i in range(self.world_size) if not self.store.check([self._key(generation, f"arrived_{i}")])]
+
+    def clear(self, generation: int):
+        for name in ["count", "done", *[f"arrived_{i}" for i in range(self.world_size)]]:
+            self.store.delete_key(self._key(generation, name))
 
 
 def format_grid(grid):
@@ -63,6 +63,30 @@ def uniform_8bit_quantize(tensor: torch.Tensor, inplace: bool = True) -> Tuple[t
     return quantized, lookup
 
 
+def quantile_4bit_quantize(tensor: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Quantize to 16 quantile buckets. Return the codes packed two per byte and the average value of each bucket"""
+    flat = tensor.flatten()
+    borders = torch.as_tensor(quantile_qq_approximation(flat.numpy(), 16 + 1)[1:-1]).to(flat.dtype)
+    quantized = torch.clamp_(torch.bucketize(flat, borders), 0, 15).to(torch.uint8)
+    lookup = average_buckets(flat, quantized, 16)
+    if quantized.numel() % 2 == 1:
+        quantized = torch.cat([quantized, quantized.new_zeros(1)])
+    packed = quantized[0::2] | (quantized[1::2] << 4)
+    return packed, lookup
+
+
+def quantile_4bit_dequantize(packed: torch.Tensor, lookup: torch.Tensor, numel: int) -> torch.Tensor:
+    quantized = torch.stack([packed & 15, packed >> 4], dim=1).flatten()[:numel]
+    return lookup[quantized.long()]
+
+
+def topk_sparsify(tensor: torch.Tensor, k: int) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Keep the k values with the largest magnitude. Return the values and their flat indices"""
+    flat = tensor.flatten()
+    _, indices = torch.topk(flat.abs(), k, sorted=False)
+    return flat[indices], indices.to(torch.int32)
+
+
 def quantile_8bit_quantize(tensor: torch.Tensor, inplace: bool = True) -> Tuple[torch.Tensor, torch.Tensor]:
     borders = torch.as_tensor(quantile_qq_approximation(tensor.numpy(), n_bins + 1)[1:-1])
     quantized = torch.clamp_(torch.bucketize(tensor, borders), 0, n_bins - 1)
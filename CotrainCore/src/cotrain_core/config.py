@@ -2,6 +2,11 @@ from enum import Enum
 from typing import Any, Literal, TypeAlias
 import os
 
+try:
+    import tomllib
+except ModuleNotFoundError:  # python<3.11
+    import tomli as tomllib
+
 from pydantic import create_model, model_validator
 from pydantic_config import BaseConfig
 
@@ -10,6 +15,8 @@ AttnFnType: TypeAlias = Literal["flex", "math"]
 class Compression(Enum):
     NO = "no"
     UINT8 = "uint8"
+    QUANTILE4 = "quantile4"  # 4 bit quantile quantization with error feedback
+    TOPK = "topk"  # top-k sparsification with error feedback
 
 
 class DataConfig(BaseConfig):
@@ -27,6 +34,16 @@ class DataConfig(BaseConfig):
     reverse_data_files: bool = False
     split_by_data_rank: bool = True
 
+    # read parquet files one row group at a time instead of loading whole files
+    parquet_streaming: bool = False
+    tokenize_workers: int = 0  # 0 means tokenizing in the dataset process
+    tokenize_queue_size: int = 16  # max number of tokenized chunks in flight
+
+    # dataset_name_or_paths point to folders of token shards created with scripts/tokenize_data.py
+    pretokenized: bool = False
+
+    token_counts_cache_dir: str | None = None  # where to cache the token counts of the parquet files used to seek
+
 
 class AdamConfig(BaseConfig):
     type: Literal["adam"] = (
@@ -69,10 +86,58 @@ class OptimConfig(BaseConfig):
 class DilocoConfig(BaseConfig):
     outer_lr: float = 0.7
     inner_steps: int
+    # quantile4 and topk all gather the compressed payloads: past 4 ranks (quantile4) or 1 / (4 * topk_ratio) ranks
+    # (topk), each rank receives more than with the uint8 ring (see collectives.all_gather_max_world_size)
     compression: Compression = Compression.NO
+    topk_ratio: float = 0.01  # fraction of the values sent by the topk compression
 
     retry_all_reduce: int = 3
 
+    compression_threads: int | None = None  # size of the compression thread pool, None means one per cpu core
+
+    # number of peers whose bandwidth is measured at the same time. The concurrent probes share the NIC of this node
+    # and each one measures a fraction of its bandwidth, only raise it when the bottleneck is the links to the peers
+    bandwidth_probe_concurrency: int = 1
+    bandwidth_cache_ttl: float = 600  # seconds before a measured bandwidth is measured again on reinit
+
+    # hierarchical all reduce: reduce inside groups of well connected nodes, all reduce between the group leaders
+    hierarchical: bool = False
+    hierarchical_group: str | None = None  # label of this node (e.g. its datacenter), None to group by bandwidth
+    hierarchical_min_bandwidth: float = 10.0  # Gbit/s, nodes linked faster than this are grouped together
+
+    # pipelined python ring all reduce (no and uint8 compression), instead of gloo or the c++ uint8 ring
+    ring_buffer_depth: int | None = None  # number of sub-chunks in flight, None to not use the pipelined ring
+    ring_chunk_size: int | None = None  # elements per sub-chunk, None to size them from the tensor
+
+    # streaming diloco: the outer all reduce overlaps with the first `delay_steps` inner steps of the next outer step
+    delay_steps: int = 0  # 0 means the all reduce is blocking
+    num_fragments: int = 1  # number of layer fragments reduced and applied one after the other
+
+    @model_validator(mode="after")
+    def validate_streaming(self):
+        if self.delay_steps < 0 or self.delay_steps >= self.inner_steps:
+            raise ValueError("delay_steps must be in [0, inner_steps)")
+        if self.num_fragments < 1:
+            raise ValueError("num_fragments must be at least 1")
+        if self.compression_threads is not None and self.compression_threads < 1:
+            raise ValueError("compression_threads must be at least 1")
+        if self.bandwidth_probe_concurrency < 1:
+            raise ValueError("bandwidth_probe_concurrency must be at least 1")
+        if self.hierarchical_min_bandwidth <= 0:
+            raise ValueError("hierarchical_min_bandwidth must be positive")
+        if not 0 < self.topk_ratio <= 1:
+            raise ValueError("topk_ratio must be in (0, 1]")
+        if self.hierarchical and self.compression in [Compression.QUANTILE4, Compression.TOPK]:
+            raise ValueError(f"hierarchical all reduce does not support {self.compression.value} compression")
+        if self.ring_buffer_depth is not None:
+            if self.ring_buffer_depth < 1:
+                raise ValueError("ring_buffer_depth must be at least 1")
+            if self.hierarchical or self.compression not in [Compression.NO, Compression.UINT8]:
+                raise ValueError("ring_buffer_depth needs no or uint8 compression and no hierarchical all reduce")
+        if self.ring_chunk_size is not None and self.ring_chunk_size < 1:
+            raise ValueError("ring_chunk_size must be at least 1")
+        return self
+
 
 class MemoryProfilerConfig(BaseConfig):
     freq: int = 10
@@ -128,17 +193,47 @@ class CkptConfig(BaseConfig):
     skip_dataloader: bool = False
 
     live_recovery_rank_src: int | None = None
+    # send the live recovery ckpt in large flat chunks instead of one message per tensor, must match on all peers
+    live_recovery_bulk: bool = False
 
     data_path: str | None = None
 
     token_count: int | None = None
 
+    # snapshot the states to pinned cpu memory and write them to disk in the background
+    async_save: bool = False
+
+    # remote pushes: files are uploaded in parallel, each one streamed by a single worker in parts of
+    # `upload_chunk_size` (the part size of the multipart upload, at least 5 MiB on S3), with a checksum manifest to
+    # skip the unchanged files. Parallelism, retries and resume are per file, not per part: split the checkpoint in
+    # several files (e.g. one per rank) to use the workers
+    upload_workers: int = 8
+    upload_chunk_size: int = 64 * 2**20  # bytes
+    upload_retries: int = 3
+
+    # write a full checkpoint every `delta_interval` saves and, in between, only the compressed difference with it.
+    # The last full checkpoint is kept in host memory to encode the deltas: as much cpu memory as the local model
+    # and optimizer shards.
+    delta_interval: int | None = None
+    delta_compression_threads: int | None = None  # None for one thread per cpu
+
     @model_validator(mode="after")
     def validate_path_and_interval(self):
         if (self.path is None) != (self.interval is None):
             raise ValueError("path and interval must be both set or both None")
         if self.path is None and self.remote is not None:
             raise ValueError("remote_path is set but path is not set")
+        if self.path is None and self.async_save:
+            raise ValueError("async_save is set but path is not set")
+        if self.upload_workers < 1 or self.upload_chunk_size < 1 or self.upload_retries < 0:
+            raise ValueError("upload_workers and upload_chunk_size must be at least 1, upload_retries at least 0")
+        if self.delta_interval is not None:
+            if self.delta_interval < 1:
+                raise ValueError("delta_interval must be at least 1")
+            if self.async_save:
+                raise ValueError("delta_interval and async_save are mutually exclusive")
+        if self.delta_compression_threads is not None and self.delta_compression_threads < 1:
+            raise ValueError("delta_compression_threads must be at least 1")
 
         return self
 
@@ -165,10 +260,16 @@ class Config(BaseConfig):
     run_name: str | None = None
 
     # Logger
-    metric_logger_type: Literal["wandb", "dummy"] = "wandb"
+    metric_logger_type: Literal["wandb", "dummy", "stream"] = "wandb"
     wandb_resume: bool = False
     log_level: Literal["NOTSET", "DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"] = "INFO"
     log_all_rank: bool = False
+    metrics_max_lag: int = 16  # steps the logged metrics can lag behind the training to avoid a device sync per step
+    metric_logger_queue_size: int = 1000  # records buffered for the background metric logger thread
+    metric_stream_address: str | None = None  # unix socket the "stream" metric logger sends the metrics to
+
+    # checkpoint and exit at the end of the outer step once this file exists (set by the TrainingManager)
+    stop_file: str | None = None
 
     # sub config
     diloco: DilocoConfig | None = None
@@ -193,6 +294,22 @@ class Config(BaseConfig):
             raise ValueError("live_recovery_rank_src is only supported with diloco")
         return self
 
+    @model_validator(mode="after")
+    def validate_metric_logging(self):
+        if self.metrics_max_lag < 0:
+            raise ValueError("metrics_max_lag must be non negative")
+        if self.metric_logger_queue_size < 1:
+            raise ValueError("metric_logger_queue_size must be positive")
+        if self.metric_logger_type == "stream" and self.metric_stream_address is None:
+            raise ValueError("the stream metric logger needs metric_stream_address")
+        return self
+
+
+def load_config(config_path: str) -> dict[str, Any]:
+    """Read a toml config file as a dict, the way `@config.toml` is passed to the train entry point"""
+    with open(config_path, "rb") as f:
+        return tomllib.load(f)
+
 
 def resolve_env_vars(config: Config) -> None:
     """
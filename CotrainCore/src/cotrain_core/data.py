@@ -1,14 +1,20 @@
 from dataclasses import dataclass, asdict
-import random
 from typing import Any, Generator, Optional, List, Dict, TypedDict, Union
 import functools
+import glob
+import hashlib
+import multiprocessing
+import os
 import threading
+from collections import deque
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
 
 from zeroband.models.llama.model import create_block_mask_from_seqlens
 from zeroband.utils.logger import get_logger
 from zeroband.utils.world_info import get_world_info
 from zeroband.config import DataConfig
 
+import numpy as np
 import torch
 from torch.utils.data import IterableDataset, Dataset
 from torchdata.stateful_dataloader import StatefulDataLoader
@@ -23,29 +29,50 @@ TEST_VOCAB_SIZE = 1024
 
 
 class FakeTokenizedDataset(IterableDataset):
-    """This is a dummy dataset that generates random sequences of length seq_len and vocab_size"""
+    """This is a dummy dataset that generates random sequences of length seq_len and vocab_size
 
-    def __init__(self, seq_len: int, vocab_size: int):
+    Each sample is drawn from a counter based generator keyed by the seed and the sample index, so the state is just the
+    index of the next sample and restoring it does not replay the previous samples.
+    """
+
+    def __init__(self, seq_len: int, vocab_size: int, seed: int = 42):
         self.seq_len = seq_len
         self.vocab_size = vocab_size
         assert vocab_size > 3, "Vocab size must be greater than 3"
+        self.seed = seed
         self.step = 0
 
+    def _get_sample(self, index: int, worker_id: int) -> list[int]:
+        # the worker id is part of the key so that each dataloader worker yields its own stream. The index is in the
+        # second word of the counter: Philox increments the first word for each block of 4 values, an index there
+        # would make each sample the stream of the previous one shifted by one block
+        generator = np.random.Generator(np.random.Philox(key=[self.seed, worker_id], counter=[0, index, 0, 0]))
+        len_ = int(generator.integers(1, self.seq_len + 1))
+        return generator.integers(3, self.vocab_size, (len_,)).tolist()
+
     def __iter__(self) -> Generator[dict[str, Any], Any, None]:
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id = worker_info.id if worker_info is not None else 0
         while True:
-            len_ = random.randint(1, self.seq_len)
-            input_ids = torch.randint(3, self.vocab_size, (len_,)).tolist()
+            input_ids = self._get_sample(self.step, worker_id)
             self.step += 1
             yield {"input_ids": input_ids}
 
+    def sample_lengths(self) -> Generator[int, Any, None]:
+        """Yield the length of the next samples without moving the dataset"""
+        index = self.step
+        while True:
+            yield len(self._get_sample(index, worker_id=0))
+            index += 1
+
+    def seek(self, num_samples: int):
+        self.step += num_samples
+
     def state_dict(self):
         return {"step": self.step}
 
     def load_state_dict(self, state_dict):
         self.step = state_dict["step"]
-        itera = iter(self)
-        for _ in range(self.step):
-            next(itera)
 
 
 class BatchOutput(TypedDict):
@@ -105,6 +132,36 @@ class SequencePackingDataSet(IterableDataset, Stateful):
 
                 yield data
 
+    def seek(self, num_samples: int):
+        """
+        Skip the next num_samples packed samples without tokenizing them.
+
+        The packing is replayed on the lengths given by `sample_lengths` of the wrapped dataset which is then moved
+        forward with its own `seek`. The remaining tokens of the sample closing a sequence are dropped, so the packing
+        buffer is empty after the seek.
+        """
+        if num_samples == 0:
+            return
+
+        num_tokens = len(self.state.inputs_ids)
+        num_og_samples = 0
+        for length in self.dataset.sample_lengths():
+            num_og_samples += 1
+            if length < self.max_seq_length - num_tokens:
+                num_tokens += length
+            else:
+                num_tokens = 0
+                num_samples -= 1
+                if num_samples == 0:
+                    break
+
+        self.dataset.seek(num_og_samples)
+        self.state = SequencePackingDataSetState(inputs_ids=[], labels=[], seqlens=[])
+
+    def seek_tokens(self, num_tokens: int):
+        """Skip the packed samples holding the next num_tokens tokens"""
+        self.seek(num_tokens // self.max_seq_length)
+
     def state_dict(self):
         return {"dataset": self.dataset.state_dict(), "state": asdict(self.state)}
 
@@ -149,11 +206,14 @@ class ParquetDataset(IterableDataset, Stateful):
     * [ ] handle mutli proc dataloader pytorch
     """
 
-    def __init__(self, files: List[str], tokenizer: PreTrainedTokenizer):
+    def __init__(self, files: List[str], tokenizer: PreTrainedTokenizer, token_counts_cache_dir: str | None = None):
         self.arg_files = files
         self.tokenizer = tokenizer
+        self.token_counts_cache_dir = token_counts_cache_dir
 
         self.state = None
+        self._num_rows: dict[str, int] = {}
+        self._token_counts: dict[str, np.ndarray] = {}
 
     def _lazy_init(self):
         worker_info = torch.utils.data.get_worker_info()
@@ -200,6 +260,84 @@ class ParquetDataset(IterableDataset, Stateful):
 
                 yield {"input_ids": self.tokenizer.encode(str(row))}
 
+    def _get_num_rows(self, file: str) -> int:
+        if file not in self._num_rows:
+            # only the footer is read, the row count comes from the row group metadata
+            self._num_rows[file] = pq.ParquetFile(file).metadata.num_rows
+        return self._num_rows[file]
+
+    def _get_token_counts(self, file: str) -> np.ndarray:
+        """Number of tokens of each row of a file, tokenized once and cached in memory and in token_counts_cache_dir"""
+        if file in self._token_counts:
+            return self._token_counts[file]
+
+        cache_path = None
+        if self.token_counts_cache_dir is not None:
+            tokenizer_name = getattr(self.tokenizer, "name_or_path", type(self.tokenizer).__name__)
+            key = hashlib.sha256(f"{os.path.abspath(file)}:{tokenizer_name}".encode()).hexdigest()
+            cache_path = os.path.join(self.token_counts_cache_dir, f"{key}.npy")
+
+        if cache_path is not None and os.path.exists(cache_path):
+            token_counts = np.load(cache_path)
+        else:
+            parquet_file = pq.ParquetFile(file)
+            token_counts = np.empty(parquet_file.metadata.num_rows, dtype=np.int64)
+            offset = 0
+            for row_group_index in range(parquet_file.num_row_groups):
+                texts = parquet_file.read_row_group(row_group_index, columns=["text"])["text"].to_pylist()
+                token_counts[offset : offset + len(texts)] = [len(ids) for ids in _encode_texts(self.tokenizer, texts)]
+                offset += len(texts)
+
+            if cache_path is not None:
+                os.makedirs(self.token_counts_cache_dir, exist_ok=True)
+                tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+                with open(tmp_path, "wb") as f:
+                    np.save(f, token_counts)
+                os.replace(tmp_path, cache_path)  # atomic so that concurrent ranks never read a partial file
+
+        self._token_counts[file] = token_counts
+        return token_counts
+
+    def sample_lengths(self) -> Generator[int, Any, None]:
+        """Yield the number of tokens of the next samples without moving the dataset"""
+        if self.state is None:
+            self._lazy_init()
+
+        file_index, row_index = self.state.file_index, self.state.row_index
+        while True:
+            token_counts = self._get_token_counts(self.state.files[file_index])
+            yield from token_counts[row_index :: self.state.increment].tolist()
+            row_index = self.state.init_row_index
+            file_index = (file_index + 1) % len(self.state.files)
+
+    def seek(self, num_samples: int):
+        """Move the dataset forward by num_samples samples. Rows are counted from the parquet metadata, not read"""
+        if self.state is None:
+            self._lazy_init()
+
+        rows_per_epoch = None
+        while num_samples > 0:
+            if self.state.file_index == 0 and self.state.row_index == self.state.init_row_index:
+                # the dataset is infinite, skip the whole epochs at once
+                if rows_per_epoch is None:
+                    rows_per_epoch = sum(
+                        len(range(self.state.init_row_index, self._get_num_rows(file), self.state.increment))
+                        for file in self.state.files
+                    )
+                num_samples %= rows_per_epoch
+                if num_samples == 0:
+                    break
+
+            num_rows = self._get_num_rows(self.state.files[self.state.file_index])
+            rows_left = len(range(self.state.row_index, num_rows, self.state.increment))
+            if num_samples < rows_left:
+                self.state.row_index += num_samples * self.state.increment
+                num_samples = 0
+            else:
+                num_samples -= rows_left
+                self.state.row_index = self.state.init_row_index
+                self.state.file_index = (self.state.file_index + 1) % len(self.state.files)
+
     @property
     def is_empty(self):
         return len(self.arg_files) == 0
@@ -211,10 +349,377 @@ class ParquetDataset(IterableDataset, Stateful):
         self.state = PQDatasetState(**state_dict)
 
 
+TOKENIZE_CHUNK_SIZE = 256
+
+_worker_tokenizer: PreTrainedTokenizer | None = None
+
+
+def _encode_texts(tokenizer: PreTrainedTokenizer, texts: List[str]) -> List[List[int]]:
+    return [tokenizer.encode(str(text)) for text in texts]
+
+
+def _init_tokenize_worker(tokenizer: PreTrainedTokenizer):
+    global _worker_tokenizer
+    _worker_tokenizer = tokenizer
+
+
+def _tokenize_in_worker(texts: List[str]) -> List[List[int]]:
+    return _encode_texts(_worker_tokenizer, texts)
+
+
+@dataclass
+class StreamingPQDatasetState:
+    files: List[str]
+    file_index: int
+    row_group_index: int
+    row_offset: int
+    increment: int
+    init_row_group_index: int
+
+
+class StreamingParquetDataset(ParquetDataset):
+    """
+    Streaming version of ParquetDataset. Parquet files are read one row group at a time and tokenization is fanned out
+    to a pool of workers, so that memory and time to first sample do not depend on the size of the files.
+
+    At most `queue_size` chunks of `TOKENIZE_CHUNK_SIZE` rows are tokenized ahead of the consumer. The state is the
+    position (file, row group, row offset) of the next row to yield, which allows to resume without re-reading the file.
+
+    The pool uses processes when the dataset is iterated from the main process. Inside a dataloader worker (daemonic
+    process that cannot have children) it falls back to threads, fast tokenizers release the GIL anyway.
+    """
+
+    def __init__(
+        self,
+        files: List[str],
+        tokenizer: PreTrainedTokenizer,
+        num_workers: int = 0,
+        queue_size: int = 16,
+        token_counts_cache_dir: str | None = None,
+    ):
+        super().__init__(files, tokenizer, token_counts_cache_dir=token_counts_cache_dir)
+        assert queue_size > 0, "queue_size must be greater than 0"
+        self.num_workers = num_workers
+        self.queue_size = queue_size
+        self._row_group_offsets: dict[str, np.ndarray] = {}
+
+    def _lazy_init(self):
+        worker_info = torch.utils.data.get_worker_info()
+        if worker_info is not None:
+            if worker_info.num_workers > len(self.arg_files):
+                get_logger().warning(
+                    f"dataloader rank {worker_info.id} Number of workers {worker_info.num_workers} is greater than the number of files {len(self.arg_files)}"
+                )
+                self.state = StreamingPQDatasetState(
+                    files=self.arg_files,
+                    file_index=0,
+                    row_group_index=worker_info.id,
+                    row_offset=0,
+                    increment=worker_info.num_workers,
+                    init_row_group_index=worker_info.id,
+                )
+                return
+
+            files = self.arg_files[worker_info.id :: worker_info.num_workers]
+        else:
+            files = self.arg_files
+
+        self.state = StreamingPQDatasetState(
+            files=files, file_index=0, row_group_index=0, row_offset=0, increment=1, init_row_group_index=0
+        )
+
+    def _iter_chunks(self, cursor: StreamingPQDatasetState) -> Generator[tuple[int, int, int, List[str]], Any, None]:
+        """Yield (file_index, row_group_index, row_offset, texts) chunks starting from the cursor position"""
+        while True:
+            parquet_file = pq.ParquetFile(cursor.files[cursor.file_index])
+
+            while cursor.row_group_index < parquet_file.num_row_groups:
+                texts = parquet_file.read_row_group(cursor.row_group_index, columns=["text"])["text"].to_pylist()
+
+                for start in range(cursor.row_offset, len(texts), TOKENIZE_CHUNK_SIZE):
+                    yield (
+                        cursor.file_index,
+                        cursor.row_group_index,
+                        start,
+                        texts[start : start + TOKENIZE_CHUNK_SIZE],
+                    )
+
+                cursor.row_offset = 0
+                cursor.row_group_index += cursor.increment
+
+            cursor.row_group_index = cursor.init_row_group_index
+            cursor.file_index += 1
+            if cursor.file_index >= len(cursor.files):  # infinite datasets
+                cursor.file_index = 0
+
+    def _get_executor(self) -> Executor | None:
+        if self.num_workers == 0:
+            return None
+
+        if torch.utils.data.get_worker_info() is not None:
+            return ThreadPoolExecutor(max_workers=self.num_workers)
+
+        return ProcessPoolExecutor(
+            max_workers=self.num_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_tokenize_worker,
+            initargs=(self.tokenizer,),
+        )
+
+    def _submit(self, executor: Executor | None, texts: List[str]) -> Future:
+        if executor is None:
+            future = Future()
+            future.set_result(_encode_texts(self.tokenizer, texts))
+            return future
+        if isinstance(executor, ThreadPoolExecutor):
+            return executor.submit(_encode_texts, self.tokenizer, texts)
+        return executor.submit(_tokenize_in_worker, texts)
+
+    def __iter__(self):
+        if self.state is None:
+            self._lazy_init()
+
+        executor = self._get_executor()
+        # the read cursor runs ahead of self.state, which only moves when a sample is yielded
+        chunks = self._iter_chunks(StreamingPQDatasetState(**asdict(self.state)))
+        pending: deque[tuple[int, int, int, Future]] = deque()
+
+        try:
+            while True:
+                while len(pending) < self.queue_size:
+                    file_index, row_group_index, row_offset, texts = next(chunks)
+                    pending.append((file_index, row_group_index, row_offset, self._submit(executor, texts)))
+
+                file_index, row_group_index, row_offset, future = pending.popleft()
+                for i, input_ids in enumerate(future.result()):
+                    self.state.file_index = file_index
+                    self.state.row_group_index = row_group_index
+                    self.state.row_offset = row_offset + i + 1
+                    yield {"input_ids": input_ids}
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=False, cancel_futures=True)
+
+    def _get_row_group_offsets(self, file: str) -> np.ndarray:
+        """Index of the first row of each row group of a file, followed by the number of rows, from the metadata"""
+        if file not in self._row_group_offsets:
+            metadata = pq.ParquetFile(file).metadata
+            num_rows = [metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)]
+            self._row_group_offsets[file] = np.concatenate([[0], np.cumsum(num_rows, dtype=np.int64)])
+        return self._row_group_offsets[file]
+
+    def sample_lengths(self) -> Generator[int, Any, None]:
+        """Yield the number of tokens of the next samples without moving the dataset"""
+        if self.state is None:
+            self._lazy_init()
+
+        file_index, row_group_index = self.state.file_index, self.state.row_group_index
+        row_offset = self.state.row_offset
+        while True:
+            file = self.state.files[file_index]
+            token_counts, offsets = self._get_token_counts(file), self._get_row_group_offsets(file)
+            for group in range(row_group_index, len(offsets) - 1, self.state.increment):
+                yield from token_counts[offsets[group] + row_offset : offsets[group + 1]].tolist()
+                row_offset = 0
+            row_group_index, row_offset = self.state.init_row_group_index, 0
+            file_index = (file_index + 1) % len(self.state.files)
+
+    def seek(self, num_samples: int):
+        """
+        Move the dataset forward by num_samples samples, to the same state as iterating over them. Rows are counted
+        from the row groups in the parquet metadata, not read
+        """
+        if self.state is None:
+            self._lazy_init()
+
+        rows_per_epoch = None
+        while num_samples > 0:
+            if (
+                self.state.file_index == 0
+                and self.state.row_group_index == self.state.init_row_group_index
+                and self.state.row_offset == 0
+            ):
+                # the dataset is infinite, skip the whole epochs at once
+                if rows_per_epoch is None:
+                    rows_per_epoch = 0
+                    for file in self.state.files:
+                        group_rows = np.diff(self._get_row_group_offsets(file))
+                        rows_per_epoch += int(group_rows[self.state.init_row_group_index :: self.state.increment].sum())
+                num_samples %= rows_per_epoch
+                if num_samples == 0:
+                    break
+
+            offsets = self._get_row_group_offsets(self.state.files[self.state.file_index])
+            if self.state.row_group_index >= len(offsets) - 1:
+                self.state.row_group_index = self.state.init_row_group_index
+                self.state.row_offset = 0
+                self.state.file_index = (self.state.file_index + 1) % len(self.state.files)
+                continue
+
+            group = self.state.row_group_index
+            rows_left = int(offsets[group + 1] - offsets[group]) - self.state.row_offset
+            if num_samples <= rows_left:
+                # like the iterator, the state stays in the row group of the last sample
+                self.state.row_offset += num_samples
+                num_samples = 0
+            else:
+                num_samples -= rows_left
+                self.state.row_group_index += self.state.increment
+                self.state.row_offset = 0
+
+    def load_state_dict(self, state_dict):
+        self.state = StreamingPQDatasetState(**state_dict)
+
+
+TOKEN_SHARD_SUFFIX = ".bin"
+TOKEN_INDEX_SUFFIX = ".idx"
+
+
+def get_token_dtype(vocab_size: int) -> np.dtype:
+    return np.dtype(np.uint16) if vocab_size <= np.iinfo(np.uint16).max + 1 else np.dtype(np.uint32)
+
+
+class TokenShardWriter:
+    """
+    Write documents to a pre-tokenized token shard.
+
+    A shard is made of two files:
+    * `<name>.bin`: every document followed by the eos token, flattened into a single uint16/uint32 array
+    * `<name>.idx`: a npy int64 array `[itemsize, 0, end_doc_0, end_doc_1, ...]` with the document offsets in the .bin
+
+    Both files can be memory mapped, see `load_token_shard`.
+    """
+
+    def __init__(self, path: str, vocab_size: int, eos_token: int):
+        self.path = path
+        self.dtype = get_token_dtype(vocab_size)
+        self.eos_token = eos_token
+        self.offsets = [0]
+        self._file = open(path + TOKEN_SHARD_SUFFIX, "wb")
+
+    def write(self, input_ids: List[int]):
+        tokens = np.empty(len(input_ids) + 1, dtype=self.dtype)
+        tokens[:-1] = input_ids
+        tokens[-1] = self.eos_token
+        tokens.tofile(self._file)
+        self.offsets.append(self.offsets[-1] + len(tokens))
+
+    def close(self):
+        self._file.close()
+        with open(self.path + TOKEN_INDEX_SUFFIX, "wb") as f:
+            np.save(f, np.array([self.dtype.itemsize] + self.offsets, dtype=np.int64))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def load_token_shard(path: str) -> tuple[np.memmap, np.ndarray]:
+    """Memory map a token shard written by `TokenShardWriter`. `path` can point to the .bin file or omit the suffix"""
+    if path.endswith(TOKEN_SHARD_SUFFIX):
+        path = path[: -len(TOKEN_SHARD_SUFFIX)]
+    index = np.load(path + TOKEN_INDEX_SUFFIX, mmap_mode="r")
+    dtype = np.uint16 if index[0] == 2 else np.uint32
+    tokens = np.memmap(path + TOKEN_SHARD_SUFFIX, dtype=dtype, mode="r")
+    return tokens, index[1:]
+
+
+@dataclass
+class TokenShardDatasetState:
+    files: List[str]
+    file_index: int
+    token_index: int
+    increment: int
+    init_token_index: int
+
+
+class TokenShardDataset(IterableDataset, Stateful):
+    """
+    Iterate over pre-tokenized token shards (see `TokenShardWriter`) and yield samples already packed to seq_length.
+
+    Tokens are read through np.memmap so nothing is tokenized or loaded in memory besides the yielded window. The
+    output has the same format as SequencePackingDataSet, documents boundaries are given by the seqlens.
+    The remaining tokens at the end of a shard that do not fill a full sequence are dropped.
+    """
+
+    def __init__(self, files: List[str], seq_length: int):
+        self.arg_files = files
+        self.seq_length = seq_length
+
+        self.state = None
+
+    def _lazy_init(self):
+        worker_info = torch.utils.data.get_worker_info()
+        if worker_info is not None:
+            if worker_info.num_workers > len(self.arg_files):
+                get_logger().warning(
+                    f"dataloader rank {worker_info.id} Number of workers {worker_info.num_workers} is greater than the number of files {len(self.arg_files)}"
+                )
+                self.state = TokenShardDatasetState(
+                    files=self.arg_files,
+                    file_index=0,
+                    token_index=worker_info.id * self.seq_length,
+                    increment=worker_info.num_workers * self.seq_length,
+                    init_token_index=worker_info.id * self.seq_length,
+                )
+                return
+
+            files = self.arg_files[worker_info.id :: worker_info.num_workers]
+        else:
+            files = self.arg_files
+
+        self.state = TokenShardDatasetState(
+            files=files, file_index=0, token_index=0, increment=self.seq_length, init_token_index=0
+        )
+
+    def _get_seqlens(self, offsets: np.ndarray, start: int) -> list[int]:
+        end = start + self.seq_length
+        inner_bounds = offsets[np.searchsorted(offsets, start, side="right") : np.searchsorted(offsets, end)]
+        return np.diff([start, *inner_bounds.tolist(), end]).tolist()
+
+    def __iter__(self) -> Generator[BatchOutput, Any, None]:
+        if self.state is None:
+            self._lazy_init()
+
+        while True:
+            tokens, offsets = load_token_shard(self.state.files[self.state.file_index])
+
+            while self.state.token_index + self.seq_length + 1 <= len(tokens):
+                start = self.state.token_index
+                window = torch.from_numpy(tokens[start : start + self.seq_length + 1].astype(np.int64))
+                seqlens = self._get_seqlens(offsets, start)
+
+                self.state.token_index += self.state.increment
+
+                yield {"input_ids": window[:-1], "labels": window[1:], "seqlens": seqlens}
+
+            self.state.token_index = self.state.init_token_index
+            self.state.file_index += 1
+            if self.state.file_index >= len(self.state.files):  # infinite datasets
+                self.state.file_index = 0
+
+    @property
+    def is_empty(self):
+        return len(self.arg_files) == 0
+
+    def state_dict(self) -> dict[str, Any]:
+        return asdict(self.state) if self.state is not None else {}
+
+    def load_state_dict(self, state_dict):
+        self.state = TokenShardDatasetState(**state_dict)
+
+
+SEEK_CHUNK_SIZE = 65536  # number of interleaving draws computed at once when seeking
+
+
 @dataclass
 class InterleaveDatasetState:
     current_index: int
     seed: int
+    # number of samples drawn from each dataset, None for states saved before it was tracked
+    samples_per_dataset: list[int] | None = None
 
 
 class InterleaveDataset(IterableDataset, Stateful):
@@ -222,7 +727,8 @@ class InterleaveDataset(IterableDataset, Stateful):
 
     It draw a sample from each dataset with a probability given by the probabilities list.
 
-    The state can be saved and restored. Under the hood we just fast forward the random generator to the current position.
+    The dataset of the i-th sample is chosen with a counter based generator keyed by the seed and i. The state is
+    just the sample index and the state of each dataset, restoring it is constant time.
     """
 
     def __init__(self, datasets: List[ParquetDataset], probabilities: List[float], seed: int = 42):
@@ -239,29 +745,50 @@ class InterleaveDataset(IterableDataset, Stateful):
             else:
                 get_logger().warning(f"Dataset {dataset} is empty. Skipping.")
 
-        self.state = InterleaveDatasetState(current_index=0, seed=seed)
-        self._init_random_state()
+        self.state = InterleaveDatasetState(current_index=0, seed=seed, samples_per_dataset=[0] * len(self.datasets))
+        self._cumulative_probabilities = np.cumsum(self.probabilities) / sum(self.probabilities)
 
-    def _init_random_state(self):
-        """Initialize random generator and advance to current position"""
-        self.random_generator = random.Random(self.state.seed)
-        # Advance the RNG to the current position
-        for _ in range(self.state.current_index):
-            self._get_dataset_to_yield_from()
-
-    def _get_dataset_to_yield_from(self) -> int:
-        return self.random_generator.choices(range(len(self.datasets)), weights=self.probabilities, k=1)[0]
+    def _choose_datasets(self, start: int, count: int) -> np.ndarray:
+        """Index of the dataset of the samples start to start + count, each draw only depends on the sample index"""
+        # Philox increments its counter before computing a block of 4 values, we use the first value of each block
+        raw = np.random.Philox(key=self.state.seed, counter=start).random_raw(4 * count)[::4]
+        uniform = (raw >> np.uint64(11)) * 2.0**-53
+        indices = np.searchsorted(self._cumulative_probabilities, uniform, side="right")
+        return np.minimum(indices, len(self.datasets) - 1)  # guard against float rounding of the last probability
 
     def __iter__(self):
         data_iters = [iter(dataset) for dataset in self.datasets]
         while True:
-            dataset_to_yield_from = self._get_dataset_to_yield_from()
+            dataset_to_yield_from = int(self._choose_datasets(self.state.current_index, 1)[0])
 
             sample = next(data_iters[dataset_to_yield_from])
             self.state.current_index += 1
+            self.state.samples_per_dataset[dataset_to_yield_from] += 1
 
             yield sample
 
+    def sample_lengths(self) -> Generator[int, Any, None]:
+        """Yield the number of tokens of the next samples without moving the dataset"""
+        lengths_iters = [dataset.sample_lengths() for dataset in self.datasets]
+        index = self.state.current_index
+        while True:
+            for dataset_index in self._choose_datasets(index, SEEK_CHUNK_SIZE).tolist():
+                yield next(lengths_iters[dataset_index])
+            index += SEEK_CHUNK_SIZE
+
+    def seek(self, num_samples: int):
+        """Move the dataset forward by num_samples samples, each dataset is moved by the number of samples it got"""
+        samples_per_dataset = np.zeros(len(self.datasets), dtype=np.int64)
+        end = self.state.current_index + num_samples
+        for start in range(self.state.current_index, end, SEEK_CHUNK_SIZE):
+            choices = self._choose_datasets(start, min(SEEK_CHUNK_SIZE, end - start))
+            samples_per_dataset += np.bincount(choices, minlength=len(self.datasets))
+
+        for i, dataset in enumerate(self.datasets):
+            dataset.seek(int(samples_per_dataset[i]))
+            self.state.samples_per_dataset[i] += int(samples_per_dataset[i])
+        self.state.current_index = end
+
     def state_dict(self):
         state = {"interleave_state": asdict(self.state)}
 
@@ -271,9 +798,10 @@ class InterleaveDataset(IterableDataset, Stateful):
 
     def load_state_dict(self, state_dict):
         self.state = InterleaveDatasetState(**state_dict["interleave_state"])
+        if self.state.samples_per_dataset is None:
+            self.state.samples_per_dataset = [0] * len(self.datasets)
         for i, dataset in enumerate(self.datasets):
             dataset.load_state_dict(state_dict[f"dataset_{i}"])
-        self._init_random_state()
 
 
 class PrefetchDataLoader(StatefulDataLoader):
@@ -313,17 +841,23 @@ class PrefetchDataLoader(StatefulDataLoader):
         if state_dict['dataloader_state'] is not None:
             self.original_dataloader.load_state_dict(state_dict['dataloader_state'])
         if state_dict['_prefetch_iterator'] is not None:
-            self._prefetch_iterator = self._PrefetchIterator(self.original_dataloader, self.config)
+            # the dataloader state was saved after fetching the ready batch, it has to be yielded first
+            iterator_state = state_dict['_prefetch_iterator']
+            self.original_dataloader.load_state_dict(iterator_state['dataloader_iter'])
+            self._prefetch_iterator = self._PrefetchIterator(
+                self.original_dataloader, self.config, ready_batch=iterator_state['ready_batch']
+            )
 
     class _PrefetchIterator(Stateful):
-        def __init__(self, original_dataloader: StatefulDataLoader, config: DataConfig):
+        def __init__(self, original_dataloader: StatefulDataLoader, config: DataConfig, ready_batch=None):
             self.dataloader_iter = iter(original_dataloader)
             self.config = config
-            self.ready_batch = None
+            self.ready_batch = ready_batch
             self.thread = None
 
             # Immediately transfer first batch async.
-            self._prefetch_next()
+            if self.ready_batch is None:
+                self._prefetch_next()
 
         def state_dict(self) -> Dict[str, Any]:
             self._await_prefetch()
@@ -401,13 +935,16 @@ def get_dataloader(
     data_config: DataConfig,
 ) -> StatefulDataLoader:
     if data_config.fake:
-        train_dataset = FakeTokenizedDataset(data_config.seq_length, TEST_VOCAB_SIZE)
+        train_dataset = FakeTokenizedDataset(data_config.seq_length, TEST_VOCAB_SIZE, seed=rank)
     else:
         train_dataset = load_all_datasets(
             data_config=data_config, split="train", tokenizer=tokenizer, rank=rank, world_size=world_size
         )
 
-    dataset = SequencePackingDataSet(train_dataset, data_config.seq_length, eos_token=tokenizer.eos_token_id)
+    if data_config.pretokenized and not data_config.fake:
+        dataset = train_dataset  # token shards are already packed to seq_length
+    else:
+        dataset = SequencePackingDataSet(train_dataset, data_config.seq_length, eos_token=tokenizer.eos_token_id)
     mp_batch_dataloader = StatefulDataLoader(
         dataset,
         batch_size=batch_size,
@@ -434,6 +971,13 @@ def _get_datafiles(path: str, name: Optional[str] = None, split: str = "train")
     return builder_config[name].data_files[split]
 
 
+def _get_token_shard_files(path: str) -> List[str]:
+    files = sorted(glob.glob(os.path.join(path, "**", f"*{TOKEN_SHARD_SUFFIX}"), recursive=True))
+    if len(files) == 0:
+        raise ValueError(f"No token shard found in {path}, use scripts/tokenize_data.py to create them")
+    return files
+
+
 def _nice_print(kwargs: Dict[str, Union[str, List[str]]]) -> str:
     def _foo(a):
         if isinstance(a, list):
@@ -452,6 +996,12 @@ def _load_datasets(
     streaming: bool = True,
     probabilities: Optional[List[float]] = None,
     reverse_data_files: bool = False,
+    parquet_streaming: bool = False,
+    tokenize_workers: int = 0,
+    tokenize_queue_size: int = 16,
+    pretokenized: bool = False,
+    seq_length: int = 1024,
+    token_counts_cache_dir: Optional[str] = None,
 ) -> InterleaveDataset:
     get_logger().debug(dataset_names)
     ds_args = []
@@ -460,7 +1010,10 @@ def _load_datasets(
         _ds_args: dict[str, Any] = {"path": _ds_name}
         if _ds_config:
             _ds_args["name"] = _ds_config
-        _data_files = _get_datafiles(_ds_name, _ds_config, split)
+        if pretokenized:
+            _data_files = _get_token_shard_files(_ds_name)
+        else:
+            _data_files = _get_datafiles(_ds_name, _ds_config, split)
         if reverse_data_files:
             _data_files = _data_files[::-1]
             _ds_args["data_files"] = _data_files
@@ -475,7 +1028,20 @@ def _load_datasets(
     datasets = []
     for ds_arg in ds_args:
         # logger.debug(f"Loading dataset: {ds_arg['data_files']}")
-        _ds = ParquetDataset(files=ds_arg["data_files"], tokenizer=tokenizer)
+        if pretokenized:
+            _ds = TokenShardDataset(files=ds_arg["data_files"], seq_length=seq_length)
+        elif parquet_streaming:
+            _ds = StreamingParquetDataset(
+                files=ds_arg["data_files"],
+                tokenizer=tokenizer,
+                num_workers=tokenize_workers,
+                queue_size=tokenize_queue_size,
+                token_counts_cache_dir=token_counts_cache_dir,
+            )
+        else:
+            _ds = ParquetDataset(
+                files=ds_arg["data_files"], tokenizer=tokenizer, token_counts_cache_dir=token_counts_cache_dir
+            )
         datasets.append(_ds)
 
     if len(datasets) > 1:
@@ -526,6 +1092,12 @@ def load_all_datasets(
         probabilities=_get_probabilities(data_config),
         reverse_data_files=data_config.reverse_data_files,
         tokenizer=tokenizer,
+        parquet_streaming=data_config.parquet_streaming,
+        tokenize_workers=data_config.tokenize_workers,
+        tokenize_queue_size=data_config.tokenize_queue_size,
+        pretokenized=data_config.pretokenized,
+        seq_length=data_config.seq_length,
+        token_counts_cache_dir=data_config.token_counts_cache_dir,
     )
 
     get_logger().info(f"Train dataset: {ds}")
@@ -1,9 +1,20 @@
+import queue
 import re
+import threading
 import time
+from dataclasses import dataclass
 import torch
 from torch import nn
 from zeroband.comms import ElasticDeviceMesh
-from zeroband.collectives import Compression, all_reduce
+from zeroband.collectives import (
+    ERROR_FEEDBACK_COMPRESSIONS,
+    Compression,
+    all_gather_max_world_size,
+    all_reduce,
+    error_feedback_all_reduce,
+    hierarchical_all_reduce,
+    ring_allreduce_py,
+)
 from zeroband.utils.world_info import get_world_info
 from zeroband.utils.logger import get_logger
 from zeroband.config import DilocoConfig
@@ -21,6 +32,16 @@ def _find_first_number(s: str) -> int:
         return -1
 
 
+@dataclass
+class _Fragment:
+    """A contiguous range of layer groups in the flat offloaded buffers, reduced and applied as a whole"""
+
+    start: int
+    end: int
+    param_indices: list[int]
+    grad_groups: list[torch.Tensor]
+
+
 class Diloco:
     """
     This class implements the diloco algorithm from  https://arxiv.org/abs/2311.08105 and https://arxiv.org/abs/2407.07852.
@@ -45,6 +66,11 @@ class Diloco:
                 optimizer.step()
 
         diloco.step(model)
+
+    When `config.delay_steps > 0` (streaming diloco, https://arxiv.org/abs/2501.18512), `step` only snapshots the
+    local model and all reduces the pseudo gradient in a background thread, one fragment of layers after the other.
+    `apply_pending_sync` must then be called during the next inner steps: it applies the outer update of each fragment
+    whose all reduce is done, and blocks on the remaining ones once `delay_steps` inner steps have been done.
     """
 
     def __init__(
@@ -59,21 +85,80 @@ class Diloco:
             from zeroband.C.collectives import ring_allreduce as _  # noqa: F401
             # just force compilation
 
+            if config.compression_threads is not None:
+                from zeroband.C import collectives, compression
+
+                collectives.set_num_threads(config.compression_threads)
+                compression.set_num_threads(config.compression_threads)
+
+        self._ring_quantization_func = None
+        if config.ring_buffer_depth is not None and config.compression == Compression.UINT8:
+            from zeroband.C.compression import uniform_8bit_quantize
+
+            self._ring_quantization_func = uniform_8bit_quantize
+
         self.elastic_device_mesh = elastic_device_mesh
 
         self._logger = get_logger()
         self.world_info = get_world_info()
 
+        self._sync_thread: threading.Thread | None = None
+        self._pending_fragments: set[int] = set()
+        self._ready_fragments: queue.Queue[int] = queue.Queue()
+
         self._init_offloaded_optimizer(model=model)
 
+    @property
+    def streaming(self) -> bool:
+        return self.config.delay_steps > 0
+
+    @property
+    def has_pending_sync(self) -> bool:
+        return self._sync_thread is not None
+
     @torch.no_grad()
     def _init_offloaded_optimizer(self, model):
         self.param_list_cpu = self.get_offloaded_param(model)
-        self.outer_optimizer = torch.optim.SGD(
-            self.param_list_cpu, lr=self.config.outer_lr, momentum=0.9, nesterov=True
-        )
+        if self.streaming:
+            self._init_fragments()
+            # one param group per fragment so that each fragment can be stepped on its own
+            params = [{"params": [self.param_list_cpu[i] for i in f.param_indices]} for f in self._fragments]
+        else:
+            params = self.param_list_cpu
+        self.outer_optimizer = torch.optim.SGD(params, lr=self.config.outer_lr, momentum=0.9, nesterov=True)
         self._logger.debug("offload model to cpu")
 
+    def _init_fragments(self):
+        """
+        Split the layer groups into `num_fragments` contiguous fragments of roughly the same number of elements.
+        """
+        numels = self.offloaded_grad_flat_tensor.numel()
+        num_fragments = min(self.config.num_fragments, len(self._param_group_cutoff) - 1)
+
+        self._fragments: list[_Fragment] = []
+        group_index = 0
+        for fragment_id in range(num_fragments):
+            start = self._param_group_cutoff[group_index]
+            target_end = numels * (fragment_id + 1) // num_fragments
+            first_group = group_index
+            # each fragment takes at least one group and leaves at least one group per remaining fragment
+            max_group = len(self._param_group_cutoff) - 1 - (num_fragments - fragment_id - 1)
+            group_index += 1
+            while group_index < max_group and self._param_group_cutoff[group_index] < target_end:
+                group_index += 1
+            end = self._param_group_cutoff[group_index]
+
+            self._fragments.append(
+                _Fragment(
+                    start=start,
+                    end=end,
+                    param_indices=[i for i, (offset, _) in enumerate(self._param_offsets) if start <= offset < end],
+                    grad_groups=self._offloaded_grad_grouped_tensor[first_group:group_index],
+                )
+            )
+
+        self._logger.debug(f"Streaming diloco fragments numels: {[f.end - f.start for f in self._fragments]}")
+
     @torch.no_grad()
     def sync_pseudo_gradient(self, model: nn.Module, fake: bool = False, flag: str = "outer"):
         """
@@ -89,14 +174,11 @@ class Diloco:
         self._logger.debug("sync pseudo gradient %s with world size %d", " fake" if fake else "", world_size)
 
         global_pg = self.elastic_device_mesh.global_pg
+        self._check_all_gather_world_size(world_size)
+        if not fake:
+            self._snapshot_model(model)
         for i in range(self.config.retry_all_reduce):
-            for param_offloaded, param in zip(self.param_list_cpu, model.parameters()):
-                assert isinstance(param_offloaded.grad, DTensor)
-                if fake:
-                    param_offloaded.grad.to_local().zero_()
-                else:
-                    param_offloaded.grad.to_local().copy_(param_offloaded.data.to_local())
-                    param_offloaded.grad.to_local().sub_(param.data.to_local().to(param_offloaded.data.device))
+            self._compute_pseudo_gradient(fake)
             try:
                 self.offloaded_grad_flat_tensor.div_(world_size)
                 _collective_start_time = time.perf_counter()
@@ -107,7 +189,7 @@ class Diloco:
                 # all_reduce(self.config.compression, self.offloaded_grad_flat_tensor, dist.ReduceOp.SUM, global_pg)
                 for j, tensor_group in enumerate(self._offloaded_grad_grouped_tensor):
                     t0 = time.perf_counter()
-                    all_reduce(self.config.compression, tensor_group, dist.ReduceOp.SUM, global_pg)
+                    self._all_reduce(tensor_group, global_pg)
                     self._logger.debug(
                         f"{j}/{len(self._offloaded_grad_grouped_tensor)} all reduce bucket done in {time.perf_counter() - t0:.6f} seconds, numel: {tensor_group.numel()}"
                     )
@@ -115,6 +197,7 @@ class Diloco:
                 self._logger.debug(
                     f"All reduce takes {time.perf_counter() - _collective_start_time:.6f} seconds numels: {self.offloaded_grad_flat_tensor.numel()}"
                 )
+                self._commit_residual(0, self.offloaded_grad_flat_tensor.numel())
                 break
             except Exception as e:
                 self._logger.error(f"Error syncing pseudo gradient: {e}, retry {i+1}/{self.config.retry_all_reduce}")
@@ -124,24 +207,87 @@ class Diloco:
                 "Failed to sync pseudo gradient after %d retries. Resorting to calculating pseudo-gradient without reduce",
                 self.config.retry_all_reduce,
             )
-            for param_offloaded, param in zip(self.param_list_cpu, model.parameters()):
-                if fake:
-                    param_offloaded.grad.to_local().zero_()
-                else:
-                    param_offloaded.grad.to_local().copy_(param_offloaded.data.to_local())
-                    param_offloaded.grad.to_local().sub_(param.data.to_local().to(param_offloaded.data.device))
+            self._compute_pseudo_gradient(fake)
 
         self._logger.info(f"Sync psuedo-gradient in {time.perf_counter() - _start_time:.6f} seconds")
 
     @torch.no_grad()
+    def _snapshot_model(self, model: nn.Module):
+        """Copy the local model into the flat snapshot buffer, in one call and a single device synchronization"""
+        local_params = [param.data.to_local() for param in model.parameters()]
+        torch._foreach_copy_(self._param_snapshots, local_params, non_blocking=self._pin_memory)
+        if self._pin_memory:
+            torch.cuda.synchronize()
+
+    @torch.no_grad()
+    def _compute_pseudo_gradient(self, fake: bool):
+        """The pseudo gradient of all the parameters is one subtraction of the flat buffers"""
+        if fake:
+            self.offloaded_grad_flat_tensor.zero_()
+        else:
+            torch.sub(self.offloaded_data_flat_tensor, self._snapshot_flat_tensor, out=self.offloaded_grad_flat_tensor)
+
+    @torch.no_grad()
+    def _all_reduce(self, tensor: torch.Tensor, global_pg: dist.ProcessGroup):
+        """Sum the tensor over the global group, through the group leaders if the hierarchical all reduce is on"""
+        hierarchical_groups = self.elastic_device_mesh.hierarchical_groups
+        if self.residual_flat_tensor is not None:
+            # the tensor is a view of the grad buffer, its residual is at the same offset
+            size, stride, offset = tensor.size(), tensor.stride(), tensor.storage_offset()
+            residual = self.residual_flat_tensor.as_strided(size, stride, offset)
+            staged = self._staged_residual_flat_tensor.as_strided(size, stride, offset)
+            error_feedback_all_reduce(
+                self.config.compression,
+                tensor,
+                residual,
+                dist.ReduceOp.SUM,
+                global_pg,
+                topk_ratio=self.config.topk_ratio,
+                new_residual=staged,
+            )
+        elif hierarchical_groups is not None:
+            hierarchical_all_reduce(self.config.compression, tensor, hierarchical_groups, dist.ReduceOp.SUM)
+        elif self.config.ring_buffer_depth is not None:
+            ring_allreduce_py(
+                tensor,
+                dist.ReduceOp.SUM,
+                global_pg,
+                quantization_func=self._ring_quantization_func,
+                buffer_depth=self.config.ring_buffer_depth,
+                chunk_size=self.config.ring_chunk_size,
+            )
+        else:
+            all_reduce(self.config.compression, tensor, dist.ReduceOp.SUM, global_pg)
+
+    def _commit_residual(self, start: int, end: int):
+        """
+        Replace the residuals of [start, end) by the staged ones, once all its buckets are reduced. A failed bucket is
+        retried from the previous residuals, the ones staged by the buckets done before are computed again.
+        """
+        if self.residual_flat_tensor is not None:
+            self.residual_flat_tensor[start:end].copy_(self._staged_residual_flat_tensor[start:end])
+
+    def _check_all_gather_world_size(self, world_size: int):
+        if self.residual_flat_tensor is None:
+            return
+        max_world_size = all_gather_max_world_size(self.config.compression, self.config.topk_ratio)
+        if world_size > max_world_size and world_size != self._warned_world_size:
+            self._logger.warning(
+                f"{self.config.compression.value} compression all gathers the payloads of {world_size} ranks, "
+                f"more traffic than the uint8 ring above {max_world_size} ranks"
+            )
+            self._warned_world_size = world_size
+
     def sync_inner_model(self, model: nn.Module):
         """
         Sync the inner model from the CPU outer model to GPU
         """
 
         self._logger.debug("sync inner model")
-        for param_offloaded, param in zip(self.param_list_cpu, model.parameters()):
-            param.data.to_local().copy_(param_offloaded.data.to_local())
+        local_params = [param.data.to_local() for param in model.parameters()]
+        torch._foreach_copy_(local_params, self._offloaded_data_views, non_blocking=self._pin_memory)
+        if self._pin_memory:
+            torch.cuda.synchronize()
 
     @torch.no_grad()
     def get_offloaded_param(self, model: nn.Module) -> list[nn.Parameter]:
@@ -151,11 +297,28 @@ class Diloco:
         param_items = [(name, param) for name, param in model.named_parameters() if param.requires_grad]
         numels = sum(param.to_local().numel() for _, param in param_items)
 
-        self.offloaded_data_flat_tensor = torch.empty((numels,), device="cpu", dtype=torch.float32)
+        # the flat buffers exchanged with the gpu are pinned so that the copies of all the parameters are async
+        self._pin_memory = torch.cuda.is_available()
+        self.offloaded_data_flat_tensor = torch.empty(
+            (numels,), device="cpu", dtype=torch.float32, pin_memory=self._pin_memory
+        )
         self.offloaded_grad_flat_tensor = torch.zeros((numels,), device="cpu", dtype=torch.float32)
+        # snapshot of the local model, the pseudo gradient is offloaded_data_flat_tensor - _snapshot_flat_tensor
+        self._snapshot_flat_tensor = torch.empty(
+            (numels,), device="cpu", dtype=torch.float32, pin_memory=self._pin_memory
+        )
+        # what the lossy compression of the pseudo gradient lost so far, same layout as the grad buffer
+        # the new residuals are staged until the all reduce of every bucket succeeded (one more fp32 copy of the model)
+        self.residual_flat_tensor = None
+        self._staged_residual_flat_tensor = None
+        self._warned_world_size = None
+        if self.config.compression in ERROR_FEEDBACK_COMPRESSIONS:
+            self.residual_flat_tensor = torch.zeros((numels,), device="cpu", dtype=torch.float32)
+            self._staged_residual_flat_tensor = torch.zeros((numels,), device="cpu", dtype=torch.float32)
         current_offset = 0
         offloaded_params = []
         param_group_cutoff = []
+        self._param_offsets = []
 
         prev_id = None
         for name, param in param_items:
@@ -168,6 +331,7 @@ class Diloco:
             target = param.data.to_local().detach()
             data_tensor = self.offloaded_data_flat_tensor.as_strided(target.size(), target.stride(), current_offset)
             grad_tensor = self.offloaded_grad_flat_tensor.as_strided(target.size(), target.stride(), current_offset)
+            self._param_offsets.append((current_offset, (target.size(), target.stride())))
             current_offset += data_tensor.numel()
             data_tensor.copy_(target)
 
@@ -189,6 +353,12 @@ class Diloco:
             offloaded_params.append(offloaded_param)
 
         param_group_cutoff.append(current_offset)
+        self._param_group_cutoff = param_group_cutoff
+
+        self._offloaded_data_views = [param.data.to_local() for param in offloaded_params]
+        self._param_snapshots = [
+            self._snapshot_flat_tensor.as_strided(size, stride, offset) for offset, (size, stride) in self._param_offsets
+        ]
         # self._logger.debug(f"Cutoffs: {param_group_cutoff}")
 
         self._offloaded_grad_grouped_tensor = [
@@ -200,11 +370,133 @@ class Diloco:
         # )
         return offloaded_params
 
+    @torch.no_grad()
+    def _start_streaming_sync(self, model: nn.Module, fake: bool = False, flag: str = "outer"):
+        """
+        Snapshot the local model on cpu and start the all reduce of the pseudo gradient in a background thread
+        """
+        assert not self.has_pending_sync, "the previous streaming sync was not applied"
+
+        self.elastic_device_mesh.maybe_reinit_global_pg(admit_joiners=False)
+
+        self._snapshot_model(model)
+
+        self._pending_fragments = set(range(len(self._fragments)))
+        self._ready_fragments = queue.Queue()
+        self._sync_thread = threading.Thread(target=self._streaming_all_reduce, args=(fake, flag), daemon=True)
+        self._sync_thread.start()
+
+    @torch.no_grad()
+    def _streaming_all_reduce(self, fake: bool, flag: str):
+        """
+        Background thread all reducing the fragments one after the other. Each fragment is pushed to the ready queue
+        once its pseudo gradient is final, even if the all reduce failed (we then fall back to the local one).
+        """
+        _start_time = time.perf_counter()
+        global_pg = self.elastic_device_mesh.global_pg
+        self._check_all_gather_world_size(global_pg.size())
+        barrier_done = False
+
+        for fragment_id, fragment in enumerate(self._fragments):
+            grad = self.offloaded_grad_flat_tensor[fragment.start : fragment.end]
+            data = self.offloaded_data_flat_tensor[fragment.start : fragment.end]
+            snapshot = self._snapshot_flat_tensor[fragment.start : fragment.end]
+
+            for i in range(self.config.retry_all_reduce):
+                if fake:
+                    grad.zero_()
+                else:
+                    torch.sub(data, snapshot, out=grad)
+                try:
+                    grad.div_(global_pg.size())
+                    if not barrier_done:
+                        self.elastic_device_mesh.monitored_barrier(flag)
+                        barrier_done = True
+
+                    t0 = time.perf_counter()
+                    for tensor_group in fragment.grad_groups:
+                        self._all_reduce(tensor_group, global_pg)
+                    self._logger.debug(
+                        f"{fragment_id}/{len(self._fragments)} fragment all reduce done in {time.perf_counter() - t0:.6f} seconds, numel: {grad.numel()}"
+                    )
+                    self._commit_residual(fragment.start, fragment.end)
+                    break
+                except Exception as e:
+                    self._logger.error(
+                        f"Error syncing fragment {fragment_id}: {e}, retry {i+1}/{self.config.retry_all_reduce}"
+                    )
+                    global_pg = self.elastic_device_mesh.get_global_pg(maybe_reinit=True)
+                    barrier_done = False
+            else:
+                self._logger.error(
+                    "Failed to sync fragment %d after %d retries. Resorting to calculating pseudo-gradient without reduce",
+                    fragment_id,
+                    self.config.retry_all_reduce,
+                )
+                if fake:
+                    grad.zero_()
+                else:
+                    torch.sub(data, snapshot, out=grad)
+
+            self._ready_fragments.put(fragment_id)
+
+        self._logger.info(f"Streaming sync psuedo-gradient in {time.perf_counter() - _start_time:.6f} seconds")
+
+    @torch.no_grad()
+    def _apply_fragment(self, fragment_id: int, model_params: list[nn.Parameter]):
+        """
+        Step the outer optimizer on one fragment and add the outer update to the local model. The local model
+        has kept training since the snapshot, so instead of overwriting it we add the difference between the new
+        outer model and the snapshot, keeping the progress made during the delay.
+        """
+        fragment = self._fragments[fragment_id]
+
+        param_groups = self.outer_optimizer.param_groups
+        self.outer_optimizer.param_groups = [param_groups[fragment_id]]
+        try:
+            self.outer_optimizer.step()
+        finally:
+            self.outer_optimizer.param_groups = param_groups
+
+        snapshot = self._snapshot_flat_tensor[fragment.start : fragment.end]
+        torch.sub(self.offloaded_data_flat_tensor[fragment.start : fragment.end], snapshot, out=snapshot)
+        for i in fragment.param_indices:
+            local_param = model_params[i].data.to_local()
+            local_param.add_(self._param_snapshots[i].to(local_param.device))
+
+    @torch.no_grad()
+    def apply_pending_sync(self, model: nn.Module, blocking: bool = True):
+        """
+        Apply the outer update of the fragments whose all reduce is done.
+        If blocking, wait for the remaining fragments as well.
+        """
+        if not self.has_pending_sync:
+            return
+
+        model_params = list(model.parameters())
+        while self._pending_fragments:
+            try:
+                fragment_id = self._ready_fragments.get(block=blocking)
+            except queue.Empty:
+                return
+            self._apply_fragment(fragment_id, model_params)
+            self._pending_fragments.remove(fragment_id)
+
+        assert self._sync_thread is not None
+        self._sync_thread.join()
+        self._sync_thread = None
+        self._logger.debug("streaming sync applied")
+
     @torch.no_grad()
     def step(self, model: nn.Module, fake: bool = False, flag: str = "outer"):
         """
         Step the optimizer
         """
+        if self.streaming:
+            # the outer update is applied later on by apply_pending_sync
+            self._start_streaming_sync(model, fake=fake, flag=flag)
+            return
+
         time_start = time.perf_counter()
         self.sync_pseudo_gradient(model, fake=fake, flag=flag)
         self._logger.info(f"all reduce pseudo gradient in: {time.perf_counter() - time_start} seconds")
@@ -25,7 +25,7 @@ from cotrain_core.training_manager import TrainingManager
 from cotrain_core.utils.logger import get_logger
 
 # Initialize logger
-logger = get_logger(__name__)
+logger = get_logger(name=__name__)
 
 # Initialize FastAPI app
 app = FastAPI(
@@ -155,9 +155,28 @@ async def start_training(request: TrainingRequest, background_tasks: BackgroundT
         logger.error(f"Error starting training: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/api/v1/training/resume")
+async def resume_training():
+    """Resume the last training session from its latest checkpoint"""
+    global training_manager
+
+    try:
+        if not training_manager:
+            raise HTTPException(status_code=409, detail="No training session to resume")
+        if training_manager.is_running():
+            raise HTTPException(status_code=409, detail="Training is already running")
+
+        training_manager.resume()
+        return {"message": "Training resumed successfully", "status": "started"}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error resuming training: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.post("/api/v1/training/stop")
-async def stop_training():
-    """Stop the current training session"""
+def stop_training():
+    """Stop the current training session, waits for its checkpoint (runs in the threadpool)"""
     global training_manager
     
     try:
@@ -185,6 +204,20 @@ async def get_training_status():
         logger.error(f"Error getting training status: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/api/v1/training/metrics")
+async def get_training_metrics(last: int = 100):
+    """Get the most recent training metrics"""
+    global training_manager
+
+    try:
+        if not training_manager:
+            return {"metrics": [], "message": "No training session available"}
+
+        return {"metrics": training_manager.get_metrics(last=last)}
+    except Exception as e:
+        logger.error(f"Error getting training metrics: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.get("/api/v1/training/logs")
 async def get_training_logs(lines: int = 100):
     """Get recent training logs"""
@@ -27,7 +27,8 @@ from zeroband.utils import (
     get_num_params,
     get_num_flop_per_token,
 )
-from zeroband.utils.metric_logger import MetricLogger, WandbMetricLogger, DummyMetricLogger
+from zeroband.training_manager import stop_requested
+from zeroband.utils.metric_logger import DeviceMetrics, MetricLogger, get_metric_logger
 from zeroband.utils.activation_ckpt import apply_ac_ckpt
 from zeroband.utils.profiler import MemoryProfiler
 from zeroband.utils.world_info import get_world_info
@@ -76,6 +77,18 @@ def log_hash_training_state(
             metric_logger.log(metrics)
 
 
+def maybe_admit_joiners(elastic_device_mesh: ElasticDeviceMesh, ckpt_manager: CkptManager):
+    """Let the joiners in the global group and send the checkpoint to the one waiting for live recovery, if any"""
+    elastic_device_mesh.maybe_reinit_global_pg(admit_joiners=True)
+
+    maybe_dest_rank = elastic_device_mesh.live_recovery.should_send_ckpt_to()
+    if maybe_dest_rank is not None:
+        logger.info(f"Start live recovery to rank {maybe_dest_rank}")
+        ckpt_manager.send_ckpt_to_peer(elastic_device_mesh.global_pg, maybe_dest_rank, blocking=True)
+
+        elastic_device_mesh.live_recovery.reset()
+
+
 def train(config: Config):
     # batch_size is the total batch size for all GPUs
     assert config.optim.batch_size % world_info.local_world_size == 0
@@ -137,8 +150,19 @@ def train(config: Config):
             num = 1 if isinstance(config.train.ac_ckpt, bool) else config.train.ac_ckpt
             apply_ac_ckpt(model, num)
 
+        mesh_kwargs = {}
+        if config.diloco is not None:
+            mesh_kwargs = {
+                "bandwidth_probe_concurrency": config.diloco.bandwidth_probe_concurrency,
+                "bandwidth_cache_ttl": config.diloco.bandwidth_cache_ttl,
+                "hierarchical": config.diloco.hierarchical,
+                "hierarchical_group": config.diloco.hierarchical_group,
+                "hierarchical_min_bandwidth": config.diloco.hierarchical_min_bandwidth,
+            }
         elastic_device_mesh = ElasticDeviceMesh(
-            enable=config.diloco is not None, live_recovery_rank_src=config.ckpt.live_recovery_rank_src
+            enable=config.diloco is not None,
+            live_recovery_rank_src=config.ckpt.live_recovery_rank_src,
+            **mesh_kwargs,
         )
 
         mp_policy = MixedPrecisionPolicy(
@@ -193,14 +217,13 @@ def train(config: Config):
             data_rank=config.data.data_rank,
             diloco_offloaded_optimizer=diloco.outer_optimizer if config.diloco is not None else None,  # type: ignore
             diloco_offloaded_param_list=diloco.param_list_cpu if config.diloco is not None else None,  # type: ignore
+            diloco_residual=diloco.residual_flat_tensor if config.diloco is not None else None,  # type: ignore
         )
 
     if world_info.rank == 0:
-        logger_cls = WandbMetricLogger if config.metric_logger_type == "wandb" else DummyMetricLogger
-        metric_logger = logger_cls(
-            project=config.project,
-            logger_config={"config": config.model_dump(), "world_info": world_info.json()},
-            resume=config.wandb_resume,
+        # the backend is called from a background thread, the train loop only enqueues the metrics
+        metric_logger = get_metric_logger(
+            config, logger_config={"config": config.model_dump(), "world_info": world_info.json()}
         )
     else:
         metric_logger = None
@@ -227,6 +250,22 @@ def train(config: Config):
 
     num_inner_steps = config.diloco.inner_steps if config.diloco is not None else 1
     perf_counter = PerfCounter(window_size=10)
+    # the loss and grad norm are read back without a device sync per step, at most `metrics_max_lag` steps late
+    device_metrics = DeviceMetrics(max_pending=config.metrics_max_lag)
+
+    def log_metrics(records: list[dict]):
+        for metrics in records:
+            log = f"step: {metrics['step']}, loss: {metrics['Loss']:.4f}"
+            if "tokens_per_second" in metrics:
+                log += f", tokens_per_second: {metrics['tokens_per_second']:.2f}, mfu: {metrics['mfu']:.2f}"
+            if "num_peers" in metrics:
+                log += f", diloco_peers: {metrics['num_peers']}"
+
+            if world_info.rank == 0:
+                assert metric_logger is not None
+                metric_logger.log(metrics)
+
+            logger.info(log)
 
     logger.debug("Finished setup in %f seconds", sw.elapsed())
 
@@ -243,14 +282,9 @@ def train(config: Config):
             # this is a patch for now to allow live recovery worker to not affect the all reduce at all
 
             if not need_live_recovery:
-                elastic_device_mesh.maybe_reinit_global_pg(admit_joiners=True)
-
-                maybe_dest_rank = elastic_device_mesh.live_recovery.should_send_ckpt_to()
-                if maybe_dest_rank is not None:
-                    logger.info(f"Start live recovery to rank {maybe_dest_rank}")
-                    ckpt_manager.send_ckpt_to_peer(elastic_device_mesh.global_pg, maybe_dest_rank, blocking=True)
-
-                    elastic_device_mesh.live_recovery.reset()
+                # with streaming diloco, joiners are admitted once the pending outer update has been applied
+                if not diloco.has_pending_sync:
+                    maybe_admit_joiners(elastic_device_mesh, ckpt_manager)
             else:
                 ## receiving
                 time_start_live_recovery = time.perf_counter()
@@ -281,10 +315,17 @@ def train(config: Config):
         # at the beginning of the inner steps we allow joiner to arrive.
         # We maybe reinit before the all reduce but only to allow leaving, not to join anymore
 
-        for inner_step in range(num_inner_steps):
+        # a peer admitted in the middle of an outer step (streaming diloco) only does the remaining inner steps
+        for inner_step in range(training_progress.step % num_inner_steps, num_inner_steps):
             logger.debug("Starting inner step.")
             sw.start("inner_step")
 
+            if config.diloco is not None and diloco.has_pending_sync:
+                with sw.record_block("Apply Outer Update"):
+                    diloco.apply_pending_sync(model, blocking=inner_step >= config.diloco.delay_steps)
+                if not diloco.has_pending_sync:
+                    maybe_admit_joiners(elastic_device_mesh, ckpt_manager)
+
             loss_batch = 0
             z_loss_batch = 0
 
@@ -387,21 +428,17 @@ def train(config: Config):
                 training_progress.total_tokens += new_tokens * elastic_device_mesh.global_pg.size()
 
             assert isinstance(loss_batch, torch.Tensor)
+            device_tensors = {"Loss": loss_batch, "Perplexity": torch.exp(loss_batch), "grad_norm": grad_norm}
             metrics = {
-                "Loss": loss_batch.item(),
                 "step": training_progress.step,
                 "inner_lr": inner_lr,
-                "Perplexity": torch.exp(loss_batch).item(),
                 "total_tokens": training_progress.total_tokens,
                 "time": time.time(),
-                "grad_norm": grad_norm.item(),
             }
 
             if config.optim.z_loss:
                 assert isinstance(z_loss_batch, torch.Tensor)
-                metrics["z_loss"] = z_loss_batch.item()
-
-            log = f"step: {training_progress.step}, loss: {loss_batch.item():.4f}"
+                device_tensors["z_loss"] = z_loss_batch
 
             tokens_per_second = perf_counter.get_tokens_per_second()
             if tokens_per_second is not None:
@@ -409,17 +446,12 @@ def train(config: Config):
                 metrics["mfu"] = (
                     100 * num_flop_per_token * tokens_per_second / gpu_peak_flops / world_info.local_world_size
                 )
-                log += f", tokens_per_second: {tokens_per_second:.2f}, mfu: {metrics['mfu']:.2f}"
 
             if config.diloco is not None:
                 metrics["num_peers"] = elastic_device_mesh.global_pg.size()
-                log += f", diloco_peers: {metrics['num_peers']}"
-
-            if world_info.rank == 0:
-                assert metric_logger is not None
-                metric_logger.log(metrics)
 
-            logger.info(log)
+            device_metrics.push(device_tensors, metrics)
+            log_metrics(device_metrics.pop_ready())
 
             if config.train.memory_profiler is not None:
                 memory_profiler.step()
@@ -427,6 +459,10 @@ def train(config: Config):
             elapsed = sw.stop("inner_step")
             logger.debug(f"Inner step {inner_step} completed in {elapsed:.2f} seconds")
 
+        if config.diloco is not None:
+            # the outer step syncs anyway, the inner step metrics are logged before the outer ones
+            log_metrics(device_metrics.flush())
+
         if config.diloco is not None:
             assert diloco is not None
             time_start_inner = time.perf_counter()
@@ -439,13 +475,19 @@ def train(config: Config):
 
         training_progress.outer_step += 1
 
-        if (
-            config.ckpt.interval is not None
-            and training_progress.step > 0
-            and training_progress.step % config.ckpt.interval == 0
+        # the TrainingManager asks to stop with the stop file, the run is checkpointed to be resumed later
+        stop = config.stop_file is not None and stop_requested(config.stop_file, elastic_device_mesh.local_pg)
+
+        if training_progress.step > 0 and (
+            (config.ckpt.interval is not None and training_progress.step % config.ckpt.interval == 0)
+            or (stop and config.ckpt.path is not None)
         ):
             # we only allow to checkpoint after a outer step. For non diloco training outer step = 1 anyway
 
+            if diloco is not None:
+                # the checkpoint must contain the outer update of this outer step
+                diloco.apply_pending_sync(model)
+
             do_remote = config.ckpt.remote is not None and training_progress.step % config.ckpt.remote.interval == 0
             ckpt_manager.save(remote=do_remote)
             log_hash_training_state(
@@ -480,6 +522,15 @@ def train(config: Config):
             # Since ckpt strategy and all reduce is done at the outer loop level.
             break
 
+        if stop:
+            logger.info(f"Found the stop file {config.stop_file}, stopping at step {training_progress.step}")
+            break
+
+    if diloco is not None:
+        diloco.apply_pending_sync(model)
+
+    log_metrics(device_metrics.flush())
+
     if world_info.rank == 0:
         assert metric_logger is not None
         metric_logger.finish()
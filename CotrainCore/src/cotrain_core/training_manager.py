@@ -4,138 +4,285 @@ Training Manager for CotrainCore
 
 This module provides a high-level interface for managing training sessions,
 including starting, stopping, and monitoring training processes.
+
+The training runs the train entry point in a subprocess, with torchrun or as a single process.
+Its log lines are read from its stdout and its metrics are sent by the "stream" metric logger
+over a unix socket, both are kept in bounded ring buffers. Stopping creates the stop file of the
+run: the training checkpoints at the end of the outer step and exits, `resume` restarts from the
+latest checkpoint.
 """
 
+import json
 import os
-import time
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
 import threading
+import time
+from collections import deque
+from itertools import islice
 from pathlib import Path
 from typing import Dict, Any, Optional, List
-from collections import deque
+
+import torch
+import torch.distributed as dist
 
 from .config import load_config
+from .utils import get_random_available_port
 from .utils.logger import get_logger
 
-logger = get_logger(__name__)
+logger = get_logger(name=__name__)
+
+TRAIN_ENTRYPOINT = str(Path(__file__).parent / "train.py")
+STOP_FILE = "stop"
+METRICS_SOCKET = "metrics.sock"
+
+
+def flatten_config(config: Dict[str, Any], prefix: str = "") -> Dict[str, Any]:
+    """Flatten nested config dicts to dotted keys: {"optim": {"total_steps": 10}} -> {"optim.total_steps": 10}"""
+    flat = {}
+    for key, value in config.items():
+        if isinstance(value, dict):
+            flat.update(flatten_config(value, f"{prefix}{key}."))
+        else:
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+
+def config_to_argv(config: Dict[str, Any]) -> List[str]:
+    """Turn dotted config keys into the cli arguments of the train entry point"""
+    argv = []
+    for key, value in flatten_config(config).items():
+        if isinstance(value, bool):
+            argv.append(f"--{key}" if value else f"--no-{key}")
+        elif value is not None:
+            argv += [f"--{key}", json.dumps(value) if isinstance(value, list) else str(value)]
+    return argv
+
+
+def stop_requested(stop_file: str, group: dist.ProcessGroup) -> bool:
+    """
+    Training side of the stop protocol: whether the stop file exists. The ranks agree on it since the file can appear
+    while they check it
+    """
+    device = "cuda" if dist.get_backend(group) == dist.Backend.NCCL else "cpu"
+    stop = torch.tensor(float(os.path.exists(stop_file)), device=device)
+    dist.all_reduce(stop, op=dist.ReduceOp.MAX, group=group)
+    return stop.item() > 0
+
 
 class TrainingManager:
     """Manages training sessions and provides status monitoring"""
-    
-    def __init__(self, config_path: str):
+
+    def __init__(
+        self,
+        config_path: str,
+        nproc_per_node: Optional[int] = None,
+        entrypoint: str = TRAIN_ENTRYPOINT,
+        max_logs: int = 1000,
+        max_metrics: int = 10_000,
+        stop_timeout: float = 600.0,
+    ):
+        """
+        `nproc_per_node` None runs the entry point as a single process, otherwise with torchrun.
+        `stop_timeout` is how long `stop_training` waits for the checkpoint before killing the training.
+        """
         self.config_path = config_path
-        self.config = load_config(config_path)
-        self._is_running = False
-        self._training_thread: Optional[threading.Thread] = None
+        self.config = flatten_config(load_config(config_path))
+        self.nproc_per_node = nproc_per_node
+        self.entrypoint = entrypoint
+        self.stop_timeout = stop_timeout
+
+        self._overrides: Dict[str, Any] = {}
+        self._process: Optional[subprocess.Popen] = None
+        self._run_dir: Optional[str] = None
+        self._threads: List[threading.Thread] = []
         self._start_time: Optional[float] = None
-        self._current_step = 0
-        self._total_steps = 0
-        self._current_loss = 0.0
-        self._current_lr = 0.0
-        self._throughput = 0.0
-        self._logs = deque(maxlen=1000)  # Keep last 1000 log entries
-        
+        self._returncode: Optional[int] = None
+
+        self._latest_metrics: Dict[str, Any] = {}
+        self._metrics: deque[Dict[str, Any]] = deque(maxlen=max_metrics)
+        self._logs: deque[str] = deque(maxlen=max_logs)
+
     def is_running(self) -> bool:
         """Check if training is currently running"""
-        return self._is_running
-    
+        return self._process is not None and self._process.poll() is None
+
+    def _get_config(self, key: str, default: Any = None) -> Any:
+        return self._overrides.get(key, self.config.get(key, default))
+
     def start_training(self, resume_from: Optional[str] = None, overrides: Optional[Dict[str, Any]] = None):
-        """Start a training session"""
-        if self._is_running:
+        """Start a training session, the overrides are kept for the next resumes"""
+        if self.is_running():
             raise RuntimeError("Training is already running")
-        
-        self._is_running = True
-        self._start_time = time.time()
-        
-        # Apply overrides to config if provided
+        self._join_readers()
+
         if overrides:
-            self.config.update(overrides)
-        
-        # Start training in a separate thread
-        self._training_thread = threading.Thread(
-            target=self._run_training,
-            args=(resume_from,),
-            daemon=True
+            self._overrides.update(flatten_config(overrides))
+
+        self._run_dir = tempfile.mkdtemp(prefix="cotrain_run_")
+        address = os.path.join(self._run_dir, METRICS_SOCKET)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(address)
+        server.listen(1)
+
+        args = {
+            **self._overrides,
+            "metric_logger_type": "stream",
+            "metric_stream_address": address,
+            "stop_file": os.path.join(self._run_dir, STOP_FILE),
+        }
+        if resume_from is not None:
+            args["ckpt.resume"] = resume_from
+
+        env = os.environ.copy()
+        if self.nproc_per_node is None:
+            cmd = [sys.executable, self.entrypoint]
+            env.update(
+                RANK="0",
+                WORLD_SIZE="1",
+                LOCAL_RANK="0",
+                LOCAL_WORLD_SIZE="1",
+                MASTER_ADDR="localhost",
+                MASTER_PORT=str(get_random_available_port()),
+            )
+        else:
+            cmd = ["torchrun", f"--nproc_per_node={self.nproc_per_node}", self.entrypoint]
+        cmd += [f"@{self.config_path}", *config_to_argv(args)]
+
+        self._latest_metrics = {}
+        self._returncode = None
+        self._start_time = time.time()
+        self._process = subprocess.Popen(
+            cmd,
+            env=env,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            bufsize=1,
+            start_new_session=True,  # to kill torchrun and its workers together
         )
-        self._training_thread.start()
-        
-        self._log("Training session started")
-    
+        self._threads = [
+            threading.Thread(target=self._read_logs, args=(self._process,), daemon=True),
+            threading.Thread(target=self._read_metrics, args=(self._process, server), daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+
+        self._log(f"Training session started: {' '.join(cmd)}")
+
+    def resume(self, overrides: Optional[Dict[str, Any]] = None):
+        """Start a training session from the latest checkpoint"""
+        if overrides:
+            self._overrides.update(flatten_config(overrides))
+        checkpoint = self.latest_checkpoint()
+        if checkpoint is None:
+            raise RuntimeError("No checkpoint to resume from")
+        self.start_training(resume_from=checkpoint)
+
     def stop_training(self):
-        """Stop the current training session"""
-        if not self._is_running:
+        """
+        Stop the current training session. The training checkpoints and exits at the end of its outer step, it is
+        killed if it did not exit after `stop_timeout` seconds.
+        """
+        if not self.is_running():
             raise RuntimeError("No training session is currently running")
-        
-        self._is_running = False
+        assert self._process is not None and self._run_dir is not None
+
+        self._log("Stopping the training session")
+        Path(self._run_dir, STOP_FILE).touch()
+        try:
+            self._process.wait(timeout=self.stop_timeout)
+        except subprocess.TimeoutExpired:
+            self._log(f"Training did not stop after {self.stop_timeout} seconds, killing it")
+            os.killpg(self._process.pid, signal.SIGTERM)
+            try:
+                self._process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                os.killpg(self._process.pid, signal.SIGKILL)
+                self._process.wait()
+        self._join_readers()
         self._log("Training session stopped")
-        
-        # Wait for training thread to finish
-        if self._training_thread and self._training_thread.is_alive():
-            self._training_thread.join(timeout=10.0)
-    
+
+    def wait(self, timeout: Optional[float] = None) -> Optional[int]:
+        """Wait for the training to exit and return its exit code"""
+        if self._process is None:
+            return None
+        self._process.wait(timeout=timeout)
+        self._join_readers()
+        return self._returncode
+
+    def latest_checkpoint(self) -> Optional[str]:
+        ckpt_path = self._get_config("ckpt.path")
+        if ckpt_path is None or not os.path.isdir(ckpt_path):
+            return None
+        steps = [int(d.split("_")[1]) for d in os.listdir(ckpt_path) if d.startswith("step_")]
+        if not steps:
+            return None
+        return os.path.join(ckpt_path, f"step_{max(steps)}")
+
     def get_status(self) -> Dict[str, Any]:
         """Get current training status"""
+        metrics = self._latest_metrics
         return {
-            "is_running": self._is_running,
-            "current_step": self._current_step if self._is_running else None,
-            "total_steps": self._total_steps if self._is_running else None,
-            "loss": self._current_loss if self._is_running else None,
-            "learning_rate": self._current_lr if self._is_running else None,
-            "throughput": self._throughput if self._is_running else None,
-            "uptime": time.time() - self._start_time if self._start_time else None
+            "is_running": self.is_running(),
+            "current_step": metrics.get("step"),
+            "total_steps": self._get_config("optim.total_steps"),
+            "loss": metrics.get("Loss"),
+            "learning_rate": metrics.get("inner_lr"),
+            "throughput": metrics.get("tokens_per_second"),
+            "uptime": time.time() - self._start_time if self._start_time else None,
+            "returncode": self._returncode,
         }
-    
+
+    def get_metrics(self, last: int = 100) -> List[Dict[str, Any]]:
+        """Get the most recent metrics, oldest first"""
+        return list(islice(reversed(self._metrics), last))[::-1]
+
     def get_logs(self, lines: int = 100) -> List[str]:
         """Get recent training logs"""
-        return list(self._logs)[-lines:] if self._logs else []
-    
-    def _run_training(self, resume_from: Optional[str] = None):
-        """Main training loop (placeholder implementation)"""
+        return list(islice(reversed(self._logs), lines))[::-1]
+
+    def _read_logs(self, process: subprocess.Popen):
+        assert process.stdout is not None
+        for line in process.stdout:
+            self._logs.append(line.rstrip("\n"))
+        self._returncode = process.wait()
+        self._log(f"Training exited with code {self._returncode}")
+
+    def _read_metrics(self, process: subprocess.Popen, server: socket.socket):
+        # the training may die before connecting
+        server.settimeout(1.0)
         try:
-            # This is a placeholder implementation
-            # In a real implementation, this would call the actual training logic
-            
-            self._total_steps = self.config.get("training", {}).get("max_steps", 1000)
-            
-            self._log(f"Starting training with config: {self.config_path}")
-            if resume_from:
-                self._log(f"Resuming from checkpoint: {resume_from}")
-            
-            # Simulate training loop
-            for step in range(self._total_steps):
-                if not self._is_running:
+            while True:
+                try:
+                    conn, _ = server.accept()
                     break
-                
-                # Simulate training step
-                time.sleep(0.1)  # Simulate computation time
-                
-                # Update metrics (simulated)
-                self._current_step = step + 1
-                self._current_loss = 1.0 / (step + 1)  # Decreasing loss
-                self._current_lr = 0.001 * (0.99 ** step)  # Decaying learning rate
-                self._throughput = 100.0  # Tokens per second (simulated)
-                
-                # Log progress every 100 steps
-                if (step + 1) % 100 == 0:
-                    self._log(
-                        f"Step {step + 1}/{self._total_steps}, "
-                        f"Loss: {self._current_loss:.4f}, "
-                        f"LR: {self._current_lr:.6f}"
-                    )
-            
-            if self._is_running:
-                self._log("Training completed successfully")
-            else:
-                self._log("Training was stopped")
-                
-        except Exception as e:
-            self._log(f"Training failed with error: {e}")
-            logger.error(f"Training error: {e}")
+                except socket.timeout:
+                    if process.poll() is not None:
+                        return
+            with conn, conn.makefile("r") as f:
+                for line in f:
+                    metrics = json.loads(line)
+                    self._metrics.append(metrics)
+                    self._latest_metrics = {**self._latest_metrics, **metrics}
         finally:
-            self._is_running = False
-    
+            server.close()
+
+    def _join_readers(self):
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        if self._run_dir is not None:
+            shutil.rmtree(self._run_dir, ignore_errors=True)
+            self._run_dir = None
+
     def _log(self, message: str):
         """Add a log entry with timestamp"""
         timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
         log_entry = f"[{timestamp}] {message}"
         self._logs.append(log_entry)
-        logger.info(message)
\ No newline at end of file
+        logger.info(message)
@@ -1,7 +1,17 @@
+import json
+import os
 import pickle
+import queue
+import socket
+import threading
+from collections import deque
 from typing import Any, Protocol
 import importlib.util
 
+import torch
+
+from zeroband.config import Config
+
 
 class MetricLogger(Protocol):
     def __init__(self, project, logger_config): ...
@@ -34,16 +44,144 @@ class WandbMetricLogger(MetricLogger):
 
 
 class DummyMetricLogger(MetricLogger):
+    """
+    Append each metrics dict to the `project` file as soon as it is logged, one pickle per dict, and rewrite the file
+    as a single pickled list in `finish`. `read_dummy_metrics` reads the file of a run that did not finish as well.
+    """
+
     def __init__(self, project, logger_config, *args, **kwargs):
         self.project = project
         self.logger_config = logger_config
-        open(self.project, "a").close()  # Create an empty file to append to
+        self._file = open(self.project, "wb")
+
+    def log(self, metrics: dict[str, Any]):
+        pickle.dump(metrics, self._file)
+        self._file.flush()
 
-        self.data = []
+    def finish(self):
+        self._file.close()
+        data = read_dummy_metrics(self.project)
+        with open(f"{self.project}.tmp", "wb") as f:
+            pickle.dump(data, f)
+        os.replace(f"{self.project}.tmp", self.project)
+
+
+def read_dummy_metrics(path: str) -> list[dict[str, Any]]:
+    data = []
+    with open(path, "rb") as f:
+        while True:
+            try:
+                record = pickle.load(f)
+            except EOFError:
+                return data
+            if isinstance(record, list):
+                data.extend(record)
+            else:
+                data.append(record)
+
+
+class StreamMetricLogger(MetricLogger):
+    """Send each metrics dict as a json line to the unix socket `address`, where a `TrainingManager` listens"""
+
+    def __init__(self, project, logger_config, *args, address: str, **kwargs):
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.connect(address)
+        self._file = self._socket.makefile("w")
+
+    def log(self, metrics: dict[str, Any]):
+        self._file.write(json.dumps(metrics) + "\n")
+        self._file.flush()
+
+    def finish(self):
+        self._file.close()
+        self._socket.close()
+
+
+class AsyncMetricLogger(MetricLogger):
+    """
+    Hand the metrics to `metric_logger` in a background thread, so that a slow backend (e.g. wandb over the network)
+    never stalls the train loop. The queue is bounded: `log` blocks if the backend falls `max_queue_size` records
+    behind instead of growing the memory.
+    """
+
+    def __init__(self, metric_logger: MetricLogger, max_queue_size: int = 1000):
+        self.metric_logger = metric_logger
+        self._queue: queue.Queue[dict[str, Any] | None] = queue.Queue(maxsize=max_queue_size)
+        self._error: BaseException | None = None
+        self._thread = threading.Thread(target=self._run, name="metric-logger", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while (metrics := self._queue.get()) is not None:
+            try:
+                self.metric_logger.log(metrics)
+            except BaseException as e:
+                # keep consuming the queue so that log never blocks forever, the error is raised by finish
+                self._error = self._error or e
 
     def log(self, metrics: dict[str, Any]):
-        self.data.append(metrics)
+        self._queue.put(metrics)
 
     def finish(self):
-        with open(self.project, "wb") as f:
-            pickle.dump(self.data, f)
+        self._queue.put(None)
+        self._thread.join()
+        self.metric_logger.finish()
+        if self._error is not None:
+            raise self._error
+
+
+def get_metric_logger(config: Config, logger_config: dict[str, Any]) -> MetricLogger:
+    """The metric logger of `config.metric_logger_type`, the backend is called from a background thread"""
+    logger_kwargs = {"project": config.project, "logger_config": logger_config, "resume": config.wandb_resume}
+    if config.metric_logger_type == "wandb":
+        backend = WandbMetricLogger(**logger_kwargs)
+    elif config.metric_logger_type == "stream":
+        backend = StreamMetricLogger(**logger_kwargs, address=config.metric_stream_address)
+    else:
+        backend = DummyMetricLogger(**logger_kwargs)
+    return AsyncMetricLogger(backend, max_queue_size=config.metric_logger_queue_size)
+
+
+class DeviceMetrics:
+    """
+    Turn the scalar tensors of the train loop into python floats without a host sync per step.
+
+    `push` copies the scalars of one step to pinned host memory asynchronously and records a cuda event. `pop_ready`
+    returns, in order, the records of the steps whose copy is done without waiting, except when more than
+    `max_pending` steps are pending where it waits for the oldest ones. `flush` waits for all of them.
+    On cpu the copies are synchronous and every step is ready right away.
+    """
+
+    def __init__(self, max_pending: int = 16):
+        self.max_pending = max_pending
+        self._pending: deque[tuple[torch.cuda.Event | None, list[str], torch.Tensor, dict[str, Any]]] = deque()
+
+    def push(self, tensors: dict[str, torch.Tensor], record: dict[str, Any]) -> None:
+        names = list(tensors)
+        values = torch.stack([tensors[name].detach().float().reshape(()) for name in names])
+        event = None
+        if values.is_cuda:
+            host_values = torch.empty(values.shape, dtype=values.dtype, pin_memory=True)
+            host_values.copy_(values, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record()
+        else:
+            host_values = values
+        self._pending.append((event, names, host_values, record))
+
+    def _pop(self) -> dict[str, Any]:
+        event, names, host_values, record = self._pending.popleft()
+        if event is not None:
+            event.synchronize()
+        return {**record, **dict(zip(names, host_values.tolist()))}
+
+    def pop_ready(self) -> list[dict[str, Any]]:
+        records = []
+        while self._pending and (
+            len(self._pending) > self.max_pending or self._pending[0][0] is None or self._pending[0][0].query()
+        ):
+            records.append(self._pop())
+        return records
+
+    def flush(self) -> list[dict[str, Any]]:
+        return [self._pop() for _ in range(len(self._pending))]
@@ -0,0 +1,213 @@
+"""
+Upload a checkpoint folder to a remote fsspec location with a pool of parallel workers.
+
+The remote folder is a plain mirror of the local one: each file is written to the same key, streamed in parts of the
+chunk size (a multipart upload on S3, a resumable upload on GCS), and the workers upload several files at a time.
+The remote `upload_manifest.json` holds the sha256 of every chunk of the uploaded files: an interrupted upload, or an
+upload to a location holding a previous version of the folder (e.g. the `latest` data folder), only uploads the files
+that are missing or changed. `download_directory` reads the chunks in parallel and checks them against the manifest.
+
+The upload works at the granularity of files, not chunks: each file is streamed by a single worker, so a checkpoint
+made of one large shard is uploaded by one thread, and a failure retries the whole file. The chunks only set the part
+size of the stream and the unit of the checksums; a generic fsspec file cannot upload its parts concurrently or
+resume from a part. The checksums are computed before the upload, which reads the checkpoint one extra time
+(usually from the page cache, right after it was saved), so that the unchanged files can be skipped.
+"""
+
+import hashlib
+import json
+import math
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Callable, TypeVar
+
+import fsspec
+from fsspec.generic import rsync as rsync_fsspec
+
+from zeroband.utils.logger import get_logger
+
+MANIFEST_FILE = "upload_manifest.json"
+MANIFEST_WRITE_INTERVAL = 5  # seconds between two writes of the manifest while uploading
+
+T = TypeVar("T")
+
+
+def _num_chunks(size: int, chunk_size: int) -> int:
+    return max(1, math.ceil(size / chunk_size))
+
+
+def _with_retries(func: Callable[[], T], max_retries: int, what: str) -> T:
+    for attempt in range(max_retries + 1):
+        try:
+            return func()
+        except Exception as e:
+            if attempt == max_retries:
+                raise
+            get_logger().warning(f"Error {what}: {e}, retry {attempt + 1}/{max_retries}")
+            time.sleep(2**attempt)
+
+
+def read_manifest(fs: fsspec.AbstractFileSystem, remote_path: str) -> dict[str, Any] | None:
+    try:
+        return json.loads(fs.cat_file(f"{remote_path}/{MANIFEST_FILE}"))
+    except FileNotFoundError:
+        return None
+
+
+def _write_manifest(fs: fsspec.AbstractFileSystem, remote_path: str, manifest: dict[str, Any]) -> None:
+    fs.pipe_file(f"{remote_path}/{MANIFEST_FILE}", json.dumps(manifest).encode())
+
+
+def upload_directory(
+    local_path: str,
+    remote_path: str,
+    chunk_size: int = 64 * 2**20,
+    num_workers: int = 8,
+    max_retries: int = 3,
+    fs: fsspec.AbstractFileSystem | None = None,
+) -> None:
+    """
+    Upload the content of `local_path` to `remote_path`. The chunks of the files are hashed by `num_workers` threads,
+    then the files that changed are uploaded by the same threads, one file per thread, each file retried from its
+    start `max_retries` times. Raise if a file could not be uploaded, the files uploaded so far are recorded in the
+    manifest so that the next call resumes from the first file that is not complete.
+    """
+    if fs is None:
+        fs, remote_path = fsspec.core.url_to_fs(remote_path)
+    remote_path = remote_path.rstrip("/")
+    time_start = time.perf_counter()
+
+    sizes = {}
+    for root, _, filenames in os.walk(local_path):
+        for filename in filenames:
+            path = os.path.join(root, filename)
+            sizes[os.path.relpath(path, local_path).replace(os.sep, "/")] = os.path.getsize(path)
+
+    previous = read_manifest(fs, remote_path)
+    if previous is not None and previous["chunk_size"] != chunk_size:
+        previous = None
+
+    checksums = {relpath: [None] * _num_chunks(size, chunk_size) for relpath, size in sizes.items()}
+
+    def read_chunk(relpath: str, index: int) -> bytes:
+        with open(os.path.join(local_path, relpath), "rb") as f:
+            f.seek(index * chunk_size)
+            return f.read(chunk_size)
+
+    def hash_chunk(relpath: str, index: int) -> tuple[str, int, str]:
+        return relpath, index, hashlib.sha256(read_chunk(relpath, index)).hexdigest()
+
+    def upload_file(relpath: str) -> tuple[str, int]:
+        """Stream the file to its remote key, one part per chunk, return the number of bytes uploaded"""
+
+        def upload():
+            with fs.open(f"{remote_path}/{relpath}", "wb", block_size=chunk_size) as f:
+                for index in range(len(checksums[relpath])):
+                    f.write(read_chunk(relpath, index))
+
+        _with_retries(upload, max_retries, f"uploading {remote_path}/{relpath}")
+        return relpath, sizes[relpath]
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = [
+            executor.submit(hash_chunk, relpath, index)
+            for relpath, chunks in checksums.items()
+            for index in range(len(chunks))
+        ]
+        for future in as_completed(futures):
+            relpath, index, checksum = future.result()
+            checksums[relpath][index] = checksum
+
+    # the checksums of each file once it is uploaded, None before
+    files = {relpath: {"size": size, "chunks": [None] * len(checksums[relpath])} for relpath, size in sizes.items()}
+    to_upload = []
+    for relpath, file in files.items():
+        previous_file = previous["files"].get(relpath) if previous is not None else None
+        if previous_file is not None and previous_file == {"size": file["size"], "chunks": checksums[relpath]}:
+            file["chunks"] = checksums[relpath]
+        else:
+            to_upload.append(relpath)
+
+    # the files are overwritten in place: a previous version of the folder is not complete anymore
+    manifest = {"chunk_size": chunk_size, "complete": False, "files": files}
+    _write_manifest(fs, remote_path, manifest)
+
+    # object stores have no directories, on a filesystem the parents must exist before the workers write
+    for parent in {os.path.dirname(f"{remote_path}/{relpath}") for relpath in to_upload}:
+        fs.makedirs(parent, exist_ok=True)
+
+    uploaded_bytes = 0
+    try:
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            futures = [executor.submit(upload_file, relpath) for relpath in to_upload]
+            last_manifest_write = time.perf_counter()
+            for future in as_completed(futures):
+                relpath, num_bytes = future.result()
+                files[relpath]["chunks"] = checksums[relpath]
+                uploaded_bytes += num_bytes
+                if time.perf_counter() - last_manifest_write > MANIFEST_WRITE_INTERVAL:
+                    _write_manifest(fs, remote_path, manifest)
+                    last_manifest_write = time.perf_counter()
+        manifest["complete"] = True
+    finally:
+        _write_manifest(fs, remote_path, manifest)
+
+    elapsed = time.perf_counter() - time_start
+    get_logger().debug(
+        f"Uploaded {uploaded_bytes / 2**20:.1f} MiB of {local_path} to {remote_path} in {elapsed:.2f} seconds "
+        f"({uploaded_bytes / 2**20 / elapsed:.1f} MiB/s), {len(files) - len(to_upload)} files already uploaded"
+    )
+
+
+def download_directory(
+    remote_path: str,
+    local_path: str,
+    num_workers: int = 8,
+    max_retries: int = 3,
+    fs: fsspec.AbstractFileSystem | None = None,
+) -> None:
+    """
+    Download a folder uploaded by `upload_directory` and check its checksums.
+    A remote folder without manifest is copied with fsspec rsync.
+    """
+    if fs is None:
+        remote_url = remote_path
+        fs, remote_path = fsspec.core.url_to_fs(remote_path)
+    else:
+        remote_url = fs.unstrip_protocol(remote_path)
+    remote_path = remote_path.rstrip("/")
+
+    manifest = read_manifest(fs, remote_path)
+    if manifest is None:
+        rsync_fsspec(remote_url, destination=local_path)
+        return
+    if not manifest["complete"]:
+        raise RuntimeError(f"The upload to {remote_path} is not complete")
+
+    chunk_size = manifest["chunk_size"]
+    for relpath, file in manifest["files"].items():
+        path = os.path.join(local_path, relpath)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.truncate(file["size"])
+
+    def download_chunk(relpath: str, index: int):
+        file = manifest["files"][relpath]
+        path, start = f"{remote_path}/{relpath}", index * chunk_size
+        end = min(start + chunk_size, file["size"])
+        data = _with_retries(lambda: fs.cat_file(path, start=start, end=end), max_retries, f"downloading {path}")
+        if hashlib.sha256(data).hexdigest() != file["chunks"][index]:
+            raise RuntimeError(f"Checksum mismatch for chunk {index} of {path}")
+        with open(os.path.join(local_path, relpath), "r+b") as f:
+            f.seek(index * chunk_size)
+            f.write(data)
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = [
+            executor.submit(download_chunk, relpath, index)
+            for relpath, file in manifest["files"].items()
+            for index in range(len(file["chunks"]))
+        ]
+        for future in as_completed(futures):
+            future.result()
@@ -1,4 +1,5 @@
 import io
+from typing import Any
 import pickle
 import torch
 from torch.distributed import ProcessGroup
@@ -163,3 +164,209 @@ def recv_state_dict(pg: ProcessGroup, src_rank: int, og_state_dict: dict) -> dic
     # logger.debug(f"recv tensors {get_tensor_list_signature(tensors)}")
 
     return state_dict
+
+
+# ===============
+# Bulk transfer
+# ---------------
+# Instead of one send per tensor, the bytes of all tensors are seen as a single stream cut in chunks of at most
+# `chunk_bytes`. Small tensors are packed together in the same chunk, large tensors are split over several chunks.
+# A header describing the layout is sent first so that the receiver can check it against its own tensors.
+# Chunks covering a single contiguous cpu tensor are sent from / received into the tensor storage directly,
+# the others go through a few staging buffers so that packing (or unpacking) a chunk overlaps with the transfer
+# of the previous ones.
+
+BULK_CHUNK_BYTES = 64 * 1024 * 1024
+BULK_PIPELINE_DEPTH = 2
+
+
+def _local_tensor(tensor: torch.Tensor) -> torch.Tensor:
+    if isinstance(tensor, DTensor):
+        tensor = tensor.to_local()
+    return tensor.detach()
+
+
+def _byte_view(tensor: torch.Tensor) -> torch.Tensor | None:
+    """Flat uint8 view sharing the storage of a contiguous tensor, None if the tensor is not contiguous"""
+    if not tensor.is_contiguous():
+        return None
+    return tensor.reshape(-1).view(torch.uint8)
+
+
+def _get_tensors_layout(tensors: list[torch.Tensor]) -> list[tuple[str, str, int]]:
+    return [(str(tuple(t.shape)), str(t.dtype), t.numel() * t.element_size()) for t in tensors]
+
+
+def _plan_chunks(nbytes: list[int], chunk_bytes: int) -> list[list[tuple[int, int, int]]]:
+    """
+    Cut the byte stream of the tensors in chunks. Each chunk is a list of (tensor index, start byte, end byte).
+    Sender and receiver compute the same plan from the header.
+    """
+    chunks: list[list[tuple[int, int, int]]] = []
+    current: list[tuple[int, int, int]] = []
+    current_bytes = 0
+    for idx, size in enumerate(nbytes):
+        start = 0
+        while start < size:
+            end = min(size, start + chunk_bytes - current_bytes)
+            current.append((idx, start, end))
+            current_bytes += end - start
+            start = end
+            if current_bytes == chunk_bytes:
+                chunks.append(current)
+                current, current_bytes = [], 0
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def _direct_view(pieces: list[tuple[int, int, int]], byte_views: list[torch.Tensor | None]) -> torch.Tensor | None:
+    """Return the slice of storage to use as send / recv buffer if the chunk lies in a single contiguous cpu tensor"""
+    if len(pieces) != 1:
+        return None
+    idx, start, end = pieces[0]
+    view = byte_views[idx]
+    if view is None or view.device.type != "cpu":
+        return None
+    return view[start:end]
+
+
+def _allocate_staging(tensors: list[torch.Tensor], chunks: list[list[tuple[int, int, int]]]) -> list[torch.Tensor]:
+    """One staging buffer per chunk in flight, pinned if the tensors live on gpu"""
+    pin_memory = torch.cuda.is_available() and any(t.is_cuda for t in tensors)
+    max_chunk_bytes = max((sum(end - start for _, start, end in pieces) for pieces in chunks), default=0)
+    return [
+        torch.empty(max_chunk_bytes, dtype=torch.uint8, pin_memory=pin_memory)
+        for _ in range(min(BULK_PIPELINE_DEPTH, len(chunks)))
+    ]
+
+
+def send_tensors_bulk(
+    pg: ProcessGroup,
+    dest_rank: int,
+    tensors: list[torch.Tensor],
+    state_dict: dict | None = None,
+    chunk_bytes: int = BULK_CHUNK_BYTES,
+) -> None:
+    """
+    Send a list of tensors, and optionally a non tensor state dict, in a few large chunks.
+    To be used in pair with `recv_tensors_bulk`.
+    """
+    tensors = [_local_tensor(t) for t in tensors]
+    layout = _get_tensors_layout(tensors)
+    header_buffer, header_size = _object_to_tensor(
+        {"chunk_bytes": chunk_bytes, "layout": layout, "state_dict": state_dict}
+    )
+    pg.send([header_size], dest_rank, 0).wait()
+    pg.send([header_buffer], dest_rank, 0).wait()
+
+    byte_views = [_byte_view(t) for t in tensors]
+    chunks = _plan_chunks([nbytes for _, _, nbytes in layout], chunk_bytes)
+    staging = _allocate_staging(tensors, chunks)
+    in_flight: list[Any] = [None] * len(staging)
+
+    for i, pieces in enumerate(chunks):
+        slot = i % max(len(staging), 1)
+        # the staging buffer can only be refilled once its previous send is done
+        if in_flight[slot] is not None:
+            in_flight[slot].wait()
+
+        buffer = _direct_view(pieces, byte_views)
+        if buffer is None:
+            offset = 0
+            for idx, start, end in pieces:
+                src = byte_views[idx]
+                if src is None:
+                    src = _byte_view(tensors[idx].contiguous())
+                staging[slot][offset : offset + end - start].copy_(src[start:end])
+                offset += end - start
+            buffer = staging[slot][:offset]
+
+        in_flight[slot] = pg.send([buffer], dest_rank, i + 1)
+
+    for work in in_flight:
+        if work is not None:
+            work.wait()
+
+
+def recv_tensors_bulk(
+    pg: ProcessGroup,
+    src_rank: int,
+    tensors: list[torch.Tensor],
+) -> dict | None:
+    """
+    Receive a list of tensors sent with `send_tensors_bulk` directly into `tensors`.
+    Return the non tensor state dict sent along with them, if any.
+    """
+    size = torch.LongTensor(1)
+    pg.recv([size], src_rank, 0).wait()
+    header_buffer = torch.empty(size.item(), dtype=torch.uint8)
+    pg.recv([header_buffer], src_rank, 0).wait()
+    header = _tensor_to_object(header_buffer, size)
+
+    tensors = [_local_tensor(t) for t in tensors]
+    layout = _get_tensors_layout(tensors)
+    if header["layout"] != layout:
+        mismatches = [
+            f"tensor {i}: expected {expected} got {received}"
+            for i, (expected, received) in enumerate(zip(layout, header["layout"]))
+            if expected != received
+        ]
+        raise ValueError(
+            f"Bulk transfer layout mismatch: {len(header['layout'])} tensors received, {len(layout)} expected. "
+            + "; ".join(mismatches[:5])
+        )
+
+    chunk_bytes = header["chunk_bytes"]
+    byte_views = [_byte_view(t) for t in tensors]
+    chunks = _plan_chunks([nbytes for _, _, nbytes in layout], chunk_bytes)
+    staging = _allocate_staging(tensors, chunks)
+    posted: dict[int, tuple[Any, torch.Tensor, bool]] = {}
+
+    def post(i: int):
+        direct = _direct_view(chunks[i], byte_views)
+        if direct is not None:
+            posted[i] = (pg.recv([direct], src_rank, i + 1), direct, True)
+        else:
+            buffer = staging[i % len(staging)][: sum(end - start for _, start, end in chunks[i])]
+            posted[i] = (pg.recv([buffer], src_rank, i + 1), buffer, False)
+
+    # keep BULK_PIPELINE_DEPTH receives in flight, a staging buffer is reused once its chunk has been unpacked
+    for i in range(min(len(staging), len(chunks))):
+        post(i)
+
+    for i, pieces in enumerate(chunks):
+        work, buffer, direct = posted.pop(i)
+        work.wait()
+
+        if not direct:
+            offset = 0
+            for idx, start, end in pieces:
+                dest = byte_views[idx]
+                if dest is not None:
+                    dest[start:end].copy_(buffer[offset : offset + end - start])
+                else:
+                    # non contiguous destination, go through a contiguous copy of the whole tensor
+                    flat = tensors[idx].contiguous()
+                    _byte_view(flat)[start:end].copy_(buffer[offset : offset + end - start])
+                    tensors[idx].copy_(flat)
+                offset += end - start
+
+        if i + len(staging) < len(chunks):
+            post(i + len(staging))
+
+    return header["state_dict"]
+
+
+def send_state_dict_bulk(
+    pg: ProcessGroup, state_dict: dict, dest_rank: int, chunk_bytes: int = BULK_CHUNK_BYTES
+) -> None:
+    non_tensored_state_dict, tensors = _get_sendable_state_dict(state_dict)
+    send_tensors_bulk(pg, dest_rank, tensors, state_dict=non_tensored_state_dict, chunk_bytes=chunk_bytes)
+
+
+def recv_state_dict_bulk(pg: ProcessGroup, src_rank: int, og_state_dict: dict) -> dict:
+    """Same as `recv_state_dict` but the tensors of `og_state_dict` are received in place with `recv_tensors_bulk`"""
+    _, tensors = _get_sendable_state_dict(og_state_dict)
+    state_dict = recv_tensors_bulk(pg, src_rank, tensors)
+    return _load_sendable_state_dict(tensors, state_dict)
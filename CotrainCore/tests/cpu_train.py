@@ -0,0 +1,81 @@
+"""
+CPU stand-in of the train entry point for tests/test_training_manager.py, train.py needs cuda.
+
+It reads the same config, uses the FakeTokenizer and the fake data with a tiny language model, and talks to the
+TrainingManager with the same code as train.py: the metric logger of `get_metric_logger` and `stop_requested` on a
+single process gloo group. It checkpoints and exits once the stop file exists, and resumes from `--ckpt.resume`.
+"""
+
+import os
+
+import torch
+import torch.distributed as dist
+import torch.nn.functional as F
+from pydantic_config import parse_argv
+
+from zeroband.config import Config, resolve_env_vars
+from zeroband.data import TEST_VOCAB_SIZE, FakeTokenizedDataset
+from zeroband.training_manager import stop_requested
+from zeroband.utils import FakeTokenizer
+from zeroband.utils.metric_logger import get_metric_logger
+
+
+def main(config: Config):
+    tokenizer = FakeTokenizer()
+    dataset = FakeTokenizedDataset(config.data.seq_length, TEST_VOCAB_SIZE)
+    model = torch.nn.Sequential(torch.nn.Embedding(TEST_VOCAB_SIZE, 32), torch.nn.Linear(32, TEST_VOCAB_SIZE))
+    optimizer = torch.optim.AdamW(model.parameters(), lr=config.optim.optim.lr)
+    step = 0
+
+    if config.ckpt.resume is not None:
+        state = torch.load(os.path.join(config.ckpt.resume, "state.pt"), weights_only=True)
+        model.load_state_dict(state["model"])
+        optimizer.load_state_dict(state["optimizer"])
+        dataset.load_state_dict(state["data"])
+        step = state["step"]
+        print(f"Resumed from {config.ckpt.resume} at step {step}", flush=True)
+
+    assert config.metric_logger_type == "stream"
+    metric_logger = get_metric_logger(config, logger_config={"config": config.model_dump()})
+    samples = iter(dataset)
+
+    while step < config.optim.total_steps:
+        tokens = torch.full((config.optim.batch_size, config.data.seq_length), tokenizer.pad_token_id)
+        for i in range(config.optim.batch_size):
+            sample = next(samples)["input_ids"]
+            tokens[i, : len(sample)] = torch.tensor(sample)
+
+        logits = model(tokens[:, :-1])
+        loss = F.cross_entropy(logits.flatten(0, 1), tokens[:, 1:].flatten(), ignore_index=tokenizer.pad_token_id)
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad()
+        step += 1
+
+        metric_logger.log({"step": step, "Loss": loss.item(), "inner_lr": config.optim.optim.lr})
+        print(f"step: {step}, loss: {loss.item():.4f}", flush=True)
+
+        stop = config.stop_file is not None and stop_requested(config.stop_file, dist.group.WORLD)
+        if config.ckpt.path is not None and (stop or step % config.ckpt.interval == 0):
+            ckpt_path = os.path.join(config.ckpt.path, f"step_{step}")
+            os.makedirs(ckpt_path, exist_ok=True)
+            state = {
+                "model": model.state_dict(),
+                "optimizer": optimizer.state_dict(),
+                "data": dataset.state_dict(),
+                "step": step,
+            }
+            torch.save(state, os.path.join(ckpt_path, "state.pt"))
+        if stop:
+            print(f"Found the stop file {config.stop_file}, stopping at step {step}", flush=True)
+            break
+
+    metric_logger.finish()
+
+
+if __name__ == "__main__":
+    config = Config(**parse_argv())  # type: ignore
+    resolve_env_vars(config)
+    dist.init_process_group("gloo", store=dist.HashStore(), rank=0, world_size=1)
+    main(config)
+    dist.destroy_process_group()
@@ -1,7 +1,8 @@
 import torch
 import torch.distributed as dist
 from zeroband.C.collectives import ring_allreduce
-from zeroband.collectives import ring_allreduce_py
+from zeroband.collectives import all_gather_max_world_size, error_feedback_all_reduce, ring_allreduce_py
+from zeroband.config import Compression
 from zeroband.C.compression import uniform_8bit_quantize
 import math
 import pytest
@@ -66,3 +67,110 @@ def test_ring_allreduce(world_size: int, pg_source: str, random_available_port:
         p.join()
         if p.exitcode != 0:
             pytest.fail(f"Process {p.pid} failed with exit code {p.exitcode}")
+
+
+def test_all_gather_max_world_size():
+    assert all_gather_max_world_size(Compression.QUANTILE4) == 4
+    assert all_gather_max_world_size(Compression.TOPK, topk_ratio=0.01) == 25
+    assert all_gather_max_world_size(Compression.TOPK, topk_ratio=1.0) == 1
+
+
+@pytest.mark.parametrize("compression", [Compression.QUANTILE4, Compression.TOPK])
+def test_error_feedback_all_reduce(compression: Compression, random_available_port: int, dist_environment):
+    world_size = 2
+
+    def all_reduce(rank: int, world_size: int):
+        with dist_environment(random_available_port, "gloo", rank=rank, world_size=world_size):
+            dist.init_process_group(backend="gloo")
+            torch.manual_seed(rank)
+            a = torch.randn(N // 10)
+            expected = a.clone()
+            dist.all_reduce(expected, dist.ReduceOp.SUM)
+
+            residual = torch.zeros_like(a)
+            staged = torch.zeros_like(a)
+            b = a.clone()
+            error_feedback_all_reduce(compression, b, residual, dist.ReduceOp.SUM, topk_ratio=0.1, new_residual=staged)
+            assert residual.abs().sum() == 0  # staged residuals leave the residual untouched until they are committed
+            residual.copy_(staged)
+
+            # the residual is what this rank did not send
+            assert residual.abs().sum() > 0
+            sent = a - residual
+            sent_sum = sent.clone()
+            dist.all_reduce(sent_sum, dist.ReduceOp.SUM)
+            assert torch.allclose(b, sent_sum, atol=1e-4)
+
+            # with error feedback, the sum over several rounds is much closer to the exact sum than a single round
+            single_round_error = torch.norm(b - expected) / torch.norm(expected)
+            total, total_expected = b.clone(), expected.clone()
+            for _ in range(30):
+                c = a.clone()
+                error_feedback_all_reduce(compression, c, residual, dist.ReduceOp.SUM, topk_ratio=0.1)
+                total += c
+                total_expected += expected
+            assert torch.norm(total - total_expected) / torch.norm(total_expected) < 0.5 * single_round_error
+
+            dist.destroy_process_group()
+
+    processes = [mp.Process(target=all_reduce, args=(rank, world_size)) for rank in range(world_size)]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+        if p.exitcode != 0:
+            pytest.fail(f"Process {p.pid} failed with exit code {p.exitcode}")
+
+
+@pytest.mark.parametrize("world_size", [2, 3])
+@pytest.mark.parametrize("buffer_depth", [1, 4])
+@pytest.mark.parametrize("quantize", [False, True])
+def test_pipelined_ring_allreduce(
+    world_size: int, buffer_depth: int, quantize: bool, random_available_port: int, dist_environment
+):
+    def all_reduce(rank: int, world_size: int):
+        with dist_environment(random_available_port, "gloo", rank=rank, world_size=world_size):
+            dist.init_process_group(backend="gloo")
+            store = dist.TCPStore(
+                host_name="localhost",
+                port=random_available_port + 1,
+                world_size=world_size,
+                is_master=(rank == 0),
+            )
+            pg = dist.distributed_c10d.ProcessGroupGloo(store, rank, world_size)
+
+            torch.manual_seed(rank)
+            # not divisible by the world size nor by the chunk size
+            a = torch.randn(100_003)
+            expected = a.clone()
+            dist.all_reduce(expected, dist.ReduceOp.AVG)
+
+            ring_allreduce_py(
+                a,
+                dist.ReduceOp.AVG,
+                pg,
+                quantization_func=uniform_8bit_quantize if quantize else None,
+                buffer_depth=buffer_depth,
+                chunk_size=7_000,
+            )
+
+            if quantize:
+                assert torch.norm(a - expected) / torch.norm(expected) < 0.1
+            else:
+                assert torch.allclose(a, expected, atol=1e-5)
+
+            # all the ranks must end up with exactly the same tensor
+            gathered = [torch.empty_like(a) for _ in range(world_size)]
+            dist.all_gather(gathered, a)
+            for other in gathered:
+                assert torch.equal(other, a)
+
+            dist.destroy_process_group()
+
+    processes = [mp.Process(target=all_reduce, args=(rank, world_size)) for rank in range(world_size)]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+        if p.exitcode != 0:
+            pytest.fail(f"Process {p.pid} failed with exit code {p.exitcode}")
@@ -1,9 +1,20 @@
+import math
+
+import pytest
 import torch
 from torch.utils.benchmark import Timer
 from zeroband.compression import uniform_8bit_quantize as uniform_8bit_quantize_old
 from zeroband.compression import average_buckets as average_buckets_old
+from zeroband.compression import quantile_4bit_dequantize, quantile_4bit_quantize, topk_sparsify
 
-from zeroband.C.compression import average_buckets, uniform_8bit_quantize, quantize_per_tensor_uint8
+from zeroband.C.compression import (
+    average_buckets,
+    get_num_threads,
+    quantize_per_tensor_uint8,
+    set_num_threads,
+    uniform_8bit_quantize,
+    uniform_8bit_quantize_batched,
+)
 
 N = 10_000_000
 TIME_COUNT = 1
@@ -76,3 +87,68 @@ def test_average_buckets():
     )
     time_old = timer_old.timeit(TIME_COUNT)
     print(f"torch.bucketize time: {time_old.mean:.6f} seconds")
+
+
+def _reference_uniform_8bit_quantize(tensor: torch.Tensor) -> torch.Tensor:
+    """The codes of the C++ kernel computed with torch ops: clamp(round(x / scale) + 128, 0, 255), ties rounded up"""
+    n_bins = 256
+    std_unbiased = math.sqrt(tensor.double().square().sum().item() / max(tensor.numel() - 1, 1))
+    inv_scale = 1.0 / (6.0 * std_unbiased / n_bins)
+    return torch.clamp(torch.floor(tensor * inv_scale + (n_bins // 2 + 0.5)), 0, n_bins - 1).to(torch.uint8)
+
+
+def test_uniform_8bit_quantize_batched():
+    tensors = [torch.randn(size) for size in [1, 100, 10_000, 1_000_000, N]]
+
+    results = uniform_8bit_quantize_batched(tensors)
+
+    assert len(results) == len(tensors)
+    for tensor, (quantized, lookup) in zip(tensors, results):
+        assert quantized.shape == tensor.shape
+        # float rounding of the scale may move a value on a bucket border to the next bucket
+        diff = (quantized.int() - _reference_uniform_8bit_quantize(tensor).int()).abs()
+        assert diff.max() <= 1 and (diff > 0).float().mean() < 1e-4
+        # the lookup is the average of the values of each bucket, computed by the python implementation
+        torch.testing.assert_close(lookup, average_buckets_old(tensor, quantized, 256), rtol=1e-3, atol=1e-5)
+
+
+def test_num_threads_does_not_change_results():
+    a = torch.randn(N)
+    num_threads = get_num_threads()
+    try:
+        set_num_threads(1)
+        single_quantized, single_lookup = uniform_8bit_quantize(a)
+        set_num_threads(4)
+        assert get_num_threads() == 4
+        multi_quantized, multi_lookup = uniform_8bit_quantize(a)
+    finally:
+        set_num_threads(num_threads)
+
+    assert torch.equal(single_quantized, multi_quantized)
+    torch.testing.assert_close(single_lookup, multi_lookup)
+
+
+@pytest.mark.parametrize("numel", [1, 1001, 100_000])
+def test_quantile_4bit_quantize(numel: int):
+    a = torch.randn(numel)
+    packed, lookup = quantile_4bit_quantize(a)
+
+    assert packed.dtype == torch.uint8
+    assert packed.numel() == (numel + 1) // 2
+    assert lookup.numel() == 16
+
+    b = quantile_4bit_dequantize(packed, lookup, numel)
+    assert b.shape == a.shape
+    # every value lands in one of the 16 buckets, which are ordered
+    assert torch.all(lookup[1:] >= lookup[:-1])
+    if numel > 1000:
+        assert torch.norm(b - a) / torch.norm(a) < 0.2
+
+
+def test_topk_sparsify():
+    a = torch.randn(10_000)
+    values, indices = topk_sparsify(a, 100)
+
+    assert indices.dtype == torch.int32
+    assert torch.equal(a[indices.long()], values)
+    assert values.abs().min() >= torch.topk(a.abs(), 100).values.min()
@@ -0,0 +1,70 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+
+import pytest
+import torch
+
+from zeroband.checkpoint import (
+    DELTA_BASE_FILE,
+    apply_state_delta,
+    clone_local_state,
+    encode_state_delta,
+    get_checkpoints_to_delete,
+)
+
+
+@pytest.mark.parametrize("dtype", [torch.float32, torch.bfloat16, torch.int64, torch.bool])
+def test_state_delta_roundtrip(dtype: torch.dtype):
+    base_state = {
+        "model": {"weight": (torch.randn(64, 32) * 10).to(dtype), "empty": torch.empty(0, dtype=dtype)},
+        "step": 3,
+    }
+    base = clone_local_state(base_state)
+
+    new_state = {
+        "model": {
+            "weight": (base_state["model"]["weight"].float() + torch.randn(64, 32) * 0.01).to(dtype),
+            "empty": torch.empty(0, dtype=dtype),
+            "new": torch.ones(5, dtype=dtype),  # not in the base
+        },
+        "step": 4,
+    }
+    delta = encode_state_delta(new_state, base)
+
+    # the delta is applied on a state holding the base values, like after loading the base checkpoint
+    loaded = clone_local_state(base_state)
+    apply_state_delta(loaded, delta)
+
+    assert loaded["step"] == 4
+    for key, value in new_state["model"].items():
+        assert loaded["model"][key].dtype == value.dtype
+        assert torch.equal(loaded["model"][key], value)
+
+
+def test_state_delta_is_small():
+    base = {"weight": torch.randn(1_000_000)}
+    state = {"weight": base["weight"].clone()}
+    state["weight"][:1000] += 1
+
+    with ThreadPoolExecutor(4) as executor:
+        delta = encode_state_delta(state, base, executor)
+    assert len(delta["weight"].chunks) > 1
+    assert sum(len(chunk) for chunk in delta["weight"].chunks) < 0.05 * base["weight"].numel() * 4
+
+    loaded = clone_local_state(base)
+    apply_state_delta(loaded, delta)
+    assert torch.equal(loaded["weight"], state["weight"])
+
+
+def test_delete_topk_keeps_delta_bases(tmp_path):
+    # step_10 is a full checkpoint, step_20 and step_30 are deltas against it
+    for step in [5, 10, 20, 30]:
+        os.makedirs(tmp_path / f"step_{step}")
+    for step in [20, 30]:
+        (tmp_path / f"step_{step}" / DELTA_BASE_FILE).write_text("step_10")
+
+    to_delete = get_checkpoints_to_delete(str(tmp_path), topk=2)
+    assert to_delete == [str(tmp_path / "step_5")]
+
+    to_delete = get_checkpoints_to_delete(str(tmp_path), topk=3)
+    assert to_delete == [str(tmp_path / "step_5")]
@@ -1,4 +1,6 @@
 import copy
+import os
+import numpy as np
 import torch
 from tests.test_dist.zeroband import InterleaveDataset, ParquetDataset, SequencePackingDataSet, collate_fn
 from torch.utils.data import DataLoader
@@ -14,6 +16,8 @@ from faker import Faker
 from typing import List
 import string
 from torchdata.stateful_dataloader import StatefulDataLoader
+from zeroband.data import StreamingParquetDataset, TokenShardDataset, TokenShardWriter, load_token_shard
+from zeroband import data as zeroband_data
 
 
 @pytest.mark.skip(reason="not using hf for now")
@@ -156,6 +160,20 @@ def parquet_files(tmp_path, fake_sentences):
     return files
 
 
+@pytest.fixture
+def parquet_files_row_groups(tmp_path, fake_sentences):
+    """Create 4 parquet files with 100 sentences each split into row groups of 16 rows"""
+    files = []
+    for i in range(4):
+        sentences = fake_sentences[i * 100 : (i + 1) * 100]
+        table = pa.Table.from_arrays([pa.array(sentences)], names=["text"])
+        file_path = tmp_path / f"data_rg_{i}.parquet"
+        pq.write_table(table, file_path, row_group_size=16)
+        files.append(str(file_path))
+
+    return files
+
+
 @pytest.fixture
 def tokenizer():
     """Get a simple character-based tokenizer"""
@@ -183,6 +201,92 @@ def test_parquet_dataset_ckpt(parquet_files, tokenizer):
         assert data1["input_ids"] == data2["input_ids"]
 
 
+@pytest.mark.parametrize("num_workers", [0, 2])
+def test_streaming_parquet_dataset(parquet_files_row_groups, fake_sentences, tokenizer, num_workers):
+    dataset = StreamingParquetDataset(parquet_files_row_groups, tokenizer, num_workers=num_workers, queue_size=2)
+
+    # 500 samples go through the 4 files and wrap around to the first one
+    expected = fake_sentences[:400] + fake_sentences[:100]
+    for sentence, data in zip(expected, dataset):
+        assert data["input_ids"] == tokenizer.encode(sentence)
+
+
+@pytest.mark.parametrize("num_workers", [0, 2])
+def test_streaming_parquet_dataset_ckpt(parquet_files_row_groups, tokenizer, num_workers):
+    dataset1 = StreamingParquetDataset(parquet_files_row_groups, tokenizer, num_workers=num_workers)
+    halfway_point = 150
+
+    for _, data in zip(range(halfway_point), dataset1):
+        pass
+
+    state_dict = dataset1.state_dict()
+    # 150 = 100 rows of the first file + 3 row groups of 16 + 2 rows
+    assert (state_dict["file_index"], state_dict["row_group_index"], state_dict["row_offset"]) == (1, 3, 2)
+
+    dataset2 = StreamingParquetDataset(parquet_files_row_groups, tokenizer, num_workers=num_workers)
+    dataset2.load_state_dict(copy.deepcopy(state_dict))
+
+    for _, data1, data2 in zip(range(400), dataset1, dataset2):
+        assert data1["input_ids"] == data2["input_ids"]
+
+
+@pytest.fixture
+def token_shards(tmp_path):
+    """Create 2 token shards with 20 documents each, document i of shard j is made of the token 10 * j + i"""
+    files = []
+    for j in range(2):
+        path = str(tmp_path / f"shard_{j}")
+        with TokenShardWriter(path, vocab_size=1024, eos_token=0) as writer:
+            for i in range(20):
+                writer.write([10 * j + i + 1] * (i % 5 + 1))
+        files.append(path + ".bin")
+    return files
+
+
+def test_token_shard_roundtrip(token_shards):
+    tokens, offsets = load_token_shard(token_shards[0])
+    assert tokens.dtype == np.uint16
+    assert len(offsets) == 21
+    assert offsets[-1] == len(tokens)
+    # each document is followed by the eos token
+    assert tokens[offsets[3] : offsets[4]].tolist() == [4, 4, 4, 4, 0]
+
+
+def test_token_shard_dataset(token_shards):
+    seq_length = 8
+    dataset = TokenShardDataset(token_shards, seq_length=seq_length)
+
+    tokens = [load_token_shard(file)[0] for file in token_shards]
+    expected_windows = []
+    for shard in tokens:
+        for start in range(0, len(shard) - seq_length, seq_length):
+            expected_windows.append(shard[start : start + seq_length + 1].tolist())
+
+    for window, data in zip(expected_windows, dataset):
+        assert data["input_ids"].tolist() == window[:-1]
+        assert data["labels"].tolist() == window[1:]
+        assert sum(data["seqlens"]) == seq_length
+        # every document ends with an eos so the number of segments is the number of eos in the window + 1 at most
+        assert len(data["seqlens"]) <= window[:-1].count(0) + 1
+
+
+def test_token_shard_dataset_ckpt(token_shards):
+    dataset1 = TokenShardDataset(token_shards, seq_length=8)
+
+    for _, data in zip(range(10), dataset1):
+        pass
+
+    state_dict = dataset1.state_dict()
+
+    dataset2 = TokenShardDataset(token_shards, seq_length=8)
+    dataset2.load_state_dict(copy.deepcopy(state_dict))
+
+    for _, data1, data2 in zip(range(50), dataset1, dataset2):
+        assert (data1["input_ids"] == data2["input_ids"]).all()
+        assert (data1["labels"] == data2["labels"]).all()
+        assert data1["seqlens"] == data2["seqlens"]
+
+
 def test_sequence_packing_dataset_ckpt(parquet_files, tokenizer):
     dataset1 = SequencePackingDataSet(ParquetDataset(parquet_files, tokenizer), max_seq_length=16, eos_token=0)
 
@@ -239,6 +343,157 @@ def test_interleave_dataset_ckpt(parquet_files, tokenizer):
         assert data1["input_ids"] == data2["input_ids"]
 
 
+def _split_parquet_datasets(parquet_files, tokenizer):
+    return [
+        zeroband_data.ParquetDataset(parquet_files[:2], tokenizer),
+        zeroband_data.ParquetDataset(parquet_files[2:4], tokenizer),
+    ]
+
+
+def test_interleave_dataset_resume_bit_identical(parquet_files, tokenizer):
+    def make_dataset():
+        return zeroband_data.InterleaveDataset(
+            _split_parquet_datasets(parquet_files, tokenizer),
+            probabilities=[0.3, 0.7],
+        )
+
+    reference = make_dataset()
+    expected = [data["input_ids"] for _, data in zip(range(300), reference)]
+
+    dataset1 = make_dataset()
+    for _, data in zip(range(100), dataset1):
+        pass
+    state_dict = copy.deepcopy(dataset1.state_dict())
+    assert sum(state_dict["interleave_state"]["samples_per_dataset"]) == 100
+
+    dataset2 = make_dataset()
+    dataset2.load_state_dict(state_dict)
+    resumed = [data["input_ids"] for _, data in zip(range(200), dataset2)]
+
+    assert resumed == expected[100:]
+
+
+def test_interleave_dataset_restore_is_constant_time(parquet_files, tokenizer):
+    dataset = zeroband_data.InterleaveDataset(
+        _split_parquet_datasets(parquet_files, tokenizer),
+        probabilities=[0.5, 0.5],
+    )
+    state_dict = dataset.state_dict()
+    state_dict["interleave_state"]["current_index"] = 10**15  # replaying that many draws would never finish
+    dataset.load_state_dict(state_dict)
+
+    sample = next(iter(dataset))
+    assert len(sample["input_ids"]) > 0
+    assert dataset.state.current_index == 10**15 + 1
+
+
+def test_interleave_dataset_load_legacy_state(parquet_files, tokenizer):
+    dataset = zeroband_data.InterleaveDataset(
+        _split_parquet_datasets(parquet_files, tokenizer),
+        probabilities=[0.5, 0.5],
+    )
+    state_dict = dataset.state_dict()
+    del state_dict["interleave_state"]["samples_per_dataset"]
+    dataset.load_state_dict(state_dict)
+
+    assert dataset.state.samples_per_dataset == [0, 0]
+    next(iter(dataset))
+    assert sum(dataset.state.samples_per_dataset) == 1
+
+
+def test_fake_dataset_resume_bit_identical():
+    reference = zeroband_data.FakeTokenizedDataset(seq_len=16, vocab_size=64)
+    expected = [data["input_ids"] for _, data in zip(range(50), reference)]
+
+    dataset1 = zeroband_data.FakeTokenizedDataset(seq_len=16, vocab_size=64)
+    for _, data in zip(range(20), dataset1):
+        pass
+
+    dataset2 = zeroband_data.FakeTokenizedDataset(seq_len=16, vocab_size=64)
+    dataset2.load_state_dict(dataset1.state_dict())
+    resumed = [data["input_ids"] for _, data in zip(range(30), dataset2)]
+
+    assert resumed == expected[20:]
+    assert all(1 <= len(input_ids) <= 16 and min(input_ids) >= 3 and max(input_ids) < 64 for input_ids in expected)
+
+    # consecutive samples are independent, not shifted copies of each other
+    def _contains(tokens: list[int], sub: list[int]) -> bool:
+        if len(sub) < 4:  # short runs of tokens match by chance
+            return False
+        return any(tokens[i : i + len(sub)] == sub for i in range(len(tokens) - len(sub) + 1))
+
+    overlaps = [_contains(prev, cur[:4]) or _contains(cur, prev[:4]) for prev, cur in zip(expected, expected[1:])]
+    assert sum(overlaps) <= 2
+
+
+@pytest.mark.parametrize("num_samples", [1, 99, 100, 1234, 2500])
+def test_parquet_dataset_seek(parquet_files, tokenizer, num_samples):
+    dataset1 = zeroband_data.ParquetDataset(parquet_files[:3], tokenizer)
+    for _, data in zip(range(num_samples), dataset1):
+        pass
+
+    dataset2 = zeroband_data.ParquetDataset(parquet_files[:3], tokenizer)
+    dataset2.seek(num_samples)
+
+    assert dataset1.state_dict() == dataset2.state_dict()
+    for _, data1, data2 in zip(range(50), dataset1, dataset2):
+        assert data1["input_ids"] == data2["input_ids"]
+
+
+@pytest.mark.parametrize("num_samples", [1, 16, 100, 150, 1234, 2500])
+def test_streaming_parquet_dataset_seek(parquet_files_row_groups, tokenizer, num_samples):
+    dataset1 = StreamingParquetDataset(parquet_files_row_groups[:3], tokenizer)
+    for _, data in zip(range(num_samples), dataset1):
+        pass
+
+    dataset2 = StreamingParquetDataset(parquet_files_row_groups[:3], tokenizer)
+    dataset2.seek(num_samples)
+    lengths = [length for _, length in zip(range(50), dataset2.sample_lengths())]
+
+    assert dataset1.state_dict() == dataset2.state_dict()
+    for _, data1, data2, length in zip(range(50), dataset1, dataset2, lengths):
+        assert data1["input_ids"] == data2["input_ids"]
+        assert len(data2["input_ids"]) == length
+
+
+def test_parquet_dataset_token_counts_cache(parquet_files, tokenizer, tmp_path, monkeypatch):
+    cache_dir = str(tmp_path / "token_counts")
+    dataset = zeroband_data.ParquetDataset(parquet_files[:2], tokenizer, token_counts_cache_dir=cache_dir)
+    lengths = [length for _, length in zip(range(150), dataset.sample_lengths())]
+    assert lengths == [len(data["input_ids"]) for _, data in zip(range(150), dataset)]
+    assert len(os.listdir(cache_dir)) == 2
+
+    # a new dataset reads the counts from the cache instead of tokenizing the files
+    def _fail(*args, **kwargs):
+        raise AssertionError("the token counts should come from the cache")
+
+    monkeypatch.setattr(zeroband_data, "_encode_texts", _fail)
+    dataset = zeroband_data.ParquetDataset(parquet_files[:2], tokenizer, token_counts_cache_dir=cache_dir)
+    assert [length for _, length in zip(range(150), dataset.sample_lengths())] == lengths
+
+
+@pytest.mark.parametrize("num_samples", [1, 37, 500])
+def test_sequence_packing_interleave_dataset_seek(parquet_files, tokenizer, num_samples):
+    def make_dataset():
+        interleave = zeroband_data.InterleaveDataset(
+            _split_parquet_datasets(parquet_files, tokenizer), probabilities=[0.3, 0.7]
+        )
+        return zeroband_data.SequencePackingDataSet(interleave, max_seq_length=64, eos_token=0)
+
+    dataset1 = make_dataset()
+    for _, data in zip(range(num_samples), dataset1):
+        pass
+
+    dataset2 = make_dataset()
+    dataset2.seek(num_samples)
+
+    assert dataset1.state_dict() == dataset2.state_dict()
+    for _, data1, data2 in zip(range(50), dataset1, dataset2):
+        assert (data1["input_ids"] == data2["input_ids"]).all()
+        assert (data1["labels"] == data2["labels"]).all()
+        assert data1["seqlens"] == data2["seqlens"]
+
+
 @pytest.mark.skip(reason="not working for now")
 @pytest.mark.parametrize("num_workers", [0, 2, 16])
 def test_dataloader_parquet_dataset(parquet_files, tokenizer, num_workers):
@@ -0,0 +1,88 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+import torch.distributed as dist
+
+from zeroband.comms import UNKNOWN_PING, ElasticDeviceMesh
+from zeroband.utils.logger import get_logger
+
+NUM_PEERS = 8
+PROBE_TIME = 0.2
+
+
+@pytest.fixture
+def mesh(random_available_port, monkeypatch):
+    store = dist.TCPStore("localhost", random_available_port, is_master=True, wait_for_workers=False)
+    peers = [f"peer{i}" for i in range(NUM_PEERS)]
+    for i, peer in enumerate(peers):
+        store.set(f"iperf_{peer}", f"127.0.0.{i + 1}:{10101 + i}")
+
+    # only the attributes used by the bandwidth probing, the mesh is not initialized
+    edm = ElasticDeviceMesh.__new__(ElasticDeviceMesh)
+    edm._logger = get_logger()
+    edm.world_info = SimpleNamespace(global_unique_id="self")
+    edm.god_store = store
+    edm._global_ids = ["self", *peers]
+    edm.bandwidth_probe_concurrency = 1
+    edm.bandwidth_cache_ttl = 600
+
+    edm.probed_hosts = []
+    edm.failing_hosts = set()
+    edm.max_concurrent_probes = 0
+    num_probes = 0
+    lock = threading.Lock()
+
+    def measure_bandwidth(target_host: str, target_port: int) -> int:
+        nonlocal num_probes
+        with lock:
+            num_probes += 1
+            edm.max_concurrent_probes = max(edm.max_concurrent_probes, num_probes)
+        time.sleep(PROBE_TIME)
+        with lock:
+            num_probes -= 1
+            edm.probed_hosts.append(target_host)
+        return UNKNOWN_PING if target_host in edm.failing_hosts else target_port
+
+    monkeypatch.setattr(edm, "measure_bandwidth", measure_bandwidth)
+    return edm
+
+
+def test_probes_run_one_after_the_other(mesh):
+    mesh._measure_connectivity()
+    assert mesh.max_concurrent_probes == 1
+    assert sorted(mesh.probed_hosts) == sorted(f"127.0.0.{i + 1}" for i in range(NUM_PEERS))
+
+
+def test_probes_run_concurrently(mesh):
+    mesh.bandwidth_probe_concurrency = NUM_PEERS
+    start = time.perf_counter()
+    mesh._measure_connectivity()
+    assert time.perf_counter() - start < NUM_PEERS * PROBE_TIME / 2
+
+    assert sorted(mesh.probed_hosts) == sorted(f"127.0.0.{i + 1}" for i in range(NUM_PEERS))
+    for i in range(NUM_PEERS):
+        assert int(mesh.god_store.get(f"ping_self_peer{i}")) == 10101 + i
+
+
+def test_cached_pairs_are_not_measured_again(mesh):
+    mesh.bandwidth_probe_concurrency = NUM_PEERS
+    mesh.failing_hosts = {"127.0.0.3"}
+    mesh._measure_connectivity()
+    assert len(mesh.probed_hosts) == NUM_PEERS
+    assert int(mesh.god_store.get("ping_self_peer2")) == UNKNOWN_PING
+
+    # a new peer and the failed probe are measured, the others come from the cache
+    mesh.god_store.set("iperf_new_peer", "127.0.0.100:10200")
+    mesh._global_ids.append("new_peer")
+    mesh.probed_hosts = []
+    mesh._measure_connectivity()
+    assert sorted(mesh.probed_hosts) == ["127.0.0.100", "127.0.0.3"]
+
+    # stale pairs are measured again
+    mesh.bandwidth_cache_ttl = 0
+    mesh.probed_hosts = []
+    time.sleep(0.01)
+    mesh._measure_connectivity()
+    assert len(mesh.probed_hosts) == NUM_PEERS + 1
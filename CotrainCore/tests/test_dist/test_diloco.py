@@ -25,6 +25,7 @@ def test_diloco_all_reduce(world_size, random_available_port, dist_environment):
     class FakeElasticDeviceMesh:
         def __init__(self):
             self.global_pg = dist.new_group(backend="gloo")
+            self.hierarchical_groups = None
 
         def maybe_reinit_global_pg(self, *args, **kwargs) -> None: ...
 
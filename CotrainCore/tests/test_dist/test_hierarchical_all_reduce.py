@@ -0,0 +1,65 @@
+from datetime import timedelta
+import multiprocessing as mp
+
+import pytest
+import torch
+import torch.distributed as dist
+
+from zeroband.collectives import (
+    Compression,
+    create_hierarchical_groups,
+    gloo_all_reduce,
+    group_ranks_by_bandwidth,
+    group_ranks_by_label,
+    hierarchical_all_reduce,
+)
+
+N = 100_003  # not a multiple of the world size
+
+
+def test_group_ranks_by_label():
+    assert group_ranks_by_label(["us", "eu", "us", "asia", "eu"]) == [[0, 2], [1, 4], [3]]
+
+
+def test_group_ranks_by_bandwidth():
+    slow, fast = 10_000, 100
+    pings = [[slow] * 5 for _ in range(5)]
+    for i, j in [(0, 3), (3, 4), (1, 2)]:
+        pings[i][j] = pings[j][i] = fast
+    pings[1][4] = fast  # only fast in one direction
+    assert group_ranks_by_bandwidth(pings, max_ping=1_000) == [[0, 3, 4], [1, 2]]
+    assert group_ranks_by_bandwidth(pings, max_ping=10) == [[0], [1], [2], [3], [4]]
+
+
+@pytest.mark.parametrize(
+    "groups",
+    [[[0, 1], [2, 3]], [[0, 2, 3], [1]], [[0], [1], [2], [3]], [[0, 1, 2, 3]]],
+)
+@pytest.mark.parametrize("op", [dist.ReduceOp.SUM, dist.ReduceOp.AVG])
+def test_hierarchical_all_reduce(groups, op, random_available_port, dist_environment):
+    world_size = 4
+
+    def all_reduce(rank: int):
+        with dist_environment(random_available_port, "gloo", rank=rank, world_size=world_size):
+            dist.init_process_group(backend="gloo")
+            store = dist.TCPStore("localhost", random_available_port + 1, world_size, is_master=rank == 0)
+            hierarchical_groups = create_hierarchical_groups(
+                store, rank, groups, prefix="test", timeout=timedelta(seconds=60)
+            )
+
+            torch.manual_seed(rank)
+            a = torch.randn(N)
+            b = a.clone()
+            hierarchical_all_reduce(Compression.NO, a, hierarchical_groups, op)
+            gloo_all_reduce(b, op)
+
+            assert torch.allclose(a, b, atol=1e-5)
+            dist.destroy_process_group()
+
+    processes = [mp.Process(target=all_reduce, args=(rank,)) for rank in range(world_size)]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+        if p.exitcode != 0:
+            pytest.fail(f"Process {p.pid} failed with exit code {p.exitcode}")
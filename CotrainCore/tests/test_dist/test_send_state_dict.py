@@ -1,12 +1,16 @@
 import os
 import pytest
 import torch
+import torch.distributed as dist
 from zeroband.comms import ElasticDeviceMesh
 from zeroband.utils.state_dict_send_recv import (
     _get_sendable_state_dict,
     _load_sendable_state_dict,
+    _plan_chunks,
     recv_state_dict,
+    recv_state_dict_bulk,
     send_state_dict,
+    send_state_dict_bulk,
 )
 import multiprocessing as mp
 
@@ -108,3 +112,66 @@ def test_send_recv_state_dict(world_size: int, random_available_port: int, mock_
         p.join()
         if p.exitcode != 0:
             pytest.fail(f"Process {p.pid} failed with exit code {p.exitcode}")
+
+
+def test_plan_chunks():
+    chunks = _plan_chunks([10, 3, 25, 0, 2], chunk_bytes=8)
+
+    assert all(sum(end - start for _, start, end in pieces) <= 8 for pieces in chunks)
+    assert sum(end - start for pieces in chunks for _, start, end in pieces) == 40
+    # small tensors are packed together and large ones are split
+    assert chunks[1] == [(0, 8, 10), (1, 0, 3), (2, 0, 3)]
+    assert chunks[-1] == [(2, 19, 25), (4, 0, 2)]
+
+
+@pytest.mark.parametrize("chunk_bytes", [7, 1024 * 1024])
+def test_send_recv_state_dict_bulk(chunk_bytes: int, random_available_port: int, mock_env):
+    def make_state_dict(fill: float) -> dict:
+        return {
+            "step": int(fill),
+            "weight": torch.full((4, 5), fill),
+            "nested": {"bias": torch.full((3,), fill, dtype=torch.bfloat16), "ids": torch.full((7,), int(fill))},
+            "transposed": torch.full((5, 4), fill).t(),
+        }
+
+    def foo(**kwargs):
+        with mock_env(**kwargs):
+            dist.init_process_group(backend="gloo")
+            pg = dist.distributed_c10d._get_default_group()
+
+            if dist.get_rank() == 0:
+                send_state_dict_bulk(pg, make_state_dict(1.0), 1, chunk_bytes=chunk_bytes)
+            else:
+                og_state_dict = make_state_dict(0.0)
+                storage_ptr = og_state_dict["weight"].data_ptr()
+                state_dict = recv_state_dict_bulk(pg, 0, og_state_dict)
+
+                expected = make_state_dict(1.0)
+                assert state_dict["step"] == 1
+                assert torch.equal(state_dict["weight"], expected["weight"])
+                assert state_dict["weight"].data_ptr() == storage_ptr  # received in place
+                assert torch.equal(state_dict["nested"]["bias"], expected["nested"]["bias"])
+                assert torch.equal(state_dict["nested"]["ids"], expected["nested"]["ids"])
+                assert torch.equal(state_dict["transposed"], expected["transposed"])
+
+            dist.destroy_process_group()
+
+    processes = []
+    for rank in range(2):
+        processes.append(
+            mp.Process(
+                target=foo,
+                kwargs={
+                    "MASTER_ADDR": "localhost",
+                    "MASTER_PORT": str(random_available_port),
+                    "RANK": str(rank),
+                    "WORLD_SIZE": "2",
+                },
+            )
+        )
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+        if p.exitcode != 0:
+            pytest.fail(f"Process {p.pid} failed with exit code {p.exitcode}")
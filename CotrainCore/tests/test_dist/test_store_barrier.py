@@ -0,0 +1,50 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+import pytest
+import torch.distributed as dist
+
+from zeroband.comms import StoreBarrier
+
+WORLD_SIZE = 4
+
+
+@pytest.fixture
+def stores(random_available_port):
+    master = dist.TCPStore("localhost", random_available_port, is_master=True, wait_for_workers=False)
+    clients = [dist.TCPStore("localhost", random_available_port, is_master=False) for _ in range(WORLD_SIZE - 1)]
+    return [master, *clients]
+
+
+def test_store_barrier(stores):
+    barriers = [StoreBarrier(store, rank, WORLD_SIZE) for rank, store in enumerate(stores)]
+
+    def run(barrier: StoreBarrier) -> list[str]:
+        return [barrier.wait(barrier.arrive(f"flag_{i}"), timedelta(seconds=10)) for i in range(20)]
+
+    with ThreadPoolExecutor(max_workers=WORLD_SIZE) as executor:
+        results = list(executor.map(run, barriers))
+
+    assert results == [[f"flag_{i}" for i in range(20)]] * WORLD_SIZE
+
+    barriers[0].clear(0)
+    assert not stores[0].check(["barrier_0_done"])
+    assert stores[0].check(["barrier_1_done"])
+
+
+def test_store_barrier_abort(stores):
+    barriers = [StoreBarrier(store, rank, WORLD_SIZE) for rank, store in enumerate(stores)]
+
+    # rank 2 never arrives
+    generations = [barriers[rank].arrive("flag") for rank in [0, 1, 3]]
+    assert generations == [0, 0, 0]
+    with pytest.raises(dist.DistStoreError):
+        barriers[0].wait(0, timedelta(milliseconds=100))
+
+    assert barriers[0].abort(0) == "error"
+    assert barriers[0].missing_ranks(0) == [2]
+    assert barriers[1].wait(0) == "error"
+
+    # arriving after the abort does not override the result
+    barriers[2].arrive("flag")
+    assert barriers[3].wait(0) == "error"
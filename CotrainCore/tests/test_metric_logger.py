@@ -0,0 +1,63 @@
+import pickle
+import threading
+
+import pytest
+import torch
+
+from zeroband.utils.metric_logger import AsyncMetricLogger, DeviceMetrics, DummyMetricLogger, read_dummy_metrics
+
+
+def test_dummy_metric_logger(tmp_path):
+    path = str(tmp_path / "metrics.pkl")
+    metric_logger = DummyMetricLogger(project=path, logger_config={})
+    metric_logger.log({"step": 1})
+    metric_logger.log({"step": 2})
+
+    # readable while the run is going
+    assert read_dummy_metrics(path) == [{"step": 1}, {"step": 2}]
+
+    metric_logger.finish()
+    with open(path, "rb") as f:
+        assert pickle.load(f) == [{"step": 1}, {"step": 2}]
+
+
+class SlowMetricLogger:
+    def __init__(self):
+        self.data = []
+        self.release = threading.Event()
+        self.finished = False
+
+    def log(self, metrics):
+        self.release.wait()
+        if metrics["step"] == 3:
+            raise RuntimeError("backend error")
+        self.data.append(metrics)
+
+    def finish(self):
+        self.finished = True
+
+
+def test_async_metric_logger():
+    inner = SlowMetricLogger()
+    metric_logger = AsyncMetricLogger(inner, max_queue_size=10)
+    for step in range(5):
+        # does not wait for the backend
+        metric_logger.log({"step": step})
+    assert inner.data == []
+
+    inner.release.set()
+    with pytest.raises(RuntimeError, match="backend error"):
+        metric_logger.finish()
+    assert [metrics["step"] for metrics in inner.data] == [0, 1, 2, 4]
+    assert inner.finished
+
+
+def test_device_metrics():
+    device_metrics = DeviceMetrics(max_pending=4)
+    device_metrics.push({"Loss": torch.tensor(2.0), "grad_norm": torch.tensor([0.5])}, {"step": 1})
+    assert device_metrics.pop_ready() == [{"step": 1, "Loss": 2.0, "grad_norm": 0.5}]
+
+    for step in range(3):
+        device_metrics.push({"Loss": torch.tensor(float(step))}, {"step": step})
+    assert [metrics["step"] for metrics in device_metrics.flush()] == [0, 1, 2]
+    assert device_metrics.flush() == []
@@ -0,0 +1,114 @@
+import json
+import os
+
+import pytest
+from fsspec.implementations.local import LocalFileSystem
+
+from zeroband.utils.remote_upload import MANIFEST_FILE, download_directory, upload_directory
+
+CHUNK_SIZE = 1000
+
+
+class CountingFileSystem(LocalFileSystem):
+    """Local filesystem counting the uploads, the first `num_failures` ones fail"""
+
+    cachable = False  # a new instance for every test
+
+    def __init__(self, num_failures: int = 0):
+        super().__init__()
+        self.num_failures = num_failures
+        self.uploads = []
+        self.manifests = []
+
+    def _open(self, path, mode="rb", **kwargs):
+        if "w" in mode:
+            if self.num_failures > 0:
+                self.num_failures -= 1
+                raise OSError("simulated upload failure")
+            self.uploads.append(path)
+        return super()._open(path, mode=mode, **kwargs)
+
+    def pipe_file(self, path, value, **kwargs):
+        self.manifests.append(json.loads(value))
+        return super().pipe_file(path, value, **kwargs)
+
+
+def _write_files(path, sizes: dict[str, int]):
+    for relpath, size in sizes.items():
+        os.makedirs(os.path.dirname(path / relpath), exist_ok=True)
+        (path / relpath).write_bytes(os.urandom(size))
+
+
+def _assert_same_files(a, b):
+    for root, _, filenames in os.walk(a):
+        for filename in filenames:
+            relpath = os.path.relpath(os.path.join(root, filename), a)
+            assert (b / relpath).read_bytes() == (a / relpath).read_bytes()
+
+
+@pytest.mark.parametrize("num_workers", [1, 4])
+def test_upload_download(tmp_path, num_workers: int):
+    local, remote, downloaded = tmp_path / "local", tmp_path / "remote", tmp_path / "downloaded"
+    sizes = {"empty.pt": 0, "small.pt": 10, "exact.pt": CHUNK_SIZE, "data/large.pt": 5 * CHUNK_SIZE + 1}
+    _write_files(local, sizes)
+
+    upload_directory(str(local), str(remote), chunk_size=CHUNK_SIZE, num_workers=num_workers)
+
+    manifest = json.loads((remote / MANIFEST_FILE).read_text())
+    assert manifest["complete"]
+    assert len(manifest["files"]["data/large.pt"]["chunks"]) == 6
+    # the remote folder is a plain mirror of the local one
+    _assert_same_files(local, remote)
+
+    download_directory(str(remote), str(downloaded), num_workers=num_workers)
+    _assert_same_files(local, downloaded)
+
+
+def test_upload_resume(tmp_path):
+    local, remote = tmp_path / "local", tmp_path / "remote"
+    _write_files(local, {"a.pt": 3 * CHUNK_SIZE, "b.pt": 10})
+
+    fs = CountingFileSystem()
+    upload_directory(str(local), str(remote), chunk_size=CHUNK_SIZE, fs=fs)
+    assert sorted(fs.uploads) == [str(remote / "a.pt"), str(remote / "b.pt")]
+
+    # only the modified file is uploaded again
+    with open(local / "a.pt", "r+b") as f:
+        f.seek(CHUNK_SIZE + 1)
+        f.write(b"x")
+    fs = CountingFileSystem()
+    upload_directory(str(local), str(remote), chunk_size=CHUNK_SIZE, fs=fs)
+    assert fs.uploads == [str(remote / "a.pt")]
+    # the manifest stops claiming the previous version is complete before it is overwritten
+    assert not fs.manifests[0]["complete"]
+    assert fs.manifests[0]["files"]["a.pt"]["chunks"] == [None] * 3
+    assert fs.manifests[0]["files"]["b.pt"]["chunks"][0] is not None
+    assert fs.manifests[-1]["complete"]
+
+    download_directory(str(remote), str(tmp_path / "downloaded"))
+    _assert_same_files(local, tmp_path / "downloaded")
+
+
+def test_upload_retry(tmp_path, monkeypatch):
+    monkeypatch.setattr("time.sleep", lambda _: None)
+    local, remote = tmp_path / "local", tmp_path / "remote"
+    _write_files(local, {"a.pt": 2 * CHUNK_SIZE})
+
+    fs = CountingFileSystem(num_failures=2)
+    upload_directory(str(local), str(remote), chunk_size=CHUNK_SIZE, num_workers=1, max_retries=2, fs=fs)
+    assert json.loads((remote / MANIFEST_FILE).read_text())["complete"]
+
+    fs = CountingFileSystem(num_failures=10)
+    with pytest.raises(OSError):
+        upload_directory(str(local), str(tmp_path / "remote2"), chunk_size=CHUNK_SIZE, max_retries=1, fs=fs)
+
+
+def test_download_corrupted_chunk(tmp_path):
+    local, remote = tmp_path / "local", tmp_path / "remote"
+    _write_files(local, {"a.pt": 2 * CHUNK_SIZE})
+    upload_directory(str(local), str(remote), chunk_size=CHUNK_SIZE)
+
+    with open(remote / "a.pt", "r+b") as f:
+        f.write(os.urandom(10))
+    with pytest.raises(RuntimeError, match="Checksum mismatch"):
+        download_directory(str(remote), str(tmp_path / "downloaded"), max_retries=0)
@@ -104,6 +104,24 @@ def test_all_reduce_diloco(backend: Compression):
     _test_multi_gpu(num_gpus, "debug/diloco.toml", extra_args=["--diloco.compression", backend.value], diloco=True)
 
 
+@pytest.mark.parametrize("num_fragments", [1, 2])
+def test_streaming_diloco(num_fragments: int):
+    num_gpus = [2, 1]
+    _test_multi_gpu(
+        num_gpus,
+        "debug/diloco.toml",
+        extra_args=[
+            "--diloco.delay_steps",
+            "2",
+            "--diloco.num_fragments",
+            str(num_fragments),
+            "--optim.total_steps",
+            "10",
+        ],
+        diloco=True,
+    )
+
+
 def test_z_loss():
     num_gpus = [1, 1]
     _test_multi_gpu(num_gpus, "debug/normal.toml", extra_args=["--optim.z_loss"])
@@ -128,8 +146,11 @@ def test_soap(diloco: bool):
 
 
 @pytest.mark.parametrize("soap", [False, True])
-def test_ckpt(tmp_path: Path, soap: bool):
+@pytest.mark.parametrize("save_mode", ["sync", "async", "delta"])
+def test_ckpt(tmp_path: Path, soap: bool, save_mode: str):
     num_gpus = [1, 2]
+    # with deltas every other checkpoint, step_10 is a delta against step_5
+    resume_step = 10 if save_mode == "delta" else 5
     v1_file = tmp_path / "v1.log"
     v2_file = tmp_path / "v2.log"
     # v3_file = tmp_path / "v3.log"
@@ -159,7 +180,9 @@ def test_ckpt(tmp_path: Path, soap: bool):
             "--train.attn_fn",
             "math",
         ]
-        + (["--optim.optim.precondition_frequency", "1"] if soap else []),
+        + (["--optim.optim.precondition_frequency", "1"] if soap else [])
+        + (["--ckpt.async_save"] if save_mode == "async" else [])
+        + (["--ckpt.delta_interval", "2"] if save_mode == "delta" else []),
         diloco=True,
     )
     _test_multi_gpu(
@@ -173,7 +196,7 @@ def test_ckpt(tmp_path: Path, soap: bool):
             "--ckpt.interval",
             "5",
             "--ckpt.resume",
-            str(v1_ckpt / "step_5"),
+            str(v1_ckpt / f"step_{resume_step}"),
             "--optim.total_steps",
             "20",
             "--train.log_model_hash",
@@ -236,15 +259,15 @@ def test_ckpt(tmp_path: Path, soap: bool):
     ## check that loading from v1 to v2 worked
 
     # first check that the hash of saving is the same as the hash of loading
-    assert v1_data[5]["inner_model_hash_save"] == v2_data[5]["inner_model_hash_resume"]
-    assert v1_data[5]["inner_optimizer_hash_save"] == v2_data[5]["inner_optimizer_hash_resume"]
-    assert v1_data[5]["outer_optimizer_hash_save"] == v2_data[5]["outer_optimizer_hash_resume"]
-    assert v1_data[5]["outer_model_hash_save"] == v2_data[5]["outer_model_hash_resume"]
+    assert v1_data[resume_step]["inner_model_hash_save"] == v2_data[resume_step]["inner_model_hash_resume"]
+    assert v1_data[resume_step]["inner_optimizer_hash_save"] == v2_data[resume_step]["inner_optimizer_hash_resume"]
+    assert v1_data[resume_step]["outer_optimizer_hash_save"] == v2_data[resume_step]["outer_optimizer_hash_resume"]
+    assert v1_data[resume_step]["outer_model_hash_save"] == v2_data[resume_step]["outer_model_hash_resume"]
 
     # then we check that the loss and lr value are the same after loading the ckpt
     for step, data_v2 in v2_data.items():
-        if step == 5:
-            continue  # not testing 5 as ts the one were we restarted from
+        if step == resume_step:
+            continue  # not testing the step we restarted from
 
         data_v1 = v1_data[step]
         assert abs(data_v1["Loss"] - data_v2["Loss"]) < .1
@@ -0,0 +1,52 @@
+import time
+from pathlib import Path
+
+from zeroband.training_manager import TrainingManager, config_to_argv
+
+CONFIG_PATH = str(Path(__file__).parent.parent / "configs" / "debug" / "normal.toml")
+CPU_ENTRYPOINT = str(Path(__file__).parent / "cpu_train.py")
+
+
+def _wait_for(condition, timeout: float = 120):
+    start = time.time()
+    while not condition():
+        assert time.time() - start < timeout, "timed out"
+        time.sleep(0.1)
+
+
+def test_config_to_argv():
+    argv = config_to_argv({"optim": {"total_steps": 10}, "data.sequence_packing": False, "train.ac_ckpt": True})
+    assert argv == ["--optim.total_steps", "10", "--no-data.sequence_packing", "--train.ac_ckpt"]
+
+
+def test_training_manager_stop_resume(tmp_path):
+    manager = TrainingManager(CONFIG_PATH, entrypoint=CPU_ENTRYPOINT, max_metrics=5)
+    manager.start_training(
+        overrides={
+            "project": str(tmp_path / "debug"),
+            "optim": {"total_steps": 1_000_000},
+            "ckpt": {"path": str(tmp_path / "ckpt"), "interval": 1_000_000},
+            "data": {"seq_length": 16},
+        }
+    )
+    assert manager.is_running()
+    _wait_for(lambda: (manager.get_status()["current_step"] or 0) >= 10)
+
+    # checkpoints at the step it stops at
+    manager.stop_training()
+    status = manager.get_status()
+    assert not status["is_running"]
+    assert status["returncode"] == 0
+    stopped_step = status["current_step"]
+    assert manager.latest_checkpoint() == str(tmp_path / "ckpt" / f"step_{stopped_step}")
+
+    # the ring buffers only keep the last entries
+    metrics = manager.get_metrics(last=100)
+    assert [m["step"] for m in metrics] == list(range(stopped_step - 4, stopped_step + 1))
+    assert any(line.startswith(f"step: {stopped_step},") for line in manager.get_logs())
+
+    manager.resume(overrides={"optim": {"total_steps": stopped_step + 3}})
+    assert manager.wait(timeout=120) == 0
+    assert [m["step"] for m in manager.get_metrics(last=3)] == [stopped_step + 1, stopped_step + 2, stopped_step + 3]
+    assert manager.get_status()["current_step"] == stopped_step + 3
+    assert any(line.startswith("Resumed from") for line in manager.get_logs())
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""
+A self-contained benchmark of the server start-up: the time until all blocks are loaded and converted, on CPU.
+
+It creates a tiny randomly initialized Llama model saved in several safetensors shards, then loads its blocks
+like ModuleContainer.create() does, once with the sequential loader (load_pretrained_block() for each block, which
+opens the shards again for each block) and once for each number of loading workers with load_pretrained_blocks().
+Each run happens in a fresh process, so that the results include its peak RSS and do not benefit from the previous
+runs (except for the OS page cache, which is warmed up before the first run).
+
+Example:
+    python benchmarks/benchmark_block_loading.py --num_blocks 16 --hidden_size 1024 --num_workers 1 2 4 \
+        --max_loading_memory 256MB --output block_loading.json
+"""
+
+import argparse
+import json
+import multiprocessing as mp
+import os
+import resource
+import tempfile
+import time
+from typing import Dict, Optional
+
+import torch
+from hivemind.utils.logging import get_logger
+from humanfriendly import parse_size
+from transformers import LlamaConfig, LlamaForCausalLM
+
+from petals import AutoDistributedConfig
+from petals.server.from_pretrained import load_pretrained_block, load_pretrained_blocks
+from petals.utils.convert_block import QuantType, convert_block
+
+logger = get_logger()
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--num_blocks", type=int, default=16, help="Number of transformer blocks in the model")
+    parser.add_argument("--hidden_size", type=int, default=512, help="Hidden size of the tiny model")
+    parser.add_argument("--max_shard_size", type=str, default="20MB", help="Max size of a checkpoint shard")
+    parser.add_argument("--num_workers", type=int, nargs="+", default=[1, 2, 4], help="Numbers of loading workers")
+    parser.add_argument("--max_loading_memory", type=str, default=None, help="Host memory budget, e.g. 256MB")
+    parser.add_argument("--torch_dtype", type=str, default="float32", help="dtype of the loaded blocks")
+    parser.add_argument("--output", type=str, default="block_loading_benchmark.json", help="Where to write results")
+    args = parser.parse_args()
+    max_loading_memory = parse_size(args.max_loading_memory) if args.max_loading_memory is not None else None
+
+    with tempfile.TemporaryDirectory(prefix="petals_block_loading_") as workdir:
+        model_path = create_tiny_model(workdir, args)
+        checkpoint_size = sum(
+            os.path.getsize(os.path.join(model_path, f)) for f in os.listdir(model_path) if f.endswith(".safetensors")
+        )
+        logger.info(f"Created a checkpoint of {checkpoint_size / 2**20:.1f} MiB in {model_path}")
+        run_in_subprocess(workdir, model_path, args, num_workers=None, max_loading_memory=None)  # Warm up page cache
+
+        results = {
+            "args": vars(args),
+            "checkpoint_size_mb": checkpoint_size / 2**20,
+            "runs": {"sequential": run_in_subprocess(workdir, model_path, args, None, None)},
+        }
+        logger.info(f"sequential: {results['runs']['sequential']}")
+        for num_workers in args.num_workers:
+            name = f"workers={num_workers}"
+            results["runs"][name] = run_in_subprocess(workdir, model_path, args, num_workers, max_loading_memory)
+            logger.info(f"{name}: {results['runs'][name]}")
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    logger.info(f"Saved results to {args.output}")
+
+
+def create_tiny_model(workdir: str, args) -> str:
+    config = LlamaConfig(
+        vocab_size=1024,
+        hidden_size=args.hidden_size,
+        intermediate_size=2 * args.hidden_size,
+        num_hidden_layers=args.num_blocks,
+        num_attention_heads=8,
+        num_key_value_heads=8,
+    )
+    torch.manual_seed(0)
+    model_path = os.path.join(workdir, "model")
+    LlamaForCausalLM(config).save_pretrained(model_path, safe_serialization=True, max_shard_size=args.max_shard_size)
+    return model_path
+
+
+def run_in_subprocess(
+    workdir: str, model_path: str, args, num_workers: Optional[int], max_loading_memory: Optional[int]
+) -> Dict[str, float]:
+    ctx = mp.get_context("spawn")
+    pipe_recv, pipe_send = ctx.Pipe(duplex=False)
+    process = ctx.Process(
+        target=load_blocks, args=(workdir, model_path, args, num_workers, max_loading_memory, pipe_send)
+    )
+    process.start()
+    result = pipe_recv.recv()
+    process.join()
+    return result
+
+
+def load_blocks(
+    workdir: str, model_path: str, args, num_workers: Optional[int], max_loading_memory: Optional[int], result_pipe
+):
+    """Loads all blocks, with the sequential loader if num_workers is None"""
+    config = AutoDistributedConfig.from_pretrained(model_path)
+    torch_dtype = getattr(torch, args.torch_dtype)
+    device = torch.device("cpu")
+    cache_dir = os.path.join(workdir, "cache")
+    block_indices = range(args.num_blocks)
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # ru_maxrss is in KiB on Linux
+
+    def _convert_block(block: torch.nn.Module, block_index: int) -> torch.nn.Module:
+        return convert_block(block, block_index, config, [device], device, QuantType.NONE, freeze=True)
+
+    start_time = time.perf_counter()
+    if num_workers is None:
+        blocks = [
+            _convert_block(
+                load_pretrained_block(
+                    model_path, block_index, config=config, torch_dtype=torch_dtype, cache_dir=cache_dir
+                ),
+                block_index,
+            )
+            for block_index in block_indices
+        ]
+    else:
+        blocks = list(
+            load_pretrained_blocks(
+                model_path,
+                block_indices,
+                config=config,
+                torch_dtype=torch_dtype,
+                cache_dir=cache_dir,
+                convert=_convert_block,
+                num_workers=num_workers,
+                max_memory=max_loading_memory,
+            )
+        )
+    elapsed = time.perf_counter() - start_time
+
+    assert len(blocks) == args.num_blocks
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    result_pipe.send(
+        {
+            "time_to_ready_s": elapsed,
+            "blocks_per_second": args.num_blocks / elapsed,
+            "peak_rss_mb": peak_rss / 2**20,
+            "loading_rss_increase_mb": (peak_rss - rss_before) / 2**20,
+        }
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+"""
+A self-contained benchmark of a local Petals swarm running on CPU.
+
+It creates a tiny randomly initialized Llama model, starts a local DHT and several servers hosting its blocks,
+then runs inference, forward, and backward workloads from concurrent clients. For each scenario, it reports
+tokens/s, p50/p99 step latency, and peak memory of the servers and clients in a JSON file. Since no public swarm
+or GPU is involved, the results of two commits on the same machine can be compared with --compare.
+
+Example:
+    python benchmarks/benchmark_local_swarm.py --num_servers 2 --num_blocks 8 --num_clients 4 --output new.json \
+        --compare old.json
+"""
+
+import argparse
+import json
+import multiprocessing as mp
+import os
+import resource
+import shlex
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from contextlib import ExitStack
+from typing import Dict, List
+
+import numpy as np
+import psutil
+import torch
+from hivemind import DHT
+from hivemind.utils.logging import get_logger
+from transformers import LlamaConfig, LlamaForCausalLM
+
+from petals import AutoDistributedModelForCausalLM
+from petals.data_structures import UID_DELIMITER, ServerState
+from petals.utils.dht import get_remote_module_infos
+
+logger = get_logger()
+
+SCENARIOS = ["inference", "forward", "backward"]
+DHT_PREFIX = "local-swarm-benchmark"
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--scenarios", type=str, nargs="+", default=SCENARIOS, choices=SCENARIOS, help="Workloads")
+    parser.add_argument("--num_servers", type=int, default=2, help="Number of servers, blocks are split between them")
+    parser.add_argument("--num_blocks", type=int, default=8, help="Number of transformer blocks in the model")
+    parser.add_argument("--hidden_size", type=int, default=256, help="Hidden size of the tiny model")
+    parser.add_argument("--num_clients", type=int, default=2, help="Number of concurrent client processes")
+    parser.add_argument("--batch_size", type=int, default=1, help="Batch size of each client")
+    parser.add_argument("--seq_len", type=int, default=128, help="Sequence length for forward and backward")
+    parser.add_argument("--prompt_len", type=int, default=16, help="Prompt length for inference")
+    parser.add_argument("--n_steps", type=int, default=32, help="Number of measured steps per client")
+    parser.add_argument("--warmup_steps", type=int, default=2, help="Number of steps excluded from the results")
+    parser.add_argument("--server_args", type=str, default="", help="Extra arguments for run_server, e.g. '--x 1'")
+    parser.add_argument("--startup_timeout", type=float, default=300, help="Max time to wait for the servers")
+    parser.add_argument("--output", type=str, default="local_swarm_benchmark.json", help="Where to write results")
+    parser.add_argument("--compare", type=str, default=None, help="Results of a previous run to compare with")
+    args = parser.parse_args()
+
+    with ExitStack() as stack:
+        workdir = stack.enter_context(tempfile.TemporaryDirectory(prefix="petals_local_swarm_"))
+        model_path = create_tiny_model(workdir, args)
+
+        dht = DHT(start=True, host_maddrs=["/ip4/127.0.0.1/tcp/0"])
+        stack.callback(dht.shutdown)
+        initial_peers = [str(maddr) for maddr in dht.get_visible_maddrs()]
+        logger.info(f"Started a local DHT: {initial_peers}")
+
+        servers = start_servers(workdir, model_path, initial_peers, args)
+        stack.callback(stop_servers, servers)
+        wait_for_swarm(dht, servers, args)
+
+        results = {
+            "commit": get_git_commit(),
+            "timestamp": time.time(),
+            "args": vars(args),
+            "scenarios": {},
+        }
+        for scenario in args.scenarios:
+            results["scenarios"][scenario] = run_scenario(scenario, model_path, initial_peers, servers, args)
+            logger.info(f"{scenario}: {results['scenarios'][scenario]}")
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    logger.info(f"Saved results to {args.output}")
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare_results(json.load(f), results)
+
+
+def create_tiny_model(workdir: str, args) -> str:
+    config = LlamaConfig(
+        vocab_size=1024,
+        hidden_size=args.hidden_size,
+        intermediate_size=2 * args.hidden_size,
+        num_hidden_layers=args.num_blocks,
+        num_attention_heads=4,
+        num_key_value_heads=4,
+        max_position_embeddings=max(args.seq_len, args.prompt_len + args.n_steps + args.warmup_steps),
+    )
+    torch.manual_seed(0)
+    model_path = os.path.join(workdir, "model")
+    LlamaForCausalLM(config).save_pretrained(model_path, safe_serialization=True)
+    return model_path
+
+
+def start_servers(workdir: str, model_path: str, initial_peers: List[str], args) -> List[subprocess.Popen]:
+    block_bounds = np.linspace(0, args.num_blocks, args.num_servers + 1).astype(int)
+    servers = []
+    for i in range(args.num_servers):
+        cmd = [
+            sys.executable,
+            "-m",
+            "petals.cli.run_server",
+            model_path,
+            "--initial_peers",
+            *initial_peers,
+            "--dht_prefix",
+            DHT_PREFIX,
+            "--block_indices",
+            f"{block_bounds[i]}:{block_bounds[i + 1]}",
+            "--device",
+            "cpu",
+            "--torch_dtype",
+            "float32",
+            "--throughput",
+            "1",
+            "--cache_dir",
+            os.path.join(workdir, "cache"),
+            *shlex.split(args.server_args),
+        ]
+        log_file = open(os.path.join(workdir, f"server{i}.log"), "wb")
+        servers.append(subprocess.Popen(cmd, stdout=log_file, stderr=subprocess.STDOUT))
+    return servers
+
+
+def stop_servers(servers: List[subprocess.Popen]):
+    for server in servers:
+        server.terminate()
+    for server in servers:
+        try:
+            server.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            server.kill()
+
+
+def wait_for_swarm(dht: DHT, servers: List[subprocess.Popen], args):
+    uids = [f"{DHT_PREFIX}{UID_DELIMITER}{i}" for i in range(args.num_blocks)]
+    deadline = time.perf_counter() + args.startup_timeout
+    while time.perf_counter() < deadline:
+        if any(server.poll() is not None for server in servers):
+            raise RuntimeError("A server exited during startup, see the server logs for details")
+
+        infos = get_remote_module_infos(dht, uids, latest=True)
+        num_online = sum(
+            any(server_info.state == ServerState.ONLINE for server_info in info.servers.values()) for info in infos
+        )
+        if num_online == len(uids):
+            logger.info(f"All {len(uids)} blocks are online")
+            return
+        logger.info(f"Waiting for the servers: {num_online}/{len(uids)} blocks online")
+        time.sleep(2)
+    raise TimeoutError(f"Blocks are not online after {args.startup_timeout} s")
+
+
+def run_scenario(
+    scenario: str, model_path: str, initial_peers: List[str], servers: List[subprocess.Popen], args
+) -> Dict[str, float]:
+    ctx = mp.get_context("spawn")
+    pipe_recv, pipe_send = ctx.Pipe(duplex=False)
+    barrier = ctx.Barrier(args.num_clients)
+    clients = [
+        ctx.Process(target=run_client, args=(i, scenario, model_path, initial_peers, args, barrier, pipe_send))
+        for i in range(args.num_clients)
+    ]
+
+    memory_monitor = ServerMemoryMonitor(servers)
+    memory_monitor.start()
+    for client in clients:
+        client.start()
+    client_results = [pipe_recv.recv() for _ in clients]
+    for client in clients:
+        client.join()
+    memory_monitor.stop()
+
+    latencies = np.concatenate([result["latencies"] for result in client_results])
+    total_tokens = sum(result["tokens"] for result in client_results)
+    wall_time = max(result["elapsed"] for result in client_results)
+    return {
+        "tokens_per_second": total_tokens / wall_time,
+        "latency_p50_ms": float(np.percentile(latencies, 50) * 1000),
+        "latency_p99_ms": float(np.percentile(latencies, 99) * 1000),
+        "num_steps": int(len(latencies)),
+        "server_peak_rss_mb": memory_monitor.peak_rss / 2**20,
+        "client_peak_rss_mb": max(result["peak_rss"] for result in client_results) / 2**20,
+    }
+
+
+def run_client(client_idx: int, scenario: str, model_path: str, initial_peers: List[str], args, barrier, result_pipe):
+    torch.manual_seed(client_idx)
+    model = AutoDistributedModelForCausalLM.from_pretrained(
+        model_path, initial_peers=initial_peers, dht_prefix=DHT_PREFIX, torch_dtype=torch.float32
+    )
+    blocks = model.transformer.h
+    hidden_size = model.config.hidden_size
+    barrier.wait()  # start all clients together, after their (slow) initialization
+
+    latencies = []
+    tokens = 0
+    start_time = None
+    if scenario == "inference":
+        max_length = args.prompt_len + args.warmup_steps + args.n_steps
+        with torch.inference_mode(), blocks.inference_session(max_length=max_length) as session:
+            session.step(torch.randn(args.batch_size, args.prompt_len, hidden_size))
+            for step in range(args.warmup_steps + args.n_steps):
+                if step == args.warmup_steps:
+                    start_time = time.perf_counter()
+                step_start = time.perf_counter()
+                session.step(torch.randn(args.batch_size, 1, hidden_size))
+                if step >= args.warmup_steps:
+                    latencies.append(time.perf_counter() - step_start)
+                    tokens += args.batch_size
+    else:
+        for step in range(args.warmup_steps + args.n_steps):
+            if step == args.warmup_steps:
+                start_time = time.perf_counter()
+            hidden_states = torch.randn(args.batch_size, args.seq_len, hidden_size)
+            step_start = time.perf_counter()
+            if scenario == "forward":
+                with torch.no_grad():
+                    blocks(hidden_states)
+            else:
+                hidden_states.requires_grad_(True)
+                blocks(hidden_states).sum().backward()
+            if step >= args.warmup_steps:
+                latencies.append(time.perf_counter() - step_start)
+                tokens += hidden_states.shape[0] * hidden_states.shape[1]
+
+    result_pipe.send(
+        {
+            "latencies": latencies,
+            "tokens": tokens,
+            "elapsed": time.perf_counter() - start_time,
+            "peak_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,  # ru_maxrss is in KiB on Linux
+        }
+    )
+
+
+class ServerMemoryMonitor(threading.Thread):
+    """Samples the total RSS of the server processes (including their children) while a scenario runs"""
+
+    def __init__(self, servers: List[subprocess.Popen], interval: float = 0.2):
+        super().__init__(daemon=True)
+        self.processes = [psutil.Process(server.pid) for server in servers]
+        self.interval = interval
+        self.peak_rss = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self.peak_rss = max(self.peak_rss, self._total_rss())
+            self._stop_event.wait(self.interval)
+
+    def _total_rss(self) -> int:
+        total = 0
+        for process in self.processes:
+            try:
+                for p in [process, *process.children(recursive=True)]:
+                    total += p.memory_info().rss
+            except psutil.NoSuchProcess:
+                pass
+        return total
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+def compare_results(baseline: dict, results: dict):
+    logger.info(f"Comparing with {baseline.get('commit')} (baseline) -> {results.get('commit')}")
+    for scenario, metrics in results["scenarios"].items():
+        if scenario not in baseline["scenarios"]:
+            continue
+        changes = []
+        for key, value in metrics.items():
+            old_value = baseline["scenarios"][scenario].get(key)
+            if old_value:
+                changes.append(f"{key}: {old_value:.2f} -> {value:.2f} ({(value / old_value - 1) * 100:+.1f}%)")
+        logger.info(f"{scenario}: " + ", ".join(changes))
+
+
+def get_git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], text=True, stderr=subprocess.DEVNULL).strip()
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        return "unknown"
+
+
+if __name__ == "__main__":
+    main()
@@ -76,11 +76,22 @@ def main():
     parser.add_argument('--max_batch_size', type=int, default=None,
                         help='The total number of tokens in the same batch will not exceed this value. '
                              'Default: 8192 for models with multi-query attention (based on Llama 2, Falcon), 2048 for others')
+    parser.add_argument('--max_batched_tasks', type=int, default=1,
+                        help='Merge up to this many compatible forward/inference requests into one batched call. '
+                             'Default: 1 (no batching)')
+    parser.add_argument('--max_batch_wait', type=float, default=0.0,
+                        help='Wait up to this many seconds after a request arrives for other requests to batch with it')
     parser.add_argument('--max_chunk_size_bytes', type=int, default=256 * 1024 * 1024,
                         help='Maximum size of activation tensor processed in one go; larger tensors are split into chunks')
     parser.add_argument('--attn_cache_tokens', type=int, default=None,
                         help='The number of past attention key/value pairs that will be stored between inference steps. '
                              'Default: 16384 for models with multi-query attention (based on Llama 2, Falcon), 4096 for others')
+    parser.add_argument('--attn_cache_page_size', type=int, default=None,
+                        help='If set, allocate the attention cache in pages of this many tokens as sessions grow, '
+                             'instead of reserving max_length tokens when a session is opened. Default: disabled')
+    parser.add_argument('--prefix_cache_share', type=float, default=0.0,
+                        help='Share of the attention cache used to keep keys/values of first inference steps, '
+                             'reused by new sessions starting with the same prefix (LRU). Default: 0 (disabled)')
 
     parser.add_argument('--cache_dir', type=str, default=None,
                         help='Path to a directory in which a downloaded pretrained model configuration should be cached if the standard cache should not be used.')
@@ -92,6 +103,12 @@ def main():
                              "for a long time and caches all model blocks after a number of rebalancings. "
                              "However, this worst case is unlikely, expect the server to consume "
                              "the disk space equal to 2-4x of your GPU memory on average.")
+    parser.add_argument('--num_loading_workers', type=int, default=1,
+                        help='Load and convert up to this many blocks at once when the server starts. '
+                             'The checkpoint files are memory-mapped once and shared between the blocks')
+    parser.add_argument('--max_loading_memory', type=str, default=None,
+                        help='Maximal host memory used by the blocks being loaded at once. Example: 8GB, 16GiB. '
+                             'Default: unlimited (up to --num_loading_workers blocks)')
 
     parser.add_argument('--device', type=str, default=None, required=False,
                         help='all blocks will use this device in torch notation; default: cuda if available else cpu')
@@ -116,7 +133,7 @@ def main():
     parser.add_argument('--update_period', type=float, required=False, default=120,
                         help='Server will report blocks to DHT once in this many seconds')
     parser.add_argument('--expiration', type=float, required=False, default=None,
-                        help='DHT entries will expire after this many seconds')
+                        help='DHT entries will expire after this many seconds (default: 3 x update_period)')
     parser.add_argument('--request_timeout', type=float, required=False, default=3 * 60,
                         help='Timeout (in seconds) for the whole rpc_forward/rpc_backward/rpc_forward_stream/rpc_backward_stream request')
     parser.add_argument('--session_timeout', type=float, required=False, default=30 * 60,
@@ -203,6 +220,10 @@ def main():
         max_disk_space, (int, type(None))
     ), "Unrecognized value for --max_disk_space. Correct examples: 1.5GB or 1500MB or 1572864000 (bytes)"
 
+    max_loading_memory = args.pop("max_loading_memory")
+    if max_loading_memory is not None:
+        max_loading_memory = parse_size(max_loading_memory)
+
     if args.pop("new_swarm"):
         args["initial_peers"] = []
 
@@ -222,6 +243,7 @@ def main():
         announce_maddrs=announce_maddrs,
         compression=compression,
         max_disk_space=max_disk_space,
+        max_loading_memory=max_loading_memory,
     )
     try:
         server.run()
@@ -222,12 +222,18 @@ class InferenceSession:
     An interface to a multi-step *inference* session for a sequence of remote transformer blocks
     """
 
-    def __init__(self, sequence_manager: RemoteSequenceManager, max_length: int):
+    def __init__(self, sequence_manager: RemoteSequenceManager, max_length: int, prefix_id: Optional[str] = None):
+        """
+        :param prefix_id: if specified, the first step of this session is a prefix (e.g. a system prompt) shared by all
+          sessions of this client with the same prefix_id, so servers may reuse its attention cache instead of
+          recomputing it
+        """
         self._sequence_manager = sequence_manager
         self._closed = False
         self._server_sessions = []
         self._position = 0
         self._max_length = max_length
+        self._prefix_id = prefix_id
         self.output_ids = None
         self.past_key_values = None
 
@@ -252,6 +258,8 @@ class InferenceSession:
             for span in chosen_spans:
                 span_uids = CHAIN_DELIMITER.join(self._sequence_manager.block_uids[span.start : span.end])
                 metadata = self._sequence_manager.get_request_metadata("rpc_inference", span_uids, peer_id=span.peer_id)
+                if self._prefix_id is not None:
+                    metadata["prefix_id"] = self._prefix_id
                 session = RemoteExpertWorker.run_coroutine(
                     _ServerInferenceSession.create(
                         self._sequence_manager.config,
@@ -115,3 +115,4 @@ class InferenceMetadata:
     prefix_length: int
     cache_handles: Tuple[Handle, ...]
     active_adapter: Optional[str]
+    prefix_id: Optional[str] = None  # identifies the prefix sent in the first step, see PrefixCache.make_span_prefix_id
@@ -2,7 +2,7 @@ from __future__ import annotations
 
 from collections import Counter
 from itertools import chain
-from typing import Any, Dict, Optional, Sequence, Tuple, Union
+from typing import Any, Dict, Hashable, Optional, Sequence, Tuple, Union
 
 import torch
 from hivemind import BatchTensorDescriptor, TensorDescriptor
@@ -14,7 +14,8 @@ from tensor_parallel.tensor_parallel import PerDeviceTensors
 from transformers import PretrainedConfig
 
 from petals.data_structures import InferenceMetadata
-from petals.server.memory_cache import MemoryCache
+from petals.server.memory_cache import MemoryCache, PagedTensor
+from petals.server.prefix_cache import PrefixCache
 from petals.server.task_pool import PrioritizedTaskPool
 from petals.utils.misc import get_size_in_bytes, is_dummy
 
@@ -33,6 +34,9 @@ class TransformerBackend(ModuleBackend):
         memory_cache: MemoryCache,
         backend_dtype: torch.dtype,
         max_chunk_size_bytes: int,
+        max_batched_tasks: int = 1,
+        max_batch_wait: float = 0.0,
+        prefix_cache: Optional[PrefixCache] = None,
         **kwargs,
     ):
         import petals.utils.peft as _peft_module
@@ -43,6 +47,7 @@ class TransformerBackend(ModuleBackend):
         assert isinstance(self.module, TensorParallel)
         self.config = config
         self.memory_cache = memory_cache
+        self.prefix_cache = prefix_cache
         self.max_chunk_size_bytes = max_chunk_size_bytes
 
         for name, param in self.module.named_parameters():
@@ -56,7 +61,14 @@ class TransformerBackend(ModuleBackend):
             self.inference_step, max_batch_size=max_batch_size, device=device, name=f"{self.name}_inference"
         )  # note: inference_pools may be merged later, see merge_inference_pools_inplace
         self.forward_pool = PrioritizedTaskPool(
-            self.forward, max_batch_size=max_batch_size, device=device, name=f"{self.name}_forward"
+            self.forward,
+            max_batch_size=max_batch_size,
+            device=device,
+            name=f"{self.name}_forward",
+            batch_process_func=self._batched_forward,
+            get_batch_key=self._get_forward_batch_key,
+            max_batched_tasks=max_batched_tasks,
+            max_batch_wait=max_batch_wait,
         )
         self.backward_pool = PrioritizedTaskPool(
             self.backward, max_batch_size=max_batch_size, device=device, name=f"{self.name}_backward"
@@ -98,6 +110,10 @@ class TransformerBackend(ModuleBackend):
             cache_tensors.extend((keys, values))
         return cache_tensors
 
+    def get_inference_cache_length_dims(self) -> Sequence[int]:
+        """For each tensor from get_inference_cache_descriptors, the index of its sequence length dimension"""
+        return [3, 2] * len(self.module.devices)
+
     def forward(self, *inputs: Union[torch.Tensor, str]) -> Tuple[torch.Tensor, ...]:
         *inputs, active_adapter = inputs
         with self._peft_module.using_adapter(active_adapter):
@@ -108,6 +124,15 @@ class TransformerBackend(ModuleBackend):
         with self._peft_module.using_adapter(active_adapter):
             return super().backward(*inputs)
 
+    def _get_forward_batch_key(self, args: Sequence[Any]) -> Optional[Hashable]:
+        """Forward tasks can be merged if their hidden states only differ in batch size and they use the same adapter"""
+        hidden_states, active_adapter = args
+        return hidden_states.shape[1:], hidden_states.dtype, active_adapter
+
+    def _batched_forward(self, task_args: Sequence[Sequence[Any]]) -> Tuple[torch.Tensor, ...]:
+        hidden_states = torch.cat([args[0] for args in task_args])
+        return self.forward(hidden_states, task_args[0][-1])
+
     @torch.inference_mode()
     def inference_step(
         self,
@@ -116,33 +141,189 @@ class TransformerBackend(ModuleBackend):
         inference_info: InferenceMetadata,
     ) -> Tuple[torch.Tensor, ...]:
         assert hidden_states.ndim == 3, "expected hidden states to be 3-dimensional: [batch_size, seq_len, hid_size]"
-        seq_len = hidden_states.shape[1]
 
         with self.memory_cache.use_cache(
             *inference_info.cache_handles
         ) as cache_tensors, self._peft_module.using_adapter(inference_info.active_adapter):
-            self._reorder_cache_inplace(cache_tensors, hypo_ids)
-
-            # We chunk the inputs so that peak memory for long sequences fits into `autograd_memory`
-            # reserved in `Server._choose_num_blocks()`. This saves us from OOMs if `max_chunk_size_bytes`
-            # is at least 4-6x less than `autograd_memory`.
-            max_chunk_length = self._estimate_max_chunk_length(hidden_states, inference_info)
-            output_hidden_states = torch.empty_like(hidden_states) if seq_len > max_chunk_length else None
-            layer_past = self._select_layer_past(cache_tensors, inference_info.prefix_length)
-            for offset in range(0, seq_len, max_chunk_length):
-                hidden_states_chunk = hidden_states[:, offset : offset + max_chunk_length, :]
-                output_hidden_states_chunk, new_kvs = self.module.forward(
-                    hidden_states_chunk, layer_past=layer_past, use_cache=True
-                )
-                if seq_len > max_chunk_length:
-                    output_hidden_states[:, offset : offset + max_chunk_length] = output_hidden_states_chunk
+            self._allocate_pages(cache_tensors, inference_info.prefix_length + hidden_states.shape[1])
+            if (
+                self.prefix_cache is not None
+                and inference_info.prefix_length == 0
+                and inference_info.prefix_id is not None
+            ):
+                return (self._inference_step_with_prefix_cache(hidden_states, hypo_ids, cache_tensors, inference_info),)
+            return (self._inference_step_on_cache(hidden_states, hypo_ids, cache_tensors, inference_info),)
+
+    def ensure_cache_length(self, inference_infos: Sequence[InferenceMetadata], length: int):
+        """
+        In paged mode, allocate the cache pages of the sessions up to length tokens. Called before a step modifies
+        any cache: if the cache is full, it raises AllocationFailed and the caches of the sessions are left unchanged
+        """
+        if self.memory_cache.paged:
+            handles = [handle for info in inference_infos for handle in info.cache_handles]
+            with self.memory_cache.use_cache(*handles) as cache_tensors:
+                self._allocate_pages(cache_tensors, length)
+
+    def _allocate_pages(self, cache_tensors: Sequence[Union[torch.Tensor, PagedTensor]], length: int):
+        if self.memory_cache.paged:
+            for cache_tensor in cache_tensors:
+                cache_tensor.ensure_length(length)
+
+    def _inference_step_on_cache(
+        self,
+        hidden_states: torch.Tensor,
+        hypo_ids: torch.LongTensor,
+        cache_tensors: Sequence[Union[torch.Tensor, PagedTensor]],
+        inference_info: InferenceMetadata,
+    ) -> torch.Tensor:
+        if self.memory_cache.paged:
+            paged_tensors = cache_tensors
+            new_length = inference_info.prefix_length + hidden_states.shape[1]
+            cache_tensors, write_from = self._gather_paged_cache(
+                paged_tensors, hypo_ids, inference_info.prefix_length, new_length
+            )
+            output_hidden_states = self._forward_with_cache(hidden_states, cache_tensors, inference_info)
+            for paged_tensor, cache_tensor in zip(paged_tensors, cache_tensors):
+                paged_tensor.write(cache_tensor, write_from, new_length)
+            return output_hidden_states
+
+        self._reorder_cache_inplace(cache_tensors, hypo_ids)
+        return self._forward_with_cache(hidden_states, cache_tensors, inference_info)
+
+    def _inference_step_with_prefix_cache(
+        self,
+        hidden_states: torch.Tensor,
+        hypo_ids: torch.LongTensor,
+        cache_tensors: Sequence[Union[torch.Tensor, PagedTensor]],
+        inference_info: InferenceMetadata,
+    ) -> torch.Tensor:
+        """First step of a session: reuse the keys/values of an identical cached prefix, or compute and cache them"""
+        seq_len = hidden_states.shape[1]
+        key = self.prefix_cache.make_key(
+            self.name, hidden_states, inference_info.active_adapter, inference_info.prefix_id
+        )
+        entry = self.prefix_cache.get(key)
+        if entry is not None:
+            for i, (cache_tensor, cached_tensor) in enumerate(zip(cache_tensors, entry.cache_tensors)):
+                if isinstance(cache_tensor, PagedTensor):
+                    cache_tensor.ensure_length(seq_len)
+                    cache_tensor.write(cached_tensor, 0, seq_len)
                 else:
-                    output_hidden_states = output_hidden_states_chunk  # saves one memcopy
-                layer_past = new_kvs
+                    _select_length(cache_tensor, i, 0, seq_len)[...] = cached_tensor
+            return entry.outputs.clone()
+
+        output_hidden_states = self._inference_step_on_cache(hidden_states, hypo_ids, cache_tensors, inference_info)
+        prefix_tensors = [
+            cache_tensor.read(seq_len)
+            if isinstance(cache_tensor, PagedTensor)
+            else _select_length(cache_tensor, i, 0, seq_len)
+            for i, cache_tensor in enumerate(cache_tensors)
+        ]
+        self.prefix_cache.put(key, output_hidden_states, prefix_tensors)
+        return output_hidden_states
 
-            self._update_cache_inplace(cache_tensors, new_kvs, inference_info.prefix_length)
+    @torch.inference_mode()
+    def batched_inference_step(
+        self,
+        hidden_states: torch.Tensor,
+        hypo_ids: Sequence[torch.LongTensor],
+        inference_infos: Sequence[InferenceMetadata],
+    ) -> Tuple[torch.Tensor, ...]:
+        """
+        Run one inference step for several sessions at once. The hidden states of the sessions are concatenated
+        along the batch dimension, in the same order as inference_infos; all sessions must have the same prefix length
+        and adapter. The sessions' caches are gathered into a temporary batch and the new keys/values are written back.
+
+        :note: gathering copies the whole prefix of every session, O(prefix_length) per step instead of O(seq_len):
+          this is why _MergedInferenceStep only batches sessions up to max_batched_prefix_length tokens
+        """
+        assert hidden_states.ndim == 3, "expected hidden states to be 3-dimensional: [batch_size, seq_len, hid_size]"
+        prefix_length = inference_infos[0].prefix_length
+        new_length = prefix_length + hidden_states.shape[1]
+        assert all(info.prefix_length == prefix_length for info in inference_infos), "sessions must be aligned"
+
+        all_handles = [handle for info in inference_infos for handle in info.cache_handles]
+        with self.memory_cache.use_cache(
+            *all_handles
+        ) as all_cache_tensors, self._peft_module.using_adapter(inference_infos[0].active_adapter):
+            num_tensors = len(inference_infos[0].cache_handles)
+            session_caches = [
+                all_cache_tensors[i : i + num_tensors] for i in range(0, len(all_cache_tensors), num_tensors)
+            ]
+            self._allocate_pages(all_cache_tensors, new_length)
+            if self.memory_cache.paged:
+                paged_caches = session_caches
+                gathered = [
+                    self._gather_paged_cache(session_cache, session_hypo_ids, prefix_length, new_length)
+                    for session_cache, session_hypo_ids in zip(paged_caches, hypo_ids)
+                ]
+                session_caches = [session_cache for session_cache, _ in gathered]
+            else:
+                for session_cache, session_hypo_ids in zip(session_caches, hypo_ids):
+                    self._reorder_cache_inplace(session_cache, session_hypo_ids)
+
+            # keys are [batch, num_kv_heads, head_dim, length], values are [batch, num_kv_heads, length, head_dim]
+            batched_cache = [
+                torch.cat([_select_length(session_cache[i], i, 0, new_length) for session_cache in session_caches])
+                for i in range(num_tensors)
+            ]
+            output_hidden_states = self._forward_with_cache(hidden_states, batched_cache, inference_infos[0])
+
+            offset = 0
+            for session_cache in session_caches:
+                batch_size = session_cache[0].shape[0]
+                for i, (cache_tensor, batched_tensor) in enumerate(zip(session_cache, batched_cache)):
+                    session_tensor = batched_tensor[offset : offset + batch_size]
+                    new_entries = _select_length(session_tensor, i, prefix_length, new_length)
+                    _select_length(cache_tensor, i, prefix_length, new_length)[...] = new_entries
+                offset += batch_size
+
+            if self.memory_cache.paged:
+                for paged_cache, session_cache, (_, write_from) in zip(paged_caches, session_caches, gathered):
+                    for paged_tensor, cache_tensor in zip(paged_cache, session_cache):
+                        paged_tensor.write(cache_tensor, write_from, new_length)
             return (output_hidden_states,)
 
+    def _gather_paged_cache(
+        self, paged_tensors: Sequence[PagedTensor], hypo_ids: torch.Tensor, prefix_length: int, new_length: int
+    ) -> Tuple[Sequence[torch.Tensor], int]:
+        """
+        Allocate pages up to new_length and get the session's cache as contiguous tensors (views of the pages).
+        Returns these tensors and the first token that must be written back to the pages after the step.
+        """
+        for paged_tensor in paged_tensors:
+            paged_tensor.ensure_length(new_length)
+        cache_tensors = [paged_tensor.read(new_length) for paged_tensor in paged_tensors]
+        self._reorder_cache_inplace(cache_tensors, hypo_ids)
+        write_from = prefix_length if is_dummy(hypo_ids) else 0  # reordering also changes the cached tokens
+        return cache_tensors, write_from
+
+    def _forward_with_cache(
+        self, hidden_states: torch.Tensor, cache_tensors: Sequence[torch.Tensor], inference_info: InferenceMetadata
+    ) -> torch.Tensor:
+        """Run the block on hidden_states attending to the first prefix_length cached tokens, then update the cache"""
+        seq_len = hidden_states.shape[1]
+
+        # We chunk the inputs so that peak memory for long sequences fits into `autograd_memory`
+        # reserved in `Server._choose_num_blocks()`. This saves us from OOMs if `max_chunk_size_bytes`
+        # is at least 4-6x less than `autograd_memory`.
+        max_chunk_length = self._estimate_max_chunk_length(hidden_states, inference_info)
+        output_hidden_states = torch.empty_like(hidden_states) if seq_len > max_chunk_length else None
+        layer_past = self._select_layer_past(cache_tensors, inference_info.prefix_length)
+        for offset in range(0, seq_len, max_chunk_length):
+            hidden_states_chunk = hidden_states[:, offset : offset + max_chunk_length, :]
+            output_hidden_states_chunk, new_kvs = self.module.forward(
+                hidden_states_chunk, layer_past=layer_past, use_cache=True
+            )
+            if seq_len > max_chunk_length:
+                output_hidden_states[:, offset : offset + max_chunk_length] = output_hidden_states_chunk
+            else:
+                output_hidden_states = output_hidden_states_chunk  # saves one memcopy
+            layer_past = new_kvs
+
+        self._update_cache_inplace(cache_tensors, new_kvs, inference_info.prefix_length)
+        return output_hidden_states
+
     def _estimate_max_chunk_length(self, hidden_states: torch.Tensor, inference_info: InferenceMetadata) -> int:
         # We assume that attention logit matrices are the main thing that consumes memory, given that
         # the model uses multi-query attention
@@ -198,15 +379,31 @@ class TransformerBackend(ModuleBackend):
             p.data = dummy
 
 
-def merge_inference_pools_inplace(backends: Dict[ExpertUID, TransformerBackend]):
+def _select_length(cache_tensor: torch.Tensor, index: int, start: int, end: int) -> torch.Tensor:
+    """Select tokens [start, end) of a cache tensor; even indices are keys, odd indices are values"""
+    return cache_tensor[:, :, :, start:end] if index % 2 == 0 else cache_tensor[:, :, start:end, :]
+
+
+MAX_BATCHED_PREFIX_LENGTH = 1024
+
+
+def merge_inference_pools_inplace(
+    backends: Dict[ExpertUID, TransformerBackend], max_batched_prefix_length: int = MAX_BATCHED_PREFIX_LENGTH
+):
     """Replace each backend's rpc_inference pools with a combined pool runs multiple blocks in one call"""
     assert len(backends) != 0 and all(isinstance(b, TransformerBackend) for b in backends.values())
-    first_pool = next(iter(backends.values())).inference_pool
+    first_backend = next(iter(backends.values()))
+    first_pool = first_backend.inference_pool
+    merged_inference_step = _MergedInferenceStep(backends, max_batched_prefix_length)
     merged_pool = PrioritizedTaskPool(
-        _MergedInferenceStep(backends),
+        merged_inference_step,
         max_batch_size=first_pool.max_batch_size,
         device=first_pool.device,
         name=f"merged_inference",
+        batch_process_func=merged_inference_step.batched,
+        get_batch_key=merged_inference_step.get_batch_key,
+        max_batched_tasks=first_backend.forward_pool.max_batched_tasks,
+        max_batch_wait=first_backend.forward_pool.max_batch_wait,
     )
     for backend in backends.values():
         assert not backend.inference_pool.is_alive()
@@ -214,8 +411,11 @@ def merge_inference_pools_inplace(backends: Dict[ExpertUID, TransformerBackend])
 
 
 class _MergedInferenceStep:
-    def __init__(self, backends: Dict[ExpertUID, TransformerBackend]):
+    def __init__(
+        self, backends: Dict[ExpertUID, TransformerBackend], max_batched_prefix_length: int = MAX_BATCHED_PREFIX_LENGTH
+    ):
         self.backends = backends
+        self.max_batched_prefix_length = max_batched_prefix_length
 
     @torch.inference_mode()
     def __call__(
@@ -228,8 +428,46 @@ class _MergedInferenceStep:
         assert len(inference_infos) == len(
             optional_prompts
         ), f"found {len(inference_infos)} blocks but {len(optional_prompts)} prompts"
+        self._ensure_cache_length([inference_infos], hidden_states.shape[1])
         for inference_info, optional_prompt in zip(inference_infos, optional_prompts):
             if optional_prompt is not None:
                 hidden_states[:, : optional_prompt.shape[1]] += optional_prompt
             (hidden_states,) = self.backends[inference_info.uid].inference_step(hidden_states, hypo_ids, inference_info)
         return (hidden_states,)
+
+    def _ensure_cache_length(self, sessions_infos: Sequence[Sequence[InferenceMetadata]], seq_len: int):
+        """Allocate the pages of all blocks before running the first one: a full cache fails the step cleanly"""
+        for block_index, inference_info in enumerate(sessions_infos[0]):
+            self.backends[inference_info.uid].ensure_cache_length(
+                [infos[block_index] for infos in sessions_infos], inference_info.prefix_length + seq_len
+            )
+
+    def get_batch_key(self, args: Sequence[Any]) -> Optional[Hashable]:
+        """
+        Inference steps can be merged if they run the same blocks at the same position without deep prompts.
+        Steps after max_batched_prefix_length tokens are not merged: copying the long prefixes of the sessions into
+        the batch would cost more than the separate steps (see TransformerBackend.batched_inference_step)
+        """
+        hidden_states, hypo_ids, inference_infos, *optional_prompts = args
+        if any(prompt is not None for prompt in optional_prompts):
+            return None
+        if inference_infos[0].prefix_length > self.max_batched_prefix_length:
+            return None
+        if inference_infos[0].prefix_length == 0 and any(
+            self.backends[info.uid].prefix_cache is not None for info in inference_infos
+        ):
+            return None  # first steps go through the prefix cache one session at a time
+        block_keys = tuple((info.uid, info.prefix_length, info.active_adapter) for info in inference_infos)
+        return hidden_states.shape[1:], hidden_states.dtype, block_keys
+
+    @torch.inference_mode()
+    def batched(self, task_args: Sequence[Sequence[Any]]) -> Tuple[torch.Tensor, ...]:
+        """Run several inference steps (see get_batch_key) at once, each with its own attention caches"""
+        hidden_states = torch.cat([args[0] for args in task_args])
+        hypo_ids = [args[1] for args in task_args]
+        self._ensure_cache_length([args[2] for args in task_args], hidden_states.shape[1])
+        for block_index, inference_info in enumerate(task_args[0][2]):
+            (hidden_states,) = self.backends[inference_info.uid].batched_inference_step(
+                hidden_states, hypo_ids, [args[2][block_index] for args in task_args]
+            )
+        return (hidden_states,)
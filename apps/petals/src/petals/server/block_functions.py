@@ -14,6 +14,7 @@ from hivemind.utils.nested import nested_flatten
 
 from petals.data_structures import Handle, InferenceMetadata
 from petals.server.backend import TransformerBackend
+from petals.server.prefix_cache import PrefixCache
 from petals.server.task_pool import PrioritizedTaskPool
 from petals.server.task_prioritizer import TaskPrioritizerBase
 from petals.utils.convert_block import QuantType
@@ -153,6 +154,7 @@ async def iterate_rpc_inference(
     points: int,
     quant_type: QuantType,
     args_structure: Any = None,
+    prefix_id: Optional[str] = None,
 ) -> AsyncIterator[Tuple[Sequence[runtime_pb2.Tensor], bool, Dict]]:
     assert len(cache_handles) == len(requested_backends)
 
@@ -206,13 +208,16 @@ async def iterate_rpc_inference(
             type="inference",
         )
 
+        step_prefix_id = None  # the prefix only describes the first step
+        if prefix_length == 0 and requested_backends[0].prefix_cache is not None and hidden_states.numel() > 0:
+            step_prefix_id = PrefixCache.make_span_prefix_id(requested_uids[0], hidden_states, prompts, prefix_id)
         # A client may pass a tensor with 0 tokens. This is a special case that occurs, e.g.
         # when user wants to pre-allocate cache or check that server *can* allocate that cache.
         if hidden_states.numel() > 0:
             assert hidden_states.ndim == 3, f"hidden states must be a single 3d tensor"
             if can_merge_pools:
                 inference_infos = tuple(
-                    InferenceMetadata(uid, prefix_length, tuple(handles), active_adapter)
+                    InferenceMetadata(uid, prefix_length, tuple(handles), active_adapter, step_prefix_id)
                     for uid, handles in zip(requested_uids, cache_handles)
                 )
                 (hidden_states,) = await requested_backends[0].inference_pool.submit_task(
@@ -220,7 +225,9 @@ async def iterate_rpc_inference(
                 )
             else:
                 for backend, uid, handles, prompt in zip(requested_backends, requested_uids, cache_handles, prompts):
-                    inference_infos = (InferenceMetadata(uid, prefix_length, tuple(handles), active_adapter),)
+                    inference_infos = (
+                        InferenceMetadata(uid, prefix_length, tuple(handles), active_adapter, step_prefix_id),
+                    )
                     (hidden_states,) = await backend.inference_pool.submit_task(
                         hidden_states, hypo_ids, inference_infos, prompt, priority=priority
                     )
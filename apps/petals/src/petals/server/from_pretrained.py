@@ -6,10 +6,16 @@ If necessary, one can rewrite this to implement a different behavior, such as:
  - fetch the weights over IPoAC, using a fleet of trained pigeons ( http://www.faqs.org/rfcs/rfc1149.html )
 
 """
+from __future__ import annotations
+
 import json
+import mmap
+import struct
+import threading
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from contextlib import suppress
-from typing import Dict, Optional, Union
+from typing import Callable, Dict, Iterator, Optional, Sequence, Union
 
 import safetensors
 import torch
@@ -24,7 +30,7 @@ from transformers.utils import get_file_from_repo
 
 from petals.constants import DTYPE_MAP
 from petals.models.mixtral import WrappedMixtralBlock
-from petals.server.block_utils import get_model_block, resolve_block_dtype
+from petals.server.block_utils import get_block_size, get_model_block, resolve_block_dtype
 from petals.utils.auto_config import AutoDistributedConfig
 from petals.utils.disk_cache import DEFAULT_CACHE_DIR, allow_cache_reads, allow_cache_writes, free_disk_space_for
 from petals.utils.hf_auth import always_needs_auth
@@ -42,6 +48,7 @@ def load_pretrained_block(
     token: Optional[Union[str, bool]] = None,
     cache_dir: Optional[str] = None,
     max_disk_space: Optional[int] = None,
+    shard_cache: Optional[ShardCache] = None,
 ) -> nn.Module:
     if config is None:
         config = AutoDistributedConfig.from_pretrained(model_name, use_auth_token=token)
@@ -62,11 +69,12 @@ def load_pretrained_block(
         token=token,
         cache_dir=cache_dir,
         max_disk_space=max_disk_space,
+        shard_cache=shard_cache,
     )
 
     for param_name, _ in block.named_parameters():
         assert param_name in state_dict, f"{param_name} not in state dict"
-        param = state_dict[param_name]
+        param = state_dict.pop(param_name)
         if not str(param.dtype).startswith(("torch.uint", "torch.int", "torch.bool")):
             param = param.to(torch_dtype)
         set_module_tensor_to_device(block, param_name, "cpu", value=param, dtype=param.dtype)
@@ -86,6 +94,7 @@ def _load_state_dict_from_repo(
     token: Optional[Union[str, bool]] = None,
     cache_dir: str,
     max_disk_space: Optional[int] = None,
+    shard_cache: Optional[ShardCache] = None,
 ) -> StateDict:
     if always_needs_auth(model_name) and token is None:
         token = True
@@ -118,6 +127,7 @@ def _load_state_dict_from_repo(
             token=token,
             cache_dir=cache_dir,
             max_disk_space=max_disk_space,
+            shard_cache=shard_cache,
         )
         shard_state_dict = {
             param_name[len(block_prefix) :]: param
@@ -168,6 +178,7 @@ def _load_state_dict_from_repo_file(
     token: Optional[Union[str, bool]] = None,
     cache_dir: str,
     max_disk_space: Optional[int] = None,
+    shard_cache: Optional[ShardCache] = None,
     delay: float = 30,
 ) -> StateDict:
     # First, try to find the weights locally
@@ -182,7 +193,7 @@ def _load_state_dict_from_repo_file(
                 local_files_only=True,
             )
             if path is not None:
-                return _load_state_dict_from_local_file(path, block_prefix=block_prefix)
+                return _load_state_dict_from_local_file(path, block_prefix=block_prefix, shard_cache=shard_cache)
     except Exception:
         logger.warning(f"Cache for file {filename} is corrupted, it will be downloaded again", exc_info=True)
 
@@ -207,13 +218,18 @@ def _load_state_dict_from_repo_file(
                 )
                 if path is None:
                     raise RuntimeError(f"File {filename} does not exist in repo {model_name}")
-                return _load_state_dict_from_local_file(path, block_prefix=block_prefix)
+                return _load_state_dict_from_local_file(path, block_prefix=block_prefix, shard_cache=shard_cache)
         except Exception as e:
             logger.warning(f"Failed to load file {filename} from HF Hub (retry in {delay:.0f} sec)", exc_info=True)
             time.sleep(delay)
 
 
-def _load_state_dict_from_local_file(path: str, *, block_prefix: Optional[str] = None) -> StateDict:
+def _load_state_dict_from_local_file(
+    path: str, *, block_prefix: Optional[str] = None, shard_cache: Optional[ShardCache] = None
+) -> StateDict:
+    if shard_cache is not None:
+        return shard_cache.load(path, block_prefix=block_prefix)
+
     if path.endswith(".bin"):
         return torch.load(path, map_location="cpu")
 
@@ -222,3 +238,203 @@ def _load_state_dict_from_local_file(path: str, *, block_prefix: Optional[str] =
             return {key: f.get_tensor(key) for key in f.keys() if block_prefix is None or key.startswith(block_prefix)}
 
     raise ValueError(f"Unknown weight format: {path}")
+
+
+SAFETENSORS_DTYPES = {
+    name: getattr(torch, dtype_name)
+    for name, dtype_name in [
+        ("F64", "float64"),
+        ("F32", "float32"),
+        ("F16", "float16"),
+        ("BF16", "bfloat16"),
+        ("F8_E4M3", "float8_e4m3fn"),
+        ("F8_E5M2", "float8_e5m2"),
+        ("I64", "int64"),
+        ("I32", "int32"),
+        ("I16", "int16"),
+        ("I8", "int8"),
+        ("U64", "uint64"),
+        ("U32", "uint32"),
+        ("U16", "uint16"),
+        ("U8", "uint8"),
+        ("BOOL", "bool"),
+    ]
+    if hasattr(torch, dtype_name)  # float8 types need torch>=2.1, uint16/32/64 torch>=2.3
+}
+
+
+def _materialize(tensor: torch.Tensor, dtype: Optional[torch.dtype], *, copy: bool) -> torch.Tensor:
+    """Copy a tensor out of a mapped file, casting floating point tensors to `dtype` on the way"""
+    if dtype is not None and tensor.is_floating_point():
+        return tensor.to(dtype, copy=copy)
+    return tensor.clone() if copy else tensor
+
+
+class MappedSafetensors:
+    """
+    A memory-mapped safetensors file, the tensors are read from disk only when they are copied out of it.
+    Tensors of a dtype missing from SAFETENSORS_DTYPES are read with safetensors.safe_open() instead.
+    """
+
+    def __init__(self, path: str):
+        self._path = path
+        with open(path, "rb") as f:
+            (header_size,) = struct.unpack("<Q", f.read(8))
+            self._entries = json.loads(f.read(header_size))
+            # A private mapping is writable for torch.frombuffer(), the file itself is never modified
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        self._entries.pop("__metadata__", None)
+        self._data_offset = 8 + header_size
+
+    def keys(self):
+        return self._entries.keys()
+
+    def get_tensor(self, key: str, dtype: Optional[torch.dtype] = None) -> torch.Tensor:
+        entry = self._entries[key]
+        if entry["dtype"] not in SAFETENSORS_DTYPES:
+            with safetensors.safe_open(self._path, framework="pt", device="cpu") as f:
+                return _materialize(f.get_tensor(key), dtype, copy=False)
+
+        shape, stored_dtype = entry["shape"], SAFETENSORS_DTYPES[entry["dtype"]]
+        begin, end = entry["data_offsets"]
+        if begin == end:
+            return torch.empty(shape, dtype=stored_dtype if dtype is None else dtype)
+
+        start = self._data_offset + begin
+        data = torch.frombuffer(self._mmap, dtype=torch.uint8, count=end - begin, offset=start)
+        tensor = _materialize(data.view(stored_dtype).reshape(shape), dtype, copy=True)
+        del data
+        self._release_pages(start, end - begin)
+        return tensor
+
+    def _release_pages(self, start: int, length: int):
+        # The pages were only read, dropping them keeps the RSS low: they are read from the file again if needed
+        if hasattr(mmap, "MADV_DONTNEED"):
+            page_start = start - start % mmap.PAGESIZE
+            self._mmap.madvise(mmap.MADV_DONTNEED, page_start, start + length - page_start)
+
+
+class ShardCache:
+    """
+    Opens each checkpoint file once and shares it between the blocks loaded from it, possibly from several threads.
+    Safetensors files are memory-mapped, .bin files are loaded with torch.load(mmap=True) if supported.
+    Only the tensors of the requested block are copied to memory, floating point ones are cast to `torch_dtype`.
+    """
+
+    def __init__(self, torch_dtype: Optional[torch.dtype] = None):
+        self.torch_dtype = torch_dtype
+        self._shards: Dict[str, Union[MappedSafetensors, StateDict]] = {}
+        self._mapped: Dict[str, bool] = {}
+        self._lock = threading.Lock()
+
+    def load(self, path: str, *, block_prefix: Optional[str] = None) -> StateDict:
+        shard = self._open(path)
+        keys = [key for key in shard.keys() if block_prefix is None or key.startswith(block_prefix)]
+        if isinstance(shard, MappedSafetensors):
+            return {key: shard.get_tensor(key, dtype=self.torch_dtype) for key in keys}
+        return {key: _materialize(shard[key], self.torch_dtype, copy=self._mapped[path]) for key in keys}
+
+    def _open(self, path: str) -> Union[MappedSafetensors, StateDict]:
+        with self._lock:
+            if path not in self._shards:
+                if path.endswith(".safetensors"):
+                    self._shards[path] = MappedSafetensors(path)
+                elif path.endswith(".bin"):
+                    try:
+                        self._shards[path], self._mapped[path] = torch.load(path, map_location="cpu", mmap=True), True
+                    except (TypeError, RuntimeError):  # torch<2.1 or a checkpoint in the legacy format
+                        self._shards[path], self._mapped[path] = torch.load(path, map_location="cpu"), False
+                else:
+                    raise ValueError(f"Unknown weight format: {path}")
+                logger.debug(f"Opened {path}")
+            return self._shards[path]
+
+    def close(self):
+        with self._lock:
+            self._shards.clear()
+            self._mapped.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class LoadingMemoryBudget:
+    """Limits the host memory used by the blocks being loaded at once, a block larger than the limit is loaded alone"""
+
+    def __init__(self, max_bytes: Optional[int]):
+        self.max_bytes = max_bytes
+        self._used_bytes = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, num_bytes: int):
+        if self.max_bytes is None:
+            return
+        with self._cond:
+            self._cond.wait_for(lambda: self._used_bytes == 0 or self._used_bytes + num_bytes <= self.max_bytes)
+            self._used_bytes += num_bytes
+
+    def release(self, num_bytes: int):
+        if self.max_bytes is None:
+            return
+        with self._cond:
+            self._used_bytes -= num_bytes
+            self._cond.notify_all()
+
+
+def load_pretrained_blocks(
+    model_name: str,
+    block_indices: Sequence[int],
+    *,
+    config: PretrainedConfig,
+    torch_dtype: Union[torch.dtype, str] = "auto",
+    revision: Optional[str] = None,
+    token: Optional[Union[str, bool]] = None,
+    cache_dir: Optional[str] = None,
+    max_disk_space: Optional[int] = None,
+    convert: Optional[Callable[[nn.Module, int], nn.Module]] = None,
+    num_workers: int = 1,
+    max_memory: Optional[int] = None,
+) -> Iterator[nn.Module]:
+    """
+    Load blocks with up to `num_workers` threads, applying `convert(block, block_index)` to each of them (e.g., moving
+    it to GPU). The checkpoint files are memory-mapped once for all blocks (see ShardCache). Yields the blocks in the
+    order of `block_indices`. If `max_memory` is set, blocks are loaded only while the host memory of the blocks being
+    loaded and converted is below `max_memory` bytes.
+    """
+    torch_dtype = resolve_block_dtype(config, torch_dtype)
+    block_size = get_block_size(config, "memory", dtype=torch_dtype)
+    budget = LoadingMemoryBudget(max_memory)
+
+    def _load_block(block_index: int) -> nn.Module:
+        budget.acquire(block_size)
+        try:
+            block = load_pretrained_block(
+                model_name,
+                block_index,
+                config=config,
+                torch_dtype=torch_dtype,
+                revision=revision,
+                token=token,
+                cache_dir=cache_dir,
+                max_disk_space=max_disk_space,
+                shard_cache=shard_cache,
+            )
+            if convert is not None:
+                block = convert(block, block_index)
+            return block
+        finally:
+            budget.release(block_size)
+
+    with ShardCache(torch_dtype) as shard_cache:
+        executor = ThreadPoolExecutor(num_workers, thread_name_prefix="BlockLoader")
+        futures: Sequence[Future] = [executor.submit(_load_block, block_index) for block_index in block_indices]
+        try:
+            for future in futures:
+                yield future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=True)
@@ -184,6 +184,7 @@ class TransformerConnectionHandler(ConnectionHandler):
                         points=points,
                         quant_type=self.quant_type,
                         args_structure=args_structure,
+                        prefix_id=self._get_prefix_id(metadata, context),
                     ):
                         if can_push:
                             task = asyncio.create_task(self._push_outputs(request, output_tensors[0], step_metadata))
@@ -493,6 +494,14 @@ class TransformerConnectionHandler(ConnectionHandler):
             raise KeyError(f"adapter {active_adapter} not found")
         return active_adapter
 
+    @staticmethod
+    def _get_prefix_id(metadata: dict, context: P2PContext) -> Optional[str]:
+        """Scope the client-supplied prefix_id to the client's peer, so that peers can't use each other's prefixes"""
+        prefix_id = metadata.get("prefix_id")
+        if prefix_id is None:
+            return None
+        return f"{context.remote_id}/{prefix_id}"
+
     def _serialize_grads(
         self,
         grads: Sequence[torch.Tensor],
@@ -543,7 +552,10 @@ class TransformerConnectionHandler(ConnectionHandler):
         :returns: a list of {len(backends)} elements, where i-th element is a tuple of cache handles for i-th backend
         """
         descriptors = [backend.get_inference_cache_descriptors(batch_size, max_length) for backend in backends]
-        async with backends[0].memory_cache.allocate_cache(*chain(*descriptors), timeout=timeout) as handles:
+        length_dims = [dim for backend in backends for dim in backend.get_inference_cache_length_dims()]
+        async with backends[0].memory_cache.allocate_cache(
+            *chain(*descriptors), timeout=timeout, length_dims=length_dims
+        ) as handles:
             yield nested_pack(handles, descriptors)
 
     def _log_request(
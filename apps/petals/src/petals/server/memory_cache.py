@@ -3,6 +3,11 @@ A pytorch memory cache that can be allocated by ConnectionHandler (on cpu) and u
 
 For now, the only purpose of this code is to ensure that allocated memory will be deleted properly.
 
+If page_size is specified, nothing is reserved when a session is opened: the runtime allocates the cache in pages of
+page_size tokens as the sequence grows and charges them to the same byte budget (see PagedTensor), so short sessions
+only use what they need. A step that needs pages while the cache is full fails with AllocationFailed before it
+modifies any cache (see TransformerBackend.ensure_cache_length): the session is closed with that error and the client
+replays it on another server, like after a server failure.
 """
 import asyncio
 import contextlib
@@ -10,7 +15,7 @@ import ctypes
 import multiprocessing as mp
 import os
 import time
-from typing import AsyncContextManager, Dict, Optional, Sequence
+from typing import AsyncContextManager, Dict, List, Optional, Sequence, Union
 
 import async_timeout
 import torch
@@ -26,14 +31,18 @@ logger = get_logger(__name__)
 class MemoryCache:
     """A shared cache for storing tensors that persist across calls. Main use case: storing past attention KVs"""
 
-    def __init__(self, max_size_bytes: Optional[int], max_alloc_timeout: Optional[float] = None):
+    def __init__(
+        self, max_size_bytes: Optional[int], max_alloc_timeout: Optional[float] = None, page_size: Optional[int] = None
+    ):
         self.max_size_bytes = max_size_bytes if max_size_bytes is not None else (2**64 - 1)
         self.max_alloc_timeout = max_alloc_timeout
+        assert page_size is None or page_size > 0, "page_size must be positive"
+        self.page_size = page_size
         self._lock_metadata = mp.Lock()
         self._current_size = mp.Value(ctypes.c_int64, 0, lock=False)
         self._enqueued_size = mp.Value(ctypes.c_int64, 0, lock=True)
         self._handle_counter = mp.Value(ctypes.c_int64, 0, lock=False)
-        self._allocated_tensors: Dict[Handle, torch.Tensor] = {}
+        self._allocated_tensors: Dict[Handle, Union[torch.Tensor, PagedTensor]] = {}
         self.runtime_pid = os.getpid()
 
         self._pipe_recv, self._pipe_send = mp.Pipe(duplex=False)  # any ConnectionHandler -> runtime
@@ -60,6 +69,10 @@ class MemoryCache:
     def bytes_left(self) -> int:
         return self.max_size_bytes - self.current_size_bytes
 
+    @property
+    def paged(self) -> bool:
+        return self.page_size is not None
+
     @property
     def handle_counter(self) -> int:
         return self._handle_counter.value
@@ -70,13 +83,15 @@ class MemoryCache:
 
     @contextlib.asynccontextmanager
     async def allocate_cache(
-        self, *descriptors: TensorDescriptor, timeout: float
+        self, *descriptors: TensorDescriptor, timeout: float, length_dims: Optional[Sequence[int]] = None
     ) -> AsyncContextManager[Sequence[Handle]]:
         """
         Create a handle that is associated with buffers on unique device. If cache full, raises AllocationFailed.
 
         :param descriptors: one or more tensors tensor of this size, dtype, etc
         :param timeout: optional maximum time to wait for cache allocation; None (default) means no time limit
+        :param length_dims: for each descriptor, the index of its sequence length dimension (required if paged).
+          In paged mode, nothing is reserved here: the runtime reserves the pages when the tensors grow
 
         :note: if descriptors reside on different devices, it is expected that they are approximately balanced across devices;
           if not, it will count maximum tensor allocation across devices for the purposes of size limit
@@ -86,9 +101,11 @@ class MemoryCache:
         """
         assert os.getpid() != self.runtime_pid, "must be called by a ConnectionHandler, not runtime"
         assert all(descr.device is not None for descr in descriptors), "please specify allocated devices"
+        if self.paged:
+            assert length_dims is not None and len(length_dims) == len(descriptors), "paged cache needs length_dims"
         if self.max_alloc_timeout is not None:
             timeout = min(timeout, self.max_alloc_timeout)
-        max_alloc_size = self.get_allocation_size(*descriptors)
+        max_alloc_size = self.get_allocation_size(*descriptors) if not self.paged else 0
 
         gib = 1024**3
         cur_size, max_size = self.current_size_bytes, self.max_size_bytes
@@ -98,7 +115,9 @@ class MemoryCache:
             f"already used {cur_size / gib:.2f}/{friendly_max_size} GiB ({cur_size / max_size * 100:.1f}%)"
         )
 
-        alloc_task = asyncio.create_task(self._schedule_alloc(max_alloc_size, *descriptors, timeout=timeout))
+        alloc_task = asyncio.create_task(
+            self._schedule_alloc(max_alloc_size, *descriptors, timeout=timeout, length_dims=length_dims)
+        )
         try:
             handles = await shield_and_wait(alloc_task)
             logger.info(f"rpc_inference.alloc_done(size={max_alloc_size / gib:.2f} GiB)")
@@ -116,7 +135,11 @@ class MemoryCache:
         return max(alloc_size_by_device.values())
 
     async def _schedule_alloc(
-        self, alloc_size: int, *descriptors: TensorDescriptor, timeout: Optional[float]
+        self,
+        alloc_size: int,
+        *descriptors: TensorDescriptor,
+        timeout: Optional[float],
+        length_dims: Optional[Sequence[int]] = None,
     ) -> Sequence[Handle]:
         """
         This method should be called inside asyncio.shield() because:
@@ -128,7 +151,7 @@ class MemoryCache:
                     handles = tuple(int(self.handle_counter) + i for i in range(len(descriptors)))
                     self.current_size_bytes += alloc_size
                     self.handle_counter += len(handles)  # note: this will eventually overflow and it is okay
-                    self._pipe_send.send((handles, descriptors))
+                    self._pipe_send.send((handles, descriptors, length_dims))
                     return handles
         except TimeoutError:
             raise AllocationFailed(f"Could not allocate {alloc_size} (timeout={timeout})")
@@ -172,7 +195,7 @@ class MemoryCache:
         handles = alloc_task.result()
 
         with self._lock_metadata:
-            self._pipe_send.send((handles, None))  # signal runtime to free these handles
+            self._pipe_send.send((handles, None, None))  # signal runtime to free these handles
             self.current_size_bytes -= alloc_size
         self._memory_freed_event.set()
 
@@ -193,9 +216,9 @@ class MemoryCache:
             self._memory_freed_event.clear()
 
     @contextlib.contextmanager
-    def use_cache(self, *handles: Handle) -> Sequence[torch.Tensor]:
+    def use_cache(self, *handles: Handle) -> Sequence[Union[torch.Tensor, "PagedTensor"]]:
         """
-        Return one or more tensors previously allocated with allocate_cache,
+        Return one or more tensors previously allocated with allocate_cache (PagedTensor instances if paged),
 
         :note: This method is called by ModuleBackend in runtime: a single process with NO process parallelism.
         However, runtime may call use_cache concurrently with one or more connection handlers calling allocate_cache
@@ -205,11 +228,14 @@ class MemoryCache:
 
         # read creation/deletion requests from connection handlers
         while self._pipe_recv.poll():
-            recv_handles, recv_data = self._pipe_recv.recv()
+            recv_handles, recv_data, length_dims = self._pipe_recv.recv()
             if recv_data is not None:  # create new tensors
                 assert len(recv_handles) == len(recv_data)
-                for handle, descr in zip(recv_handles, recv_data):
-                    self._allocated_tensors[handle] = descr.make_zeros()
+                for i, (handle, descr) in enumerate(zip(recv_handles, recv_data)):
+                    if self.paged:
+                        self._allocated_tensors[handle] = PagedTensor(descr, length_dims[i], self.page_size, self)
+                    else:
+                        self._allocated_tensors[handle] = descr.make_zeros()
                     assert handle in self._allocated_tensors, f"Sanity check failed: no such handle ({handle})"
             else:  # delete tensors by handle
                 for handle in recv_handles:
@@ -217,9 +243,116 @@ class MemoryCache:
                         logger.warning(
                             f"Sanity check failed: asked to delete handle {handle}, but there is no such handle"
                         )
-                    self._allocated_tensors.pop(handle, None)
+                    tensor = self._allocated_tensors.pop(handle, None)
+                    if isinstance(tensor, PagedTensor):
+                        tensor.free()
         yield tuple(self._allocated_tensors[handle] for handle in handles)
 
+    def reserve_runtime_bytes(self, num_bytes: int):
+        """Account for memory allocated by the runtime itself (e.g. cache pages). Raises AllocationFailed if full"""
+        assert os.getpid() == self.runtime_pid
+        with self._lock_metadata:
+            if self.current_size_bytes + num_bytes > self.max_size_bytes:
+                raise AllocationFailed(
+                    f"Could not allocate {num_bytes} bytes for new cache pages: "
+                    f"{self.current_size_bytes}/{self.max_size_bytes} bytes in use"
+                )
+            self.current_size_bytes += num_bytes
+
+    def release_runtime_bytes(self, num_bytes: int):
+        with self._lock_metadata:
+            self.current_size_bytes -= num_bytes
+        self._memory_freed_event.set()
+
+
+class PagedTensor:
+    """
+    A cache tensor whose sequence dimension (length_dim) is allocated on demand, in pages of page_size tokens.
+    The pages are charged to the MemoryCache when they are allocated and released when the tensor is freed.
+
+    Attention needs contiguous past keys/values, so the pages are slices of one buffer (see block_table): reads are
+    views of it. The buffer grows by doubling its number of pages, so that a generation copies O(max_length) tokens in
+    total. While it grows, the old and the new buffer exist together and both are charged to the MemoryCache. If the
+    doubled buffer does not fit, the buffer only grows to the pages that are needed.
+    """
+
+    def __init__(self, descr: TensorDescriptor, length_dim: int, page_size: int, memory_cache: MemoryCache):
+        self.shape, self.dtype, self.device = tuple(descr.shape), descr.dtype, descr.device
+        self.length_dim, self.page_size, self.memory_cache = length_dim, page_size, memory_cache
+        self.max_length = self.shape[length_dim]
+        self.bytes_per_token = descr.numel() // max(self.max_length, 1) * get_size_in_bytes(self.dtype)
+        self.num_pages = 0
+        self._buffer: Optional[torch.Tensor] = None
+
+    @property
+    def allocated_length(self) -> int:
+        return min(self.num_pages * self.page_size, self.max_length)
+
+    @property
+    def allocated_bytes(self) -> int:
+        return self.allocated_length * self.bytes_per_token
+
+    @property
+    def block_table(self) -> List[torch.Tensor]:
+        """The allocated pages in token order, as views of the buffer"""
+        return [
+            self._buffer.narrow(self.length_dim, start, min(self.page_size, self.allocated_length - start))
+            for start in range(0, self.allocated_length, self.page_size)
+        ]
+
+    def ensure_length(self, length: int):
+        """Allocate pages so that the first length tokens can be stored. Raises AllocationFailed if the cache is full"""
+        if length > self.max_length:
+            raise ValueError(f"Cannot store {length} tokens in a cache tensor of max length {self.max_length}")
+        if length <= self.allocated_length:
+            return
+        min_num_pages = -(-length // self.page_size)
+        try:
+            num_pages = max(min_num_pages, 2 * self.num_pages)
+            self.memory_cache.reserve_runtime_bytes(self._pages_bytes(num_pages))
+        except AllocationFailed:
+            num_pages = min_num_pages
+            self.memory_cache.reserve_runtime_bytes(self._pages_bytes(num_pages))
+
+        try:
+            new_length = min(num_pages * self.page_size, self.max_length)
+            buffer = torch.zeros(self._shape_with_length(new_length), dtype=self.dtype, device=self.device)
+        except BaseException:
+            self.memory_cache.release_runtime_bytes(self._pages_bytes(num_pages))
+            raise
+        if self._buffer is not None:
+            buffer.narrow(self.length_dim, 0, self.allocated_length).copy_(self._buffer)
+        self.free()  # the old buffer is released only once its tokens are copied
+        self._buffer, self.num_pages = buffer, num_pages
+
+    def read(self, length: int) -> torch.Tensor:
+        """Return the first length tokens, as a view that can be updated in-place"""
+        assert length <= self.allocated_length, f"only {self.allocated_length} tokens allocated, requested {length}"
+        if self._buffer is None:
+            return torch.zeros(self._shape_with_length(0), dtype=self.dtype, device=self.device)
+        return self._buffer.narrow(self.length_dim, 0, length)
+
+    def write(self, tensor: torch.Tensor, start: int, end: int):
+        """Copy tokens [start, end) of tensor (indexed from the beginning of the sequence) into the pages"""
+        assert end <= self.allocated_length, f"only {self.allocated_length} tokens allocated, writing up to {end}"
+        if end == start or tensor.data_ptr() == self._buffer.data_ptr():
+            return  # nothing to write, or a view returned by read() that is already up to date
+        num_tokens = end - start
+        self._buffer.narrow(self.length_dim, start, num_tokens).copy_(tensor.narrow(self.length_dim, start, num_tokens))
+
+    def free(self):
+        if self._buffer is not None:
+            self.memory_cache.release_runtime_bytes(self.allocated_bytes)
+        self._buffer, self.num_pages = None, 0
+
+    def _pages_bytes(self, num_pages: int) -> int:
+        return min(num_pages * self.page_size, self.max_length) * self.bytes_per_token
+
+    def _shape_with_length(self, length: int) -> Sequence[int]:
+        shape = list(self.shape)
+        shape[self.length_dim] = length
+        return shape
+
 
 class AllocationFailed(Exception):
     pass
@@ -0,0 +1,115 @@
+"""
+A runtime-side cache of attention keys/values computed for the first inference step of a session.
+
+Many clients start their sessions with the same prompt prefix (e.g., a system prompt). If the first step of a new
+session has exactly the same inputs as a cached one (or the same client-supplied prefix_id), the block copies the cached
+keys/values into the session's cache and returns the cached outputs instead of running the block again.
+
+Prefixes identified by a hash of their inputs are shared by all clients, since the same inputs give the same outputs.
+A prefix_id is only trusted for the client that sent it: the connection handler scopes it to the client's peer id.
+Either way, the handler identifies the prefix once per span and passes it to the blocks in InferenceMetadata.prefix_id.
+"""
+import hashlib
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Hashable, Optional, Sequence
+
+import torch
+from hivemind.utils import get_logger
+
+from petals.server.memory_cache import AllocationFailed, MemoryCache
+from petals.utils.misc import get_size_in_bytes
+
+logger = get_logger(__name__)
+
+
+@dataclass(frozen=True)
+class PrefixCacheEntry:
+    outputs: torch.Tensor  # block outputs for the prefix, [batch_size, prefix_length, hid_size]
+    cache_tensors: Sequence[torch.Tensor]  # keys/values for the prefix tokens, in the same order as cache handles
+    num_bytes: int
+
+
+class PrefixCache:
+    """
+    LRU cache of prefix keys/values shared by all blocks of a server. Entries are stored on the devices of the attention
+    cache and count towards the MemoryCache size; the cache itself uses at most max_size_bytes.
+
+    :note: this class is only used by the runtime, like MemoryCache.use_cache
+    """
+
+    def __init__(self, memory_cache: MemoryCache, max_size_bytes: int):
+        self.memory_cache, self.max_size_bytes = memory_cache, max_size_bytes
+        self.current_size_bytes = 0
+        self._entries: OrderedDict[Hashable, PrefixCacheEntry] = OrderedDict()
+        self.hits = self.misses = 0
+
+    @staticmethod
+    def make_span_prefix_id(
+        first_uid: str, hidden_states: torch.Tensor, prompts: Sequence[Optional[torch.Tensor]], prefix_id: Optional[str]
+    ) -> str:
+        """
+        Identify the first step of a span of blocks by the client-supplied prefix_id if any, otherwise by a hash of the
+        span inputs. The inputs of every block in the span follow from the inputs of its first block and the deep
+        prompts, so the connection handler computes this once per span from the deserialized (host) tensors instead
+        of hashing the inputs of each block on the runtime. The prefix_id must be scoped to the client
+        (see TransformerConnectionHandler._get_prefix_id).
+        """
+        if prefix_id is not None:
+            return f"id:{first_uid}:{prefix_id}"
+        digest = hashlib.sha256()
+        for tensor in (hidden_states, *(prompt for prompt in prompts if prompt is not None)):
+            digest.update(str((tuple(tensor.shape), tensor.dtype)).encode())
+            digest.update(tensor.detach().to("cpu").contiguous().flatten().view(torch.uint8).numpy())
+        return f"inputs:{first_uid}:{digest.hexdigest()}"
+
+    @staticmethod
+    def make_key(uid: str, hidden_states: torch.Tensor, active_adapter: Optional[str], span_prefix_id: str) -> Hashable:
+        """Identify the prefix of a block by the span prefix id (see make_span_prefix_id)"""
+        return uid, active_adapter, tuple(hidden_states.shape), str(hidden_states.dtype), span_prefix_id
+
+    def get(self, key: Hashable) -> Optional[PrefixCacheEntry]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key: Hashable, outputs: torch.Tensor, cache_tensors: Sequence[torch.Tensor]):
+        """Store copies of the prefix outputs and keys/values, evicting least recently used entries if needed"""
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return
+        num_bytes = sum(tensor.numel() * get_size_in_bytes(tensor.dtype) for tensor in (outputs, *cache_tensors))
+        if num_bytes > self.max_size_bytes:
+            return
+
+        while self.current_size_bytes + num_bytes > self.max_size_bytes:
+            self._evict_oldest()
+        while True:
+            try:
+                self.memory_cache.reserve_runtime_bytes(num_bytes)
+                break
+            except AllocationFailed:
+                if not self._entries:
+                    logger.debug(f"Not caching a prefix of {num_bytes} bytes: attention cache is full")
+                    return
+                self._evict_oldest()
+
+        entry = PrefixCacheEntry(outputs.clone(), tuple(tensor.clone() for tensor in cache_tensors), num_bytes)
+        self._entries[key] = entry
+        self.current_size_bytes += num_bytes
+
+    def _evict_oldest(self):
+        _, entry = self._entries.popitem(last=False)
+        self.current_size_bytes -= entry.num_bytes
+        self.memory_cache.release_runtime_bytes(entry.num_bytes)
+
+    def clear(self):
+        while self._entries:
+            self._evict_oldest()
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -1,5 +1,7 @@
 from __future__ import annotations
 
+import copy
+import dataclasses
 import gc
 import math
 import multiprocessing as mp
@@ -8,7 +10,9 @@ import random
 import sys
 import threading
 import time
-from typing import Dict, List, Optional, Sequence, Union
+import weakref
+from concurrent.futures import Future
+from typing import Dict, List, Optional, Sequence, Tuple, Union
 
 import hivemind
 import psutil
@@ -27,14 +31,15 @@ from petals.data_structures import CHAIN_DELIMITER, UID_DELIMITER, ModelInfo, Se
 from petals.server import block_selection
 from petals.server.backend import TransformerBackend, merge_inference_pools_inplace
 from petals.server.block_utils import get_block_size, resolve_block_dtype
-from petals.server.from_pretrained import load_pretrained_block
+from petals.server.from_pretrained import load_pretrained_blocks
 from petals.server.handler import TransformerConnectionHandler
 from petals.server.memory_cache import MemoryCache
+from petals.server.prefix_cache import PrefixCache
 from petals.server.reachability import ReachabilityProtocol, check_direct_reachability, validate_reachability
 from petals.server.throughput import get_dtype_name, get_server_throughput
 from petals.utils.auto_config import AutoDistributedConfig
 from petals.utils.convert_block import QuantType, check_device_balance, convert_block
-from petals.utils.dht import declare_active_modules, get_remote_module_infos
+from petals.utils.dht import DHTStoreRecord, get_active_module_records, get_remote_module_infos, store_records
 from petals.utils.misc import get_size_in_bytes
 from petals.utils.ping import PingAggregator
 from petals.utils.random import sample_up_to
@@ -63,13 +68,19 @@ class Server:
         inference_max_length: Optional[int] = None,
         min_batch_size: int = 1,
         max_batch_size: Optional[int] = None,
+        max_batched_tasks: int = 1,
+        max_batch_wait: float = 0.0,
         max_chunk_size_bytes: int = 256 * 1024 * 1024,
         max_alloc_timeout: float = 600,
         attn_cache_tokens: Optional[int] = None,
+        attn_cache_page_size: Optional[int] = None,
+        prefix_cache_share: float = 0.0,
         torch_dtype: str = "auto",
         revision: Optional[str] = None,
         cache_dir: Optional[str] = None,
         max_disk_space: Optional[int] = None,
+        num_loading_workers: int = 1,
+        max_loading_memory: Optional[int] = None,
         device: Optional[Union[str, torch.device]] = None,
         compression=CompressionType.NONE,
         stats_report_interval: Optional[int] = None,
@@ -123,7 +134,7 @@ class Server:
         self.dht_prefix = dht_prefix
 
         if expiration is None:
-            expiration = max(2 * update_period, MAX_DHT_TIME_DISCREPANCY_SECONDS)
+            expiration = ModuleAnnouncerThread.get_default_expiration(update_period)
         self.expiration = expiration
 
         self.request_timeout = request_timeout
@@ -197,6 +208,7 @@ class Server:
         if inference_max_length is None:
             inference_max_length = 8192 if is_multiquery_attn else 2048
         self.min_batch_size, self.max_batch_size = min_batch_size, max_batch_size
+        self.max_batched_tasks, self.max_batch_wait = max_batched_tasks, max_batch_wait
         self.inference_max_length = inference_max_length
         self.max_chunk_size_bytes = max_chunk_size_bytes
         self.max_alloc_timeout = max_alloc_timeout
@@ -213,6 +225,9 @@ class Server:
         self.max_disk_space = max_disk_space
         self.adapters = adapters
 
+        # For loading blocks
+        self.num_loading_workers, self.max_loading_memory = num_loading_workers, max_loading_memory
+
         assert num_blocks is None or block_indices is None, "Please specify num_blocks or block_indices, not both"
         if num_blocks is None and block_indices is None:
             num_blocks = self._choose_num_blocks()
@@ -229,6 +244,9 @@ class Server:
 
         gib = 1024**3
         self.attn_cache_bytes = self._cache_bytes_per_block * num_blocks
+        self.attn_cache_page_size = attn_cache_page_size
+        assert 0.0 <= prefix_cache_share < 1.0, "prefix_cache_share must be in [0, 1)"
+        self.prefix_cache_share = prefix_cache_share
         logger.info(f"Attention cache for all blocks will consume up to {self.attn_cache_bytes / gib:.2f} GiB")
 
         assert isinstance(throughput, float) or throughput in ["auto", "eval", "dry_run"]
@@ -334,18 +352,24 @@ class Server:
                 converted_model_name_or_path=self.converted_model_name_or_path,
                 block_config=self.block_config,
                 attn_cache_bytes=self.attn_cache_bytes,
+                attn_cache_page_size=self.attn_cache_page_size,
+                prefix_cache_share=self.prefix_cache_share,
                 server_info=self.server_info,
                 model_info=self.model_info,
                 block_indices=block_indices,
                 num_handlers=self.num_handlers,
                 min_batch_size=self.min_batch_size,
                 max_batch_size=self.max_batch_size,
+                max_batched_tasks=self.max_batched_tasks,
+                max_batch_wait=self.max_batch_wait,
                 max_chunk_size_bytes=self.max_chunk_size_bytes,
                 max_alloc_timeout=self.max_alloc_timeout,
                 inference_max_length=self.inference_max_length,
                 torch_dtype=self.torch_dtype,
                 cache_dir=self.cache_dir,
                 max_disk_space=self.max_disk_space,
+                num_loading_workers=self.num_loading_workers,
+                max_loading_memory=self.max_loading_memory,
                 device=self.device,
                 compression=self.compression,
                 stats_report_interval=self.stats_report_interval,
@@ -441,16 +465,22 @@ class ModuleContainer(threading.Thread):
         converted_model_name_or_path: str,
         block_config: PretrainedConfig,
         attn_cache_bytes: int,
+        attn_cache_page_size: Optional[int],
+        prefix_cache_share: float,
         server_info: ServerInfo,
         model_info: ModelInfo,
         block_indices: List[int],
         min_batch_size: int,
         max_batch_size: int,
+        max_batched_tasks: int,
+        max_batch_wait: float,
         max_chunk_size_bytes: int,
         max_alloc_timeout: float,
         torch_dtype: torch.dtype,
         cache_dir: str,
         max_disk_space: int,
+        num_loading_workers: int,
+        max_loading_memory: Optional[int],
         device: Union[str, torch.device],
         compression: CompressionType,
         update_period: float,
@@ -463,7 +493,10 @@ class ModuleContainer(threading.Thread):
         **kwargs,
     ) -> ModuleContainer:
         module_uids = [f"{dht_prefix}{UID_DELIMITER}{block_index}" for block_index in block_indices]
-        memory_cache = MemoryCache(attn_cache_bytes, max_alloc_timeout)
+        memory_cache = MemoryCache(attn_cache_bytes, max_alloc_timeout, page_size=attn_cache_page_size)
+        prefix_cache = None
+        if prefix_cache_share > 0:
+            prefix_cache = PrefixCache(memory_cache, max_size_bytes=int(prefix_cache_share * attn_cache_bytes))
 
         server_info.state = ServerState.JOINING
         dht_announcer = ModuleAnnouncerThread(
@@ -482,32 +515,37 @@ class ModuleContainer(threading.Thread):
 
         assert len(tensor_parallel_devices) >= 1 and all(isinstance(d, torch.device) for d in tensor_parallel_devices)
 
+        def _convert_block(block: torch.nn.Module, block_index: int) -> torch.nn.Module:
+            return convert_block(
+                block,
+                block_index,
+                block_config,
+                tensor_parallel_devices,
+                device,
+                quant_type,
+                adapters=server_info.adapters,
+                freeze=True,
+                token=token,
+                cache_dir=cache_dir,
+                max_disk_space=max_disk_space,
+            )
+
         blocks = {}
+        loaded_blocks = load_pretrained_blocks(
+            converted_model_name_or_path,
+            block_indices,
+            config=block_config,
+            torch_dtype=torch_dtype,
+            revision=revision,
+            token=token,
+            cache_dir=cache_dir,
+            max_disk_space=max_disk_space,
+            convert=_convert_block,
+            num_workers=num_loading_workers,
+            max_memory=max_loading_memory,
+        )
         try:
-            for module_uid, block_index in zip(module_uids, block_indices):
-                block = load_pretrained_block(
-                    converted_model_name_or_path,
-                    block_index,
-                    config=block_config,
-                    torch_dtype=torch_dtype,
-                    revision=revision,
-                    token=token,
-                    cache_dir=cache_dir,
-                    max_disk_space=max_disk_space,
-                )
-                block = convert_block(
-                    block,
-                    block_index,
-                    block_config,
-                    tensor_parallel_devices,
-                    device,
-                    quant_type,
-                    adapters=server_info.adapters,
-                    freeze=True,
-                    token=token,
-                    cache_dir=cache_dir,
-                    max_disk_space=max_disk_space,
-                )
+            for module_uid, block in zip(module_uids, loaded_blocks):
                 blocks[module_uid] = TransformerBackend(
                     module_uid,
                     block,
@@ -515,6 +553,9 @@ class ModuleContainer(threading.Thread):
                     memory_cache=memory_cache,
                     backend_dtype=torch_dtype,
                     max_chunk_size_bytes=max_chunk_size_bytes,
+                    max_batched_tasks=max_batched_tasks,
+                    max_batch_wait=max_batch_wait,
+                    prefix_cache=prefix_cache,
                     args_schema=(
                         BatchTensorDescriptor(
                             1, 2048, block_config.hidden_size, dtype=torch_dtype, compression=compression
@@ -535,6 +576,7 @@ class ModuleContainer(threading.Thread):
             if should_validate_reachability:
                 validate_reachability(dht.peer_id)
         except:
+            loaded_blocks.close()  # Stops loading the next blocks
             logger.debug("Shutting down backends")
             for backend in blocks.values():
                 backend.shutdown()
@@ -671,8 +713,66 @@ class ModuleContainer(threading.Thread):
         logger.info("Module container shut down successfully")
 
 
+class AnnounceBatcher:
+    """
+    Coalesces the DHT stores of the announcers sharing a DHT instance (e.g. several containers in one process):
+    the first announcer to store waits for batch_window seconds, then stores the records of all announcers at once
+    """
+
+    _instances: weakref.WeakKeyDictionary[DHT, AnnounceBatcher] = weakref.WeakKeyDictionary()
+    _instances_lock = threading.Lock()
+
+    def __init__(self, dht: DHT, batch_window: float):
+        self._dht_ref = weakref.ref(dht)
+        self.batch_window = batch_window
+        self.num_stores = 0  # number of store_records calls, for monitoring
+        self._lock = threading.Lock()
+        self._pending: Dict[Tuple[str, Optional[str]], DHTStoreRecord] = {}
+        self._batch: Optional[Future] = None
+
+    @classmethod
+    def get(cls, dht: DHT, batch_window: float) -> AnnounceBatcher:
+        with cls._instances_lock:
+            if dht not in cls._instances:
+                cls._instances[dht] = cls(dht, batch_window)
+            return cls._instances[dht]
+
+    def store(self, records: Sequence[DHTStoreRecord]) -> None:
+        """Store the records together with the ones of the other announcers, returns once they are stored"""
+        with self._lock:
+            for record in records:
+                self._pending[record.key, record.subkey] = record  # a newer record replaces the pending one
+            batch, is_leader = self._batch, self._batch is None
+            if is_leader:
+                batch = self._batch = Future()
+
+        if not is_leader:
+            return batch.result()
+
+        time.sleep(self.batch_window)
+        with self._lock:
+            records, self._pending, self._batch = list(self._pending.values()), {}, None
+        try:
+            dht = self._dht_ref()
+            assert dht is not None, "The DHT was garbage collected"
+            self.num_stores += 1
+            store_records(dht, records)
+            batch.set_result(None)
+        except BaseException as e:
+            batch.set_exception(e)
+            raise
+
+
 class ModuleAnnouncerThread(threading.Thread):
-    """Periodically announces that this container hosts the specified modules, visible to all DHT peers"""
+    """
+    Periodically announces that this container hosts the specified modules, visible to all DHT peers.
+
+    The records are only stored again if the server info changed (ignoring small changes in the number of
+    free cache tokens and in the ping times) or if they would expire before the next update. With the default
+    expiration of 3 update periods, unchanged records are stored every other update. The stores of the
+    announcers sharing a DHT are batched with AnnounceBatcher, and the update period is jittered so that the
+    servers started together do not announce at the same time.
+    """
 
     def __init__(
         self,
@@ -684,8 +784,11 @@ class ModuleAnnouncerThread(threading.Thread):
         block_config: PretrainedConfig,
         memory_cache: MemoryCache,
         update_period: float,
-        expiration: float,
+        expiration: Optional[float] = None,
         max_pinged: int = 5,
+        jitter: float = 0.1,
+        batch_window: float = 0.1,
+        cache_tokens_tolerance: float = 0.1,
         **kwargs,
     ):
         super().__init__(**kwargs)
@@ -699,8 +802,11 @@ class ModuleAnnouncerThread(threading.Thread):
         self.bytes_per_token //= block_config.num_key_value_groups
 
         self.update_period = update_period
-        self.expiration = expiration
+        self.expiration = expiration if expiration is not None else self.get_default_expiration(update_period)
+        self.jitter = jitter
+        self.cache_tokens_tolerance = cache_tokens_tolerance
         self.trigger = threading.Event()
+        self.batcher = AnnounceBatcher.get(dht, batch_window)
 
         self.dht_prefix = parse_uid(module_uids[0])[0]
         block_indices = [parse_uid(uid)[1] for uid in module_uids]
@@ -714,6 +820,14 @@ class ModuleAnnouncerThread(threading.Thread):
         ]
         self.ping_aggregator = PingAggregator(self.dht)
 
+        self._announced_info: Optional[ServerInfo] = None
+        self._modules_expiration = self._model_info_expiration = -math.inf
+
+    @staticmethod
+    def get_default_expiration(update_period: float) -> float:
+        """Long enough for an unchanged record to skip one update and still be refreshed before it expires"""
+        return max(3 * update_period, MAX_DHT_TIME_DISCREPANCY_SECONDS)
+
     def run(self) -> None:
         while True:
             start_time = time.perf_counter()
@@ -727,23 +841,13 @@ class ModuleAnnouncerThread(threading.Thread):
             else:
                 self.server_info.next_pings = None  # No need to ping if we're disconnecting
 
-            declare_active_modules(
-                self.dht,
-                self.module_uids,
-                self.server_info,
-                expiration_time=get_dht_time() + self.expiration,
-            )
+            self._announce()
             if self.server_info.state == ServerState.OFFLINE:
                 break
-            if not self.dht_prefix.startswith("_"):  # Not private
-                self.dht.store(
-                    key="_petals.models",
-                    subkey=self.dht_prefix,
-                    value=self.model_info.to_dict(),
-                    expiration_time=get_dht_time() + self.expiration,
-                )
 
-            delay = self.update_period - (time.perf_counter() - start_time)
+            # Only shortened, so that the records stored with self.expiration are refreshed in time
+            update_period = self.update_period * (1 - self.jitter * random.random())
+            delay = update_period - (time.perf_counter() - start_time)
             if delay < 0:
                 logger.warning(
                     f"Declaring blocks to DHT takes more than --update_period, consider increasing it (currently {self.update_period})"
@@ -757,6 +861,55 @@ class ModuleAnnouncerThread(threading.Thread):
         if state == ServerState.OFFLINE:
             self.join()
 
+    def _announce(self) -> None:
+        """Store the records that changed or would expire before the next update"""
+        now = get_dht_time()
+        expiration_time = now + self.expiration
+        refresh_before = now + self.update_period + MAX_DHT_TIME_DISCREPANCY_SECONDS
+
+        store_modules = (
+            self._announced_info is None
+            or self._modules_expiration < refresh_before
+            or self._info_changed(self._announced_info, self.server_info)
+        )
+        store_model_info = (
+            self.server_info.state != ServerState.OFFLINE
+            and not self.dht_prefix.startswith("_")  # Not private
+            and self._model_info_expiration < refresh_before
+        )
+
+        records = []
+        if store_modules:
+            records += get_active_module_records(self.dht, self.module_uids, self.server_info, expiration_time)
+        if store_model_info:
+            model_record = DHTStoreRecord("_petals.models", self.dht_prefix, self.model_info.to_dict(), expiration_time)
+            records.append(model_record)
+        if not records:
+            return
+
+        announced_info = copy.deepcopy(self.server_info)
+        self.batcher.store(records)
+        if store_modules:
+            self._announced_info, self._modules_expiration = announced_info, expiration_time
+        if store_model_info:
+            self._model_info_expiration = expiration_time
+
+    def _info_changed(self, announced: ServerInfo, current: ServerInfo) -> bool:
+        """Whether the announced info is outdated, small changes of the free cache and the ping times are ignored"""
+        announced_fields, current_fields = dataclasses.asdict(announced), dataclasses.asdict(current)
+        for field in ["cache_tokens_left", "next_pings"]:
+            del announced_fields[field], current_fields[field]
+        if announced_fields != current_fields:
+            return True
+
+        # Clients need to know about newly reachable next servers, not about the small changes of their ping
+        if set(announced.next_pings or ()) != set(current.next_pings or ()):
+            return True
+
+        max_cache_tokens = self.memory_cache.max_size_bytes // self.bytes_per_token
+        cache_tokens_change = abs((current.cache_tokens_left or 0) - (announced.cache_tokens_left or 0))
+        return cache_tokens_change > self.cache_tokens_tolerance * max_cache_tokens
+
     def _ping_next_servers(self) -> Dict[hivemind.PeerID, float]:
         module_infos = get_remote_module_infos(self.dht, self.next_uids, latest=True)
         middle_servers = {peer_id for info in module_infos[:-1] for peer_id in info.servers}
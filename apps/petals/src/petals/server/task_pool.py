@@ -1,11 +1,12 @@
 import ctypes
+import heapq
 import multiprocessing as mp
 import threading
 import time
 from concurrent.futures._base import PENDING
 from dataclasses import dataclass, field
 from queue import PriorityQueue
-from typing import Any, List, Optional, Sequence, Tuple, Union
+from typing import Any, Callable, Hashable, List, Optional, Sequence, Tuple, Union
 
 import torch
 from hivemind import get_logger
@@ -26,14 +27,22 @@ class Task:
         return self.future._uid
 
 
+@dataclass(frozen=True)
+class TaskBatch:
+    """Arguments of several compatible tasks, passed to PrioritizedTaskPool.process_func as its only argument"""
+
+    task_args: Sequence[Sequence[Any]]
+
+
 class PrioritizedTaskPool(threading.Thread):
     """
     Aggregates requests from multiple ConnectionHandler instances, orders them for processing in Runtime, then
     returns results (or exception) to the corresponding ConnectionHandler. Runs a background process.
     A single PrioritizedTaskPool services a specific function (e.g. layer1.forward, layer2.forward or layer1.backward)
 
-    :note: unlike hivemind.moe TaskPool, this pool does *not* combine incoming requests into batches.
-      This would require grouping requests of different length.
+    :note: unlike hivemind.moe TaskPool, this pool does *not* combine incoming requests into batches by default.
+      This would require grouping requests of different length. If batch_process_func is specified, the pool merges
+      up to max_batched_tasks pending tasks with the same batch key (see get_batch_key) into a single call.
 
     :param process_func: function to be applied to every formed batch; called by Runtime
         Note that process_func should accept only positional args (Tensors) and return a flat tuple of Tensors
@@ -44,6 +53,13 @@ class PrioritizedTaskPool(threading.Thread):
     :param min_batch_size: process at least this many inputs in a batch, otherwise wait for more
     :param device: if specified, input tensors will be moved to that device by default
     :param start: if True, start automatically at the end of __init__
+    :param batch_process_func: function applied to several compatible tasks at once. It receives the args of each task
+        and must return a flat tuple of Tensors, each of them being the concatenation of the tasks' outputs (dim 0)
+    :param get_batch_key: returns a hashable key for the args of a task; only tasks with the same key are merged.
+        If it returns None, the task is always processed alone
+    :param max_batched_tasks: merge at most this many tasks into one call (1 disables batching)
+    :param max_batch_wait: when the first task of a batch has been submitted less than this many seconds ago,
+        wait for more compatible tasks until then
     """
 
     def __init__(
@@ -55,9 +71,16 @@ class PrioritizedTaskPool(threading.Thread):
         device: Optional[torch.device] = None,
         daemon=True,
         start=False,
+        batch_process_func: Optional[Callable[[Sequence[Sequence[Any]]], Tuple[torch.Tensor, ...]]] = None,
+        get_batch_key: Optional[Callable[[Sequence[Any]], Optional[Hashable]]] = None,
+        max_batched_tasks: int = 1,
+        max_batch_wait: float = 0.0,
     ):
         super().__init__(daemon=daemon, name=name)
-        self.process_func = process_func
+        self._process_func = process_func
+        self.batch_process_func, self.get_batch_key = batch_process_func, get_batch_key
+        self.max_batched_tasks = max_batched_tasks if batch_process_func is not None else 1
+        self.max_batch_wait = max_batch_wait
         # the lower the priority is, the more urgent it is to process this pool
         self._priority = mp.Value(ctypes.c_double, 1.0)
 
@@ -110,6 +133,12 @@ class PrioritizedTaskPool(threading.Thread):
                 self.priority = (task.priority, task.time_submitted)
         return task.future
 
+    def process_func(self, *args: Any) -> Tuple[torch.Tensor, ...]:
+        """Called by Runtime on the inputs returned by load_batch_to_runtime"""
+        if len(args) == 1 and isinstance(args[0], TaskBatch):
+            return self.batch_process_func(args[0].task_args)
+        return self._process_func(*args)
+
     def get_task_size(self, task: Task) -> int:
         """compute task processing complexity; defaults to the total number of tokens"""
         if task.args and task.args[0].ndim >= 2:
@@ -122,34 +151,79 @@ class PrioritizedTaskPool(threading.Thread):
         """receive next batch of arrays"""
         device = device if device is not None else self.device
         task = self._ordered_tasks.get(block=True, timeout=timeout)
-        batch_inputs = [_move_to_device_if_tensor(arg, device, share_memory=False) for arg in task.args]
-        self._dispatched_tasks[task.uid] = task
-        self.batch_receiver.recv()  # reduce the number of active batches
+        tasks = [task]
+        if self.max_batched_tasks > 1:
+            batch_key = self.get_batch_key(task.args)
+            if batch_key is not None:
+                tasks.extend(self._get_compatible_tasks(task, batch_key))
+
+        task_args = [[_move_to_device_if_tensor(arg, device, share_memory=False) for arg in t.args] for t in tasks]
+        batch_inputs = task_args[0] if len(tasks) == 1 else [TaskBatch(task_args)]
+        self._dispatched_tasks[task.uid] = tasks
+        for _ in tasks:
+            self.batch_receiver.recv()  # reduce the number of active batches
         if not self._ordered_tasks.empty():
             first_remaining_task: Task = self._ordered_tasks.queue[0]
             self.priority = (first_remaining_task.priority, first_remaining_task.time_submitted)
         return task.uid, batch_inputs
 
+    def _get_compatible_tasks(self, first_task: Task, batch_key: Hashable) -> List[Task]:
+        """Take pending tasks that can be merged with first_task, waiting for new ones up to max_batch_wait"""
+        tasks = []
+        total_size = self.get_task_size(first_task)
+        deadline = first_task.time_submitted + self.max_batch_wait
+        with self._ordered_tasks.mutex:
+            while True:
+                queue = self._ordered_tasks.queue
+                taken = []
+                for index, task in enumerate(queue):  # note: we visit tasks in heap order, not by priority
+                    if len(tasks) + 1 >= self.max_batched_tasks:
+                        break
+                    task_size = self.get_task_size(task)
+                    if total_size + task_size <= self.max_batch_size and self.get_batch_key(task.args) == batch_key:
+                        tasks.append(task)
+                        taken.append(index)
+                        total_size += task_size
+                if taken:
+                    for index in reversed(taken):
+                        queue.pop(index)
+                    heapq.heapify(queue)
+
+                remaining_time = deadline - time.monotonic()
+                if len(tasks) + 1 >= self.max_batched_tasks or remaining_time <= 0:
+                    break
+                self._ordered_tasks.not_empty.wait(remaining_time)  # wakes up when run() puts a new task
+        return tasks
+
     def send_outputs_from_runtime(self, uid: int, batch_outputs: List[torch.Tensor]):
         """send results for a processed batch, previously loaded through load_batch_to_runtime"""
-        batch_outputs = [_move_to_device_if_tensor(output, device="cpu", share_memory=True) for output in batch_outputs]
-        task = self._dispatched_tasks.pop(uid, None)
-        if task is None:
+        tasks = self._dispatched_tasks.pop(uid, None)
+        if tasks is None:
             logger.error(
                 f"Internal error: task task with index {uid} is missing from the dictionary; " f"Could not set result"
             )
-        else:
-            task.future.set_result(batch_outputs)
+            return
+
+        # scatter the concatenated outputs back to each task, according to the batch size of its first input
+        split_sizes = [task.args[0].shape[0] for task in tasks] if len(tasks) > 1 else None
+        for i, task in enumerate(tasks):
+            if split_sizes is None:
+                task_outputs = batch_outputs
+            else:
+                task_outputs = [output.split(split_sizes)[i] for output in batch_outputs]
+            task_outputs = [_move_to_device_if_tensor(out, device="cpu", share_memory=True) for out in task_outputs]
+            task.future.set_result(task_outputs)
 
     def send_exception_from_runtime(self, uid: int, exception: BaseException):
-        task = self._dispatched_tasks.pop(uid, None)
-        if task is None:
+        tasks = self._dispatched_tasks.pop(uid, None)
+        if tasks is None:
             logger.error(
                 f"Internal error: task task with index {uid} is missing from the dictionary; "
                 f"Could not set exception {exception}"
             )
         else:
-            task.future.set_exception(exception)
+            for task in tasks:
+                task.future.set_exception(exception)
 
     @property
     def empty(self):
@@ -5,7 +5,7 @@ from __future__ import annotations
 
 import math
 from functools import partial
-from typing import Dict, List, Optional, Sequence, Union
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Union
 
 from hivemind.dht import DHT, DHTNode, DHTValue
 from hivemind.p2p import PeerID
@@ -54,6 +54,48 @@ def declare_active_modules(
     )
 
 
+class DHTStoreRecord(NamedTuple):
+    key: str
+    subkey: Optional[str]
+    value: Any
+    expiration_time: DHTExpiration
+
+
+def get_active_module_records(
+    dht: DHT, uids: Sequence[ModuleUID], server_info: ServerInfo, expiration_time: DHTExpiration
+) -> List[DHTStoreRecord]:
+    """The records stored by declare_active_modules, to be stored together with others by store_records"""
+    subkey, value = dht.peer_id.to_base58(), server_info.to_tuple()
+    return [DHTStoreRecord(uid, subkey, value, expiration_time) for uid in uids]
+
+
+def store_records(
+    dht: DHT, records: Sequence[DHTStoreRecord], wait: bool = True
+) -> Union[Dict[Any, bool], MPFuture[Dict[Any, bool]]]:
+    """
+    Store records with arbitrary keys, subkeys and expirations in a single store_many call,
+    so that the stores sent to the same DHT peer are sent in the same RPC
+
+    :param wait: if True, awaits for the stores to finish, otherwise runs in background
+    :returns: if wait, returns the store status of every record (True = store succeeded, False = store rejected)
+    """
+    return dht.run_coroutine(partial(_store_records, records=list(records)), return_future=not wait)
+
+
+async def _store_records(dht: DHT, node: DHTNode, records: List[DHTStoreRecord]) -> Dict[Any, bool]:
+    if not records:
+        return {}
+    num_workers = len(records) if dht.num_workers is None else min(len(records), dht.num_workers)
+    keys, subkeys, values, expiration_times = map(list, zip(*records))
+    return await node.store_many(
+        keys=keys,
+        subkeys=subkeys,
+        values=values,
+        expiration_time=expiration_times,
+        num_workers=num_workers,
+    )
+
+
 async def _declare_active_modules(
     dht: DHT,
     node: DHTNode,
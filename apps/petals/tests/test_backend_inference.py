@@ -0,0 +1,195 @@
+import contextlib
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import pytest
+import pytest_asyncio  # make sure the module exists; otherwise the test will be skipped
+import torch
+from hivemind import BatchTensorDescriptor
+
+from petals import AutoDistributedConfig
+from petals.data_structures import InferenceMetadata
+from petals.server.backend import TransformerBackend, _MergedInferenceStep, _select_length
+from petals.server.from_pretrained import load_pretrained_block
+from petals.server.memory_cache import MemoryCache, PagedTensor
+from petals.server.prefix_cache import PrefixCache
+from petals.utils.convert_block import QuantType, convert_block
+from petals.utils.misc import DUMMY_INT64
+from test_utils import *
+
+BLOCK_INDICES = (0, 1)
+MAX_LENGTH = 16
+
+
+def _make_backends(
+    memory_cache: MemoryCache, prefix_cache: Optional[PrefixCache] = None
+) -> Dict[str, TransformerBackend]:
+    config = AutoDistributedConfig.from_pretrained(MODEL_NAME)
+    device = torch.device("cpu")
+    backends = {}
+    for block_index in BLOCK_INDICES:
+        block = load_pretrained_block(MODEL_NAME, block_index, config=config, torch_dtype=torch.float32)
+        block = convert_block(block, block_index, config, [device], device, QuantType.NONE, freeze=True)
+        uid = f"test_block.{block_index}"
+        backends[uid] = TransformerBackend(
+            uid,
+            block,
+            config=config,
+            memory_cache=memory_cache,
+            backend_dtype=torch.float32,
+            max_chunk_size_bytes=2**30,
+            prefix_cache=prefix_cache,
+            args_schema=(BatchTensorDescriptor(1, 2048, config.hidden_size, dtype=torch.float32),),
+            kwargs_schema={},
+            outputs_schema=(BatchTensorDescriptor(1, 2048, config.hidden_size, dtype=torch.float32),),
+            min_batch_size=1,
+            max_batch_size=8192,
+        )
+    return backends
+
+
+async def _open_session(
+    stack: contextlib.AsyncExitStack, backends: Dict[str, TransformerBackend], batch_size: int
+) -> List[Sequence[int]]:
+    """Allocate the caches of one session on all blocks, like TransformerConnectionHandler._allocate_cache"""
+    memory_cache = next(iter(backends.values())).memory_cache
+    runtime_pid = memory_cache.runtime_pid
+    memory_cache.runtime_pid += 1  # pretend we're another process
+    session_handles = []
+    for backend in backends.values():
+        handles = await stack.enter_async_context(
+            memory_cache.allocate_cache(
+                *backend.get_inference_cache_descriptors(batch_size, MAX_LENGTH),
+                timeout=0,
+                length_dims=backend.get_inference_cache_length_dims(),
+            )
+        )
+        session_handles.append(handles)
+    memory_cache.runtime_pid = runtime_pid
+    return session_handles
+
+
+def _make_infos(
+    backends: Dict[str, TransformerBackend],
+    session_handles: Sequence[Sequence[int]],
+    prefix_length: int,
+    prefix_id: Optional[str] = None,
+) -> Tuple[InferenceMetadata, ...]:
+    return tuple(
+        InferenceMetadata(uid, prefix_length, tuple(handles), None, prefix_id)
+        for uid, handles in zip(backends.keys(), session_handles)
+    )
+
+
+def _read_cache(backends: Dict[str, TransformerBackend], session_handles: Sequence[Sequence[int]], length: int):
+    contents = []
+    for backend, handles in zip(backends.values(), session_handles):
+        with backend.memory_cache.use_cache(*handles) as cache_tensors:
+            for i, cache_tensor in enumerate(cache_tensors):
+                if isinstance(cache_tensor, PagedTensor):
+                    contents.append(cache_tensor.read(length).clone())
+                else:
+                    contents.append(_select_length(cache_tensor, i, 0, length).clone())
+    return contents
+
+
+@pytest.mark.forked
+@pytest.mark.asyncio
+@pytest.mark.parametrize("page_size", [None, 4])
+async def test_batched_inference_step(page_size: Optional[int], batch_sizes: Sequence[int] = (1, 2, 3)):
+    torch.manual_seed(0)
+    backends = _make_backends(MemoryCache(max_size_bytes=None, page_size=page_size))
+    hidden_size = next(iter(backends.values())).config.hidden_size
+    merged_step = _MergedInferenceStep(backends)
+
+    async with contextlib.AsyncExitStack() as stack:
+        ref_sessions = [await _open_session(stack, backends, batch_size) for batch_size in batch_sizes]
+        batched_sessions = [await _open_session(stack, backends, batch_size) for batch_size in batch_sizes]
+
+        prefix_length = 0
+        for seq_len, reorder in [(5, False), (1, True), (1, False), (3, True)]:
+            inputs = [torch.randn(batch_size, seq_len, hidden_size) for batch_size in batch_sizes]
+            hypo_ids = [torch.arange(batch_size).flip(0) if reorder else DUMMY_INT64 for batch_size in batch_sizes]
+
+            ref_outputs = []
+            for session, hidden_states, session_hypo_ids in zip(ref_sessions, inputs, hypo_ids):
+                infos = _make_infos(backends, session, prefix_length)
+                (outputs,) = merged_step(hidden_states.clone(), session_hypo_ids, infos, *([None] * len(infos)))
+                ref_outputs.append(outputs)
+
+            task_args = [
+                (hidden_states, session_hypo_ids, _make_infos(backends, session, prefix_length), None, None)
+                for session, hidden_states, session_hypo_ids in zip(batched_sessions, inputs, hypo_ids)
+            ]
+            batch_keys = {merged_step.get_batch_key(args) for args in task_args}
+            assert len(batch_keys) == 1 and None not in batch_keys
+            (batched_outputs,) = merged_step.batched(task_args)
+
+            assert torch.allclose(batched_outputs, torch.cat(ref_outputs), rtol=0, atol=1e-5)
+            prefix_length += seq_len
+            for ref_session, batched_session in zip(ref_sessions, batched_sessions):
+                ref_cache = _read_cache(backends, ref_session, prefix_length)
+                batched_cache = _read_cache(backends, batched_session, prefix_length)
+                for ref_tensor, batched_tensor in zip(ref_cache, batched_cache):
+                    assert torch.allclose(batched_tensor, ref_tensor, rtol=0, atol=1e-5)
+
+
+@pytest.mark.forked
+def test_batch_key():
+    backends = _make_backends(MemoryCache(max_size_bytes=None))
+    hidden_size = next(iter(backends.values())).config.hidden_size
+    merged_step = _MergedInferenceStep(backends, max_batched_prefix_length=8)
+
+    def _batch_key(batch_size: int, prefix_length: int, *prompts: Optional[torch.Tensor]):
+        infos = _make_infos(backends, [(0, 1)] * len(backends), prefix_length)
+        prompts = prompts or [None] * len(infos)
+        return merged_step.get_batch_key((torch.zeros(batch_size, 1, hidden_size), DUMMY_INT64, infos, *prompts))
+
+    assert _batch_key(1, 4) is not None and _batch_key(1, 4) == _batch_key(3, 4)
+    assert _batch_key(1, 4) != _batch_key(1, 5)
+    assert _batch_key(1, 4, torch.zeros(1, 1, hidden_size), None) is None
+    assert _batch_key(1, 8) is not None
+    assert _batch_key(1, 9) is None, "steps after long prefixes should not be batched"
+
+
+@pytest.mark.forked
+@pytest.mark.asyncio
+@pytest.mark.parametrize("page_size", [None, 4])
+async def test_prefix_cache_hit(page_size: Optional[int], batch_size: int = 2):
+    torch.manual_seed(0)
+    memory_cache = MemoryCache(max_size_bytes=None, page_size=page_size)
+    prefix_cache = PrefixCache(memory_cache, max_size_bytes=2**30)
+    backends = _make_backends(memory_cache, prefix_cache)
+    hidden_size = next(iter(backends.values())).config.hidden_size
+    merged_step = _MergedInferenceStep(backends)
+
+    prefix = torch.randn(batch_size, 5, hidden_size)
+    span_prefix_id = PrefixCache.make_span_prefix_id(next(iter(backends)), prefix, [None] * len(backends), None)
+
+    def _step(session, hidden_states: torch.Tensor, prefix_length: int, prefix_id: Optional[str] = None):
+        infos = _make_infos(backends, session, prefix_length, prefix_id)
+        (outputs,) = merged_step(hidden_states.clone(), DUMMY_INT64, infos, *([None] * len(infos)))
+        return outputs
+
+    async with contextlib.AsyncExitStack() as stack:
+        ref_session, first_session, second_session = [
+            await _open_session(stack, backends, batch_size) for _ in range(3)
+        ]
+
+        ref_outputs = _step(ref_session, prefix, 0)  # without a prefix id, the prefix cache is not used
+        assert prefix_cache.hits == prefix_cache.misses == 0
+        first_outputs = _step(first_session, prefix, 0, span_prefix_id)
+        assert prefix_cache.misses == len(backends) and prefix_cache.hits == 0
+        second_outputs = _step(second_session, prefix, 0, span_prefix_id)
+        assert prefix_cache.hits == len(backends), "the second session should reuse the cached prefix in all blocks"
+
+        assert torch.equal(second_outputs, first_outputs)
+        assert torch.allclose(second_outputs, ref_outputs, rtol=0, atol=1e-5)
+        first_cache = _read_cache(backends, first_session, prefix.shape[1])
+        second_cache = _read_cache(backends, second_session, prefix.shape[1])
+        for first_tensor, second_tensor in zip(first_cache, second_cache):
+            assert torch.equal(second_tensor, first_tensor)
+
+        next_inputs = torch.randn(batch_size, 1, hidden_size)
+        ref_outputs = _step(ref_session, next_inputs, prefix.shape[1])
+        second_outputs = _step(second_session, next_inputs, prefix.shape[1])
+        assert torch.allclose(second_outputs, ref_outputs, rtol=0, atol=1e-5)
@@ -0,0 +1,105 @@
+import threading
+import time
+
+import pytest
+import torch
+from safetensors.torch import save_file
+
+from petals import AutoDistributedConfig
+from petals.server.from_pretrained import (
+    SAFETENSORS_DTYPES,
+    LoadingMemoryBudget,
+    MappedSafetensors,
+    ShardCache,
+    load_pretrained_block,
+    load_pretrained_blocks,
+)
+from test_utils import MODEL_NAME
+
+
+def test_mapped_safetensors(tmp_path):
+    tensors = {
+        "h.0.weight": torch.randn(3, 5),
+        "h.0.bias": torch.randn(5, dtype=torch.float64),
+        "h.0.mask": torch.tensor([True, False, True]),
+        "h.0.ids": torch.arange(7, dtype=torch.int64),
+        "h.0.scalar": torch.tensor(1.5, dtype=torch.bfloat16),
+        "h.0.empty": torch.empty(0, 4),
+        "h.1.weight": torch.randn(2, 2, dtype=torch.float16),
+    }
+    path = str(tmp_path / "model.safetensors")
+    save_file(tensors, path, metadata={"format": "pt"})
+
+    shard = MappedSafetensors(path)
+    assert set(shard.keys()) == set(tensors.keys())
+    for key, tensor in tensors.items():
+        assert torch.equal(shard.get_tensor(key), tensor)
+
+    with ShardCache(torch.bfloat16) as shard_cache:
+        state_dict = shard_cache.load(path, block_prefix="h.0.")
+    assert set(state_dict.keys()) == {key for key in tensors if key.startswith("h.0.")}
+    assert state_dict["h.0.weight"].dtype == state_dict["h.0.bias"].dtype == torch.bfloat16
+    assert torch.equal(state_dict["h.0.weight"], tensors["h.0.weight"].bfloat16())
+    assert torch.equal(state_dict["h.0.ids"], tensors["h.0.ids"])
+    assert torch.equal(state_dict["h.0.mask"], tensors["h.0.mask"])
+
+
+def test_mapped_safetensors_unknown_dtype(tmp_path, monkeypatch):
+    tensors = {"h.0.ids": torch.arange(7, dtype=torch.int32), "h.0.weight": torch.randn(3, 5)}
+    path = str(tmp_path / "model.safetensors")
+    save_file(tensors, path, metadata={"format": "pt"})
+
+    # A dtype missing from the map is read with safetensors.safe_open()
+    monkeypatch.delitem(SAFETENSORS_DTYPES, "I32")
+    with ShardCache(torch.bfloat16) as shard_cache:
+        state_dict = shard_cache.load(path, block_prefix="h.0.")
+    assert torch.equal(state_dict["h.0.ids"], tensors["h.0.ids"])
+    assert torch.equal(state_dict["h.0.weight"], tensors["h.0.weight"].bfloat16())
+
+
+def test_loading_memory_budget():
+    budget = LoadingMemoryBudget(max_bytes=100)
+    budget.acquire(60)
+    acquired = threading.Event()
+
+    def _acquire():
+        budget.acquire(60)
+        acquired.set()
+
+    threading.Thread(target=_acquire, daemon=True).start()
+    time.sleep(0.1)
+    assert not acquired.is_set()
+    budget.release(60)
+    assert acquired.wait(timeout=5)
+
+    # A block larger than the budget is loaded alone
+    budget.release(60)
+    budget.acquire(1000)
+    budget.release(1000)
+
+
+@pytest.mark.forked
+@pytest.mark.parametrize("num_workers,max_memory", [(1, None), (3, None), (3, 1)])
+def test_load_pretrained_blocks(num_workers: int, max_memory):
+    config = AutoDistributedConfig.from_pretrained(MODEL_NAME)
+    block_indices = list(range(min(4, config.num_hidden_layers)))
+
+    blocks = list(
+        load_pretrained_blocks(
+            MODEL_NAME,
+            block_indices,
+            config=config,
+            torch_dtype=torch.float32,
+            convert=lambda block, block_index: block.requires_grad_(False),
+            num_workers=num_workers,
+            max_memory=max_memory,
+        )
+    )
+    assert len(blocks) == len(block_indices)
+
+    for block_index, block in zip(block_indices, blocks):
+        ref_block = load_pretrained_block(MODEL_NAME, block_index, config=config, torch_dtype=torch.float32)
+        ref_state_dict = ref_block.state_dict()
+        for param_name, param in block.named_parameters():
+            assert not param.requires_grad
+            assert torch.equal(param, ref_state_dict[param_name]), f"Block {block_index} differs in {param_name}"
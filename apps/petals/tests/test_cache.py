@@ -1,7 +1,9 @@
 import asyncio
+import contextlib
 import multiprocessing as mp
 import random
 import time
+from types import SimpleNamespace
 from typing import Optional
 
 import pytest
@@ -9,7 +11,9 @@ import pytest_asyncio  # make sure the module exists; otherwise the test will be
 import torch
 from hivemind import TensorDescriptor
 
+from petals.server.handler import TransformerConnectionHandler
 from petals.server.memory_cache import AllocationFailed, MemoryCache
+from petals.server.prefix_cache import PrefixCache
 from petals.utils.misc import get_size_in_bytes
 
 
@@ -182,3 +186,165 @@ async def test_cache_usage():
     assert cache.current_size_bytes == 0
     assert alloc_process1.exitcode == 0, "allocation process 1 failed or did not finish, see stderr for details"
     assert alloc_process2.exitcode == 0, "allocation process 2 failed or did not finish, see stderr for details"
+
+
+PAGE_BYTES = 2 * 3 * 5 * 4 * get_size_in_bytes(torch.float32)  # batch 2, 3 heads, head_dim 5, 4 tokens per page
+
+
+def _make_paged_descriptors():
+    keys = TensorDescriptor.from_tensor(torch.empty((2, 3, 5, 16), dtype=torch.float32))
+    values = TensorDescriptor.from_tensor(torch.empty((2, 3, 16, 5), dtype=torch.float32))
+    return keys, values
+
+
+@pytest.mark.asyncio
+async def test_paged_cache():
+    cache = MemoryCache(max_size_bytes=20 * PAGE_BYTES, page_size=4)
+    runtime_pid = cache.runtime_pid
+
+    cache.runtime_pid += 1  # pretend we're another process
+    async with cache.allocate_cache(*_make_paged_descriptors(), timeout=0, length_dims=(3, 2)) as handles:
+        assert cache.current_size_bytes == 0, "paged cache should not reserve anything on admission"
+
+        cache.runtime_pid = runtime_pid
+        with cache.use_cache(*handles) as (keys, values):
+            keys.ensure_length(6)
+            values.ensure_length(6)
+            assert keys.num_pages == values.num_pages == 2 and keys.allocated_length == 8
+            assert len(keys.block_table) == 2 and keys.block_table[1].shape == (2, 3, 5, 4)
+            assert cache.current_size_bytes == 4 * PAGE_BYTES
+
+            new_keys, new_values = torch.randn(2, 3, 5, 6), torch.randn(2, 3, 6, 5)
+            keys.write(new_keys, 0, 6)
+            values.write(new_values, 0, 6)
+            assert torch.equal(keys.read(6), new_keys) and torch.equal(values.read(6), new_values)
+
+            updated_keys = torch.randn(2, 3, 5, 6)
+            keys.write(updated_keys, 3, 6)  # only tokens 3..5 are overwritten, across a page boundary
+            assert torch.equal(keys.read(6)[..., :3], new_keys[..., :3])
+            assert torch.equal(keys.read(6)[..., 3:], updated_keys[..., 3:])
+
+            # reads are views: in-place updates are stored without copies
+            keys.read(6)[..., 5] = 0
+            keys.write(keys.read(6), 0, 6)
+            assert torch.equal(keys.read(6)[..., 5], torch.zeros(2, 3, 5))
+
+            keys.ensure_length(8)  # still fits in the second page
+            assert keys.num_pages == 2
+            keys.ensure_length(9)  # the number of pages doubles
+            assert keys.num_pages == 4 and keys.allocated_length == 16
+            assert cache.current_size_bytes == 6 * PAGE_BYTES
+            assert torch.equal(keys.read(5), updated_keys[..., :5])
+            with pytest.raises(ValueError):
+                keys.ensure_length(17)
+        cache.runtime_pid += 1
+
+    cache.runtime_pid = runtime_pid
+    with cache.use_cache():
+        pass  # the runtime frees the pages of closed sessions
+    assert cache.current_size_bytes == 0
+
+
+@pytest.mark.asyncio
+async def test_paged_cache_admits_more_sessions():
+    cache = MemoryCache(max_size_bytes=10 * PAGE_BYTES, page_size=4)
+    runtime_pid = cache.runtime_pid
+    # a contiguous cache of the same size only fits one session of max_length 16
+    assert cache.get_allocation_size(*_make_paged_descriptors()) == 8 * PAGE_BYTES
+
+    async def _open_sessions(stack: contextlib.AsyncExitStack, num_sessions: int):
+        cache.runtime_pid = runtime_pid + 1  # pretend we're another process
+        sessions = [
+            await stack.enter_async_context(
+                cache.allocate_cache(*_make_paged_descriptors(), timeout=0, length_dims=(3, 2))
+            )
+            for _ in range(num_sessions)
+        ]
+        cache.runtime_pid = runtime_pid
+        return sessions
+
+    async with contextlib.AsyncExitStack() as first_stack:
+        (first_session,) = await _open_sessions(first_stack, 1)
+        async with contextlib.AsyncExitStack() as other_stack:
+            other_sessions = await _open_sessions(other_stack, 5)
+            assert cache.current_size_bytes == 0
+
+            # five short sessions of 4 tokens fit in the budget
+            for handles in [first_session, *other_sessions[:4]]:
+                with cache.use_cache(*handles) as (keys, values):
+                    keys.ensure_length(4)
+                    values.ensure_length(4)
+            assert cache.current_size_bytes == 10 * PAGE_BYTES
+
+            # the sixth one was admitted but fails its first step, without allocating anything
+            with cache.use_cache(*other_sessions[4]) as (keys, values):
+                with pytest.raises(AllocationFailed):
+                    keys.ensure_length(4)
+                assert keys.num_pages == 0
+            assert cache.current_size_bytes == 10 * PAGE_BYTES
+
+        with cache.use_cache(*first_session) as (keys, values):
+            assert cache.current_size_bytes == 2 * PAGE_BYTES
+            keys.write(torch.ones(2, 3, 5, 4), 0, 4)
+
+            # while the buffer grows, the old and the new one are both charged
+            cache.max_size_bytes = 3 * PAGE_BYTES
+            with pytest.raises(AllocationFailed):
+                keys.ensure_length(5)
+            cache.max_size_bytes = 4 * PAGE_BYTES
+            keys.ensure_length(5)
+            assert keys.num_pages == 2 and cache.current_size_bytes == 3 * PAGE_BYTES
+
+            # if doubling the pages does not fit, the buffer only grows to the pages that are needed
+            cache.max_size_bytes = 6 * PAGE_BYTES
+            keys.ensure_length(9)
+            assert keys.num_pages == 3 and cache.current_size_bytes == 4 * PAGE_BYTES
+            assert torch.equal(keys.read(4), torch.ones(2, 3, 5, 4))
+
+    with cache.use_cache():
+        pass
+    assert cache.current_size_bytes == 0
+
+
+def test_prefix_cache_lru():
+    cache = MemoryCache(max_size_bytes=1024)
+    entry_bytes = 3 * 16 * get_size_in_bytes(torch.float32)  # outputs, keys and values of 16 floats each
+    prefix_cache = PrefixCache(cache, max_size_bytes=2 * entry_bytes)
+
+    prefixes = [torch.full((1, 4, 4), float(i)) for i in range(3)]
+    span_ids = [PrefixCache.make_span_prefix_id("block.0", prefix, [None], prefix_id=None) for prefix in prefixes]
+    assert span_ids[0] == PrefixCache.make_span_prefix_id("block.0", prefixes[0].clone(), [None], prefix_id=None)
+    assert span_ids[0] != PrefixCache.make_span_prefix_id("block.1", prefixes[0], [None], prefix_id=None)
+    assert span_ids[0] != PrefixCache.make_span_prefix_id("block.0", prefixes[0], [prefixes[1]], prefix_id=None)
+    assert PrefixCache.make_span_prefix_id("block.0", prefixes[0], [None], "system") == PrefixCache.make_span_prefix_id(
+        "block.0", prefixes[1], [None], "system"
+    )
+    keys = [PrefixCache.make_key("block.0", prefix, None, span_id) for prefix, span_id in zip(prefixes, span_ids)]
+    assert keys[0] != PrefixCache.make_key("block.1", prefixes[0], None, span_ids[0])
+    assert keys[0] != PrefixCache.make_key("block.0", prefixes[0], "adapter", span_ids[0])
+
+    # Clients using the same prefix_id do not share its entries
+    prefix_ids = [
+        TransformerConnectionHandler._get_prefix_id({"prefix_id": "system"}, SimpleNamespace(remote_id=peer_id))
+        for peer_id in ["peer1", "peer2"]
+    ]
+    assert PrefixCache.make_span_prefix_id(
+        "block.0", prefixes[0], [None], prefix_ids[0]
+    ) != PrefixCache.make_span_prefix_id("block.0", prefixes[0], [None], prefix_ids[1])
+    assert TransformerConnectionHandler._get_prefix_id({}, SimpleNamespace(remote_id="peer1")) is None
+
+    def _put(i: int):
+        prefix_cache.put(keys[i], prefixes[i] * 2, [prefixes[i].view(16), -prefixes[i].view(16)])
+
+    _put(0)
+    _put(1)
+    assert len(prefix_cache) == 2 and cache.current_size_bytes == 2 * entry_bytes
+    assert torch.equal(prefix_cache.get(keys[0]).outputs, prefixes[0] * 2)  # 0 is now the most recently used
+
+    _put(2)  # evicts 1, the least recently used entry
+    assert prefix_cache.get(keys[1]) is None
+    assert prefix_cache.get(keys[0]) is not None and prefix_cache.get(keys[2]) is not None
+    assert cache.current_size_bytes == 2 * entry_bytes
+
+    prefix_cache.clear()
+    assert len(prefix_cache) == 0 and cache.current_size_bytes == 0
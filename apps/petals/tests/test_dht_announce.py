@@ -0,0 +1,154 @@
+import time
+from types import SimpleNamespace
+
+import hivemind
+import pytest
+
+import petals.server.server
+from petals.data_structures import UID_DELIMITER, ModelInfo, ServerInfo, ServerState
+from petals.server.memory_cache import MemoryCache
+from petals.server.server import ModuleAnnouncerThread
+from petals.utils.dht import get_remote_module_infos
+
+DHT_PREFIX = "announce-test"
+NUM_SERVERS = 4
+BLOCKS_PER_SERVER = 2
+
+
+def make_announcer(dht: hivemind.DHT, index: int, **kwargs) -> ModuleAnnouncerThread:
+    block_indices = range(index * BLOCKS_PER_SERVER, (index + 1) * BLOCKS_PER_SERVER)
+    uids = [f"{DHT_PREFIX}{UID_DELIMITER}{j}" for j in block_indices]
+    return ModuleAnnouncerThread(
+        uids,
+        dht,
+        ServerInfo(state=ServerState.JOINING, throughput=1.0, torch_dtype="float32"),
+        ModelInfo(num_blocks=NUM_SERVERS * BLOCKS_PER_SERVER),
+        block_config=SimpleNamespace(hidden_size=64, num_key_value_groups=1),
+        memory_cache=MemoryCache(max_size_bytes=2**20),
+        daemon=True,
+        **kwargs,
+    )
+
+
+def start_announcers(dht: hivemind.DHT, **kwargs):
+    announcers = []
+    for i in range(NUM_SERVERS):
+        announcer = make_announcer(dht, i, **kwargs)
+        announcer.start()
+        announcers.append(announcer)
+    return announcers
+
+
+def wait_for_swarm(client_dht: hivemind.DHT, state: ServerState, timeout: float = 30) -> float:
+    """Returns the time until all blocks are visible with the given state"""
+    uids = [f"{DHT_PREFIX}{UID_DELIMITER}{j}" for j in range(NUM_SERVERS * BLOCKS_PER_SERVER)]
+    start_time = time.perf_counter()
+    while time.perf_counter() - start_time < timeout:
+        infos = get_remote_module_infos(client_dht, uids, latest=True)
+        if all(any(server.state == state for server in info.servers.values()) for info in infos):
+            return time.perf_counter() - start_time
+        time.sleep(0.05)
+    raise TimeoutError(f"Blocks were not announced as {state} in {timeout} seconds")
+
+
+@pytest.mark.forked
+def test_announce_batching():
+    bootstrap_dht = hivemind.DHT(start=True)
+    initial_peers = bootstrap_dht.get_visible_maddrs()
+    client_dht = hivemind.DHT(initial_peers=initial_peers, client_mode=True, start=True)
+
+    stats = {}
+    for batch_window in [0.0, 1.0]:
+        # Servers in one process sharing a DHT instance
+        dht = hivemind.DHT(initial_peers=initial_peers, start=True)
+        announcers = start_announcers(dht, update_period=60, expiration=120, batch_window=batch_window)
+
+        convergence_time = wait_for_swarm(client_dht, ServerState.JOINING)
+        stats[batch_window] = announcers[0].batcher.num_stores, convergence_time
+
+        for announcer in announcers:
+            announcer.announce(ServerState.OFFLINE)
+        dht.shutdown()
+
+    # Without batching, each server stores its blocks and the model info in one store
+    assert stats[1.0][0] < stats[0.0][0], f"(number of stores, convergence time) by batch window: {stats}"
+
+    client_dht.shutdown()
+    bootstrap_dht.shutdown()
+
+
+class FakeDHTTime:
+    def __init__(self, monkeypatch, start: float = 1000.0):
+        self.now = start
+        monkeypatch.setattr(petals.server.server, "get_dht_time", lambda: self.now)
+
+
+def record_stores(monkeypatch, announcer: ModuleAnnouncerThread) -> list:
+    stores = []
+    monkeypatch.setattr(announcer.batcher, "store", stores.append)
+    return stores
+
+
+@pytest.mark.forked
+def test_announce_skips_unchanged_info(monkeypatch):
+    clock = FakeDHTTime(monkeypatch)
+    dht = hivemind.DHT(start=True)
+    announcer = make_announcer(dht, 0, update_period=10, expiration=60, batch_window=0.0)
+    stores = record_stores(monkeypatch, announcer)
+    max_cache_tokens = announcer.memory_cache.max_size_bytes // announcer.bytes_per_token
+    announcer.server_info.cache_tokens_left = max_cache_tokens
+
+    announcer._announce()
+    assert len(stores) == 1 and len(stores[0]) == BLOCKS_PER_SERVER + 1, "the blocks and the model info are stored"
+
+    # The info did not change and the records do not expire soon, the updates store nothing
+    for _ in range(3):
+        clock.now += announcer.update_period
+        announcer._announce()
+    assert len(stores) == 1
+
+    # A state change is announced right away, without the model info
+    announcer.server_info.state = ServerState.ONLINE
+    announcer._announce()
+    assert len(stores) == 2 and len(stores[1]) == BLOCKS_PER_SERVER
+
+    # Small changes of the free cache are not announced, large ones are
+    announcer.server_info.cache_tokens_left -= 1
+    announcer._announce()
+    assert len(stores) == 2
+    announcer.server_info.cache_tokens_left //= 2
+    announcer._announce()
+    assert len(stores) == 3
+
+    # Newly reachable next servers are announced, new ping times to the same servers are not
+    announcer.server_info.next_pings = {"peer": 0.1}
+    announcer._announce()
+    assert len(stores) == 4
+    announcer.server_info.next_pings = {"peer": 0.2}
+    announcer._announce()
+    assert len(stores) == 4
+
+    dht.shutdown()
+
+
+@pytest.mark.forked
+def test_announce_refreshes_every_other_update(monkeypatch):
+    clock = FakeDHTTime(monkeypatch)
+    dht = hivemind.DHT(start=True)
+    update_period = 60
+    announcer = make_announcer(dht, 0, update_period=update_period, batch_window=0.0)
+    stores = record_stores(monkeypatch, announcer)
+    assert announcer.expiration == 3 * update_period
+
+    # The unchanged records are only stored every other update, and are still valid until the next one
+    store_times = []
+    for _ in range(10):
+        num_stores = len(stores)
+        announcer._announce()
+        if len(stores) > num_stores:
+            store_times.append(clock.now)
+        assert all(record.expiration_time >= clock.now + update_period for record in stores[-1])
+        clock.now += update_period
+    assert store_times == [1000.0 + i * 2 * update_period for i in range(5)]
+
+    dht.shutdown()
@@ -6,7 +6,7 @@ import pytest
 import torch
 from hivemind.moe.server.runtime import Runtime
 
-from petals.server.task_pool import PrioritizedTaskPool
+from petals.server.task_pool import PrioritizedTaskPool, TaskBatch
 
 
 def _submit_tasks(runtime_ready, pools, results_valid):
@@ -80,3 +80,36 @@ def test_priority_pools():
     #                                                  7 - task with priority 11 from pool B
 
     runtime.shutdown()
+
+
+@pytest.mark.forked
+def test_batched_pool():
+    def batched_pool_func(task_args):
+        return (torch.cat([args[0] for args in task_args]) * 2,)
+
+    pool = PrioritizedTaskPool(
+        lambda x: (x * 2,),
+        name="A",
+        max_batch_size=16,
+        batch_process_func=batched_pool_func,
+        get_batch_key=lambda args: args[0].shape[1:],
+        max_batched_tasks=3,
+        max_batch_wait=1.0,
+        start=True,
+    )
+
+    inputs = [torch.full((i + 1, 2), float(i)) for i in range(4)] + [torch.ones(1, 3)]
+    futures = [pool.submit_task(x, priority=i) for i, x in enumerate(inputs)]
+
+    # the first 3 compatible tasks are merged, the last one with another shape is processed alone
+    for expected_tasks in ([0, 1, 2], [3], [4]):
+        uid, batch = pool.load_batch_to_runtime()
+        if len(expected_tasks) > 1:
+            assert len(batch) == 1 and isinstance(batch[0], TaskBatch)
+            assert len(batch[0].task_args) == len(expected_tasks)
+        pool.send_outputs_from_runtime(uid, list(pool.process_func(*batch)))
+
+    for x, future in zip(inputs, futures):
+        assert torch.equal(future.result()[0], x * 2)
+
+    pool.shutdown()